@@ -117,13 +117,34 @@ resource "aws_iam_role_policy" "bedrock_access" {
         Resource = [
           "arn:aws:bedrock:*::foundation-model/*anthropic.claude-sonnet-4-5-*",
           "arn:aws:bedrock:*:*:inference-profile/*anthropic.claude-sonnet-4-5-*",
-          "arn:aws:bedrock:*:*:inference-profile/global.anthropic.claude-sonnet-4-5-*"
+          "arn:aws:bedrock:*:*:inference-profile/global.anthropic.claude-sonnet-4-5-*",
+          "arn:aws:bedrock:*::foundation-model/*anthropic.claude-haiku-4-5-*",
+          "arn:aws:bedrock:*:*:inference-profile/*anthropic.claude-haiku-4-5-*"
         ]
       }
     ]
   })
 }
 
+# IAM Policy for marking the upload claim of a failed run failed (re-uploads are processed again)
+resource "aws_iam_role_policy" "dynamodb_access" {
+  name = "${var.project_name}-dynamodb-policy"
+  role = aws_iam_role.ec2_trnda_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "dynamodb:UpdateItem"
+        ]
+        Resource = aws_dynamodb_table.trnda_events.arn
+      }
+    ]
+  })
+}
+
 # IAM Policy for SES Access
 resource "aws_iam_role_policy" "ses_access" {
   name = "${var.project_name}-ses-policy"
@@ -329,6 +350,55 @@ resource "aws_iam_role_policy" "lambda_s3" {
           "s3:HeadObject"
         ]
         Resource = "${aws_s3_bucket.trnda.arn}/*"
+      },
+      {
+        # Status objects of queued inputs (status/<name>.json)
+        Effect   = "Allow"
+        Action   = ["s3:PutObject"]
+        Resource = "${aws_s3_bucket.trnda.arn}/status/*"
+      }
+    ]
+  })
+}
+
+# Idempotency records of ingested uploads (claimed by the trigger Lambda, expire via TTL)
+resource "aws_dynamodb_table" "trnda_events" {
+  name         = "${var.project_name}-events"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "id"
+
+  attribute {
+    name = "id"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = {
+    Name        = "${var.project_name} Event Idempotency"
+    Environment = var.environment
+  }
+}
+
+# Policy for Lambda to claim uploads
+resource "aws_iam_role_policy" "lambda_dynamodb" {
+  name = "${var.project_name}-lambda-dynamodb-policy"
+  role = aws_iam_role.lambda_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "dynamodb:PutItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:DeleteItem"
+        ]
+        Resource = aws_dynamodb_table.trnda_events.arn
       }
     ]
   })
@@ -346,9 +416,12 @@ resource "aws_lambda_function" "trnda_trigger" {
 
   environment {
     variables = {
-      INSTANCE_ID       = aws_instance.trnda.id
-      WORKING_DIRECTORY = "/home/ubuntu/trnda"
-      S3_BUCKET         = var.s3_bucket_name
+      INSTANCE_ID             = aws_instance.trnda.id
+      WORKING_DIRECTORY       = "/home/ubuntu/trnda"
+      S3_BUCKET               = var.s3_bucket_name
+      IDEMPOTENCY_TABLE       = aws_dynamodb_table.trnda_events.name
+      IDEMPOTENCY_TTL_SECONDS = tostring(var.idempotency_ttl_seconds)
+      MANIFEST_S3             = "s3://${var.s3_bucket_name}/manifest/manifest.json"
     }
   }
 
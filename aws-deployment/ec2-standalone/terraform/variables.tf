@@ -60,3 +60,9 @@ variable "log_retention_days" {
   type        = number
   default     = 7
 }
+
+variable "idempotency_ttl_seconds" {
+  description = "How long an ingested upload (same bytes) is remembered - duplicates within this window are skipped"
+  type        = number
+  default     = 86400
+}
@@ -3,11 +3,18 @@ Lambda Trigger for TRNDA ECS Fargate Tasks
 Triggered by S3 uploads (via EventBridge), starts ECS Fargate task
 """
 
+import sys
 import json
+import hashlib
+import time
 import boto3
 import os
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
 
 ecs_client = boto3.client('ecs')
+s3 = boto3.client('s3')
+dynamodb = boto3.client('dynamodb')
 
 # Environment variables set by Terraform/CloudFormation
 ECS_CLUSTER = os.environ['ECS_CLUSTER_NAME']
@@ -16,6 +23,198 @@ SUBNET_IDS = os.environ['SUBNET_IDS'].split(',')
 SECURITY_GROUP_IDS = os.environ['SECURITY_GROUP_IDS'].split(',')
 CONTAINER_NAME = os.environ.get('CONTAINER_NAME', 'trnda-container')
 
+# Idempotency records (DynamoDB table with TTL on expires_at); unset = no deduplication
+IDEMPOTENCY_TABLE = os.environ.get('IDEMPOTENCY_TABLE')
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+
+# CloudWatch metrics as Embedded Metric Format log lines (TRNDA_METRICS=off disables)
+METRICS_NAMESPACE = os.environ.get('TRNDA_METRICS_NAMESPACE', 'TRNDA')
+DEPLOYMENT = 'ecs'
+
+
+def get_client_info_from_metadata(bucket, key):
+    """
+    Get client info from S3 object metadata
+    
+    Args:
+        bucket: S3 bucket name
+        key: S3 object key
+        
+    Returns:
+        Client info string or None
+    """
+    try:
+        response = s3.head_object(Bucket=bucket, Key=key)
+        metadata = response.get('Metadata', {})
+        client_info = metadata.get('client-info', '')
+        
+        if client_info:
+            print(f"Found client-info in metadata: {client_info}")
+            return client_info
+        
+        return None
+        
+    except Exception as e:
+        print(f"WARNING: Could not read metadata: {e}")
+        return None
+
+
+def idempotency_id(bucket, key, etag, client_info=None):
+    """
+    Idempotency key of an upload
+    
+    Single-part ETags are the MD5 of the content, so identical bytes with the
+    same client-info metadata map to one record whatever key they were
+    uploaded to. A re-upload of the same photo with a corrected client-info
+    (e.g. a new recipient) is a new job. Multipart ETags (with a "-N" suffix)
+    depend on part sizes and are combined with the key.
+    """
+    etag = (etag or '').strip('"')
+    if etag and '-' not in etag:
+        client = hashlib.sha256((client_info or '').encode('utf-8')).hexdigest()[:16]
+        return f"{bucket}/md5:{etag}/client:{client}"
+    return f"{bucket}/{key}#{etag}"
+
+
+def claim_event(event_id, key, request_id):
+    """
+    Atomically claim an upload before launching work for it
+    
+    The conditional put succeeds only if no record exists, the existing one
+    expired (DynamoDB TTL deletion lags, so expiry is checked here too) or its
+    job failed (the worker marks the claim failed, see fail_upload_claim in
+    trnda-agent.py), so a re-upload after a failed job is processed again.
+    
+    Returns:
+        None if this invocation owns the upload; for duplicates / in-flight
+        events the input key of the existing claim ('' if unknown)
+    """
+    if not IDEMPOTENCY_TABLE:
+        return None
+    
+    now = int(time.time())
+    try:
+        dynamodb.put_item(
+            TableName=IDEMPOTENCY_TABLE,
+            Item={
+                'id': {'S': event_id},
+                's3_key': {'S': key},
+                'status': {'S': 'claimed'},
+                'request_id': {'S': request_id},
+                'claimed_at': {'N': str(now)},
+                'expires_at': {'N': str(now + IDEMPOTENCY_TTL_SECONDS)}
+            },
+            ConditionExpression='attribute_not_exists(id) OR expires_at < :now OR #status = :failed',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':now': {'N': str(now)}, ':failed': {'S': 'failed'}},
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        return None
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return e.response.get('Item', {}).get('s3_key', {}).get('S', '')
+        # Store unavailable - rather launch a duplicate than drop an upload
+        print(f"WARNING: Could not claim {event_id}, processing anyway: {e}")
+        return None
+
+
+def record_launch(event_id, launch_id):
+    """Mark a claimed upload as launched (ECS task ARN / SSM command ID)"""
+    if not IDEMPOTENCY_TABLE:
+        return
+    try:
+        dynamodb.update_item(
+            TableName=IDEMPOTENCY_TABLE,
+            Key={'id': {'S': event_id}},
+            UpdateExpression='SET #status = :status, launch_id = :launch_id',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':status': {'S': 'launched'}, ':launch_id': {'S': launch_id}}
+        )
+    except ClientError as e:
+        print(f"WARNING: Could not update idempotency record {event_id}: {e}")
+
+
+def release_claim(event_id):
+    """Drop a claim after a failed launch, so a redelivery or re-upload can retry"""
+    if not IDEMPOTENCY_TABLE:
+        return
+    try:
+        dynamodb.delete_item(TableName=IDEMPOTENCY_TABLE, Key={'id': {'S': event_id}})
+    except ClientError as e:
+        print(f"WARNING: Could not release idempotency record {event_id}: {e}")
+
+
+def status_key(key):
+    """Status object of an input key: input/<name> -> status/<name>.json (same layout as trnda-agent.py)"""
+    name = key[len('input/'):] if key.startswith('input/') else key
+    return f"status/{name}.json"
+
+
+def write_status(bucket, key, state, **fields):
+    """
+    Write the per-input status object the web app polls (one small JSON)
+    
+    The worker overwrites it with running/done/failed; errors only warn.
+    """
+    status = dict(fields, input=f"s3://{bucket}/{key}", state=state,
+                  updated=datetime.now(timezone.utc).isoformat(timespec='seconds'))
+    try:
+        s3.put_object(Bucket=bucket, Key=status_key(key), Body=json.dumps(status, indent=2),
+                      ContentType='application/json', CacheControl='no-cache')
+    except Exception as e:
+        print(f"WARNING: Could not write status object for {key}: {e}")
+
+
+def event_age_seconds(event):
+    """Seconds since the EventBridge event was created (None without a parseable "time")"""
+    try:
+        created = datetime.fromisoformat(event['time'].replace('Z', '+00:00'))
+    except (KeyError, TypeError, AttributeError, ValueError):
+        return None
+    return round(max(0.0, time.time() - created.timestamp()), 3)
+
+
+def emit_metrics(outcome, started, event, launch_seconds=None):
+    """
+    Print this invocation's CloudWatch metrics as one EMF log line
+    
+    Lambda turns EMF lines of its log into metrics, no API call needed. Metrics
+    (by Deployment and by Deployment + Outcome): TriggerEvents, TriggerSeconds,
+    EventAgeSeconds (upload event -> trigger) and LaunchSeconds.
+    
+    Args:
+        outcome: 'launched', 'skipped', 'duplicate', 'invalid' or 'launch_failed'
+        started: time.time() at the start of the invocation
+        event: EventBridge event
+        launch_seconds: Duration of the launch call, if made
+    """
+    if os.environ.get('TRNDA_METRICS', 'on') == 'off':
+        return
+    values = {
+        'TriggerEvents': (1, 'Count'),
+        'TriggerSeconds': (round(time.time() - started, 3), 'Seconds'),
+        'EventAgeSeconds': (event_age_seconds(event), 'Seconds'),
+        'LaunchSeconds': (launch_seconds, 'Seconds'),
+    }
+    values = {name: value for name, value in values.items() if value[0] is not None}
+    record = {name: value for name, (value, unit) in values.items()}
+    record.update({
+        'Deployment': DEPLOYMENT,
+        'Outcome': outcome,
+        'input_key': ((event.get('detail') or {}).get('object') or {}).get('key'),
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Deployment'], ['Deployment', 'Outcome']],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in values.items()]
+            }]
+        }
+    })
+    # One write per line, like trnda-agent.py's emit_metrics
+    sys.stdout.write(json.dumps(record, separators=(',', ':')) + "\n")
+    sys.stdout.flush()
+
 
 def lambda_handler(event, context):
     """
@@ -29,6 +228,7 @@ def lambda_handler(event, context):
         Response with task ARN
     """
     
+    started = time.time()
     print(f"Received event: {json.dumps(event)}")
     
     # Extract S3 information from EventBridge event
@@ -37,6 +237,7 @@ def lambda_handler(event, context):
         key = event['detail']['object']['key']
     except KeyError as e:
         print(f"ERROR: Invalid event structure: {e}")
+        emit_metrics('invalid', started, event)
         return {
             'statusCode': 400,
             'body': json.dumps(f'Invalid event structure: {e}')
@@ -45,6 +246,7 @@ def lambda_handler(event, context):
     # Validate file extension
     if not key.lower().endswith(('.jpg', '.jpeg', '.png')):
         print(f"SKIP: Not an image file: {key}")
+        emit_metrics('skipped', started, event)
         return {
             'statusCode': 200,
             'body': json.dumps(f'Skipped non-image file: {key}')
@@ -53,22 +255,49 @@ def lambda_handler(event, context):
     # Skip if file is in output/ folder (to avoid processing our own outputs)
     if key.startswith('output/'):
         print(f"SKIP: File in output folder: {key}")
+        emit_metrics('skipped', started, event)
         return {
             'statusCode': 200,
             'body': json.dumps(f'Skipped output file: {key}')
         }
     
+    # Client info from S3 metadata (part of the idempotency key)
+    client_info = get_client_info_from_metadata(bucket, key) if IDEMPOTENCY_TABLE else None
+    
+    # Duplicate deliveries and re-uploads of identical bytes are dropped here
+    event_id = idempotency_id(bucket, key, event['detail']['object'].get('etag'), client_info)
+    original_key = claim_event(event_id, key, context.aws_request_id)
+    if original_key is not None:
+        print(f"SKIP: Duplicate or in-flight upload: s3://{bucket}/{key} ({event_id})")
+        if original_key and original_key != key:
+            # Re-upload under a new key: the web app polls this key - point it at the original job
+            write_status(bucket, key, 'duplicate', duplicate_of=f"s3://{bucket}/{original_key}",
+                         status=status_key(original_key))
+        emit_metrics('duplicate', started, event)
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'message': 'Duplicate event skipped', 'idempotencyId': event_id})
+        }
+    
     print(f"Processing: s3://{bucket}/{key}")
+    # Before the launch - the task overwrites it once running
+    write_status(bucket, key, 'queued')
     
-    # Prepare event data for ECS task
-    trnda_event = json.dumps({
+    # Prepare event data for ECS task (event time: the task reports queue wait from it;
+    # idempotency claim: a failed task marks it failed so a re-upload is processed again)
+    trnda_event = {
+        'time': event.get('time'),
         'detail': {
             'bucket': {'name': bucket},
             'object': {'key': key}
         }
-    })
+    }
+    if IDEMPOTENCY_TABLE:
+        trnda_event['idempotency'] = {'table': IDEMPOTENCY_TABLE, 'id': event_id}
+    trnda_event = json.dumps(trnda_event)
     
     # Start ECS Fargate task
+    launch_started = time.time()
     try:
         response = ecs_client.run_task(
             cluster=ECS_CLUSTER,
@@ -103,6 +332,8 @@ def lambda_handler(event, context):
         
         task_arn = response['tasks'][0]['taskArn']
         print(f"Started ECS task: {task_arn}")
+        emit_metrics('launched', started, event, round(time.time() - launch_started, 3))
+        record_launch(event_id, task_arn)
         
         return {
             'statusCode': 200,
@@ -116,6 +347,9 @@ def lambda_handler(event, context):
         
     except Exception as e:
         print(f"ERROR starting ECS task: {e}")
+        release_claim(event_id)
+        emit_metrics('launch_failed', started, event, round(time.time() - launch_started, 3))
+        write_status(bucket, key, 'failed', error=f"Failed to start ECS task: {e}")
         return {
             'statusCode': 500,
             'body': json.dumps(f'Failed to start ECS task: {str(e)}')
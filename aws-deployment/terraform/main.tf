@@ -165,7 +165,9 @@ resource "aws_iam_role_policy" "ecs_task_bedrock_policy" {
         Resource = [
           "arn:aws:bedrock:*::foundation-model/*anthropic.claude-sonnet-4-5-*",
           "arn:aws:bedrock:*:*:inference-profile/*anthropic.claude-sonnet-4-5-*",
-          "arn:aws:bedrock:*:*:inference-profile/global.anthropic.claude-sonnet-4-5-*"
+          "arn:aws:bedrock:*:*:inference-profile/global.anthropic.claude-sonnet-4-5-*",
+          "arn:aws:bedrock:*::foundation-model/*anthropic.claude-haiku-4-5-*",
+          "arn:aws:bedrock:*:*:inference-profile/*anthropic.claude-haiku-4-5-*"
         ]
       }
     ]
@@ -193,6 +195,25 @@ resource "aws_iam_role_policy" "ecs_task_pricing_policy" {
   })
 }
 
+# Policy for marking the upload claim of a failed task failed (re-uploads are processed again)
+resource "aws_iam_role_policy" "ecs_task_dynamodb_policy" {
+  name = "${var.project_name}-ecs-dynamodb-policy"
+  role = aws_iam_role.ecs_task_role.id
+  
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "dynamodb:UpdateItem"
+        ]
+        Resource = aws_dynamodb_table.trnda_events.arn
+      }
+    ]
+  })
+}
+
 # Policy for SES access (email notifications)
 resource "aws_iam_role_policy" "ecs_task_ses_policy" {
   name = "${var.project_name}-ses-policy"
@@ -238,6 +259,22 @@ resource "aws_ecs_task_definition" "trnda" {
         {
           name  = "AWS_DEFAULT_REGION"
           value = var.aws_region
+        },
+        {
+          name  = "TRNDA_LEDGER_S3"
+          value = "s3://${var.bucket_name}/ledger/"
+        },
+        {
+          name  = "TRNDA_SIMILARITY_S3"
+          value = "s3://${var.bucket_name}/similarity/index.jsonl"
+        },
+        {
+          name  = "TRNDA_MANIFEST_S3"
+          value = "s3://${var.bucket_name}/manifest/manifest.json"
+        },
+        {
+          name  = "TRNDA_PROFILE"
+          value = var.profile_runs ? "1" : "0"
         }
       ]
       
@@ -289,11 +326,13 @@ resource "aws_lambda_function" "trnda_trigger" {
   
   environment {
     variables = {
-      ECS_CLUSTER_NAME      = aws_ecs_cluster.trnda.name
-      TASK_DEFINITION_ARN   = aws_ecs_task_definition.trnda.arn
-      SUBNET_IDS            = join(",", var.subnet_ids)
-      SECURITY_GROUP_IDS    = aws_security_group.ecs_tasks.id
-      CONTAINER_NAME        = "trnda-container"
+      ECS_CLUSTER_NAME        = aws_ecs_cluster.trnda.name
+      TASK_DEFINITION_ARN     = aws_ecs_task_definition.trnda.arn
+      SUBNET_IDS              = join(",", var.subnet_ids)
+      SECURITY_GROUP_IDS      = aws_security_group.ecs_tasks.id
+      CONTAINER_NAME          = "trnda-container"
+      IDEMPOTENCY_TABLE       = aws_dynamodb_table.trnda_events.name
+      IDEMPOTENCY_TTL_SECONDS = tostring(var.idempotency_ttl_seconds)
     }
   }
   
@@ -352,6 +391,76 @@ resource "aws_iam_role_policy" "lambda_ecs_policy" {
   })
 }
 
+# Idempotency records of ingested uploads (claimed by the trigger Lambda, expire via TTL)
+resource "aws_dynamodb_table" "trnda_events" {
+  name         = "${var.project_name}-events"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "id"
+  
+  attribute {
+    name = "id"
+    type = "S"
+  }
+  
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+  
+  tags = {
+    Name        = "TRNDA Event Idempotency"
+    Environment = var.environment
+  }
+}
+
+# Policy for Lambda to claim uploads
+resource "aws_iam_role_policy" "lambda_dynamodb_policy" {
+  name = "${var.project_name}-lambda-dynamodb-policy"
+  role = aws_iam_role.lambda_execution_role.id
+  
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "dynamodb:PutItem",
+          "dynamodb:UpdateItem",
+          "dynamodb:DeleteItem"
+        ]
+        Resource = aws_dynamodb_table.trnda_events.arn
+      }
+    ]
+  })
+}
+
+# Policy for Lambda to write status objects of queued inputs (status/<name>.json)
+# and to read the client-info metadata of inputs (part of the idempotency key)
+resource "aws_iam_role_policy" "lambda_status_policy" {
+  name = "${var.project_name}-lambda-status-policy"
+  role = aws_iam_role.lambda_execution_role.id
+  
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:PutObject"
+        ]
+        Resource = "${aws_s3_bucket.trnda_bucket.arn}/status/*"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject"
+        ]
+        Resource = "${aws_s3_bucket.trnda_bucket.arn}/input/*"
+      }
+    ]
+  })
+}
+
 # EventBridge Rule for S3 uploads
 resource "aws_cloudwatch_event_rule" "s3_upload" {
   name        = "${var.project_name}-s3-upload"
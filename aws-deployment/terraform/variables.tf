@@ -43,6 +43,12 @@ variable "task_memory" {
   default     = "4096"  # 4 GB
 }
 
+variable "profile_runs" {
+  description = "Profile every run (sampling profiler + tracemalloc); profile files are uploaded with the report"
+  type        = bool
+  default     = false
+}
+
 variable "log_retention_days" {
   description = "CloudWatch log retention in days"
   type        = number
@@ -54,3 +60,9 @@ variable "ses_sender_email" {
   type        = string
   default     = "trnda@ai.aws.thetrasklab.com"
 }
+
+variable "idempotency_ttl_seconds" {
+  description = "How long an ingested upload (same bytes) is remembered - duplicates within this window are skipped"
+  type        = number
+  default     = 86400
+}
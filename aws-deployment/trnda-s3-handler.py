@@ -7,18 +7,19 @@ Processes S3 upload events and runs TRNDA agent
 import os
 import sys
 import json
+import time
 import boto3
-import tempfile
 import shutil
 from datetime import datetime
 from pathlib import Path
 
-# Import the main TRNDA agent
-sys.path.insert(0, '/app')
+# Import the main TRNDA agent (/app in the container, override for local runs)
+TRNDA_APP_DIR = os.environ.get('TRNDA_APP_DIR', '/app')
+sys.path.insert(0, TRNDA_APP_DIR)
 
 # Import directly from trnda-agent.py
 import importlib.util
-spec = importlib.util.spec_from_file_location("trnda_agent", "/app/trnda-agent.py")
+spec = importlib.util.spec_from_file_location("trnda_agent", os.path.join(TRNDA_APP_DIR, "trnda-agent.py"))
 trnda_agent_module = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(trnda_agent_module)
 
@@ -28,7 +29,21 @@ compress_image_if_needed = trnda_agent_module.compress_image_if_needed
 create_output_dir = trnda_agent_module.create_output_dir
 build_system_prompt = trnda_agent_module.build_system_prompt
 write_file = trnda_agent_module.write_file
-convert_with_pandoc = trnda_agent_module.convert_with_pandoc
+RunContext = trnda_agent_module.RunContext
+resume_run = trnda_agent_module.resume_run
+DeadlineExceeded = trnda_agent_module.DeadlineExceeded
+emit_metrics = trnda_agent_module.emit_metrics
+parse_event_time = trnda_agent_module.parse_event_time
+
+# TRNDA_PROFILE=1 (Terraform: profile_runs) profiles every run - RunContext reads it, the
+# profile files land in the output directory and are uploaded with the report
+
+# Automatic retries resume from the run's checkpoint instead of starting over
+MAX_ATTEMPTS = int(os.environ.get('TRNDA_MAX_ATTEMPTS', '2'))
+RETRY_DELAY_SECONDS = int(os.environ.get('TRNDA_RETRY_DELAY_SECONDS', '30'))
+
+# Deployment dimension of the CloudWatch (EMF) metrics printed by this handler and its runs
+DEPLOYMENT = os.environ.get('TRNDA_DEPLOYMENT', 'ecs')
 
 
 def get_s3_client():
@@ -36,6 +51,24 @@ def get_s3_client():
     return boto3.client('s3', region_name=os.environ.get('AWS_REGION', 'eu-central-1'))
 
 
+def get_dynamodb_client():
+    """Get DynamoDB client (idempotency records of the trigger Lambda)"""
+    return boto3.client('dynamodb', region_name=os.environ.get('AWS_REGION', 'eu-central-1'))
+
+
+def fail_upload_claim(event: dict, error: Exception):
+    """Mark the trigger's claim of this upload failed, so a re-upload is processed again
+    
+    Args:
+        event: TRNDA_EVENT ('idempotency': {table, id} when the trigger claimed the upload)
+        error: Error that ended the job
+    """
+    claim = event.get('idempotency')
+    if claim:
+        trnda_agent_module.fail_upload_claim(claim.get('table'), claim.get('id'), str(error),
+                                             dynamodb=get_dynamodb_client())
+
+
 def download_from_s3(bucket: str, key: str, local_path: str) -> str:
     """Download file from S3
     
@@ -114,21 +147,30 @@ def extract_email_from_text(text: str) -> str:
     return None
 
 
-def get_client_info_from_s3_metadata(bucket: str, key: str) -> tuple:
+def get_s3_head(bucket: str, key: str) -> dict:
+    """Get the head (ETag, user metadata, ...) of an S3 object (empty if it cannot be read)"""
+    try:
+        return get_s3_client().head_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        print(f"[WARNING] Could not read S3 metadata: {e}")
+        return {}
+
+
+def get_client_info_from_s3_metadata(bucket: str, key: str, metadata: dict = None) -> tuple:
     """Get client information from S3 object metadata
     
     Args:
         bucket: S3 bucket name
         key: S3 object key
+        metadata: Object metadata if already read (default: read it from S3)
         
     Returns:
         Tuple of (client_info_text, extracted_email)
         Both can be None if not found
     """
     try:
-        s3 = get_s3_client()
-        response = s3.head_object(Bucket=bucket, Key=key)
-        metadata = response.get('Metadata', {})
+        if metadata is None:
+            metadata = get_s3_head(bucket, key).get('Metadata', {})
         
         # Try to get client-info from metadata
         client_info = metadata.get('client-info', '')
@@ -150,12 +192,42 @@ def get_client_info_from_s3_metadata(bucket: str, key: str) -> tuple:
         return None, None
 
 
-def process_s3_event(event: dict):
-    """Process S3 event and run TRNDA
+def process_s3_event(event: dict, context_factory=None):
+    """Process S3 event and run TRNDA, then emit the job's CloudWatch metrics
     
     Args:
         event: S3 event data (EventBridge or direct S3 notification)
+        context_factory: Optional callable(client_name, recipient_email) -> RunContext
+                         (default: RunContext, e.g. stubbed contexts in load tests)
     """
+    start = time.time()
+    job = {'outcome': 'failed', 'attempts': 0, 'queued_at': None}
+    try:
+        _process_s3_event(event, context_factory, job)
+    except DeadlineExceeded as e:
+        job['outcome'] = 'timeout'
+        fail_upload_claim(event, e)
+        raise
+    except Exception as e:
+        # Retries are over - release the upload for a re-upload
+        fail_upload_claim(event, e)
+        raise
+    finally:
+        # Jobs that never got to a run (download errors, skipped keys) show up here only
+        emit_metrics({
+            'Jobs': (1, 'Count'),
+            'JobFailed': (int(job['outcome'] in ('failed', 'timeout')), 'Count'),
+            'HandlerSeconds': (round(time.time() - start, 3), 'Seconds'),
+            'Attempts': (job['attempts'] or None, 'Count'),
+            'QueueWaitSeconds': (round(max(0.0, start - job['queued_at']), 3) if job['queued_at'] else None,
+                                 'Seconds'),
+        }, {'Deployment': DEPLOYMENT, 'Outcome': job['outcome']},
+            properties={'input_key': job.get('key'), 'run_id': job.get('run_id')},
+            dimension_sets=[['Deployment'], ['Deployment', 'Outcome']])
+
+
+def _process_s3_event(event: dict, context_factory, job: dict):
+    """Body of process_s3_event; records outcome, attempts, event time, key and run ID in job"""
     print("=" * 70)
     print("TRNDA S3 Handler - ECS Fargate")
     print("=" * 70)
@@ -164,11 +236,15 @@ def process_s3_event(event: dict):
     if 'detail' in event:  # EventBridge format
         bucket = event['detail']['bucket']['name']
         key = event['detail']['object']['key']
+        event_time = event.get('time')
     elif 'Records' in event:  # Direct S3 notification
         bucket = event['Records'][0]['s3']['bucket']['name']
         key = event['Records'][0]['s3']['object']['key']
+        event_time = event['Records'][0].get('eventTime')
     else:
         raise ValueError("Unknown event format")
+    job['key'] = key
+    job['queued_at'] = parse_event_time(event_time)
     
     print(f"Bucket: {bucket}")
     print(f"Key: {key}")
@@ -176,69 +252,110 @@ def process_s3_event(event: dict):
     # Validate file extension
     if not key.lower().endswith(('.jpg', '.jpeg', '.png')):
         print(f"[SKIP] Not an image file: {key}")
+        job['outcome'] = 'skipped'
         return
     
     # Get client info from S3 metadata
-    client_info, extracted_email = get_client_info_from_s3_metadata(bucket, key)
+    head = get_s3_head(bucket, key)
+    metadata = head.get('Metadata', {})
+    client_info, extracted_email = get_client_info_from_s3_metadata(bucket, key, metadata)
     
     print(f"Client info: {client_info or 'Not specified'}")
     if extracted_email:
         print(f"Email for report: {extracted_email}")
     
-    # Create temporary working directory
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Download image from S3
-        filename = os.path.basename(key)
-        local_image = os.path.join(temp_dir, filename)
-        download_from_s3(bucket, key, local_image)
-        
-        # Run TRNDA agent by calling main processing logic directly
-        print("=" * 70)
-        print("[START] Running TRNDA agent...")
-        print("=" * 70)
-        
-        # We'll call the trnda-agent.py's main logic by importing its core functions
-        # and recreating the process
-        # Pass client_info as client_name - it will be displayed in report header
-        # If extracted_email exists, it will be used for sending the report
-        output_dir = trnda_agent_module.process_image_standalone(
-            local_image, 
-            client_name=client_info,
-            recipient_email=extracted_email
-        )
-        
-        print("=" * 70)
-        print(f"[COMPLETED] Output: {output_dir}")
-        print("=" * 70)
-        
-        # Upload results back to S3
-        # Structure: output/YYYYMMDDHHMMSS/design.pdf, etc.
-        timestamp = os.path.basename(output_dir).replace('output_', '')
-        s3_output_prefix = f"output/{timestamp}"
-        
-        print(f"[INFO] Uploading results to s3://{bucket}/{s3_output_prefix}/")
-        upload_directory_to_s3(output_dir, bucket, s3_output_prefix)
-        
-        print("=" * 70)
-        print(f"[SUCCESS] Results uploaded to: s3://{bucket}/{s3_output_prefix}/")
-        print("   - design.md")
-        print("   - design.pdf")
-        print("   - generated-diagrams/diagram_as_is.png")
-        print("   - generated-diagrams/diagram_well_architected.png")
-        print("=" * 70)
-        
-        # Generate presigned URL for PDF
+    # Run TRNDA agent by calling main processing logic directly
+    print("=" * 70)
+    print("[START] Running TRNDA agent...")
+    print("=" * 70)
+    
+    # We'll call the trnda-agent.py's main logic by importing its core functions
+    # and recreating the process
+    # Pass client_info as client_name - it will be displayed in report header
+    # If extracted_email exists, it will be used for sending the report
+    ctx = (context_factory or RunContext)(client_name=client_info, recipient_email=extracted_email)
+    ctx.bucket = bucket  # output (and presigned email links) go to the event bucket
+    ctx.deployment = DEPLOYMENT
+    # Queue wait in the run's metrics: upload event -> task start
+    ctx.queued_at = job['queued_at'] or ctx.queued_at
+    job['run_id'] = ctx.run_id
+    # Photo already exported at model size by the web app - no compression needed
+    ctx.input_preprocessed = metadata.get(trnda_agent_module.PREPROCESSED_METADATA_KEY)
+    # Status object of the input (status/<name>.json) for the web app's /status
+    ctx.status_uri = f"s3://{bucket}/{key}"
+    ctx.publish_status('running', stage=None)
+    # Output directory inside the run workspace - removed or archived after the upload
+    ctx.base_dir = ctx.base_dir or ctx.workspace.create()
+    
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        job['attempts'] = attempt
         try:
-            pdf_key = f"{s3_output_prefix}/design.pdf"
-            s3 = get_s3_client()
-            pdf_url = s3.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': bucket, 'Key': pdf_key},
-                ExpiresIn=86400  # 24 hours
-            )
-            print(f"[INFO] PDF URL (valid 24h): {pdf_url}")
+            if ctx.output_dir:
+                # Previous attempt got far enough to checkpoint - resume it
+                output_dir = resume_run(ctx.output_dir, ctx=ctx)
+            else:
+                # Input in the run's scratch directory (cleared after each attempt, so fetched per attempt)
+                local_image = os.path.join(ctx.workspace.scratch, os.path.basename(key))
+                with ctx.trace.span(key, 's3', operation='download') as span_attrs:
+                    download_from_s3(bucket, key, local_image)
+                    span_attrs['bytes'] = os.path.getsize(local_image)
+                output_dir = trnda_agent_module.process_image_standalone(local_image, ctx=ctx)
+            break
+        except DeadlineExceeded as e:
+            # Over its time budget - no retry; publish what the run got done and give up
+            trnda_agent_module.record_deadline_failure(ctx, e, bucket)
+            raise
         except Exception as e:
-            print(f"[WARNING] Could not generate presigned URL: {e}")
+            if attempt == MAX_ATTEMPTS:
+                ctx.publish_status('failed', error=str(e))
+                raise
+            print(f"[RETRY] Attempt {attempt}/{MAX_ATTEMPTS} failed: {e}")
+            print(f"[RETRY] Resuming in {RETRY_DELAY_SECONDS}s...")
+            time.sleep(RETRY_DELAY_SECONDS)
+    
+    print("=" * 70)
+    print(f"[COMPLETED] Output: {output_dir}")
+    print("=" * 70)
+    
+    # Upload results back to S3
+    # Structure: output/YYYYMMDDHHMMSS/design.pdf, etc.
+    timestamp = os.path.basename(output_dir).replace('output_', '')
+    s3_output_prefix = f"output/{timestamp}"
+    
+    print(f"[INFO] Uploading results to s3://{bucket}/{s3_output_prefix}/")
+    upload_directory_to_s3(output_dir, bucket, s3_output_prefix)
+    
+    print("=" * 70)
+    print(f"[SUCCESS] Results uploaded to: s3://{bucket}/{s3_output_prefix}/")
+    print("   - design.md")
+    print("   - design.pdf")
+    print("   - generated-diagrams/diagram_as_is.png")
+    print("   - generated-diagrams/diagram_well_architected.png")
+    print("=" * 70)
+    
+    # Generate presigned URL for PDF
+    pdf_url = None
+    try:
+        pdf_key = f"{s3_output_prefix}/design.pdf"
+        s3 = get_s3_client()
+        pdf_url = s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket, 'Key': pdf_key},
+            ExpiresIn=86400  # 24 hours
+        )
+        print(f"[INFO] PDF URL (valid 24h): {pdf_url}")
+    except Exception as e:
+        print(f"[WARNING] Could not generate presigned URL: {e}")
+    
+    ctx.publish_status('done', output=f"s3://{bucket}/{s3_output_prefix}/", pdf_url=pdf_url,
+                       runtime_seconds=round(time.time() - ctx.trace.started, 2))
+    # The run processed a local copy - record the S3 object version, so catch-up runs
+    # (trnda-cli.py s3://bucket/input/ with TRNDA_MANIFEST_S3) skip it
+    ctx.input_uri, ctx.input_etag = f"s3://{bucket}/{key}", head.get('ETag')
+    ctx.record_processed_input(f"s3://{bucket}/{s3_output_prefix}/")
+    ctx.record_report_hashes(f"s3://{bucket}/{s3_output_prefix}/")
+    ctx.workspace.finalize(output_dir, published=True)
+    job['outcome'] = 'success'
 
 
 def main():
@@ -256,6 +373,12 @@ def main():
         process_s3_event(event)
         print("[EXIT] Success")
         sys.exit(0)
+    except DeadlineExceeded as e:
+        # Exit now - an abandoned agent turn must not keep the billed task alive
+        print(f"[ERROR] {e}")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(trnda_agent_module.DEADLINE_EXIT_CODE)
     except Exception as e:
         print(f"[ERROR] Failed to process event: {e}")
         import traceback
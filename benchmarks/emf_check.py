@@ -0,0 +1,94 @@
+"""
+Offline check of the CloudWatch metric lines (Embedded Metric Format) in a log
+
+Every JSON line with an "_aws" member is validated against emf-schema.json
+(with jsonschema, if installed) and against the rules the schema cannot
+express: every dimension named in a dimension set and every declared metric
+must be a member of the record, dimension values must be strings and metric
+values numbers. CloudWatch drops records that break these rules silently.
+"""
+
+import os
+import json
+import math
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+EMF_SCHEMA = os.path.join(BENCH_DIR, 'emf-schema.json')
+
+
+def find_emf_records(text: str) -> list:
+    """JSON objects with an "_aws" member, one per log line (other lines are ignored)"""
+    records = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not (line.startswith('{') and '"_aws"' in line):
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # Counted as an error by check_emf_output
+            record = line
+        records.append(record)
+    return records
+
+
+def load_validator(schema_path: str = EMF_SCHEMA):
+    """jsonschema validator for the EMF schema, or None if jsonschema is not installed"""
+    try:
+        import jsonschema
+    except ImportError:
+        return None
+    with open(schema_path, 'r', encoding='utf-8') as f:
+        schema = json.load(f)
+    return jsonschema.Draft7Validator(schema)
+
+
+def check_emf_record(record: dict, validator=None) -> list:
+    """Problems with one EMF record (empty if valid)"""
+    if not isinstance(record, dict):
+        return [f"Not a JSON object: {str(record)[:120]}"]
+    problems = []
+    if validator is not None:
+        problems += [f"Schema: {'/'.join(str(p) for p in error.path)}: {error.message}"
+                     for error in validator.iter_errors(record)]
+        if problems:
+            return problems
+
+    for directive in record.get('_aws', {}).get('CloudWatchMetrics', []):
+        for dimension_set in directive.get('Dimensions', []):
+            for name in dimension_set:
+                if not isinstance(record.get(name), str):
+                    problems.append(f"Dimension {name} is not a string member of the record")
+        names = [metric.get('Name') for metric in directive.get('Metrics', [])]
+        if len(names) != len(set(names)):
+            problems.append(f"Duplicate metric names in {directive.get('Namespace')}")
+        for name in names:
+            value = record.get(name)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                problems.append(f"Metric {name} has no numeric value ({value!r})")
+    return problems
+
+
+def check_emf_output(text: str) -> dict:
+    """Validate all EMF lines of a log
+
+    Returns:
+        {'records': count, 'metrics': {name: count}, 'dimensions': {name: [values]},
+         'schema': True if validated with jsonschema, 'errors': [problems]}
+    """
+    validator = load_validator()
+    summary = {'records': 0, 'metrics': {}, 'dimensions': {}, 'schema': validator is not None, 'errors': []}
+    for record in find_emf_records(text):
+        summary['records'] += 1
+        problems = check_emf_record(record, validator)
+        summary['errors'] += problems
+        if problems:
+            continue
+        for directive in record['_aws']['CloudWatchMetrics']:
+            for metric in directive['Metrics']:
+                summary['metrics'][metric['Name']] = summary['metrics'].get(metric['Name'], 0) + 1
+            for name in {name for dimension_set in directive['Dimensions'] for name in dimension_set}:
+                values = summary['dimensions'].setdefault(name, [])
+                if record[name] not in values:
+                    values.append(record[name])
+    return summary
@@ -0,0 +1,380 @@
+"""
+Local AWS stand-ins for offline benchmarks and load tests
+
+Filesystem-backed S3, an in-memory SES and an in-memory DynamoDB that
+implement the subset of the boto3 client API TRNDA uses. Pass them to RunContext(client_factory=...) or
+assign them to the module-level clients of the Lambda functions. LocalS3.post_object
+plays the browser's form upload to a presigned POST, including the policy checks.
+"""
+
+import os
+import io
+import json
+import base64
+import time
+import shutil
+import hashlib
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+
+def _client_error(code: str, message: str, operation: str, **response) -> ClientError:
+    """Build a botocore ClientError like the real client raises (extra response members, e.g. Item)"""
+    return ClientError(dict(response, Error={'Code': code, 'Message': message}), operation)
+
+
+class LocalS3:
+    """S3 stand-in storing objects under <root>/<bucket>/<key>
+
+    Object metadata (ETag, ContentType, Metadata, ...) is kept next to the
+    object in <root>/.meta/<bucket>/<key>.json. Writes are atomic (temp file
+    + rename), so concurrent workers can share one root directory; conditional
+    writes (IfMatch / IfNoneMatch) are checked and applied under one lock.
+    """
+
+    def __init__(self, root: str, latency_ms: float = 0.0):
+        """
+        Args:
+            root: Directory holding all buckets
+            latency_ms: Optional delay added to every request (simulates network)
+        """
+        self.root = root
+        self.latency_ms = latency_ms
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _request(self, operation: str):
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def _meta_path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, '.meta', bucket, f"{key}.json")
+
+    def _write(self, bucket: str, key: str, data: bytes, content_type: str = None,
+               metadata: dict = None, extra: dict = None) -> str:
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        meta = {
+            'ETag': etag,
+            'ContentLength': len(data),
+            'ContentType': content_type or 'binary/octet-stream',
+            'Metadata': {k.lower(): v for k, v in (metadata or {}).items()},
+            'LastModified': datetime.now(timezone.utc).isoformat(),
+        }
+        meta.update(extra or {})
+        meta_path = self._meta_path(bucket, key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        temp_meta = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_meta, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(temp_meta, meta_path)
+        return etag
+
+    def _meta(self, bucket: str, key: str, operation: str) -> dict:
+        if not os.path.exists(self._path(bucket, key)):
+            raise _client_error('404' if operation == 'HeadObject' else 'NoSuchKey', 'Not Found', operation)
+        try:
+            with open(self._meta_path(bucket, key), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            size = os.path.getsize(self._path(bucket, key))
+            meta = {'ETag': '""', 'ContentLength': size, 'Metadata': {}}
+        meta['LastModified'] = datetime.fromisoformat(meta['LastModified']) if 'LastModified' in meta else None
+        return meta
+
+    # --- boto3 client API subset ---
+
+    def put_object(self, Bucket: str, Key: str, Body=b'', ContentType: str = None, Metadata: dict = None,
+                   CacheControl: str = None, IfNoneMatch: str = None, IfMatch: str = None, **kwargs) -> dict:
+        self._request('PutObject')
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        extra = {'CacheControl': CacheControl} if CacheControl else None
+        with self._write_lock:
+            if IfNoneMatch == '*' and os.path.exists(self._path(Bucket, Key)):
+                raise _client_error('PreconditionFailed', 'At least one of the pre-conditions you specified did not hold', 'PutObject')
+            if IfMatch is not None and self._meta(Bucket, Key, 'PutObject')['ETag'] != IfMatch:
+                raise _client_error('PreconditionFailed', 'At least one of the pre-conditions you specified did not hold', 'PutObject')
+            etag = self._write(Bucket, Key, Body, ContentType, Metadata, extra)
+        return {'ETag': etag}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self._request('GetObject')
+        meta = self._meta(Bucket, Key, 'GetObject')
+        with open(self._path(Bucket, Key), 'rb') as f:
+            data = f.read()
+        return dict(meta, Body=io.BytesIO(data))
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self._request('HeadObject')
+        return self._meta(Bucket, Key, 'HeadObject')
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self._request('DeleteObject')
+        for path in (self._path(Bucket, Key), self._meta_path(Bucket, Key)):
+            if os.path.exists(path):
+                os.remove(path)
+        return {}
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, ExtraArgs: dict = None, **kwargs) -> None:
+        extra = dict(ExtraArgs or {})
+        with open(Filename, 'rb') as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read(),
+                            ContentType=extra.pop('ContentType', None),
+                            Metadata=extra.pop('Metadata', None),
+                            CacheControl=extra.pop('CacheControl', None))
+
+    def download_file(self, Bucket: str, Key: str, Filename: str, **kwargs) -> None:
+        self._request('GetObject')
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise _client_error('404', 'Not Found', 'HeadObject')
+        shutil.copyfile(path, Filename)
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = '', ContinuationToken: str = None,
+                        StartAfter: str = None, MaxKeys: int = 1000, **kwargs) -> dict:
+        self._request('ListObjectsV2')
+        bucket_dir = os.path.join(self.root, Bucket)
+        keys = []
+        for root, dirs, files in os.walk(bucket_dir):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                key = os.path.relpath(os.path.join(root, name), bucket_dir).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    keys.append(key)
+        keys.sort()
+
+        after = ContinuationToken or StartAfter
+        if after:
+            keys = [k for k in keys if k > after]
+        page, rest = keys[:MaxKeys], keys[MaxKeys:]
+
+        contents = []
+        for key in page:
+            meta = self._meta(Bucket, key, 'ListObjectsV2')
+            contents.append({'Key': key, 'ETag': meta['ETag'], 'Size': meta['ContentLength'],
+                             'LastModified': meta['LastModified']})
+
+        response = {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': bool(rest)}
+        if rest:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+    def get_paginator(self, operation_name: str):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(operation_name)
+        return _ListObjectsV2Paginator(self)
+
+    def generate_presigned_url(self, ClientMethod: str, Params: dict = None, ExpiresIn: int = 3600, **kwargs) -> str:
+        params = Params or {}
+        return f"file://{self._path(params.get('Bucket', ''), params.get('Key', ''))}?expires={ExpiresIn}"
+
+    def generate_presigned_post(self, Bucket: str, Key: str, Fields: dict = None, Conditions: list = None,
+                                ExpiresIn: int = 3600) -> dict:
+        fields = dict(Fields or {})
+        fields['key'] = Key
+        expiration = datetime.fromtimestamp(time.time() + ExpiresIn, timezone.utc)
+        policy = {'expiration': expiration.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                  'conditions': [{'bucket': Bucket}, {'key': Key}] + list(Conditions or [])}
+        fields['policy'] = base64.b64encode(json.dumps(policy).encode('utf-8')).decode('ascii')
+        return {'url': f"file://{os.path.join(self.root, Bucket)}", 'fields': fields}
+
+    def post_object(self, url: str, fields: dict, file: bytes) -> dict:
+        """Browser form upload to a presigned POST (what S3 does with the multipart form)
+
+        Enforces the policy like S3: not expired, every condition met, no form
+        field without a condition, size within content-length-range.
+        """
+        self._request('PostObject')
+        bucket = os.path.basename(url[len('file://'):].rstrip('/'))
+        data = file.read() if hasattr(file, 'read') else file
+        policy = json.loads(base64.b64decode(fields['policy']))
+        expiration = datetime.strptime(policy['expiration'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+        if datetime.now(timezone.utc) > expiration:
+            raise _client_error('AccessDenied', 'Invalid according to Policy: Policy expired.', 'PostObject')
+
+        form = {k.lower(): v for k, v in fields.items() if k.lower() != 'policy'}
+        form['bucket'] = bucket
+        covered = set()
+        for condition in policy['conditions']:
+            if isinstance(condition, dict):
+                (name, expected), = condition.items()
+                name, operator = name.lower(), 'eq'
+            else:
+                operator, name, expected = condition[0], condition[1], condition[2]
+            if operator == 'content-length-range':
+                if len(data) > condition[2]:
+                    raise _client_error('EntityTooLarge', 'Your proposed upload exceeds the maximum allowed size', 'PostObject')
+                if len(data) < condition[1]:
+                    raise _client_error('EntityTooSmall', 'Your proposed upload is smaller than the minimum allowed size', 'PostObject')
+                continue
+            name = name.lower().lstrip('$')
+            covered.add(name)
+            value = form.get(name, '')
+            if (operator == 'eq' and value != expected) or (operator == 'starts-with' and not value.startswith(expected)):
+                raise _client_error('AccessDenied', f"Invalid according to Policy: Policy Condition failed: {condition}", 'PostObject')
+
+        extra_fields = set(form) - covered
+        if extra_fields:
+            raise _client_error('AccessDenied', f"Invalid according to Policy: Extra input fields: {sorted(extra_fields)}", 'PostObject')
+
+        metadata = {k[len('x-amz-meta-'):]: v for k, v in form.items() if k.startswith('x-amz-meta-')}
+        etag = self._write(bucket, form['key'], data, form.get('content-type'), metadata)
+        return {'ETag': etag, 'Location': f"{url.rstrip('/')}/{form['key']}"}
+
+
+class _ListObjectsV2Paginator:
+    """Minimal paginator for LocalS3.list_objects_v2"""
+
+    def __init__(self, s3: LocalS3):
+        self.s3 = s3
+
+    def paginate(self, Bucket: str, Prefix: str = '', PaginationConfig: dict = None, **kwargs):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        token = None
+        while True:
+            page = self.s3.list_objects_v2(Bucket=Bucket, Prefix=Prefix, ContinuationToken=token, MaxKeys=page_size)
+            yield page
+            if not page['IsTruncated']:
+                return
+            token = page['NextContinuationToken']
+
+
+class LocalSES:
+    """SES stand-in recording sent messages in memory
+
+    Set fail_first to make the first N sends raise a throttling error.
+    """
+
+    def __init__(self, latency_ms: float = 0.0, fail_first: int = 0):
+        self.latency_ms = latency_ms
+        self.fail_first = fail_first
+        self.sent = []
+        self.attempts = 0
+        self._lock = threading.Lock()
+
+    def send_raw_email(self, Source: str, Destinations: list, RawMessage: dict, **kwargs) -> dict:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+        with self._lock:
+            self.attempts += 1
+            if self.attempts <= self.fail_first:
+                raise _client_error('Throttling', 'Maximum sending rate exceeded.', 'SendRawEmail')
+            message_id = f"local-{uuid.uuid4().hex}"
+            data = RawMessage['Data']
+            self.sent.append({'MessageId': message_id, 'Source': Source, 'Destinations': list(Destinations),
+                              'Bytes': len(data)})
+        return {'MessageId': message_id}
+
+
+class LocalDynamoDB:
+    """DynamoDB stand-in (in memory) for the idempotency records of the trigger Lambdas
+
+    Supports put_item / update_item / delete_item with the expression forms
+    the Lambdas use: conditions joined by OR of attribute_not_exists(attr),
+    "attr < :value" and "attr = :value", "SET name = :value, ..." updates and
+    ReturnValuesOnConditionCheckFailure='ALL_OLD' (the existing item in the error).
+    """
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.tables = {}
+        self.requests = {}
+        self.conditional_failures = 0
+        self._lock = threading.Lock()
+
+    def _request(self, operation: str):
+        self.requests[operation] = self.requests.get(operation, 0) + 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+
+    @staticmethod
+    def _value(attribute: dict):
+        (kind, value), = attribute.items()
+        return float(value) if kind == 'N' else value
+
+    def _condition_holds(self, item: dict, expression: str, values: dict, names: dict) -> bool:
+        for clause in expression.split(' OR '):
+            clause = clause.strip()
+            if clause.startswith('attribute_not_exists('):
+                name = clause[len('attribute_not_exists('):-1]
+                if item is None or names.get(name, name) not in item:
+                    return True
+            else:
+                name, operator, placeholder = clause.split()
+                if operator not in ('<', '='):
+                    raise ValueError(f"Unsupported condition: {clause}")
+                current = (item or {}).get(names.get(name, name))
+                if current is None:
+                    continue
+                current, value = self._value(current), self._value(values[placeholder])
+                if current < value if operator == '<' else current == value:
+                    return True
+        return False
+
+    def put_item(self, TableName: str, Item: dict, ConditionExpression: str = None,
+                 ExpressionAttributeValues: dict = None, ExpressionAttributeNames: dict = None,
+                 ReturnValuesOnConditionCheckFailure: str = None, **kwargs) -> dict:
+        with self._lock:
+            self._request('PutItem')
+            table = self.tables.setdefault(TableName, {})
+            key = Item['id']['S']
+            if ConditionExpression and not self._condition_holds(table.get(key), ConditionExpression,
+                                                                 ExpressionAttributeValues or {},
+                                                                 ExpressionAttributeNames or {}):
+                self.conditional_failures += 1
+                existing = {'Item': dict(table[key])} if ReturnValuesOnConditionCheckFailure == 'ALL_OLD' else {}
+                raise _client_error('ConditionalCheckFailedException', 'The conditional request failed', 'PutItem',
+                                    **existing)
+            table[key] = dict(Item)
+        return {}
+
+    def update_item(self, TableName: str, Key: dict, UpdateExpression: str,
+                    ExpressionAttributeValues: dict = None, ExpressionAttributeNames: dict = None, **kwargs) -> dict:
+        names = ExpressionAttributeNames or {}
+        with self._lock:
+            self._request('UpdateItem')
+            item = self.tables.setdefault(TableName, {}).setdefault(Key['id']['S'], dict(Key))
+            for assignment in UpdateExpression[len('SET '):].split(','):
+                name, placeholder = (part.strip() for part in assignment.split('='))
+                item[names.get(name, name)] = ExpressionAttributeValues[placeholder]
+        return {}
+
+    def delete_item(self, TableName: str, Key: dict, **kwargs) -> dict:
+        with self._lock:
+            self._request('DeleteItem')
+            self.tables.get(TableName, {}).pop(Key['id']['S'], None)
+        return {}
+
+
+def local_client_factory(s3: LocalS3, ses: LocalSES = None):
+    """client_factory for RunContext that returns the local stand-ins"""
+    ses = ses or LocalSES()
+
+    def factory(service_name: str, region: str = None):
+        if service_name == 's3':
+            return s3
+        if service_name == 'ses':
+            return ses
+        raise ValueError(f"No local stand-in for AWS service: {service_name}")
+
+    return factory
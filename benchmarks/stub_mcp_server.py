@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Stub MCP server replaying recorded tool interactions (stdio transport)
+
+Usage:
+    python benchmarks/stub_mcp_server.py benchmarks/recordings/aws_pricing.json
+
+The recording lists the server's tools (name, description, inputSchema) and a
+canned response per tool. Tools flagged with "writes_diagram" also create a
+PNG at <workspace_dir>/generated-diagrams/<filename>.png, like the real AWS
+Diagram MCP server does.
+"""
+
+import os
+import sys
+import json
+import asyncio
+
+import mcp.types as types
+from mcp.server.lowlevel import Server
+from mcp.server.stdio import stdio_server
+
+
+def load_recording(path: str) -> dict:
+    """Load recording JSON"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_stub_diagram(arguments: dict, image_size: list) -> str:
+    """Create a placeholder diagram PNG where the real server would save it
+
+    Returns:
+        Path of the created PNG
+    """
+    from PIL import Image, ImageDraw
+
+    workspace_dir = arguments.get('workspace_dir') or os.getcwd()
+    filename = arguments.get('filename') or 'diagram'
+    if not filename.endswith('.png'):
+        filename += '.png'
+    path = filename if os.path.isabs(filename) else os.path.join(workspace_dir, 'generated-diagrams', filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    img = Image.new('RGB', tuple(image_size), 'white')
+    draw = ImageDraw.Draw(img)
+    width, height = img.size
+    for i in range(4):
+        x = width * (i + 1) // 5
+        draw.rectangle([x - 80, height // 2 - 60, x + 80, height // 2 + 60], outline='black', width=4)
+        if i:
+            draw.line([x - width // 5 + 80, height // 2, x - 80, height // 2], fill='black', width=3)
+    img.save(path, format='PNG')
+    return path
+
+
+# Scale factor for recorded latencies (e.g. 0.1 for faster load tests)
+LATENCY_SCALE = float(os.environ.get('STUB_MCP_LATENCY_SCALE', '1.0'))
+
+
+def create_server(recording: dict) -> Server:
+    """Create MCP server answering from the recording"""
+    server = Server(recording.get('server', 'stub'))
+    tools = recording['tools']
+    responses = recording.get('responses', {})
+
+    @server.list_tools()
+    async def list_tools() -> list:
+        return [types.Tool(name=t['name'], description=t.get('description', ''), inputSchema=t['inputSchema'])
+                for t in tools]
+
+    @server.call_tool()
+    async def call_tool(name: str, arguments: dict) -> list:
+        response = responses.get(name, {'text': f"No recorded response for {name}"})
+
+        if response.get('latency_ms'):
+            await asyncio.sleep(response['latency_ms'] * LATENCY_SCALE / 1000.0)
+        if response.get('hang'):
+            # Deliberately hanging tool (deadline tests)
+            while True:
+                await asyncio.sleep(3600)
+
+        text = response.get('text', '') * response.get('repeat', 1)
+        if response.get('writes_diagram'):
+            path = write_stub_diagram(arguments or {}, response.get('image_size', [1600, 900]))
+            text = text.replace('{path}', path)
+
+        return [types.TextContent(type='text', text=text)]
+
+    return server
+
+
+async def run(recording_path: str) -> None:
+    server = create_server(load_recording(recording_path))
+    async with stdio_server() as (read_stream, write_stream):
+        await server.run(read_stream, write_stream, server.create_initialization_options())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <recording.json>", file=sys.stderr)
+        sys.exit(2)
+    asyncio.run(run(sys.argv[1]))
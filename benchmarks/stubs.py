@@ -0,0 +1,314 @@
+"""
+Scripted model and stub MCP clients for offline TRNDA runs
+
+ScriptedModel plays back benchmarks/script.json: for every workflow stage a
+list of turns, each either tool calls or a final text answer. It never calls
+Bedrock, but it estimates the tokens the real request would have sent and
+reports them as usage, so checkpoints, trace and cost.md look like a real run.
+"""
+
+import os
+import re
+import io
+import sys
+import json
+import time
+import asyncio
+import threading
+
+from strands.models import Model
+from strands.types.exceptions import ModelThrottledException
+from mcp import stdio_client, StdioServerParameters
+from strands.tools.mcp import MCPClient
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCRIPT = os.path.join(BENCH_DIR, 'script.json')
+DEFAULT_RECORDINGS = os.path.join(BENCH_DIR, 'recordings')
+STUB_SERVER = os.path.join(BENCH_DIR, 'stub_mcp_server.py')
+
+# Rough chars-per-token ratio for estimating request size
+CHARS_PER_TOKEN = 4
+
+
+def estimate_image_tokens(image_bytes: bytes) -> int:
+    """Claude image token estimate: width * height / 750"""
+    try:
+        from PIL import Image
+        width, height = Image.open(io.BytesIO(image_bytes)).size
+        return int(width * height / 750)
+    except Exception:
+        return 1600
+
+
+def estimate_tokens(messages: list, tool_specs: list = None, system_prompt: str = None) -> int:
+    """Estimate input tokens of a model request (text chars / 4 + image tokens)"""
+    chars = len(system_prompt or '') + len(json.dumps(tool_specs or [], default=str))
+    image_tokens = 0
+
+    def walk(value):
+        nonlocal chars, image_tokens
+        if isinstance(value, dict):
+            if 'image' in value and isinstance(value['image'], dict):
+                data = value['image'].get('source', {}).get('bytes', b'')
+                image_tokens += estimate_image_tokens(data) if isinstance(data, bytes) else 1600
+                return
+            for item in value.values():
+                walk(item)
+        elif isinstance(value, list):
+            for item in value:
+                walk(item)
+        elif isinstance(value, str):
+            chars += len(value)
+        elif isinstance(value, bytes):
+            chars += len(value)
+
+    walk(messages)
+    return chars // CHARS_PER_TOKEN + image_tokens
+
+
+def load_script(path: str = DEFAULT_SCRIPT) -> dict:
+    """Load scripted model turns"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _substitute(value, variables: dict):
+    """Replace {name} placeholders in all strings of a JSON value"""
+    if isinstance(value, str):
+        for name, replacement in variables.items():
+            value = value.replace('{' + name + '}', replacement)
+        return value
+    if isinstance(value, dict):
+        return {k: _substitute(v, variables) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_substitute(v, variables) for v in value]
+    return value
+
+
+class ScriptedModel(Model):
+    """Model replaying scripted turns per workflow stage
+
+    The stage is taken from the latest "STEP <n>:" prompt, the output
+    directory from the latest "OUTPUT DIR: <path>" in the conversation.
+    Each model call returns the next turn of the current stage.
+    """
+
+    def __init__(self, script: dict = None, stage_names: list = None, latency_ms: float = 0.0,
+                 model_id: str = 'scripted'):
+        """
+        Args:
+            script: Script dict ({"stages": {stage_name: [turn, ...]}}); default benchmarks/script.json
+            stage_names: Workflow stage names in order (STEP n -> stage_names[n - 1])
+            latency_ms: Delay per model turn (simulated model latency)
+            model_id: Model ID reported in traces
+        """
+        self.script = script or load_script()
+        self.stage_names = stage_names or list(self.script['stages'])
+        self.latency_ms = latency_ms
+        self.config = {'model_id': model_id}
+        self.variables = {}
+        self.stage = None
+        self.turn = 0
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._lock = threading.Lock()
+
+    def update_config(self, **model_config):
+        self.config.update(model_config)
+
+    def get_config(self):
+        return self.config
+
+    async def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        raise NotImplementedError("ScriptedModel does not support structured output")
+        yield  # pragma: no cover
+
+    def _next_turn(self, messages: list) -> dict:
+        with self._lock:
+            texts = [''.join(block.get('text', '') for block in message['content'] if isinstance(block, dict))
+                     for message in messages if message.get('role') == 'user']
+            last_text = texts[-1] if texts else ''
+            # Latest OUTPUT DIR anywhere in the conversation (a routed model may join mid-run)
+            for text in reversed(texts):
+                output_dir = re.search(r'OUTPUT DIR: (\S+)', text)
+                if output_dir:
+                    self.variables['output_dir'] = output_dir.group(1)
+                    break
+            step = re.search(r'STEP (\d+): ', last_text)
+            if step:
+                self.stage = self.stage_names[int(step.group(1)) - 1]
+                self.turn = 0
+
+            turns = self.script['stages'].get(self.stage) or [{'text': 'Done.'}]
+            # Past the scripted turns, always end the stage with text
+            turn = turns[self.turn] if self.turn < len(turns) else {'text': 'Done.'}
+            self.turn += 1
+            self.calls += 1
+            return _substitute(turn, self.variables)
+
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        start = time.time()
+        turn = self._next_turn(messages)
+        input_tokens = estimate_tokens(messages, tool_specs, system_prompt)
+
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000.0)
+
+        yield {'messageStart': {'role': 'assistant'}}
+
+        output_chars = 0
+        if turn.get('text'):
+            output_chars += len(turn['text'])
+            yield {'contentBlockStart': {'start': {}}}
+            yield {'contentBlockDelta': {'delta': {'text': turn['text']}}}
+            yield {'contentBlockStop': {}}
+
+        tool_calls = turn.get('tools', [])
+        for index, call in enumerate(tool_calls):
+            tool_input = json.dumps(call.get('input', {}))
+            output_chars += len(tool_input)
+            yield {'contentBlockStart': {'start': {'toolUse': {
+                'toolUseId': f"tooluse_{self.calls}_{index}", 'name': call['name']}}}}
+            yield {'contentBlockDelta': {'delta': {'toolUse': {'input': tool_input}}}}
+            yield {'contentBlockStop': {}}
+
+        output_tokens = max(1, output_chars // CHARS_PER_TOKEN)
+        with self._lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+
+        yield {'messageStop': {'stopReason': 'tool_use' if tool_calls else 'end_turn'}}
+        yield {'metadata': {
+            'usage': {'inputTokens': input_tokens, 'outputTokens': output_tokens,
+                      'totalTokens': input_tokens + output_tokens},
+            'metrics': {'latencyMs': int((time.time() - start) * 1000)},
+        }}
+
+
+class FakeBedrockQuota:
+    """Shared requests-per-minute / tokens-per-minute quota (sliding 60 s window)
+
+    Share one instance between all fake models of a process to simulate one
+    account-level Bedrock quota.
+    """
+
+    def __init__(self, requests_per_minute: int = None, tokens_per_minute: int = None, window_seconds: float = 60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window_seconds = window_seconds
+        self.accepted = 0
+        self.throttled = 0
+        self.first_throttled_at = None
+        self._events = []
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int) -> bool:
+        """Record a request; False if it exceeds the quota (request is then not counted)"""
+        now = time.time()
+        with self._lock:
+            self._events = [(t, n) for t, n in self._events if now - t < self.window_seconds]
+            over_requests = self.requests_per_minute is not None and len(self._events) + 1 > self.requests_per_minute
+            over_tokens = (self.tokens_per_minute is not None
+                           and sum(n for _, n in self._events) + tokens > self.tokens_per_minute)
+            if over_requests or over_tokens:
+                self.throttled += 1
+                if self.first_throttled_at is None:
+                    self.first_throttled_at = now
+                return False
+            self._events.append((now, tokens))
+            self.accepted += 1
+            return True
+
+
+class ThrottlingScriptedModel(ScriptedModel):
+    """ScriptedModel that raises ModelThrottledException above a shared quota, like Bedrock does"""
+
+    def __init__(self, quota: FakeBedrockQuota, **kwargs):
+        super().__init__(**kwargs)
+        self.quota = quota
+        self.throttled = 0
+
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        tokens = estimate_tokens(messages, tool_specs, system_prompt)
+        if not self.quota.acquire(tokens):
+            self.throttled += 1
+            raise ModelThrottledException("ThrottlingException: Too many requests, please wait before trying again.")
+        async for event in super().stream(messages, tool_specs, system_prompt, **kwargs):
+            yield event
+
+
+class StubEndpoint(Model):
+    """One endpoint (region / inference profile) in front of a shared ScriptedModel
+
+    Injects latency and errors the way a degraded Bedrock endpoint shows them,
+    before the request reaches the scripted model (a failed request does not
+    use up a scripted turn, so the conversation continues on the next endpoint).
+    """
+
+    def __init__(self, model: ScriptedModel, latency_ms: float = 0.0, throttle_after: int = None,
+                 error_rate: float = 0.0, seed: int = 0):
+        """
+        Args:
+            model: Scripted model shared by all endpoints of a tier
+            latency_ms: Extra delay before the first event
+            throttle_after: Throttle every request after this many served turns
+            error_rate: Fraction of requests failing with ServiceUnavailableException
+            seed: Random seed for error_rate
+        """
+        import random
+        self.model = model
+        self.latency_ms = latency_ms
+        self.throttle_after = throttle_after
+        self.error_rate = error_rate
+        self.served = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+
+    def update_config(self, **model_config):
+        self.model.update_config(**model_config)
+
+    def get_config(self):
+        return self.model.get_config()
+
+    async def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        raise NotImplementedError("StubEndpoint does not support structured output")
+        yield  # pragma: no cover
+
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        from botocore.exceptions import ClientError
+
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000.0)
+        if self.throttle_after is not None and self.served >= self.throttle_after:
+            self.errors += 1
+            raise ModelThrottledException("ThrottlingException: Too many requests, please wait before trying again.")
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            raise ClientError({'Error': {'Code': 'ServiceUnavailableException', 'Message': 'Service unavailable'}},
+                              'ConverseStream')
+        self.served += 1
+        async for event in self.model.stream(messages, tool_specs, system_prompt, **kwargs):
+            yield event
+
+
+def stub_mcp_clients(recordings_dir: str = DEFAULT_RECORDINGS, latency_scale: float = 1.0) -> dict:
+    """MCP clients talking to local stub servers (one subprocess per server, like the real ones)
+
+    Args:
+        recordings_dir: Directory with <server>.json recordings
+        latency_scale: Scale factor for recorded tool latencies
+
+    Returns:
+        Dictionary of server name -> MCPClient (same names as create_mcp_clients)
+    """
+    env = dict(os.environ, STUB_MCP_LATENCY_SCALE=str(latency_scale))
+    clients = {}
+    for name in ('aws_knowledge', 'aws_diagram', 'aws_pricing'):
+        recording = os.path.join(recordings_dir, f"{name}.json")
+        clients[name] = MCPClient(
+            lambda recording=recording: stdio_client(
+                StdioServerParameters(command=sys.executable, args=[STUB_SERVER, recording], env=env)
+            )
+        )
+    return clients
@@ -86,9 +86,10 @@ function handleImageSelect(event) {
         return;
     }
 
-    const maxSize = 10 * 1024 * 1024;
+    // Only the model-size export is uploaded, so larger originals are fine
+    const maxSize = 30 * 1024 * 1024;
     if (file.size > maxSize) {
-        showStatus('Image size must be less than 10MB.', 'error');
+        showStatus('Image size must be less than 30MB.', 'error');
         return;
     }
 
@@ -113,14 +114,12 @@ function loadImageToCanvas(file) {
     reader.readAsDataURL(file);
 }
 
-function drawImageOnCanvas(img, angle) {
-    const canvas = previewCanvas;
+function drawImageOnCanvas(img, angle, canvas = previewCanvas, maxDimension = 2048) {
     const ctx = canvas.getContext('2d');
 
     let width = img.width;
     let height = img.height;
     
-    const maxDimension = 2048;
     if (width > maxDimension || height > maxDimension) {
         const scale = Math.min(maxDimension / width, maxDimension / height);
         width = Math.floor(width * scale);
@@ -143,6 +142,34 @@ function drawImageOnCanvas(img, angle) {
     ctx.restore();
 }
 
+// Model-optimal export: longest edge and JPEG quality match the backend's model
+// image (MODEL_IMAGE_MAX_EDGE / MODEL_IMAGE_QUALITY in trnda-agent.py), rotation
+// and EXIF orientation are already applied by the canvas
+const EXPORT_MAX_EDGE = 1568;
+const EXPORT_QUALITY = 0.85;
+const EXPORT_MIN_QUALITY = 0.55;
+const EXPORT_MAX_BYTES = 1.5 * 1024 * 1024;
+const EXPORT_TIME_BUDGET_MS = 3000;
+
+async function exportImage() {
+    const start = performance.now();
+    const canvas = document.createElement('canvas');
+    drawImageOnCanvas(originalImageData, rotation, canvas, EXPORT_MAX_EDGE);
+    const encode = (q) => new Promise((resolve) => canvas.toBlob(resolve, 'image/jpeg', q));
+    let quality = EXPORT_QUALITY;
+    let blob = await encode(quality);
+    // Lower quality until the size budget is met, unless the time budget is used up (slow phones)
+    while (blob.size > EXPORT_MAX_BYTES && quality > EXPORT_MIN_QUALITY &&
+           performance.now() - start < EXPORT_TIME_BUDGET_MS) {
+        quality -= 0.1;
+        blob = await encode(quality);
+    }
+    const preprocessed = 'w=' + canvas.width + ',h=' + canvas.height + ',q=' + quality.toFixed(2) +
+        ',src=' + originalImageData.width + 'x' + originalImageData.height +
+        ',ms=' + Math.round(performance.now() - start);
+    return { blob, preprocessed };
+}
+
 function handleRotate() {
     if (!originalImageData) return;
     rotation = (rotation + 90) % 360;
@@ -192,14 +219,13 @@ async function handleUpload() {
         loadingOverlay.classList.remove('hidden');
         uploadBtn.disabled = true;
 
-        // Get rotated image as blob
-        const blob = await new Promise((resolve) => {
-            previewCanvas.toBlob(resolve, 'image/jpeg', 0.85);
-        });
+        // Rotated photo at model size (see exportImage)
+        const { blob, preprocessed } = await exportImage();
 
-        // Generate filename
+        // Generate filename (random suffix: one input key and status object per upload)
         const timestamp = new Date().toISOString().replace(/[:.]/g, '-');
-        const filename = `diagram-${timestamp}.jpg`;
+        const suffix = Math.random().toString(16).slice(2, 10).padEnd(8, '0');
+        const filename = `diagram-${timestamp}-${suffix}.jpg`;
         const key = `input/${filename}`;
 
         // Prepare S3 upload parameters
@@ -210,11 +236,12 @@ async function handleUpload() {
             ContentType: 'image/jpeg'
         };
 
-        // Add metadata if client info provided
+        // Add metadata (client info if provided, export parameters for the backend)
+        params.Metadata = {
+            'trnda-preprocessed': preprocessed
+        };
         if (clientInfo) {
-            params.Metadata = {
-                'client-info': clientInfo
-            };
+            params.Metadata['client-info'] = clientInfo;
         }
 
         // Upload to S3
@@ -104,6 +104,13 @@ resource "aws_iam_role_policy" "lambda" {
         ]
         Resource = "arn:aws:s3:::${var.diagrams_bucket_name}/input/*"
       },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject"
+        ]
+        Resource = "arn:aws:s3:::${var.diagrams_bucket_name}/status/*"
+      },
       {
         Effect = "Allow"
         Action = [
@@ -132,17 +139,31 @@ resource "aws_lambda_function" "upload" {
   handler         = "upload.lambda_handler"
   source_code_hash = data.archive_file.lambda.output_base64sha256
   runtime         = "python3.11"
-  timeout         = 30
-  memory_size     = 256
+  # Only signs presigned POSTs, the image goes from the browser straight to S3
+  timeout         = 10
+  memory_size     = 128
   
   environment {
     variables = {
-      UPLOAD_PASSWORD = var.upload_password
-      BUCKET_NAME     = var.diagrams_bucket_name
+      UPLOAD_PASSWORD  = var.upload_password
+      BUCKET_NAME      = var.diagrams_bucket_name
+      UPLOAD_MAX_BYTES = tostring(var.upload_max_mb * 1024 * 1024)
     }
   }
 }
 
+# CORS on the diagrams bucket for the browser's presigned POST upload
+resource "aws_s3_bucket_cors_configuration" "diagrams" {
+  bucket = var.diagrams_bucket_name
+  
+  cors_rule {
+    allowed_origins = ["*"]
+    allowed_methods = ["POST"]
+    allowed_headers = ["*"]
+    max_age_seconds = 3000
+  }
+}
+
 # API Gateway
 resource "aws_apigatewayv2_api" "main" {
   name          = "trnda-upload-api"
@@ -177,6 +198,12 @@ resource "aws_apigatewayv2_route" "upload" {
   target    = "integrations/${aws_apigatewayv2_integration.lambda.id}"
 }
 
+resource "aws_apigatewayv2_route" "status" {
+  api_id    = aws_apigatewayv2_api.main.id
+  route_key = "POST /status"
+  target    = "integrations/${aws_apigatewayv2_integration.lambda.id}"
+}
+
 # API Gateway stage
 resource "aws_apigatewayv2_stage" "default" {
   api_id      = aws_apigatewayv2_api.main.id
@@ -81,9 +81,11 @@ uploadBtn.addEventListener('click', handleUpload);
 function handleImageSelect(event) {
     const file = event.target.files[0];
     if (!file) return;
+    clearTimeout(statusTimer);
     if (!file.type.startsWith('image/')) { showStatus('Please select a valid image file.', 'error'); return; }
-    const maxSize = 10 * 1024 * 1024;
-    if (file.size > maxSize) { showStatus('Image size must be less than 10MB.', 'error'); return; }
+    // Only the model-size export is uploaded, so larger originals are fine
+    const maxSize = 30 * 1024 * 1024;
+    if (file.size > maxSize) { showStatus('Image size must be less than 30MB.', 'error'); return; }
     currentImage = file;
     rotation = 0;
     loadImageToCanvas(file);
@@ -102,11 +104,9 @@ function loadImageToCanvas(file) {
     reader.readAsDataURL(file);
 }
 
-function drawImageOnCanvas(img, angle) {
-    const canvas = previewCanvas;
+function drawImageOnCanvas(img, angle, canvas = previewCanvas, maxDimension = 2048) {
     const ctx = canvas.getContext('2d');
     let width = img.width, height = img.height;
-    const maxDimension = 2048;
     if (width > maxDimension || height > maxDimension) {
         const scale = Math.min(maxDimension / width, maxDimension / height);
         width = Math.floor(width * scale);
@@ -122,6 +122,34 @@ function drawImageOnCanvas(img, angle) {
     ctx.restore();
 }
 
+// Model-optimal export: longest edge and JPEG quality match the backend's model
+// image (MODEL_IMAGE_MAX_EDGE / MODEL_IMAGE_QUALITY in trnda-agent.py), rotation
+// and EXIF orientation are already applied by the canvas
+const EXPORT_MAX_EDGE = 1568;
+const EXPORT_QUALITY = 0.85;
+const EXPORT_MIN_QUALITY = 0.55;
+const EXPORT_MAX_BYTES = 1.5 * 1024 * 1024;
+const EXPORT_TIME_BUDGET_MS = 3000;
+
+async function exportImage() {
+    const start = performance.now();
+    const canvas = document.createElement('canvas');
+    drawImageOnCanvas(originalImageData, rotation, canvas, EXPORT_MAX_EDGE);
+    const encode = (q) => new Promise((resolve) => canvas.toBlob(resolve, 'image/jpeg', q));
+    let quality = EXPORT_QUALITY;
+    let blob = await encode(quality);
+    // Lower quality until the size budget is met, unless the time budget is used up (slow phones)
+    while (blob.size > EXPORT_MAX_BYTES && quality > EXPORT_MIN_QUALITY &&
+           performance.now() - start < EXPORT_TIME_BUDGET_MS) {
+        quality -= 0.1;
+        blob = await encode(quality);
+    }
+    const preprocessed = 'w=' + canvas.width + ',h=' + canvas.height + ',q=' + quality.toFixed(2) +
+        ',src=' + originalImageData.width + 'x' + originalImageData.height +
+        ',ms=' + Math.round(performance.now() - start);
+    return { blob, preprocessed };
+}
+
 function handleRotate() {
     if (!originalImageData) return;
     rotation = (rotation + 90) % 360;
@@ -152,20 +180,31 @@ async function handleUpload() {
         loadingOverlay.classList.remove('hidden');
         uploadBtn.disabled = true;
         
-        // Convert canvas to base64
-        const base64 = previewCanvas.toDataURL('image/jpeg', 0.85).split(',')[1];
+        // Rotated photo at model size (see exportImage)
+        const { blob, preprocessed } = await exportImage();
         
-        // Send to API
-        const response = await fetch(`$${API_URL}/upload`, {
+        // Ask the API for a presigned S3 POST (no image in the request)
+        let response = await fetch(`$${API_URL}/upload`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
                 password: sessionStorage.getItem('trnda_password'),
-                image: base64,
-                clientInfo: clientInfo
+                clientInfo: clientInfo,
+                preprocessed: preprocessed
             })
         });
         
+        let uploadKey = null;
+        if (response.ok) {
+            // Send the image straight to S3 (form fields first, file last)
+            const { key, upload } = await response.json();
+            uploadKey = key;
+            const form = new FormData();
+            Object.entries(upload.fields).forEach(([name, value]) => form.append(name, value));
+            form.append('file', blob);
+            response = await fetch(upload.url, { method: 'POST', body: form });
+        }
+        
         if (response.status === 401) {
             showStatus('Wrong password. Please refresh and login again.', 'error');
             setTimeout(() => {
@@ -175,7 +214,7 @@ async function handleUpload() {
         } else if (response.ok) {
             showStatus('Upload successful! Processing takes 10-15 minutes.' +
                 (clientInfo.includes('@') ? ' Report will be sent to your email.' : ''), 'success');
-            setTimeout(() => resetForm(), 3000);
+            setTimeout(() => { resetForm(); pollStatus(uploadKey); }, 3000);
         } else {
             throw new Error('Upload failed');
         }
@@ -188,6 +227,73 @@ async function handleUpload() {
     }
 }
 
+// Processing status of the last upload: one GET of its status object per poll (see /status)
+const STATUS_POLL_MS = 15000;
+const STATUS_POLL_MAX_MS = 45 * 60 * 1000;
+let statusTimer = null;
+
+function pollStatus(key) {
+    clearTimeout(statusTimer);
+    const started = Date.now();
+    const poll = async () => {
+        try {
+            const response = await fetch(API_URL + '/status', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ password: sessionStorage.getItem('trnda_password'), key: key })
+            });
+            if (response.ok) {
+                const status = await response.json();
+                if (status.state === 'done') { showReport(status); return; }
+                if (status.state === 'failed') { showStatus('Processing failed: ' + (status.error || 'unknown error'), 'error'); return; }
+                showStatus(describeStatus(status), 'info');
+                showPreview(status.preview);
+            }
+        } catch (error) {
+            console.error('Status check failed:', error);
+        }
+        if (Date.now() - started < STATUS_POLL_MAX_MS) statusTimer = setTimeout(poll, STATUS_POLL_MS);
+    };
+    poll();
+}
+
+function describeStatus(status) {
+    if (status.state === 'running' && status.stage) {
+        return 'Processing: step ' + status.stage_index + '/' + status.stages + ' (' + status.stage + ')...';
+    }
+    if (status.state === 'running') return 'Processing started...';
+    if (status.state === 'queued') return 'Queued for processing...';
+    return 'Uploaded, waiting for processing...';
+}
+
+function showReport(status) {
+    if (!status.pdf_url) { showStatus('Report ready: ' + status.output, 'success'); return; }
+    showStatus('Report ready: ', 'success');
+    appendLink(statusDiv, status.pdf_url, 'design.pdf');
+}
+
+// Sections published while the run is still going: preview.md and the diagrams done so far
+function showPreview(preview) {
+    if (!preview || !preview.url) return;
+    const line = document.createElement('div');
+    line.appendChild(document.createTextNode('Ready so far (' + preview.sections.join(', ') + '): '));
+    appendLink(line, preview.url, 'preview');
+    Object.entries(preview.diagrams || {}).forEach(([name, url]) => {
+        line.appendChild(document.createTextNode(' | '));
+        appendLink(line, url, name + ' diagram');
+    });
+    statusDiv.appendChild(line);
+}
+
+function appendLink(parent, href, text) {
+    const link = document.createElement('a');
+    link.href = href;
+    link.target = '_blank';
+    link.rel = 'noopener';
+    link.textContent = text;
+    parent.appendChild(link);
+}
+
 function showStatus(message, type) {
     statusDiv.textContent = message;
     statusDiv.className = 'status';
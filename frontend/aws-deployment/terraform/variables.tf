@@ -29,6 +29,12 @@ variable "upload_password" {
   # No default - must be set in terraform.tfvars
 }
 
+variable "upload_max_mb" {
+  description = "Maximum photo size accepted by the presigned S3 upload (MB)"
+  type        = number
+  default     = 10
+}
+
 variable "custom_domain" {
   description = "Custom domain for CloudFront (optional, e.g., trnda.ai.aws.thetrasklab.com)"
   type        = string
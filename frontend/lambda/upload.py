@@ -2,13 +2,64 @@ import boto3
 import base64
 import json
 import os
+import re
+import uuid
 from datetime import datetime
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-s3 = boto3.client('s3')
+# Virtual addressing gives regional presigned POST URLs (the global endpoint
+# answers browser POSTs for other regions with a redirect that breaks CORS)
+s3 = boto3.client('s3', config=Config(s3={'addressing_style': 'virtual'}))
 
 # Configuration from environment variables (set by Terraform)
 PASSWORD = os.environ.get('UPLOAD_PASSWORD')
 BUCKET = os.environ.get('BUCKET_NAME')
+# Presigned POST: the browser sends the photo straight to S3, the Lambda only signs
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', str(10 * 1024 * 1024)))
+UPLOAD_URL_EXPIRES = int(os.environ.get('UPLOAD_URL_EXPIRES', '300'))
+
+
+def presigned_upload(key, client_info, preprocessed=''):
+    """Presigned POST for one input image
+
+    The policy pins the key, the content type, the client-info and
+    trnda-preprocessed metadata and the size range, so the browser cannot
+    upload anything else with it.
+    
+    Returns:
+        Dictionary with 'url' and form 'fields' (send the file as the last field)
+    """
+    fields = {'Content-Type': 'image/jpeg'}
+    conditions = [
+        {'Content-Type': 'image/jpeg'},
+        ['content-length-range', 1, UPLOAD_MAX_BYTES]
+    ]
+    
+    if client_info:
+        client_info_ascii = client_info.encode('ascii', 'ignore').decode('ascii')[:1900]
+        fields['x-amz-meta-client-info'] = client_info_ascii
+        conditions.append({'x-amz-meta-client-info': client_info_ascii})
+    
+    # Photo exported at model size by the web app ("w=1568,h=1176,q=0.85,...")
+    preprocessed = re.sub(r'[^0-9A-Za-z=,.x]', '', str(preprocessed or ''))[:200]
+    if preprocessed:
+        fields['x-amz-meta-trnda-preprocessed'] = preprocessed
+        conditions.append({'x-amz-meta-trnda-preprocessed': preprocessed})
+    
+    return s3.generate_presigned_post(
+        Bucket=BUCKET,
+        Key=key,
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=UPLOAD_URL_EXPIRES
+    )
+
+
+def status_key(key):
+    """Status object of an input key: input/<name> -> status/<name>.json (written by the backend)"""
+    return f"status/{key[len('input/'):]}.json"
+
 
 def lambda_handler(event, context):
     # CORS headers
@@ -53,15 +104,18 @@ def lambda_handler(event, context):
         try:
             image_base64 = body.get('image', '')
             client_info = body.get('clientInfo', '')
+            timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+            # Random suffix keeps uploads in the same second apart (like run IDs)
+            key = f'input/diagram-{timestamp}-{uuid.uuid4().hex[:8]}.jpg'
             
             if not image_base64:
-                return {'statusCode': 400, 'headers': headers,
-                        'body': json.dumps({'error': 'No image'})}
+                # Presigned POST - the image goes from the browser directly to S3
+                upload = presigned_upload(key, client_info, body.get('preprocessed', ''))
+                return {'statusCode': 200, 'headers': headers,
+                        'body': json.dumps({'success': True, 'key': key, 'upload': upload})}
             
-            # Decode and upload
+            # Legacy clients (old cached app.js) still send the image as base64
             image_data = base64.b64decode(image_base64)
-            timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-            key = f'input/diagram-{timestamp}.jpg'
             
             params = {
                 'Bucket': BUCKET,
@@ -84,5 +138,39 @@ def lambda_handler(event, context):
             return {'statusCode': 500, 'headers': headers,
                     'body': json.dumps({'error': str(e)})}
     
+    # Handle /status endpoint - one GET of the input's status object
+    if path.endswith('/status'):
+        if password != PASSWORD:
+            return {'statusCode': 401, 'headers': headers,
+                    'body': json.dumps({'error': 'Wrong password'})}
+        
+        key = body.get('key', '')
+        if not isinstance(key, str) or not key.startswith('input/') or '..' in key:
+            return {'statusCode': 400, 'headers': headers,
+                    'body': json.dumps({'error': 'Invalid key'})}
+        
+        try:
+            response = s3.get_object(Bucket=BUCKET, Key=status_key(key))
+            status = json.loads(response['Body'].read())
+            if status.get('state') == 'duplicate' and str(status.get('status', '')).startswith('status/'):
+                # Identical re-upload, dropped by the trigger - report the original job (one more GET)
+                try:
+                    response = s3.get_object(Bucket=BUCKET, Key=status['status'])
+                    status = dict(json.loads(response['Body'].read()), duplicate_of=status['duplicate_of'],
+                                  input=status['input'])
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                        raise
+                    status = dict(status, state='queued')
+            return {'statusCode': 200, 'headers': headers, 'body': json.dumps(status)}
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                # Uploaded, not picked up by the trigger yet
+                return {'statusCode': 200, 'headers': headers,
+                        'body': json.dumps({'input': f's3://{BUCKET}/{key}', 'state': 'pending'})}
+            print(f'Error: {str(e)}')
+            return {'statusCode': 500, 'headers': headers,
+                    'body': json.dumps({'error': str(e)})}
+    
     return {'statusCode': 404, 'headers': headers, 
             'body': json.dumps({'error': 'Not found'})}
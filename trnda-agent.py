@@ -12,9 +12,13 @@ import subprocess
 import time
 import tempfile
 import shutil
+import threading
+import uuid
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
 from strands import Agent
-from strands.models import BedrockModel
+from strands.models import BedrockModel, Model
+from strands.hooks import HookProvider, HookRegistry, BeforeToolCallEvent, AfterToolCallEvent
 from strands.agent.conversation_manager import SlidingWindowConversationManager
 from strands_tools import image_reader
 from strands.tools import tool
@@ -25,1181 +29,5808 @@ from strands.tools.mcp import MCPClient
 # S3 Configuration
 # Can be overridden via S3_BUCKET environment variable
 DEFAULT_REGION = "eu-central-1"
-
+DEFAULT_BUCKET = os.environ.get('S3_BUCKET', 'tr-sw-trnda-diagrams')
+
+# Bedrock models - Claude 4.5 Sonnet (1M context window) for design reasoning,
+# Claude 4.5 Haiku for transcription and tool orchestration.
+# Override via TRNDA_MODEL_ID / TRNDA_FAST_MODEL_ID (same ID for both = no routing).
+DEFAULT_MODEL_ID = "eu.anthropic.claude-sonnet-4-5-20250929-v1:0"
+FAST_MODEL_ID = "eu.anthropic.claude-haiku-4-5-20251001-v1:0"
+
+# Bedrock on-demand prices (USD per 1M tokens, eu-central-1)
+MODEL_CATALOG = {
+    "anthropic.claude-sonnet-4-5-20250929-v1:0": {
+        'name': 'Claude 4.5 Sonnet', 'input_price': 3.0, 'output_price': 15.0, 'context_1m': True
+    },
+    "anthropic.claude-haiku-4-5-20251001-v1:0": {
+        'name': 'Claude 4.5 Haiku', 'input_price': 1.0, 'output_price': 5.0, 'context_1m': False
+    },
+}
+
+# Process-wide strands settings (identical for every run)
 os.environ['BYPASS_TOOL_CONSENT'] = 'true'
 os.environ["STRANDS_TOOL_CONSOLE_MODE"] = "enabled"
 # AWS_PROFILE should be set by caller (CLI or environment)
 
-# MCP Servers
-aws_knowledge_mcp = MCPClient(
-    lambda: streamablehttp_client("https://knowledge-mcp.global.api.aws")
-)
-
-aws_diagram_mcp = MCPClient(
-    lambda: stdio_client(
-        StdioServerParameters(
-            command="uvx",
-            args=["awslabs.aws-diagram-mcp-server"],
-            env={
-                "FASTMCP_LOG_LEVEL": "ERROR",
-                "AWS_PROFILE": os.environ.get('AWS_PROFILE', 'default')
-            }
-        )
-    )
-)
-
-aws_pricing_mcp = MCPClient(
-    lambda: stdio_client(
-        StdioServerParameters(
-            command="uvx",
-            args=["awslabs.aws-pricing-mcp-server@latest"],
-            env={
-                "AWS_REGION": "eu-central-1",
-                "AWS_PROFILE": os.environ.get('AWS_PROFILE', 'default')
-            }
-        )
-    )
-)
-
-# Bedrock Model with 1M context window
-bedrock_model = BedrockModel(
-    model_id="eu.anthropic.claude-sonnet-4-5-20250929-v1:0",
-    region_name="eu-central-1",
-    additional_request_fields={
-        "anthropic_beta": ["context-1m-2025-08-07"]
-    }
-)
-
 
-def get_s3_client(profile=None, region=None):
-    """Get S3 client with proper credentials
+def create_mcp_clients(aws_profile: str = None, region: str = None, workspace_dir: str = None) -> dict:
+    """Create a fresh set of MCP clients for one run.
     
-    On EC2 with IAM role: uses instance profile automatically
-    Locally: uses AWS_PROFILE environment variable or default profile
+    Each run gets its own clients (and therefore its own MCP server
+    subprocesses), so concurrent runs never share an MCP session.
+    
+    Args:
+        aws_profile: AWS profile passed to the MCP servers (default: 'default')
+        region: AWS region for the pricing server (default: DEFAULT_REGION)
+        workspace_dir: Optional per-run working directory and TMPDIR of the local servers
+        
+    Returns:
+        Dictionary of server name -> MCPClient
     """
-    import boto3
+    profile = aws_profile or 'default'
     region = region or DEFAULT_REGION
+    # Keep server scratch files (temp files, caches) inside the run's workspace
+    scratch_env = {'TMPDIR': workspace_dir, 'AWS_API_MCP_WORKING_DIR': workspace_dir} if workspace_dir else {}
     
-    # Get profile from parameter or environment
-    profile = profile or os.environ.get('AWS_PROFILE')
+    return {
+        'aws_knowledge': MCPClient(
+            lambda: streamablehttp_client("https://knowledge-mcp.global.api.aws")
+        ),
+        'aws_diagram': MCPClient(
+            lambda: stdio_client(
+                StdioServerParameters(
+                    command="uvx",
+                    args=["awslabs.aws-diagram-mcp-server"],
+                    env={
+                        "FASTMCP_LOG_LEVEL": "ERROR",
+                        "AWS_PROFILE": profile,
+                        **scratch_env
+                    },
+                    cwd=workspace_dir
+                )
+            )
+        ),
+        'aws_pricing': MCPClient(
+            lambda: stdio_client(
+                StdioServerParameters(
+                    command="uvx",
+                    args=["awslabs.aws-pricing-mcp-server@latest"],
+                    env={
+                        "AWS_REGION": region,
+                        "AWS_PROFILE": profile,
+                        **scratch_env
+                    },
+                    cwd=workspace_dir
+                )
+            )
+        ),
+    }
+
+
+def get_model_info(model_id: str) -> dict:
+    """Catalog entry (name, prices) for a model ID or inference profile.
     
-    # If profile is specified, use it; otherwise boto3 will use IAM role on EC2 or default credentials
-    if profile:
-        session = boto3.Session(profile_name=profile)
-    else:
-        session = boto3.Session()
+    Regional inference profile prefixes (eu., us., global., ...) are ignored.
+    Unknown models are priced like DEFAULT_MODEL_ID.
     
-    return session.client('s3', region_name=region)
+    Args:
+        model_id: Bedrock model ID or inference profile
+        
+    Returns:
+        Dictionary with name, input_price, output_price (USD per 1M tokens), context_1m, known
+    """
+    model_id = model_id or ''
+    for catalog_id, info in MODEL_CATALOG.items():
+        if model_id == catalog_id or model_id.endswith(f".{catalog_id}"):
+            return dict(info, known=True)
+    default = get_model_info(DEFAULT_MODEL_ID) if model_id != DEFAULT_MODEL_ID else {}
+    return dict(default, name=model_id or 'unknown', context_1m=False, known=False)
 
 
-def get_ses_client(profile=None, region=None):
-    """Get SES client with proper credentials
+def create_bedrock_model(model_id: str = DEFAULT_MODEL_ID, region: str = None, aws_profile: str = None) -> BedrockModel:
+    """Create a Bedrock model for one run (1M context window where the model supports it).
     
-    On EC2 with IAM role: uses instance profile automatically
-    Locally: uses AWS_PROFILE environment variable or default profile
+    Args:
+        model_id: Bedrock model ID or inference profile
+        region: AWS region (default: DEFAULT_REGION)
+        aws_profile: Optional AWS profile (default: IAM role / default credentials)
+        
+    Returns:
+        BedrockModel instance
     """
     import boto3
-    region = region or DEFAULT_REGION
-    
-    # Get profile from parameter or environment
-    profile = profile or os.environ.get('AWS_PROFILE')
-    
-    # If profile is specified, use it; otherwise boto3 will use IAM role on EC2 or default credentials
-    if profile:
-        session = boto3.Session(profile_name=profile)
-    else:
-        session = boto3.Session()
+    session = boto3.Session(profile_name=aws_profile, region_name=region or DEFAULT_REGION)
     
-    return session.client('ses', region_name=region)
+    if get_model_info(model_id)['context_1m']:
+        return BedrockModel(
+            model_id=model_id,
+            boto_session=session,
+            additional_request_fields={
+                "anthropic_beta": ["context-1m-2025-08-07"]
+            }
+        )
+    return BedrockModel(model_id=model_id, boto_session=session)
 
 
-def is_email(text: str) -> bool:
-    """Check if text is an email address"""
-    import re
-    if not text:
-        return False
-    # Simple email regex
-    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(email_pattern, text.strip()))
+def new_run_id() -> str:
+    """Generate a unique run ID: timestamp plus random suffix.
+    
+    The timestamp keeps run IDs sortable, the suffix keeps two runs started
+    in the same second apart.
+    """
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
 
 
-def extract_email_from_text(text: str) -> str:
-    """Extract email address from longer text
+class RunTrace:
+    """Span recorder for one run: stages, model turns, tool calls, pandoc, S3, SES.
     
-    Args:
-        text: Text that may contain email address
-        
-    Returns:
-        Extracted email or None if not found
+    Spans are kept in memory (thread-safe) and written to trace.json in the
+    output directory. Start times are seconds since the trace was created.
     """
-    import re
-    if not text:
-        return None
     
-    # Find email pattern in text
-    email_pattern = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
-    match = re.search(email_pattern, text)
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self.started = time.time()
+        self.stage = None
+        self.spans = []
+        # Per-endpoint model stats (FailoverModel)
+        self.endpoints = {}
+        self._lock = threading.Lock()
     
-    if match:
-        return match.group(0)
-    return None
-
-
-def send_report_email(pdf_path: str, recipient_email: str) -> bool:
-    """Send report PDF via email using AWS SES
+    def add_span(self, name: str, kind: str, start: float, duration: float, **attrs) -> dict:
+        """Record a finished span
+        
+        Args:
+            name: Span name (stage name, tool name, ...)
+            kind: Span kind ('preprocess', 'stage', 'model', 'tool', 'pandoc', 's3', 'ses', ...)
+            start: Start time (time.time())
+            duration: Duration in seconds
+            **attrs: Extra attributes (tokens, sizes, ...); current stage is added automatically
+            
+        Returns:
+            The recorded span
+        """
+        attrs.setdefault('stage', self.stage)
+        span = {
+            'name': name,
+            'kind': kind,
+            'start': round(start - self.started, 3),
+            'duration': round(duration, 3),
+            'attrs': {k: v for k, v in attrs.items() if v is not None},
+        }
+        with self._lock:
+            self.spans.append(span)
+        return span
     
-    Args:
-        pdf_path: Path to PDF file
-        recipient_email: Recipient email address (from --client)
+    def restart(self, started: float) -> None:
+        """Move the start of the trace (recorded spans keep their absolute times)
         
-    Returns:
-        True if sent successfully, False otherwise
+        Used when a prepared job waited for another run (pipelined batches):
+        the job clock, deadline and queue wait count from the new start.
+        """
+        with self._lock:
+            shift = self.started - started
+            for span in self.spans:
+                span['start'] = round(span['start'] + shift, 3)
+            self.started = started
+    
+    @contextmanager
+    def span(self, name: str, kind: str, **attrs):
+        """Context manager recording a span; yields attrs dict that can be extended"""
+        start = time.time()
+        try:
+            yield attrs
+        except Exception as e:
+            attrs['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.add_span(name, kind, start, time.time() - start, **attrs)
+    
+    def slowest(self, n: int = 10, exclude_kinds: tuple = ('stage',)) -> list:
+        """Slowest N spans (stages are excluded by default - they contain the other spans)"""
+        with self._lock:
+            spans = [s for s in self.spans if s['kind'] not in exclude_kinds]
+        return sorted(spans, key=lambda s: s['duration'], reverse=True)[:n]
+    
+    def totals_by_kind(self) -> dict:
+        """Total duration and span count per kind"""
+        totals = {}
+        with self._lock:
+            for s in self.spans:
+                total = totals.setdefault(s['kind'], {'count': 0, 'seconds': 0.0})
+                total['count'] += 1
+                total['seconds'] = round(total['seconds'] + s['duration'], 3)
+        return totals
+    
+    def save(self, output_dir: str) -> str:
+        """Write trace.json to output directory
+        
+        Returns:
+            Path to trace.json
+        """
+        import json
+        trace_path = os.path.join(output_dir, 'trace.json')
+        with self._lock:
+            data = {
+                'run_id': self.run_id,
+                'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'duration': round(time.time() - self.started, 3),
+                'totals': None,
+                'spans': sorted(self.spans, key=lambda s: s['start']),
+            }
+        data['totals'] = self.totals_by_kind()
+        if self.endpoints:
+            data['endpoints'] = {name: dict(stats, health=get_endpoint_health(name).snapshot())
+                                 for name, stats in self.endpoints.items()}
+        with open(trace_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, default=str)
+        return trace_path
+
+
+def describe_span(span: dict) -> str:
+    """Short human-readable detail of a span for cost.md"""
+    attrs = span['attrs']
+    if span['kind'] == 'model':
+        return f"in {attrs.get('input_tokens', 0):,} / out {attrs.get('output_tokens', 0):,} tokens"
+    if span['kind'] == 'tool':
+        return f"{attrs.get('server', '?')}, {attrs.get('result_bytes', 0):,} B result"
+    if 'bytes' in attrs:
+        return f"{attrs['bytes']:,} B"
+    return ''
+
+
+# Profiling (--profile / TRNDA_PROFILE=1): sampling interval, frames kept per allocation
+# and rows of the reports
+DEFAULT_PROFILE_INTERVAL_MS = 20
+PROFILE_TRACEMALLOC_FRAMES = 10
+PROFILE_TOP_N = 30
+PROFILE_FILES = ('profile.txt', 'profile.folded', 'profile-wall.folded', 'allocations.txt')
+
+# tracemalloc is process-wide: started by the first profiled run, stopped after the last one
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+_tracemalloc_lock = threading.Lock()
+
+
+def _tracemalloc_acquire() -> None:
+    """Start tracemalloc for a profiled run unless it is already tracing"""
+    global _tracemalloc_users, _tracemalloc_owned
+    import tracemalloc
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            _tracemalloc_owned = True
+        _tracemalloc_users += 1
+
+
+def _tracemalloc_release() -> None:
+    """Stop tracemalloc when the last profiled run ends (only if a profiled run started it)"""
+    global _tracemalloc_users, _tracemalloc_owned
+    import tracemalloc
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+
+
+class RunProfiler:
+    """Sampling profiler and memory tracer for the Python side of one run
+    
+    A daemon thread samples the stacks of all other threads every interval
+    (sys._current_frames). Each sample is weighted with the CPU time the
+    thread used since the previous sample (per-thread CPU clocks), so
+    threads waiting on Bedrock, MCP servers or S3 cost nothing in the CPU
+    profile; a second profile counts wall-clock samples. tracemalloc records
+    allocations in the meantime; it is process-wide, so with concurrent runs
+    the memory peak and allocation sites include the other runs. MCP servers
+    and pandoc are subprocesses and are not sampled.
+    
+    Output (write): profile.txt (top functions), profile.folded (CPU, in
+    microseconds) and profile-wall.folded (samples) in the folded-stack
+    format of flamegraph.pl / speedscope, and allocations.txt (tracemalloc top N).
     """
-    from email.mime.multipart import MIMEMultipart
-    from email.mime.text import MIMEText
-    from email.mime.application import MIMEApplication
-    from datetime import datetime
     
-    SENDER = "trnda@ai.aws.thetrasklab.com"
-    BCC_EMAIL = "mirdvorak@trask.cz"
+    def __init__(self, interval_ms: float = None, top_n: int = PROFILE_TOP_N):
+        """
+        Args:
+            interval_ms: Sampling interval (default: TRNDA_PROFILE_INTERVAL_MS env, then DEFAULT_PROFILE_INTERVAL_MS)
+            top_n: Rows in profile.txt and allocations.txt
+        """
+        self.interval = float(interval_ms or os.environ.get('TRNDA_PROFILE_INTERVAL_MS',
+                                                            DEFAULT_PROFILE_INTERVAL_MS)) / 1000.0
+        self.top_n = top_n
+        self.cpu_stacks = {}
+        self.wall_stacks = {}
+        self.thread_cpu = {}
+        self.samples = 0
+        self.sampling_seconds = 0.0
+        self.started = None
+        self.stopped = None
+        self._last_cpu = {}
+        self.memory_current = 0
+        self.memory_peak = 0
+        self._start_snapshot = None
+        self._snapshot = None
+        self._stop_event = threading.Event()
+        self._thread = None
     
-    try:
-        # Read PDF file
-        with open(pdf_path, 'rb') as f:
-            pdf_data = f.read()
+    def start(self) -> 'RunProfiler':
+        import tracemalloc
         
-        # Create message
-        msg = MIMEMultipart()
-        msg['Subject'] = 'TRNDA Report - AWS Architecture Design'
-        msg['From'] = f'TRNDA Report <{SENDER}>'
-        msg['To'] = recipient_email
-        msg['Bcc'] = BCC_EMAIL
+        _tracemalloc_acquire()
+        self._start_snapshot = tracemalloc.take_snapshot()
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, name='trnda-profiler', daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self) -> None:
+        import tracemalloc
         
-        # Email body
-        body_text = f"""Hello,
-
-Your AWS architecture report is ready and attached to this email.
-
-Generated: {datetime.now().strftime("%d.%m.%Y %H:%M")}
-
----
-Generated by TRNDA (Trask Ručně Nakreslí, Dokončí AWS)
-Trask Solutions a.s.
-"""
+        if self.stopped:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self.stopped = time.time()
+        self._snapshot = tracemalloc.take_snapshot()
+        self.memory_current, self.memory_peak = tracemalloc.get_traced_memory()
+        _tracemalloc_release()
+    
+    @staticmethod
+    def _thread_cpu_seconds(thread_id: int) -> float:
+        """CPU time of a thread (None where per-thread CPU clocks are not available)"""
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+        except (AttributeError, OSError):
+            return None
+    
+    @staticmethod
+    def _stack(frame) -> list:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+    
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            sample_start = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                name = names.get(thread_id, f"thread-{thread_id}")
+                folded = ';'.join([name] + self._stack(frame))
+                self.wall_stacks[folded] = self.wall_stacks.get(folded, 0) + 1
+                
+                cpu = self._thread_cpu_seconds(thread_id)
+                last = self._last_cpu.get(thread_id)
+                self._last_cpu[thread_id] = cpu
+                if cpu is None or last is None or cpu <= last:
+                    continue
+                micros = int((cpu - last) * 1e6)
+                self.cpu_stacks[folded] = self.cpu_stacks.get(folded, 0) + micros
+                self.thread_cpu[name] = self.thread_cpu.get(name, 0) + micros
+            self.samples += 1
+            self.sampling_seconds += time.perf_counter() - sample_start
+    
+    def _top_functions(self, stacks: dict) -> tuple:
+        """Self and inclusive weight per function"""
+        own, inclusive = {}, {}
+        for folded, weight in stacks.items():
+            frames = folded.split(';')[1:]
+            if not frames:
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + weight
+            for function in set(frames):
+                inclusive[function] = inclusive.get(function, 0) + weight
         
-        # Attach body
-        body = MIMEText(body_text, 'plain', 'utf-8')
-        msg.attach(body)
+        def top(totals):
+            return sorted(totals.items(), key=lambda item: -item[1])[:self.top_n]
         
-        # Attach PDF
-        pdf_attachment = MIMEApplication(pdf_data, _subtype='pdf')
-        pdf_attachment.add_header('Content-Disposition', 'attachment', filename='trnda-report.pdf')
-        msg.attach(pdf_attachment)
+        return top(own), top(inclusive)
+    
+    def summary(self) -> dict:
+        """Profile totals for the trace and the log"""
+        duration = (self.stopped or time.time()) - self.started
+        return {
+            'seconds': round(duration, 2),
+            'samples': self.samples,
+            'cpu_seconds': round(sum(self.cpu_stacks.values()) / 1e6, 2),
+            'overhead_percent': round(100.0 * self.sampling_seconds / duration, 1) if duration else 0.0,
+            'memory_peak_mb': round(self.memory_peak / 1024 / 1024, 1),
+        }
+    
+    def write(self, output_dir: str) -> list:
+        """Write the profile files into output_dir
         
-        # Send email
-        ses = get_ses_client()
+        Returns:
+            Paths of the written files
+        """
+        summary = self.summary()
+        lines = [
+            f"TRNDA run profile: {summary['seconds']:.1f}s, {self.samples} samples every "
+            f"{self.interval * 1000:.0f} ms, sampler overhead {summary['overhead_percent']:.1f}%",
+            f"Python CPU time: {summary['cpu_seconds']:.2f}s (MCP servers and pandoc are subprocesses, not sampled)",
+            "",
+            "CPU seconds by thread:",
+        ]
+        lines += [f"  {micros / 1e6:>9.3f}  {name}"
+                  for name, micros in sorted(self.thread_cpu.items(), key=lambda item: -item[1])]
+        for title, stacks, scale, digits in (("CPU seconds", self.cpu_stacks, 1e6, 3),
+                                             ("wall-clock samples", self.wall_stacks, 1, 0)):
+            own, inclusive = self._top_functions(stacks)
+            for kind, rows in (("self", own), ("total (incl. callees)", inclusive)):
+                lines += ["", f"Top {len(rows)} functions by {kind} {title}:"]
+                lines += [f"  {weight / scale:>12.{digits}f}  {function}" for function, weight in rows]
         
-        print(f"[SES] Sending email to {recipient_email} (BCC: {BCC_EMAIL})")
+        paths = []
         
-        response = ses.send_raw_email(
-            Source=SENDER,
-            Destinations=[recipient_email, BCC_EMAIL],
-            RawMessage={'Data': msg.as_string()}
-        )
+        def write_file(name, content):
+            path = os.path.join(output_dir, name)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            paths.append(path)
         
-        print(f"[OK] Email sent successfully (MessageId: {response['MessageId']})")
-        return True
+        write_file('profile.txt', "\n".join(lines) + "\n")
+        write_file('profile.folded', "".join(f"{folded} {weight}\n" for folded, weight in self.cpu_stacks.items()))
+        write_file('profile-wall.folded', "".join(f"{folded} {count}\n" for folded, count in self.wall_stacks.items()))
         
-    except Exception as e:
-        print(f"[WARNING] Failed to send email: {e}")
-        print(f"         Email notification skipped, but report was generated successfully")
-        return False
-
-
-def is_s3_path(path: str) -> bool:
-    """Check if path is an S3 path"""
-    return path.startswith('s3://')
+        allocations = [
+            f"tracemalloc (process-wide, includes concurrent runs): {summary['memory_peak_mb']:.1f} MB peak, "
+            f"{self.memory_current / 1024 / 1024:.1f} MB still allocated at the end of the run",
+            "", f"Top {self.top_n} allocation sites still alive at the end of the run (growth since start):",
+        ]
+        allocations += [f"  {str(stat)}" for stat in
+                        self._snapshot.compare_to(self._start_snapshot, 'lineno')[:self.top_n]]
+        allocations += ["", f"Top {self.top_n} allocation tracebacks:"]
+        for stat in self._snapshot.statistics('traceback')[:self.top_n]:
+            allocations.append(f"  {stat.size / 1024:.1f} KiB in {stat.count} blocks")
+            allocations += [f"    {line}" for line in stat.traceback.format()]
+        write_file('allocations.txt', "\n".join(allocations) + "\n")
+        return paths
+
+
+# Run workspaces: per-run scratch directory (optionally on tmpfs); outputs published
+# to S3 are archived (under a disk quota) or removed afterwards
+DEFAULT_SCRATCH_ROOT = os.path.join(tempfile.gettempdir(), 'trnda')
+TMPFS_SCRATCH_ROOT = '/dev/shm/trnda'
+TMPFS_MIN_FREE_MB = 256
+DEFAULT_ARCHIVE_DIR = os.path.join(os.path.expanduser('~'), '.trnda', 'archive')
+DEFAULT_ARCHIVE_QUOTA_MB = 1024
+PUBLISHED_OUTPUT_POLICIES = ('archive', 'remove', 'keep')
+
+
+def disk_usage(path: str) -> int:
+    """Total size in bytes of the files under path (0 if it does not exist)"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
 
 
-def parse_s3_path(s3_path: str) -> tuple:
-    """Parse S3 path into bucket and key
+class RunWorkspace:
+    """Isolated scratch directory of one run: <root>/<run_id>/
     
-    Args:
-        s3_path: S3 path in format s3://bucket/key
-        
-    Returns:
-        Tuple of (bucket, key)
+    scratch/ holds intermediate files (downloaded input, compressed image) and
+    is the working directory and TMPDIR of the run's MCP servers. Output
+    directories of S3 runs are created next to it, so after publishing they
+    can be archived or removed with the rest of the workspace.
+    
+    Scratch I/O is timed (io()) and disk usage is measured (measure()) for
+    the trace and the run ledger.
     """
-    if not s3_path.startswith('s3://'):
-        raise ValueError(f"Invalid S3 path: {s3_path}")
     
-    path = s3_path[5:]  # Remove 's3://'
-    parts = path.split('/', 1)
+    def __init__(self, run_id: str, root: str = None, tmpfs: bool = None, published_output: str = None,
+                 archive_dir: str = None, archive_quota_mb: float = None):
+        """
+        Args:
+            run_id: Run ID (workspace directory name)
+            root: Parent of all workspaces (default: TRNDA_SCRATCH_DIR env, then tmpfs or system temp dir)
+            tmpfs: Put the workspace on tmpfs (/dev/shm) if it has room (default: TRNDA_SCRATCH_TMPFS env)
+            published_output: 'archive', 'remove' or 'keep' output directories after publishing
+                              (default: TRNDA_PUBLISHED_OUTPUT env, then 'archive')
+            archive_dir: Archive of published outputs (default: TRNDA_ARCHIVE_DIR env, then ~/.trnda/archive)
+            archive_quota_mb: Archive disk quota, oldest runs are pruned first
+                              (default: TRNDA_ARCHIVE_QUOTA_MB env, then 1024)
+        """
+        if tmpfs is None:
+            tmpfs = os.environ.get('TRNDA_SCRATCH_TMPFS', '').lower() in ('1', 'true', 'yes')
+        root = root or os.environ.get('TRNDA_SCRATCH_DIR')
+        self.tmpfs = False
+        if not root and tmpfs:
+            if self._tmpfs_has_room():
+                root, self.tmpfs = TMPFS_SCRATCH_ROOT, True
+            else:
+                print(f"[WARNING] tmpfs scratch requested but /dev/shm has less than {TMPFS_MIN_FREE_MB} MB free "
+                      f"- using disk")
+        self.root = root or DEFAULT_SCRATCH_ROOT
+        self.path = os.path.join(self.root, run_id)
+        self.published_output = published_output or os.environ.get('TRNDA_PUBLISHED_OUTPUT') or 'archive'
+        if self.published_output not in PUBLISHED_OUTPUT_POLICIES:
+            raise ValueError(f"TRNDA_PUBLISHED_OUTPUT must be one of {', '.join(PUBLISHED_OUTPUT_POLICIES)}")
+        self.archive_dir = archive_dir or os.environ.get('TRNDA_ARCHIVE_DIR') or DEFAULT_ARCHIVE_DIR
+        self.archive_quota_mb = float(archive_quota_mb if archive_quota_mb is not None
+                                      else os.environ.get('TRNDA_ARCHIVE_QUOTA_MB', DEFAULT_ARCHIVE_QUOTA_MB))
+        self.io_seconds = 0.0
+        self.peak_bytes = 0
+        self._lock = threading.Lock()
     
-    if len(parts) == 1:
-        return parts[0], ''
-    return parts[0], parts[1]
-
-
-def download_from_s3(s3_path: str, local_path: str) -> str:
-    """Download file from S3
+    @staticmethod
+    def _tmpfs_has_room() -> bool:
+        try:
+            stat = os.statvfs(os.path.dirname(TMPFS_SCRATCH_ROOT))
+        except (OSError, AttributeError):
+            return False
+        return stat.f_bavail * stat.f_frsize >= TMPFS_MIN_FREE_MB * 1024 * 1024
     
-    Args:
-        s3_path: S3 path (s3://bucket/key)
-        local_path: Local path to save file
-        
-    Returns:
-        Path to downloaded file
-    """
-    bucket, key = parse_s3_path(s3_path)
+    @property
+    def scratch(self) -> str:
+        """Scratch directory for intermediate files (created on first use)"""
+        path = os.path.join(self.path, 'scratch')
+        os.makedirs(path, exist_ok=True)
+        return path
     
-    # Add input/ prefix if not present and key doesn't start with it
-    if key and not key.startswith('input/') and not key.startswith('output/'):
-        key = f"input/{key}"
+    @property
+    def mcp_dir(self) -> str:
+        """Working directory of the run's MCP servers (created on first use)"""
+        path = os.path.join(self.scratch, 'mcp')
+        os.makedirs(path, exist_ok=True)
+        return path
     
-    print(f"[S3] Downloading s3://{bucket}/{key}")
+    def create(self) -> str:
+        """Create the workspace directory
+        
+        Returns:
+            Workspace path
+        """
+        os.makedirs(self.path, exist_ok=True)
+        return self.path
     
-    try:
-        s3 = get_s3_client()
-        os.makedirs(os.path.dirname(local_path) if os.path.dirname(local_path) else '.', exist_ok=True)
-        s3.download_file(bucket, key, local_path)
-        print(f"[OK] Downloaded to {local_path}")
-        return local_path
-    except Exception as e:
-        print(f"[ERROR] Failed to download from S3: {e}")
-        raise
-
-
-def upload_directory_to_s3(local_dir: str, s3_bucket: str, s3_prefix: str) -> list:
-    """Upload entire directory to S3
+    def contains(self, path: str) -> bool:
+        """True if path lies inside this workspace"""
+        return os.path.abspath(path).startswith(os.path.abspath(self.path) + os.sep)
     
-    Args:
-        local_dir: Local directory path
-        s3_bucket: S3 bucket name
-        s3_prefix: S3 prefix (folder)
+    @contextmanager
+    def io(self, name: str, trace: 'RunTrace' = None, **attrs):
+        """Time a scratch I/O operation (adds to io_seconds, recorded as 'scratch' span)"""
+        start = time.time()
+        try:
+            yield attrs
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                self.io_seconds += duration
+            if trace:
+                trace.add_span(name, 'scratch', start, duration, **attrs)
+    
+    def measure(self, *paths: str) -> int:
+        """Disk usage of the workspace (and extra paths outside it, e.g. the output directory)
         
-    Returns:
-        List of uploaded S3 keys
-    """
-    s3 = get_s3_client()
+        Returns:
+            Bytes in use (peak_bytes keeps the largest measurement)
+        """
+        used = disk_usage(self.path) + sum(disk_usage(p) for p in paths if p and not self.contains(p))
+        self.peak_bytes = max(self.peak_bytes, used)
+        return used
     
-    print(f"[S3] Uploading results to s3://{s3_bucket}/{s3_prefix}/")
+    def report(self) -> dict:
+        """Scratch I/O time and disk usage for the trace and the run ledger"""
+        return {
+            'tmpfs': self.tmpfs,
+            'io_seconds': round(self.io_seconds, 3),
+            'peak_bytes': self.peak_bytes,
+        }
     
-    uploaded_files = []
+    def finalize(self, output_dir: str = None, published: bool = False) -> None:
+        """Clean up after the run: remove scratch files; archive or remove a published output directory
+        
+        Output directories outside the workspace (explicit base_dir, local runs) are never touched.
+        Unpublished outputs stay in place, so an interrupted run can be resumed.
+        
+        Args:
+            output_dir: Run output directory
+            published: True once the output directory has been uploaded
+        """
+        shutil.rmtree(os.path.join(self.path, 'scratch'), ignore_errors=True)
+        
+        if not (published and output_dir and self.contains(output_dir) and os.path.isdir(output_dir)):
+            if os.path.isdir(self.path) and not os.listdir(self.path):
+                os.rmdir(self.path)
+            return
+        
+        if self.published_output == 'archive':
+            os.makedirs(self.archive_dir, exist_ok=True)
+            target = os.path.join(self.archive_dir, os.path.basename(os.path.normpath(output_dir)))
+            shutil.rmtree(target, ignore_errors=True)
+            shutil.move(output_dir, target)
+            print(f"[OK] Output archived to {target}")
+            self.prune_archive()
+        elif self.published_output == 'remove':
+            shutil.rmtree(output_dir, ignore_errors=True)
+            print(f"[OK] Removed local output {output_dir} (published)")
+        else:
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
     
-    for root, dirs, files in os.walk(local_dir):
-        for file in files:
-            local_file = os.path.join(root, file)
-            relative_path = os.path.relpath(local_file, local_dir)
-            s3_key = f"{s3_prefix}/{relative_path}".replace('\\', '/')
-            
-            try:
-                s3.upload_file(local_file, s3_bucket, s3_key)
-                print(f"[OK] Uploaded s3://{s3_bucket}/{s3_key}")
-                uploaded_files.append(s3_key)
-            except Exception as e:
-                print(f"[ERROR] Failed to upload {s3_key}: {e}")
+    def prune_archive(self) -> list:
+        """Remove the oldest archived outputs until the archive fits its quota
+        
+        Returns:
+            Removed directories
+        """
+        if not os.path.isdir(self.archive_dir):
+            return []
+        runs = [os.path.join(self.archive_dir, name) for name in os.listdir(self.archive_dir)]
+        # output_<run_id> names sort by start time
+        runs = sorted(p for p in runs if os.path.isdir(p))
+        sizes = {p: disk_usage(p) for p in runs}
+        total = sum(sizes.values())
+        quota = self.archive_quota_mb * 1024 * 1024
+        removed = []
+        # The newest run is always kept, even if it alone exceeds the quota
+        for path in runs[:-1]:
+            if total <= quota:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= sizes[path]
+            removed.append(path)
+        if removed:
+            print(f"[INFO] Archive over {self.archive_quota_mb:g} MB quota - pruned {len(removed)} oldest run(s)")
+        return removed
+
+
+# Deadlines (seconds, 0 disables): a workflow stage running longer than TRNDA_STAGE_TIMEOUT
+# or a job past TRNDA_JOB_TIMEOUT is cancelled - in-flight model call and MCP tool calls,
+# then the MCP server process groups. The job default stays below the SSM command's
+# 3600 s executionTimeout; Fargate tasks have no limit of their own.
+DEFAULT_STAGE_TIMEOUT = 900
+DEFAULT_JOB_TIMEOUT = 3000
+# pandoc + LaTeX (TRNDA_PANDOC_TIMEOUT); the whole process group is killed when exceeded
+DEFAULT_PANDOC_TIMEOUT = 180
+# How long a cancelled agent turn may take to unwind before it is abandoned
+CANCEL_GRACE_SECONDS = 30
+# How often a waiting model stream checks the cancel signal
+CANCEL_POLL_SECONDS = 0.5
+# Exit code of CLI and ECS handler after a deadline (like timeout(1))
+DEADLINE_EXIT_CODE = 124
+
+
+class DeadlineExceeded(Exception):
+    """A workflow stage or the whole job ran past its deadline (not retried)"""
     
-    return uploaded_files
+    def __init__(self, message: str, stage: str = None, scope: str = 'stage'):
+        super().__init__(message)
+        self.stage = stage
+        self.scope = scope
 
 
-def get_image_dimensions(image_path: str) -> tuple:
-    """Get image dimensions and aspect ratio.
+class DeadlineConfig:
+    """Deadlines of a run (seconds, 0 disables)"""
     
-    Args:
-        image_path: Path to the image
-        
-    Returns:
-        Tuple of (width, height, aspect_ratio, is_portrait)
-    """
-    try:
-        from PIL import Image
-        img = Image.open(image_path)
-        width, height = img.size
-        aspect_ratio = width / height
-        is_portrait = height > width
-        
-        print(f"[INFO] Image dimensions: {width}x{height}, aspect_ratio={aspect_ratio:.2f}, {'PORTRAIT' if is_portrait else 'LANDSCAPE'}")
-        
-        return width, height, aspect_ratio, is_portrait
-    except Exception as e:
-        print(f"[WARNING] Could not get image dimensions: {e}")
-        return None, None, 1.0, False
+    def __init__(self, stage_timeout: float = None, job_timeout: float = None):
+        """
+        Args:
+            stage_timeout: Seconds per workflow stage (default: TRNDA_STAGE_TIMEOUT env, then
+                           DEFAULT_STAGE_TIMEOUT)
+            job_timeout: Seconds for the whole job, counted from the start of the run trace
+                         (default: TRNDA_JOB_TIMEOUT env, then DEFAULT_JOB_TIMEOUT)
+        """
+        self.stage_timeout = float(stage_timeout if stage_timeout is not None
+                                   else os.environ.get('TRNDA_STAGE_TIMEOUT', DEFAULT_STAGE_TIMEOUT))
+        self.job_timeout = float(job_timeout if job_timeout is not None
+                                 else os.environ.get('TRNDA_JOB_TIMEOUT', DEFAULT_JOB_TIMEOUT))
+
+
+class RecordsConfig:
+    """Where runs are recorded: run ledger and processed-inputs manifest"""
+    
+    def __init__(self, ledger_path: str = None, ledger_s3_uri: str = None, manifest_path: str = None,
+                 manifest_s3_uri: str = None):
+        """
+        Args:
+            ledger_path: Run ledger file (default: TRNDA_LEDGER env, then ~/.trnda/ledger.jsonl; 'off' disables)
+            ledger_s3_uri: Optional s3://bucket/prefix/ for ledger records (default: TRNDA_LEDGER_S3 env)
+            manifest_path: Processed-inputs manifest (default: TRNDA_MANIFEST env, then ~/.trnda/manifest.json;
+                           'off' disables)
+            manifest_s3_uri: Optional s3://bucket/key of a shared manifest (default: TRNDA_MANIFEST_S3 env)
+        """
+        ledger_path = ledger_path or os.environ.get('TRNDA_LEDGER') or DEFAULT_LEDGER_PATH
+        self.ledger_path = None if ledger_path == 'off' else ledger_path
+        self.ledger_s3_uri = ledger_s3_uri or os.environ.get('TRNDA_LEDGER_S3')
+        manifest_path = manifest_path or os.environ.get('TRNDA_MANIFEST') or DEFAULT_MANIFEST_PATH
+        self.manifest_path = None if manifest_path == 'off' else manifest_path
+        self.manifest_s3_uri = manifest_s3_uri or os.environ.get('TRNDA_MANIFEST_S3')
+    
+    @property
+    def manifest_enabled(self) -> bool:
+        """True if processed inputs are recorded in a local or S3 manifest"""
+        return bool(self.manifest_path or self.manifest_s3_uri)
 
 
-def compress_image_if_needed(image_path: str, max_size_mb: float = 4.0) -> str:
-    """Compress image if it exceeds max size.
+class SimilarityConfig:
+    """Near-duplicate detection: perceptual-hash index and confidence thresholds"""
     
-    Args:
-        image_path: Path to the image
-        max_size_mb: Maximum size in MB (default 4.0 to be safe under 5MB limit)
-        
-    Returns:
-        Path to compressed image (or original if no compression needed)
+    def __init__(self, index_path: str = None, s3_uri: str = None, reuse_confidence: float = None,
+                 seed_confidence: float = None):
+        """
+        Args:
+            index_path: Perceptual-hash index of processed inputs (default: TRNDA_SIMILARITY_INDEX env,
+                        then ~/.trnda/similarity.jsonl; 'off' disables)
+            s3_uri: Optional s3://bucket/key of a shared index (default: TRNDA_SIMILARITY_S3 env)
+            reuse_confidence: Similarity from which an earlier report is reused as is (default:
+                              TRNDA_REUSE_CONFIDENCE env, then DEFAULT_REUSE_CONFIDENCE)
+            seed_confidence: Similarity from which a run starts from an earlier report (default:
+                             TRNDA_SEED_CONFIDENCE env, then DEFAULT_SEED_CONFIDENCE)
+        """
+        index_path = index_path or os.environ.get('TRNDA_SIMILARITY_INDEX') or DEFAULT_SIMILARITY_INDEX_PATH
+        self.index_path = None if index_path == 'off' else index_path
+        self.s3_uri = s3_uri or os.environ.get('TRNDA_SIMILARITY_S3')
+        self.reuse_confidence = float(reuse_confidence if reuse_confidence is not None
+                                      else os.environ.get('TRNDA_REUSE_CONFIDENCE', DEFAULT_REUSE_CONFIDENCE))
+        self.seed_confidence = float(seed_confidence if seed_confidence is not None
+                                     else os.environ.get('TRNDA_SEED_CONFIDENCE', DEFAULT_SEED_CONFIDENCE))
+
+
+class RunContext:
+    """Everything one report run owns: configuration, model, MCP sessions,
+    output paths and credentials.
+    
+    Nothing run-specific lives in module globals, so several runs can share
+    one process (parallel workers, batch modes). Model, MCP clients and AWS
+    clients can be injected, e.g. stubs for offline runs.
     """
-    try:
-        from PIL import Image
-        import io
+    
+    def __init__(self, client_name: str = None, recipient_email: str = None,
+                 aws_profile: str = None, region: str = None, bucket: str = None,
+                 model_id: str = None, fast_model_id: str = None, base_dir: str = None,
+                 model=None, fast_model=None, mcp_clients: dict = None, tools: list = None,
+                 client_factory=None, run_id: str = None, outbox: 'EmailOutbox' = None,
+                 workspace: RunWorkspace = None, records: RecordsConfig = None,
+                 similarity_config: SimilarityConfig = None, deadlines: DeadlineConfig = None,
+                 status: bool = None, model_failover: str = None, fast_model_failover: str = None,
+                 profile: bool = None, deployment: str = None, queued_at: float = None):
+        """
+        Args:
+            client_name: Optional client/project name (displayed in report header)
+            recipient_email: Optional email address for sending the report
+            aws_profile: AWS profile (default: AWS_PROFILE env, then IAM role / default credentials)
+            region: AWS region (default: DEFAULT_REGION)
+            bucket: Default S3 bucket for short image names (default: DEFAULT_BUCKET)
+            model_id: Bedrock model for 'primary' stages (default: TRNDA_MODEL_ID env, then DEFAULT_MODEL_ID)
+            fast_model_id: Bedrock model for 'fast' stages (default: TRNDA_FAST_MODEL_ID env, then FAST_MODEL_ID)
+            base_dir: Directory in which the output directory is created (default: current directory
+                      for local images, the run workspace for S3 inputs)
+            model: Optional model instance for 'primary' stages (default: Bedrock model created on first use)
+            fast_model: Optional model instance for 'fast' stages (default: Bedrock model created on
+                        first use; if only model is injected, it is used for all stages)
+            mcp_clients: Optional dict of name -> MCP client (default: fresh clients on first use)
+            tools: Optional list of custom tools (default: image_reader, save_report_data, write_file)
+            client_factory: Optional callable(service_name, region) -> AWS client
+            run_id: Optional run ID (default: generated)
+            outbox: Optional email outbox (default: process-wide outbox, see get_email_outbox)
+            workspace: Optional run workspace (default: RunWorkspace for this run ID, created on first use)
+            records: Run ledger and manifest locations (default: RecordsConfig from the environment)
+            similarity_config: Near-duplicate detection settings (default: SimilarityConfig from the environment)
+            deadlines: Stage and job timeouts (default: DeadlineConfig from the environment)
+            status: Write the status object of S3 inputs (default: on unless TRNDA_STATUS env is 'off')
+            model_failover: Further endpoints of model_id, "model_or_profile@region,..." tried after
+                            model_id in region (default: TRNDA_MODEL_FAILOVER env; see FailoverModel)
+            fast_model_failover: Same for fast_model_id (default: TRNDA_FAST_MODEL_FAILOVER env)
+            profile: Profile the run with RunProfiler (default: on if TRNDA_PROFILE env is '1')
+            deployment: Deployment dimension of the run's metrics (default: TRNDA_DEPLOYMENT env, then
+                        DEFAULT_DEPLOYMENT)
+            queued_at: When the job was queued, i.e. the upload event time, as time.time() value
+                       (default: TRNDA_EVENT_TIME env; see parse_event_time)
+        """
+        self.run_id = run_id or new_run_id()
+        self.client_name = client_name
+        self.recipient_email = recipient_email
+        self.aws_profile = aws_profile or os.environ.get('AWS_PROFILE')
+        self.region = region or DEFAULT_REGION
+        self.bucket = bucket or DEFAULT_BUCKET
+        self.model_id = model_id or os.environ.get('TRNDA_MODEL_ID') or DEFAULT_MODEL_ID
+        self.fast_model_id = fast_model_id or os.environ.get('TRNDA_FAST_MODEL_ID') or FAST_MODEL_ID
+        self.model_failover = parse_model_endpoints(
+            model_failover if model_failover is not None else os.environ.get('TRNDA_MODEL_FAILOVER'), self.model_id)
+        self.fast_model_failover = parse_model_endpoints(
+            fast_model_failover if fast_model_failover is not None else os.environ.get('TRNDA_FAST_MODEL_FAILOVER'),
+            self.fast_model_id)
+        self.base_dir = base_dir
+        self.output_dir = None
+        self.input_uri = None
+        self.input_etag = None
+        self.input_preprocessed = None
+        # S3 input whose status object this run maintains (default: input_uri)
+        self.status_uri = None
+        self.status_enabled = status if status is not None else os.environ.get('TRNDA_STATUS') != 'off'
+        self._status = {}
+        # Sections published before the report is done (see publish_preview)
+        self.preview = {}
+        self.trace = RunTrace(self.run_id)
+        self.deadlines = deadlines or DeadlineConfig()
+        self.profile = profile if profile is not None else os.environ.get('TRNDA_PROFILE') == '1'
+        self.deployment = deployment or os.environ.get('TRNDA_DEPLOYMENT') or DEFAULT_DEPLOYMENT
+        self.queued_at = queued_at if queued_at is not None else parse_event_time(os.environ.get('TRNDA_EVENT_TIME'))
+        # Set when a deadline passes: cancels the agent turn, model stream and MCP tool calls
+        self.cancel_signal = threading.Event()
         
-        # Check current size
-        current_size_mb = os.path.getsize(image_path) / (1024 * 1024)
+        self.records = records or RecordsConfig()
+        self.similarity_config = similarity_config or SimilarityConfig()
+        # Near-duplicate decision of this run (see find_similar_report)
+        self.similarity = None
         
-        if current_size_mb <= max_size_mb:
-            return image_path
+        self._model = model
+        self._fast_model = fast_model
+        self._model_injected = model is not None
+        self._mcp_clients = mcp_clients
+        self._tools = tools
+        self._client_factory = client_factory
+        self._outbox = outbox
+        self._workspace = workspace
+        self._clients = {}
+        self._lock = threading.Lock()
+    
+    @property
+    def model(self):
+        """Model for this run (created on first use)"""
+        with self._lock:
+            if self._model is None:
+                self._model = self._bedrock_model(self.model_id, self.model_failover)
+            return self._model
+    
+    @property
+    def fast_model(self):
+        """Model for 'fast' stages (created on first use, shared with model if the IDs are equal)"""
+        if self._fast_model is None and (self._model_injected or (self.fast_model_id == self.model_id
+                                                                   and self.fast_model_failover in
+                                                                   ([], self.model_failover))):
+            return self.model
+        with self._lock:
+            if self._fast_model is None:
+                self._fast_model = self._bedrock_model(self.fast_model_id, self.fast_model_failover)
+            return self._fast_model
+    
+    def _limited(self, model, model_id: str, **kwargs):
+        """Put the process-wide rate limiter of model_id in front of a Bedrock model"""
+        limiter = get_rate_limiter(model_id)
+        return RateLimitedModel(model, limiter, self.trace, **kwargs) if limiter else model
+    
+    def _bedrock_model(self, model_id: str, failover: list):
+        """Rate-limited Bedrock model, behind a FailoverModel when failover endpoints are configured
         
-        print(f"[INFO] Image is {current_size_mb:.1f}MB, compressing to under {max_size_mb}MB...")
+        Args:
+            model_id: Model ID in self.region (first endpoint)
+            failover: Further (model_id, region) endpoints
+            
+        Returns:
+            Model instance
+        """
+        if not failover:
+            return self._limited(create_bedrock_model(model_id, self.region, self.aws_profile), model_id)
         
-        # Open image
-        img = Image.open(image_path)
-        
-        # Convert RGBA to RGB if needed
-        if img.mode == 'RGBA':
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[3])
-            img = background
-        elif img.mode not in ('RGB', 'L'):
-            img = img.convert('RGB')
-        
-        # Create compressed version
-        compressed_path = image_path.rsplit('.', 1)[0] + '_compressed.jpg'
+        endpoints = []
+        for endpoint_model_id, region in [(model_id, self.region)] + failover:
+            name = f"{endpoint_model_id}@{region}"
+            # Quotas are per region: the run's region keeps the plain model ID limiter (TRNDA_BEDROCK_RPM...)
+            limiter_key = endpoint_model_id if region == self.region else name
+            endpoints.append((name, self._limited(create_bedrock_model(endpoint_model_id, region, self.aws_profile),
+                                                  limiter_key, max_queue_seconds=FAILOVER_QUEUE_SECONDS,
+                                                  requeue_throttled=False)))
+        return FailoverModel(endpoints, self.trace)
+    
+    def model_for_stage(self, stage_name: str = None):
+        """Model configured for a workflow stage ('model' key of WORKFLOW_STAGES)
         
-        # Start with quality 85 and reduce if needed
-        quality = 85
-        while quality > 20:
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG', quality=quality, optimize=True)
-            size_mb = len(buffer.getvalue()) / (1024 * 1024)
+        Args:
+            stage_name: Stage name (None = outside the stages, primary model)
             
-            if size_mb <= max_size_mb:
-                with open(compressed_path, 'wb') as f:
-                    f.write(buffer.getvalue())
-                print(f"[OK] Compressed to {size_mb:.1f}MB (quality={quality})")
-                return compressed_path
+        Returns:
+            Model instance
+        """
+        stage = next((s for s in WORKFLOW_STAGES if s['name'] == stage_name), None)
+        if stage and stage.get('model') == 'fast':
+            return self.fast_model
+        return self.model
+    
+    @property
+    def mcp_clients(self) -> dict:
+        """MCP clients for this run (created on first use)"""
+        with self._lock:
+            if self._mcp_clients is None:
+                self._mcp_clients = create_mcp_clients(self.aws_profile, self.region, self.workspace.mcp_dir)
+            return self._mcp_clients
+    
+    @property
+    def tools(self) -> list:
+        """Custom (non-MCP) tools for this run"""
+        if self._tools is None:
+            return [image_reader, save_report_data, write_file]
+        return list(self._tools)
+    
+    def client(self, service_name: str):
+        """Get (cached) AWS client for this run's credentials and region
+        
+        Args:
+            service_name: AWS service name ('s3', 'ses', ...)
             
-            quality -= 5
+        Returns:
+            boto3 client (or whatever client_factory returns)
+        """
+        with self._lock:
+            if service_name not in self._clients:
+                if self._client_factory:
+                    self._clients[service_name] = self._client_factory(service_name, self.region)
+                elif service_name == 's3':
+                    self._clients[service_name] = get_s3_client(self.aws_profile, self.region)
+                elif service_name == 'ses':
+                    self._clients[service_name] = get_ses_client(self.aws_profile, self.region)
+                else:
+                    import boto3
+                    session = boto3.Session(profile_name=self.aws_profile) if self.aws_profile else boto3.Session()
+                    self._clients[service_name] = session.client(service_name, region_name=self.region)
+            return self._clients[service_name]
+    
+    @property
+    def workspace(self) -> RunWorkspace:
+        """Scratch workspace of this run (created on first use)"""
+        if self._workspace is None:
+            self._workspace = RunWorkspace(self.run_id)
+        return self._workspace
+    
+    @property
+    def outbox(self) -> 'EmailOutbox':
+        """Email outbox for this run's report email (process-wide unless injected)"""
+        if self._outbox is None:
+            self._outbox = get_email_outbox(client_factory=self._client_factory, aws_profile=self.aws_profile,
+                                            region=self.region)
+        return self._outbox
+    
+    def create_output_dir(self) -> str:
+        """Create this run's output directory (output_<run_id>)"""
+        self.output_dir = create_output_dir(self.base_dir or '.', self.run_id)
+        return self.output_dir
+    
+    def record_processed_input(self, output_location: str) -> None:
+        """Mark this run's S3 input (key + ETag) as processed in the manifest"""
+        records = self.records
+        if not (records.manifest_enabled and self.input_uri and is_s3_path(self.input_uri) and self.input_etag):
+            return
+        bucket, key = parse_s3_path(self.input_uri)
+        input_uri = f"s3://{bucket}/{normalize_input_key(key)}"
+        try:
+            update_manifest(records.manifest_path, input_uri, {
+                'etag': self.input_etag,
+                'output': output_location,
+                'run_id': self.run_id,
+                'processed': datetime.now().isoformat(timespec='seconds'),
+            }, records.manifest_s3_uri, self.client('s3') if records.manifest_s3_uri else None)
+        except Exception as e:
+            print(f"[WARNING] Could not update manifest {records.manifest_s3_uri or records.manifest_path}: {e}")
+    
+    @property
+    def similarity_index(self) -> 'SimilarityIndex':
+        """Perceptual-hash index of processed inputs (process-wide), or None if disabled"""
+        config = self.similarity_config
+        if not (config.index_path or config.s3_uri):
+            return None
+        return get_similarity_index(config.index_path, config.s3_uri, self.client('s3') if config.s3_uri else None)
+    
+    def record_report_hashes(self, output_location: str) -> None:
+        """Add this run's input hashes and output location to the similarity index
         
-        # If still too large, resize
-        print("[INFO] Quality reduction not enough, resizing...")
-        max_dimension = 2048
-        img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        Runs that reused an indexed report are not added again.
+        """
+        info = self.similarity
+        if not info or info.get('decision') == 'reuse' or self.similarity_index is None:
+            return
+        if not (self.output_dir and os.path.exists(os.path.join(self.output_dir, 'architecture.json'))):
+            return
+        try:
+            self.similarity_index.add({
+                'dhash': info['dhash'],
+                'phash': info['phash'],
+                'output': output_location,
+                'run_id': self.run_id,
+                'input': self.input_uri,
+                'indexed': datetime.now().isoformat(timespec='seconds'),
+            })
+            print(f"[OK] Input indexed for near-duplicate detection")
+        except Exception as e:
+            print(f"[WARNING] Could not update similarity index: {e}")
+    
+    def deadline(self, stage_name: str = None) -> tuple:
+        """Deadline of the next stage: the stage timeout or the job timeout, whichever comes first
         
-        quality = 85
-        while quality > 20:
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG', quality=quality, optimize=True)
-            size_mb = len(buffer.getvalue()) / (1024 * 1024)
-            
-            if size_mb <= max_size_mb:
-                with open(compressed_path, 'wb') as f:
-                    f.write(buffer.getvalue())
-                print(f"[OK] Resized and compressed to {size_mb:.1f}MB (quality={quality})")
-                return compressed_path
-            
-            quality -= 5
+        Returns:
+            (deadline as time.time() value or None, 'stage' or 'job')
+        """
+        job_timeout, stage_timeout = self.deadlines.job_timeout, self.deadlines.stage_timeout
+        job_deadline = self.trace.started + job_timeout if job_timeout else None
+        stage_deadline = time.time() + stage_timeout if stage_timeout and stage_name else None
+        if stage_deadline and (not job_deadline or stage_deadline < job_deadline):
+            return stage_deadline, 'stage'
+        return job_deadline, 'job'
+    
+    def publish_status(self, state: str, **fields) -> None:
+        """Write the status object of this run's S3 input (status/<name>.json)
         
-        # Last resort - save whatever we have
-        img.save(compressed_path, format='JPEG', quality=20, optimize=True)
-        final_size_mb = os.path.getsize(compressed_path) / (1024 * 1024)
-        print(f"[WARNING] Best effort compression: {final_size_mb:.1f}MB")
-        return compressed_path
+        One small JSON per input key (queued, running with stage, done with the
+        output prefix and PDF link, failed), so the web app and operators poll
+        one GET instead of listing output prefixes. Errors only warn.
         
-    except Exception as e:
-        print(f"[WARNING] Could not compress image: {e}")
-        return image_path
+        Args:
+            state: 'running', 'done' or 'failed'
+            **fields: Fields to add or update (stage, output, pdf_url, error, ...)
+        """
+        import json
+        
+        uri = self.status_uri or self.input_uri
+        if not (self.status_enabled and uri and is_s3_path(uri)):
+            return
+        bucket, key = parse_s3_path(uri)
+        key = normalize_input_key(key)
+        self._status.update(fields, input=f"s3://{bucket}/{key}", state=state, run_id=self.run_id,
+                            updated=datetime.now().astimezone().isoformat(timespec='seconds'))
+        try:
+            self.client('s3').put_object(Bucket=bucket, Key=status_key(key), Body=json.dumps(self._status, indent=2),
+                                         ContentType='application/json', CacheControl='no-cache')
+        except Exception as e:
+            print(f"[WARNING] Could not write status object for {key}: {e}")
+    
+    def record_run(self, record: dict) -> None:
+        """Append a run record to this context's ledger (and S3, if configured) and emit its metrics"""
+        append_ledger_record(record, self.records.ledger_path, self.records.ledger_s3_uri,
+                             self.client('s3') if self.records.ledger_s3_uri else None)
+        emit_run_metrics(record, self.deployment)
 
 
-@tool
-def write_file(filepath: str, content: str) -> str:
-    """Write content to a file.
+def get_model_id(model) -> str:
+    """Model ID from a model's config (works for dict and object configs)"""
+    config = model.get_config()
+    if isinstance(config, dict):
+        return config.get('model_id')
+    return getattr(config, 'model_id', None)
+
+
+class ModelRouter(Model):
+    """Model wrapper sending each workflow stage to its configured model.
     
-    Args:
-        filepath: Path to the file to write
-        content: Content to write to the file
+    The current stage is taken from the run trace (set by run_workflow_stages),
+    so one agent and one conversation span all models.
+    """
+    
+    def __init__(self, ctx: 'RunContext'):
+        self.ctx = ctx
+    
+    @property
+    def model(self):
+        """Model for the current stage"""
+        return self.ctx.model_for_stage(self.ctx.trace.stage)
+    
+    def update_config(self, **model_config):
+        self.model.update_config(**model_config)
+    
+    def get_config(self):
+        return self.model.get_config()
+    
+    def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        return self.model.structured_output(output_model, prompt, system_prompt=system_prompt, **kwargs)
+    
+    def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        return self.model.stream(messages, tool_specs, system_prompt, **kwargs)
+
+
+class TracedModel(Model):
+    """Model wrapper recording one trace span per model turn (tokens, cache tokens, latency).
+    
+    With a cancel signal, a turn stops as soon as the signal is set, also while it
+    is still waiting for Bedrock (the agent only checks it between stream events).
+    """
+    
+    def __init__(self, model, trace: RunTrace, cancel_signal: threading.Event = None):
+        self.model = model
+        self.trace = trace
+        self.cancel_signal = cancel_signal
+    
+    def update_config(self, **model_config):
+        self.model.update_config(**model_config)
+    
+    def get_config(self):
+        return self.model.get_config()
+    
+    def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        return self.model.structured_output(output_model, prompt, system_prompt=system_prompt, **kwargs)
+    
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        start = time.time()
+        first_event = None
+        usage = {}
+        error = None
+        try:
+            async for event in self._events(self.model.stream(messages, tool_specs, system_prompt, **kwargs)):
+                if first_event is None:
+                    first_event = time.time()
+                if 'metadata' in event:
+                    usage = event['metadata'].get('usage', {})
+                yield event
+            if self.cancel_signal and self.cancel_signal.is_set():
+                error = 'cancelled'
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.trace.add_span(
+                'model_turn', 'model', start, time.time() - start,
+                model_id=get_model_id(self.model),
+                input_tokens=usage.get('inputTokens', 0),
+                output_tokens=usage.get('outputTokens', 0),
+                cache_read_tokens=usage.get('cacheReadInputTokens', 0),
+                cache_write_tokens=usage.get('cacheWriteInputTokens', 0),
+                time_to_first_event=round(first_event - start, 3) if first_event else None,
+                messages=len(messages),
+                error=error
+            )
+    
+    async def _events(self, stream):
+        """Events of the wrapped stream; ends early (without messageStop) once the cancel signal is set"""
+        import asyncio
         
-    Returns:
-        Success message
+        if not self.cancel_signal:
+            async for event in stream:
+                yield event
+            return
+        
+        iterator = stream.__aiter__()
+        try:
+            while not self.cancel_signal.is_set():
+                next_event = asyncio.ensure_future(iterator.__anext__())
+                while not next_event.done():
+                    await asyncio.wait({next_event}, timeout=CANCEL_POLL_SECONDS)
+                    if self.cancel_signal.is_set() and not next_event.done():
+                        next_event.cancel()
+                        return
+                try:
+                    event = next_event.result()
+                except StopAsyncIteration:
+                    return
+                yield event
+        finally:
+            if hasattr(iterator, 'aclose'):
+                try:
+                    await iterator.aclose()
+                except Exception:
+                    pass
+
+
+# Bedrock rate limiting - token buckets for requests and tokens per minute and model,
+# adapted with AIMD (cut to 70% on ThrottlingException, grow again on every success).
+# TRNDA_BEDROCK_LIMITER: 'process' (shared by all runs of a process), 'file' (shared by all
+# processes of a host via TRNDA_BEDROCK_LIMITER_DIR) or 'off'
+DEFAULT_BEDROCK_RPM = 50
+DEFAULT_BEDROCK_TPM = 400000
+DEFAULT_LIMITER_DIR = os.path.join(os.path.expanduser('~'), '.trnda', 'limiter')
+BEDROCK_MAX_QUEUE_SECONDS = 900
+
+
+def estimate_request_tokens(messages: list, tool_specs: list = None, system_prompt: str = None) -> int:
+    """Rough input tokens of a model request (text chars / 4, ~1600 tokens per image)"""
+    import json
+    chars = len(system_prompt or '') + len(json.dumps(tool_specs or [], default=str))
+    images = 0
+    stack = [messages]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            if isinstance(value.get('image'), dict):
+                images += 1
+                continue
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, str):
+            chars += len(value)
+    return chars // 4 + images * 1600
+
+
+class _ProcessLimiterState:
+    """Limiter state shared by the threads of one process"""
+    
+    def __init__(self):
+        self._state = None
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            holder = {'state': self._state}
+            yield holder
+            self._state = holder['state']
+
+
+class _FileLimiterState:
+    """Limiter state shared by all processes of a host (JSON file under an exclusive lock)"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    
+    @contextmanager
+    def locked(self):
+        import json
+        import fcntl
+        with self._lock, open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+            holder = {'state': state}
+            yield holder
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(holder['state'], f)
+            os.replace(temp_path, self.path)
+
+
+class BedrockRateLimiter:
+    """Token buckets for requests/min and tokens/min of one model, with AIMD rates.
+    
+    Rates start at the configured maximum. A throttled request cuts both
+    rates by decrease_factor and empties the buckets; every successful request
+    adds a step back - five steps while below the rate that was throttled last,
+    one step above it - up to the maximum. Buckets hold burst_seconds worth of quota; a
+    request larger than the bucket waits until the bucket is full and then
+    runs into debt, which later requests wait out.
     """
-    try:
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    
+    def __init__(self, model_id: str, requests_per_minute: float = None, tokens_per_minute: float = None,
+                 state_path: str = None, burst_seconds: float = 10.0, decrease_factor: float = 0.7,
+                 increase_fraction: float = 0.02, min_fraction: float = 0.05):
+        """
+        Args:
+            model_id: Model the quota belongs to
+            requests_per_minute: Maximum request rate (default: TRNDA_BEDROCK_RPM env, then 50)
+            tokens_per_minute: Maximum token rate (default: TRNDA_BEDROCK_TPM env, then 400000)
+            state_path: Optional state file shared between processes (default: state in this process)
+            burst_seconds: Bucket size in seconds of the current rate
+            decrease_factor: Rate multiplier on throttling
+            increase_fraction: Rate step (fraction of the maximum) per successful request
+            min_fraction: Lowest rate (fraction of the maximum)
+        """
+        self.model_id = model_id
+        self.max_rpm = float(requests_per_minute or os.environ.get('TRNDA_BEDROCK_RPM') or DEFAULT_BEDROCK_RPM)
+        self.max_tpm = float(tokens_per_minute or os.environ.get('TRNDA_BEDROCK_TPM') or DEFAULT_BEDROCK_TPM)
+        self.burst_seconds = burst_seconds
+        self.decrease_factor = decrease_factor
+        self.increase_fraction = increase_fraction
+        self.min_fraction = min_fraction
+        self.state = _FileLimiterState(state_path) if state_path else _ProcessLimiterState()
+        self.stats = {'acquired': 0, 'throttled': 0, 'queued': 0, 'wait_seconds': 0.0}
+        self._stats_lock = threading.Lock()
+    
+    def _capacity(self, state: dict) -> tuple:
+        return (max(1.0, state['rpm'] * self.burst_seconds / 60.0),
+                max(1.0, state['tpm'] * self.burst_seconds / 60.0))
+    
+    def _refill(self, holder: dict, now: float) -> dict:
+        state = holder['state']
+        if not state:
+            state = holder['state'] = {'rpm': self.max_rpm, 'tpm': self.max_tpm, 'updated': now}
+            state['requests'], state['tokens'] = self._capacity(state)
+            return state
+        elapsed = max(0.0, now - state['updated'])
+        max_requests, max_tokens = self._capacity(state)
+        state['requests'] = min(max_requests, state['requests'] + elapsed * state['rpm'] / 60.0)
+        state['tokens'] = min(max_tokens, state['tokens'] + elapsed * state['tpm'] / 60.0)
+        state['updated'] = now
+        return state
+    
+    def _count(self, name: str, value=1) -> None:
+        with self._stats_lock:
+            self.stats[name] += value
+    
+    def try_acquire(self, tokens: int) -> float:
+        """Take one request and the estimated tokens if the buckets allow it
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(content)
+        Returns:
+            0.0 if acquired, otherwise seconds to wait before trying again
+        """
+        now = time.time()
+        with self.state.locked() as holder:
+            state = self._refill(holder, now)
+            max_requests, max_tokens = self._capacity(state)
+            needed_tokens = min(tokens, max_tokens)
+            if state['requests'] >= 1.0 and state['tokens'] >= needed_tokens:
+                state['requests'] -= 1.0
+                state['tokens'] -= tokens
+                self._count('acquired')
+                return 0.0
+            return max((1.0 - state['requests']) * 60.0 / state['rpm'],
+                       (needed_tokens - state['tokens']) * 60.0 / state['tpm'], 0.05)
+    
+    def settle(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Correct the token bucket once the real usage of a request is known"""
+        with self.state.locked() as holder:
+            state = self._refill(holder, time.time())
+            state['tokens'] -= actual_tokens - estimated_tokens
+    
+    def on_success(self) -> None:
+        """Additive increase"""
+        with self.state.locked() as holder:
+            state = self._refill(holder, time.time())
+            step = self.increase_fraction * (5 if state['rpm'] < state.get('throttled_rpm', 0) else 1)
+            state['rpm'] = min(self.max_rpm, state['rpm'] + self.max_rpm * step)
+            state['tpm'] = min(self.max_tpm, state['tpm'] + self.max_tpm * step)
+    
+    def on_throttle(self) -> None:
+        """Multiplicative decrease; buckets are emptied so queued requests wait for the new rate"""
+        self._count('throttled')
+        with self.state.locked() as holder:
+            state = self._refill(holder, time.time())
+            state['throttled_rpm'] = state['rpm']
+            state['rpm'] = max(self.max_rpm * self.min_fraction, state['rpm'] * self.decrease_factor)
+            state['tpm'] = max(self.max_tpm * self.min_fraction, state['tpm'] * self.decrease_factor)
+            state['requests'] = min(state['requests'], 0.0)
+            state['tokens'] = min(state['tokens'], 0.0)
+    
+    def record_wait(self, seconds: float) -> None:
+        """Count a turn that waited in the queue (stats 'queued' and 'wait_seconds')"""
+        self._count('queued')
+        self._count('wait_seconds', seconds)
+    
+    def rates(self) -> dict:
+        """Current adapted rates (requests and tokens per minute)"""
+        with self.state.locked() as holder:
+            state = self._refill(holder, time.time())
+            return {'rpm': round(state['rpm'], 1), 'tpm': round(state['tpm'])}
+
+
+class RateLimitedModel(Model):
+    """Model wrapper that queues each turn behind a BedrockRateLimiter.
+    
+    Throttled turns (ModelThrottledException before any response event) are
+    queued and retried instead of failing the run; only a turn queued longer
+    than max_queue_seconds raises. With requeue_throttled=False a throttled
+    turn raises at once (FailoverModel moves it to another endpoint).
+    """
+    
+    def __init__(self, model, limiter: BedrockRateLimiter, trace: RunTrace = None,
+                 max_queue_seconds: float = BEDROCK_MAX_QUEUE_SECONDS, requeue_throttled: bool = True):
+        self.model = model
+        self.limiter = limiter
+        self.trace = trace
+        self.max_queue_seconds = max_queue_seconds
+        self.requeue_throttled = requeue_throttled
+    
+    def update_config(self, **model_config):
+        self.model.update_config(**model_config)
+    
+    def get_config(self):
+        return self.model.get_config()
+    
+    def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        return self.model.structured_output(output_model, prompt, system_prompt=system_prompt, **kwargs)
+    
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        import asyncio
+        from strands.types.exceptions import ModelThrottledException
         
-        return f"Successfully written to {filepath}"
-    except Exception as e:
-        return f"Error writing file: {e}"
+        estimated = estimate_request_tokens(messages, tool_specs, system_prompt)
+        queued_at = time.time()
+        throttles = 0
+        
+        while True:
+            wait = self.limiter.try_acquire(estimated)
+            if wait:
+                if time.time() - queued_at + wait > self.max_queue_seconds:
+                    raise ModelThrottledException(
+                        f"Bedrock turn queued for more than {self.max_queue_seconds:.0f}s ({self.limiter.model_id})")
+                await asyncio.sleep(min(wait, 5.0))
+                continue
+            
+            waited = time.time() - queued_at
+            started = False
+            usage = {}
+            try:
+                async for event in self.model.stream(messages, tool_specs, system_prompt, **kwargs):
+                    started = True
+                    if 'metadata' in event:
+                        usage = event['metadata'].get('usage', {})
+                    yield event
+            except ModelThrottledException:
+                # The throttled attempt used no tokens - refund its estimate before the buckets are emptied,
+                # so the re-queued attempt is not charged twice
+                self.limiter.settle(estimated, usage.get('inputTokens', 0) + usage.get('outputTokens', 0))
+                self.limiter.on_throttle()
+                throttles += 1
+                if started or not self.requeue_throttled:
+                    raise
+                print(f"[WARNING] {self.limiter.model_id} throttled, turn queued "
+                      f"(rate now {self.limiter.rates()['rpm']} requests/min)")
+                continue
+            except Exception:
+                # Failed turn: only the usage it reported counts against the token bucket
+                self.limiter.settle(estimated, usage.get('inputTokens', 0) + usage.get('outputTokens', 0))
+                raise
+            
+            self.limiter.on_success()
+            if usage:
+                self.limiter.settle(estimated, usage.get('inputTokens', 0) + usage.get('outputTokens', 0))
+            if waited > 0.01 or throttles:
+                self.limiter.record_wait(waited)
+                if self.trace:
+                    self.trace.add_span('bedrock_queue', 'throttle', queued_at, waited,
+                                        model_id=self.limiter.model_id, throttles=throttles)
+            return
 
 
-@tool
-def convert_with_pandoc(input_file: str, output_format: str) -> str:
-    """Convert markdown file to PDF using pandoc with better spacing.
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_id: str) -> BedrockRateLimiter:
+    """Limiter for a model, shared by every run of this process (and of the host with TRNDA_BEDROCK_LIMITER=file)
+    
+    Returns:
+        BedrockRateLimiter, or None if TRNDA_BEDROCK_LIMITER=off
+    """
+    mode = os.environ.get('TRNDA_BEDROCK_LIMITER', 'process')
+    if mode == 'off':
+        return None
+    with _rate_limiters_lock:
+        if model_id not in _rate_limiters:
+            state_path = None
+            if mode == 'file':
+                limiter_dir = os.environ.get('TRNDA_BEDROCK_LIMITER_DIR') or DEFAULT_LIMITER_DIR
+                state_path = os.path.join(limiter_dir, f"{model_id.replace(':', '_')}.json")
+            _rate_limiters[model_id] = BedrockRateLimiter(model_id, state_path=state_path)
+        return _rate_limiters[model_id]
+
+
+# Bedrock failover - TRNDA_MODEL_FAILOVER / TRNDA_FAST_MODEL_FAILOVER list further endpoints
+# ("model_or_inference_profile@region,...", "@region" = same model) tried after the configured
+# model in the run's region. A failing endpoint cools down FAILOVER_COOLDOWN_SECONDS (doubled per
+# consecutive failure, up to FAILOVER_MAX_COOLDOWN_SECONDS); a slow one (time to first event above
+# FAILOVER_SLOW_SECONDS or FAILOVER_SLOW_FACTOR x the fastest endpoint) is passed over until its
+# measurement is older than the base cooldown.
+FAILOVER_COOLDOWN_SECONDS = 30
+FAILOVER_MAX_COOLDOWN_SECONDS = 600
+FAILOVER_SLOW_SECONDS = 20.0
+FAILOVER_SLOW_FACTOR = 3.0
+# Proactive limiter wait per endpoint before a turn moves on
+FAILOVER_QUEUE_SECONDS = 20
+FAILOVER_EWMA_ALPHA = 0.3
+FAILOVER_ERROR_CODES = {'ThrottlingException', 'ServiceUnavailableException', 'InternalServerException',
+                        'ModelNotReadyException', 'ModelTimeoutException', 'ModelErrorException'}
+
+
+def parse_model_endpoints(spec: str, model_id: str) -> list:
+    """Parse "model_id@region,@region,..." into [(model_id, region)]
     
     Args:
-        input_file: Path to markdown file
-        output_format: Must be 'pdf'
+        spec: Comma-separated endpoints (an entry without model ID uses model_id)
+        model_id: Model of the entries without model ID
         
     Returns:
-        Success message
+        List of (model_id, region) tuples
     """
-    try:
-        if output_format != 'pdf':
-            return f"Error: format must be 'pdf', got '{output_format}'"
-        
-        output_file = input_file.replace('.md', f'.{output_format}')
-        
-        # Get directory of the markdown file
-        working_dir = os.path.dirname(os.path.abspath(input_file))
-        input_basename = os.path.basename(input_file)
-        output_basename = os.path.basename(output_file)
-        
-        # Run pandoc from the directory where the markdown file is
-        # This ensures relative image paths work correctly
-        cmd = ['pandoc', input_basename, '-o', output_basename]
-        
-        # Add better spacing for PDF
-        if output_format == 'pdf':
-            # Create header file for fancy footer
-            header_path = os.path.join(working_dir, 'header.tex')
-            with open(header_path, 'w') as f:
-                f.write(r'''\usepackage{fancyhdr}
-\pagestyle{fancy}
-\fancyhf{}
-\fancyfoot[L]{Trask Solutions a.s.}
-\fancyfoot[C]{\thepage}
-\fancyfoot[R]{TRNDA report v0.5}
-\renewcommand{\headrulewidth}{0pt}
-\renewcommand{\footrulewidth}{0.4pt}
-''')
-            
-            cmd.extend([
-                '-V', 'geometry:margin=2cm',
-                '-V', 'linestretch=1.1',
-                '-V', 'fontsize=10pt',
-                '-H', 'header.tex'
-            ])
-        
-        result = subprocess.run(
-            cmd, 
-            capture_output=True, 
-            text=True,
-            cwd=working_dir
-        )
-        
-        if result.returncode == 0:
-            return f"Successfully converted to {output_file}"
-        else:
-            return f"Error: {result.stderr}"
-            
-    except Exception as e:
-        return f"Error running pandoc: {e}"
+    endpoints = []
+    for entry in (spec or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if '@' not in entry:
+            raise ValueError(f"Endpoint '{entry}' has no region (expected model_id@region)")
+        endpoint_model_id, region = entry.rsplit('@', 1)
+        endpoints.append((endpoint_model_id or model_id, region))
+    return endpoints
+
+
+def is_failover_error(error: Exception) -> bool:
+    """Throttling, transient service errors and connection problems (another endpoint may work)"""
+    from botocore.exceptions import ClientError, BotoCoreError
+    from strands.types.exceptions import ModelThrottledException
+    if isinstance(error, (ModelThrottledException, BotoCoreError, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in FAILOVER_ERROR_CODES
+    return False
 
 
-def build_system_prompt():
-    """Simple system prompt - max 3-4 pages output."""
-    # Use consistent height-based sizing for all images (no adaptive sizing)
-    input_image_size = r"height=0.5\textheight,keepaspectratio"
+class EndpointHealth:
+    """Live health of one model endpoint, shared by every run of the process
+    
+    Time to first event and error rate are exponentially weighted; failures
+    start a cooldown that doubles with every consecutive failure.
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.latency = None
+        self.measured = 0.0
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self._lock = threading.Lock()
+    
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            alpha = FAILOVER_EWMA_ALPHA
+            self.latency = latency if self.latency is None else (1 - alpha) * self.latency + alpha * latency
+            self.measured = time.time()
+            self.error_rate *= 1 - alpha
+            self.consecutive_failures = 0
     
-    return rf"""You are an AWS Solutions Architect. Create a CONCISE report (MAX 3-4 PAGES).
+    def record_failure(self) -> float:
+        """Count a failure and start the cooldown
+        
+        Returns:
+            Cooldown in seconds
+        """
+        with self._lock:
+            self.error_rate = (1 - FAILOVER_EWMA_ALPHA) * self.error_rate + FAILOVER_EWMA_ALPHA
+            self.consecutive_failures += 1
+            cooldown = min(FAILOVER_MAX_COOLDOWN_SECONDS,
+                           FAILOVER_COOLDOWN_SECONDS * 2 ** (self.consecutive_failures - 1))
+            self.cooldown_until = time.time() + cooldown
+            return cooldown
+    
+    def fresh_latency(self, now: float) -> float:
+        """Time to first event, or None when never measured or older than the base cooldown"""
+        if self.latency is None or now - self.measured > FAILOVER_COOLDOWN_SECONDS:
+            return None
+        return self.latency
+    
+    def snapshot(self) -> dict:
+        now = time.time()
+        return {
+            'first_event_seconds': round(self.latency, 3) if self.latency is not None else None,
+            'error_rate': round(self.error_rate, 3),
+            'cooling_down_seconds': round(max(0.0, self.cooldown_until - now), 1),
+        }
 
-AVAILABLE TOOLS:
-- image_reader: Analyze images
-- AWS Diagram MCP: Generate AWS diagrams
-- AWS Pricing MCP: Calculate costs
-- write_file: Save content to files
-- convert_with_pandoc: Convert markdown to PDF
 
-WORKFLOW:
+_endpoint_health = {}
+_endpoint_health_lock = threading.Lock()
 
-1. Use image_reader to analyze the hand-drawn diagram
-2. Generate As-Is diagram (aws_diagram MCP)
-3. Calculate As-Is costs (aws_pricing MCP) - 3 scenarios
-4. Design Well-Architected version (LIST improvements only)
-5. Generate Well-Architected diagram (aws_diagram MCP)
-6. Calculate Well-Architected costs (aws_pricing MCP) - 3 scenarios
-7. Compare costs (show percentage differences)
-8. Use write_file to save markdown report to design.md
 
-MARKDOWN TEMPLATE:
+def get_endpoint_health(name: str) -> EndpointHealth:
+    """Health of an endpoint, shared by every run of this process"""
+    with _endpoint_health_lock:
+        if name not in _endpoint_health:
+            _endpoint_health[name] = EndpointHealth(name)
+        return _endpoint_health[name]
 
-```markdown
-# AWS Architecture Design - [Name]
 
-**Analysis is made for:** [CLIENT_NAME - ONLY IF PROVIDED]
-**Generated by:** TRNDA (Trask Ručně Nakreslí, Dokončí AWS)
-**Date:** [Current date]  
-**Region:** eu-central-1
+class FailoverModel(Model):
+    """Model wrapper routing each turn to the healthiest of several endpoints.
+    
+    Endpoints (regions / inference profiles, in preference order) are used in
+    configured order, skipping ones that are cooling down after a failure or
+    are markedly slower than the others. A turn that fails before its first
+    event with a throttling or transient error moves to the next endpoint, so
+    runs fail over mid-run without losing anything: the conversation lives in
+    the agent and is sent with every turn. A turn that fails after streaming
+    started is not replayed; the agent's retry picks the next endpoint.
+    Per-endpoint turns, failures and latency go to trace.json ('endpoints').
+    """
+    
+    def __init__(self, endpoints: list, trace: RunTrace = None, slow_seconds: float = FAILOVER_SLOW_SECONDS):
+        """
+        Args:
+            endpoints: List of (name, model) in preference order
+            trace: Optional run trace (failover spans and per-endpoint stats)
+            slow_seconds: Time to first event above which an endpoint counts as degraded
+        """
+        self.endpoints = list(endpoints)
+        self.models = dict(self.endpoints)
+        self.trace = trace
+        self.slow_seconds = slow_seconds
+        self.health = {name: get_endpoint_health(name) for name, _ in self.endpoints}
+        self.current = self.endpoints[0][0]
+        self.stats = {name: {'model_id': get_model_id(model), 'turns': 0, 'failures': 0, 'failovers': 0,
+                             'first_event_seconds': None, 'last_error': None}
+                      for name, model in self.endpoints}
+        if trace:
+            self.bind_trace(trace)
+    
+    def bind_trace(self, trace: RunTrace) -> None:
+        """Record failovers and per-endpoint stats in a run trace (for models created before the run context)"""
+        self.trace = trace
+        trace.endpoints.update(self.stats)
+    
+    def update_config(self, **model_config):
+        for _, model in self.endpoints:
+            model.update_config(**model_config)
+    
+    def get_config(self):
+        return self.models[self.current].get_config()
+    
+    def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        return self.models[self.current].structured_output(output_model, prompt, system_prompt=system_prompt,
+                                                           **kwargs)
+    
+    def _order(self) -> list:
+        """Endpoint names for the next turn: healthy ones in configured order, then the rest"""
+        now = time.time()
+        latencies = {name: health.fresh_latency(now) for name, health in self.health.items()}
+        measured = [latency for name, latency in latencies.items()
+                    if latency is not None and now >= self.health[name].cooldown_until]
+        fastest = min(measured) if measured else None
+        
+        def healthy(name):
+            latency = latencies[name]
+            if now < self.health[name].cooldown_until:
+                return False
+            return latency is None or (latency <= self.slow_seconds
+                                       and (fastest is None or latency <= fastest * FAILOVER_SLOW_FACTOR))
+        
+        names = [name for name, _ in self.endpoints]
+        preferred = [name for name in names if healthy(name)]
+        rest = sorted((name for name in names if name not in preferred),
+                      key=lambda name: (self.health[name].cooldown_until, latencies[name] or 0.0))
+        return preferred + rest
+    
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        order = self._order()
+        last_error = None
+        
+        for index, name in enumerate(order):
+            stats = self.stats[name]
+            start = time.time()
+            first_event = None
+            try:
+                async for event in self.models[name].stream(messages, tool_specs, system_prompt, **kwargs):
+                    if first_event is None:
+                        first_event = time.time() - start
+                    yield event
+            except Exception as e:
+                if not is_failover_error(e):
+                    raise
+                cooldown = self.health[name].record_failure()
+                stats['failures'] += 1
+                stats['last_error'] = f"{type(e).__name__}: {e}"[:300]
+                moving = first_event is None and index + 1 < len(order)
+                if moving:
+                    stats['failovers'] += 1
+                if self.trace:
+                    self.trace.add_span(name, 'failover', start, time.time() - start, error=stats['last_error'],
+                                        cooldown=cooldown, next_endpoint=order[index + 1] if moving else None)
+                print(f"[FAILOVER] {name}: {type(e).__name__} - cooling down {cooldown:.0f}s"
+                      + (f", turn moves to {order[index + 1]}" if moving else ""))
+                if first_event is not None:
+                    raise
+                last_error = e
+                continue
+            
+            self.health[name].record_success(first_event if first_event is not None else time.time() - start)
+            stats['turns'] += 1
+            stats['first_event_seconds'] = round(self.health[name].latency, 3)
+            self.current = name
+            return
+        
+        raise last_error
 
----
 
-## Original Hand-Drawn Design
+class TraceHooks(HookProvider):
+    """Agent hooks recording one trace span per tool call (server, tool, duration, payload size)."""
+    
+    def __init__(self, trace: RunTrace, tool_servers: dict = None):
+        """
+        Args:
+            trace: Run trace
+            tool_servers: Optional dict of tool name -> MCP server name (other tools are 'local')
+        """
+        self.trace = trace
+        self.tool_servers = tool_servers or {}
+        self._started = {}
+    
+    def register_hooks(self, registry: HookRegistry, **kwargs) -> None:
+        registry.add_callback(BeforeToolCallEvent, self.before_tool_call)
+        registry.add_callback(AfterToolCallEvent, self.after_tool_call)
+    
+    def before_tool_call(self, event: BeforeToolCallEvent) -> None:
+        self._started[event.tool_use['toolUseId']] = time.time()
+    
+    def after_tool_call(self, event: AfterToolCallEvent) -> None:
+        import json
+        tool_use = event.tool_use
+        start = self._started.pop(tool_use['toolUseId'], time.time())
+        result = event.result or {}
+        
+        self.trace.add_span(
+            tool_use['name'], 'tool', start, time.time() - start,
+            server=self.tool_servers.get(tool_use['name'], 'local'),
+            input_bytes=len(json.dumps(tool_use.get('input', {}), default=str)),
+            result_bytes=len(json.dumps(result.get('content', []), default=str)),
+            status=result.get('status')
+        )
 
-**Original input diagram:**
 
-\begin{{{{center}}}}
-\includegraphics[{input_image_size}]{{{{diagram_input.png}}}}
-\end{{{{center}}}}
+def get_s3_client(profile=None, region=None):
+    """Get S3 client with proper credentials
+    
+    On EC2 with IAM role: uses instance profile automatically
+    Locally: uses AWS_PROFILE environment variable or default profile
+    """
+    import boto3
+    region = region or DEFAULT_REGION
+    
+    # Get profile from parameter or environment
+    profile = profile or os.environ.get('AWS_PROFILE')
+    
+    # If profile is specified, use it; otherwise boto3 will use IAM role on EC2 or default credentials
+    if profile:
+        session = boto3.Session(profile_name=profile)
+    else:
+        session = boto3.Session()
+    
+    return session.client('s3', region_name=region)
+
 
-\newpage
+def get_ses_client(profile=None, region=None):
+    """Get SES client with proper credentials
+    
+    On EC2 with IAM role: uses instance profile automatically
+    Locally: uses AWS_PROFILE environment variable or default profile
+    """
+    import boto3
+    region = region or DEFAULT_REGION
+    
+    # Get profile from parameter or environment
+    profile = profile or os.environ.get('AWS_PROFILE')
+    
+    # If profile is specified, use it; otherwise boto3 will use IAM role on EC2 or default credentials
+    if profile:
+        session = boto3.Session(profile_name=profile)
+    else:
+        session = boto3.Session()
+    
+    return session.client('ses', region_name=region)
 
-## 1. As-Is Architecture
 
-**Components:** 
+def is_email(text: str) -> bool:
+    """Check if text is an email address"""
+    import re
+    if not text:
+        return False
+    # Simple email regex
+    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+    return bool(re.match(email_pattern, text.strip()))
+
+
+def extract_email_from_text(text: str) -> str:
+    """Extract email address from longer text
+    
+    Args:
+        text: Text that may contain email address
+        
+    Returns:
+        Extracted email or None if not found
+    """
+    import re
+    if not text:
+        return None
+    
+    # Find email pattern in text
+    email_pattern = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
+    match = re.search(email_pattern, text)
+    
+    if match:
+        return match.group(0)
+    return None
+
+
+# Report email settings
+REPORT_EMAIL_SENDER = "trnda@ai.aws.thetrasklab.com"
+REPORT_EMAIL_BCC = "mirdvorak@trask.cz"
+
+# Email outbox: spool directory, attachment limit (SES raw messages are limited to 10 MB,
+# base64 adds a third - bigger PDFs are sent as a presigned S3 link) and link lifetime
+DEFAULT_OUTBOX_DIR = os.path.join(os.path.expanduser('~'), '.trnda', 'outbox')
+DEFAULT_ATTACHMENT_MAX_MB = 7.0
+REPORT_LINK_EXPIRES_SECONDS = 7 * 24 * 3600
+
+# SES errors worth retrying (everything else - e.g. MessageRejected - fails immediately).
+# A PDF missing in S3 for the download link is uploaded from the spool copy, not retried.
+RETRYABLE_EMAIL_ERRORS = {'Throttling', 'ThrottlingException', 'ServiceUnavailable', 'InternalFailure',
+                          'RequestTimeout'}
+
+
+def build_report_email(recipient_email: str, pdf_path: str = None, download_url: str = None,
+                       link_expires: datetime = None) -> bytes:
+    """Build the report email (raw MIME message)
+    
+    Args:
+        recipient_email: Recipient email address
+        pdf_path: PDF to attach (ignored if download_url is given)
+        download_url: Presigned link to the PDF (sent instead of an attachment)
+        link_expires: When download_url expires (shown in the email body)
+        
+    Returns:
+        Raw message bytes for SES send_raw_email
+    """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.application import MIMEApplication
+    
+    msg = MIMEMultipart()
+    msg['Subject'] = 'TRNDA Report - AWS Architecture Design'
+    msg['From'] = f'TRNDA Report <{REPORT_EMAIL_SENDER}>'
+    msg['To'] = recipient_email
+    msg['Bcc'] = REPORT_EMAIL_BCC
+    
+    if download_url:
+        valid_until = f" (link valid until {link_expires.strftime('%d.%m.%Y %H:%M')})" if link_expires else ""
+        delivery_text = f"Your AWS architecture report is ready. Download it here{valid_until}:\n\n{download_url}\n"
+    else:
+        delivery_text = "Your AWS architecture report is ready and attached to this email.\n"
+    
+    # Email body
+    body_text = f"""Hello,
+
+{delivery_text}
+Generated: {datetime.now().strftime("%d.%m.%Y %H:%M")}
+
+---
+Generated by TRNDA (Trask Ručně Nakreslí, Dokončí AWS)
+Trask Solutions a.s.
+"""
+    msg.attach(MIMEText(body_text, 'plain', 'utf-8'))
+    
+    if not download_url:
+        with open(pdf_path, 'rb') as f:
+            pdf_attachment = MIMEApplication(f.read(), _subtype='pdf')
+        pdf_attachment.add_header('Content-Disposition', 'attachment', filename='trnda-report.pdf')
+        msg.attach(pdf_attachment)
+    
+    return msg.as_bytes()
+
+
+def send_report_email(pdf_path: str, recipient_email: str, ses=None) -> bool:
+    """Send report PDF via email using AWS SES (synchronously, single attempt)
+    
+    Report runs queue their email in the EmailOutbox instead; this is for
+    one-off sends.
+    
+    Args:
+        pdf_path: Path to PDF file
+        recipient_email: Recipient email address (from --client)
+        ses: Optional SES client (default: new client from environment credentials)
+        
+    Returns:
+        True if sent successfully, False otherwise
+    """
+    try:
+        raw_message = build_report_email(recipient_email, pdf_path)
+        ses = ses or get_ses_client()
+        
+        print(f"[SES] Sending email to {recipient_email} (BCC: {REPORT_EMAIL_BCC})")
+        
+        response = ses.send_raw_email(
+            Source=REPORT_EMAIL_SENDER,
+            Destinations=[recipient_email, REPORT_EMAIL_BCC],
+            RawMessage={'Data': raw_message}
+        )
+        
+        print(f"[OK] Email sent successfully (MessageId: {response['MessageId']})")
+        return True
+        
+    except Exception as e:
+        print(f"[WARNING] Failed to send email: {e}")
+        print(f"         Email notification skipped, but report was generated successfully")
+        return False
+
+
+def is_retryable_email_error(error: Exception) -> bool:
+    """True for throttling, transient service and connection errors"""
+    from botocore.exceptions import ClientError, BotoCoreError
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in RETRYABLE_EMAIL_ERRORS
+    return isinstance(error, (BotoCoreError, ConnectionError, TimeoutError))
+
+
+class EmailOutbox:
+    """Spooled report emails delivered by one background sender thread.
+    
+    enqueue() copies the PDF into the spool directory and returns at once, so
+    SES latency and failures stay off the report run. The sender retries
+    transient errors with exponential backoff and reuses one SES (and S3)
+    client for all emails. PDFs above attachment_max_bytes are sent as a
+    presigned S3 link instead of an attachment.
+    
+    Spool records (<id>.json + <id>.pdf) survive the process: records left
+    behind by a process that is gone are picked up by the next outbox started
+    on the same directory. Pending emails are drained (with a timeout) at
+    interpreter exit.
+    """
+    
+    def __init__(self, spool_dir: str = None, ses=None, s3=None, client_factory=None, region: str = None,
+                 attachment_max_bytes: int = None, link_expires_seconds: int = REPORT_LINK_EXPIRES_SECONDS,
+                 max_attempts: int = 6, base_delay: float = 2.0, max_delay: float = 300.0,
+                 drain_timeout: float = None):
+        """
+        Args:
+            spool_dir: Spool directory (default: TRNDA_OUTBOX env, then ~/.trnda/outbox)
+            ses: Optional SES client (default: created on first send)
+            s3: Optional S3 client for presigned links (default: created on first use)
+            client_factory: Optional callable(service_name, region) -> AWS client
+            region: AWS region for created clients (default: DEFAULT_REGION)
+            attachment_max_bytes: Largest PDF sent as attachment (default: TRNDA_EMAIL_ATTACH_MAX_MB env, then 7 MB)
+            link_expires_seconds: Lifetime of presigned links (SigV4 maximum: 7 days)
+            max_attempts: Attempts per email before it is marked failed
+            base_delay: First retry delay in seconds (doubled per attempt, with jitter)
+            max_delay: Maximum retry delay in seconds
+            drain_timeout: Seconds to wait for pending emails at exit (default: TRNDA_OUTBOX_DRAIN_SECONDS env, then 300)
+        """
+        self.spool_dir = spool_dir or os.environ.get('TRNDA_OUTBOX') or DEFAULT_OUTBOX_DIR
+        self.region = region or DEFAULT_REGION
+        if attachment_max_bytes is None:
+            attachment_max_bytes = float(os.environ.get('TRNDA_EMAIL_ATTACH_MAX_MB', DEFAULT_ATTACHMENT_MAX_MB)) * 1024 * 1024
+        self.attachment_max_bytes = int(attachment_max_bytes)
+        self.link_expires_seconds = link_expires_seconds
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.drain_timeout = drain_timeout if drain_timeout is not None else float(
+            os.environ.get('TRNDA_OUTBOX_DRAIN_SECONDS', '300'))
+        self.stats = {'queued': 0, 'sent': 0, 'failed': 0, 'retries': 0, 'links': 0}
+        
+        self._ses = ses
+        self._s3 = s3
+        self._client_factory = client_factory
+        self._pending = {}
+        self._locks = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        os.makedirs(self.spool_dir, exist_ok=True)
+    
+    # --- clients (one per outbox, reused for every email) ---
+    
+    def _client(self, service_name: str):
+        attr = f"_{service_name}"
+        if getattr(self, attr) is None:
+            if self._client_factory:
+                setattr(self, attr, self._client_factory(service_name, self.region))
+            elif service_name == 'ses':
+                self._ses = get_ses_client(region=self.region)
+            else:
+                self._s3 = get_s3_client(region=self.region)
+        return getattr(self, attr)
+    
+    # --- spool ---
+    
+    def _record_path(self, email_id: str, suffix: str = 'json') -> str:
+        return os.path.join(self.spool_dir, f"{email_id}.{suffix}")
+    
+    def _save(self, record: dict) -> None:
+        import json
+        path = self._record_path(record['id'])
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, indent=2)
+        os.replace(temp_path, path)
+    
+    def _claim(self, email_id: str) -> bool:
+        """Hold an exclusive lock on <id>.lock for as long as this outbox owns the record"""
+        try:
+            import fcntl
+        except ImportError:
+            # No advisory locks (Windows) - only own records are delivered
+            return True
+        handle = open(self._record_path(email_id, 'lock'), 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return False
+        self._locks[email_id] = handle
+        return True
+    
+    def _release(self, email_id: str, remove: bool) -> None:
+        if remove:
+            for suffix in ('json', 'pdf', 'lock'):
+                try:
+                    os.remove(self._record_path(email_id, suffix))
+                except FileNotFoundError:
+                    pass
+        handle = self._locks.pop(email_id, None)
+        if handle:
+            handle.close()
+    
+    def _adopt_orphans(self) -> None:
+        """Pick up pending records whose owning process is gone"""
+        import json
+        import glob
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, '*.json'))):
+            email_id = os.path.basename(path)[:-len('.json')]
+            if email_id in self._pending or not self._claim(email_id):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                self._release(email_id, remove=False)
+                continue
+            if record.get('status') != 'pending':
+                self._release(email_id, remove=False)
+                continue
+            record['next_attempt'] = time.time()
+            self._pending[email_id] = record
+            print(f"[INFO] Email outbox: resuming queued email {email_id} to {record['recipient']}")
+    
+    # --- public API ---
+    
+    def start(self) -> 'EmailOutbox':
+        """Start the sender thread (idempotent); called by enqueue()"""
+        import atexit
+        with self._cond:
+            if self._thread is None:
+                self._adopt_orphans()
+                self._thread = threading.Thread(target=self._run, name='trnda-email-outbox', daemon=True)
+                self._thread.start()
+                atexit.register(self._drain_at_exit)
+        return self
+    
+    def enqueue(self, pdf_path: str, recipient_email: str, run_id: str = None, link_s3_uri: str = None) -> str:
+        """Queue the report email and return immediately
+        
+        Args:
+            pdf_path: Report PDF (copied into the spool directory)
+            recipient_email: Recipient email address
+            run_id: Run ID (for logs)
+            link_s3_uri: S3 location used for the presigned link if the PDF is too big to attach
+                         (uploaded from the spool copy if it does not exist yet)
+            
+        Returns:
+            Email ID
+        """
+        email_id = f"{run_id or new_run_id()}-{uuid.uuid4().hex[:6]}"
+        spool_pdf = self._record_path(email_id, 'pdf')
+        shutil.copyfile(pdf_path, spool_pdf)
+        record = {
+            'id': email_id,
+            'run_id': run_id,
+            'recipient': recipient_email,
+            'pdf': spool_pdf,
+            'bytes': os.path.getsize(spool_pdf),
+            'link_s3_uri': link_s3_uri,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt': time.time(),
+            'error': None,
+        }
+        self._claim(email_id)
+        self._save(record)
+        with self._cond:
+            self._pending[email_id] = record
+            self.stats['queued'] += 1
+            self._cond.notify_all()
+        self.start()
+        delivery = 'link' if record['bytes'] > self.attachment_max_bytes else 'attachment'
+        print(f"[OK] Email to {recipient_email} queued ({delivery}, {record['bytes'] / 1024:.0f} KB, id {email_id})")
+        return email_id
+    
+    def message_bytes(self, pdf_path: str, recipient_email: str) -> int:
+        """Size of the email this outbox sends for a PDF (attachment, or link above attachment_max_bytes)"""
+        if os.path.getsize(pdf_path) > self.attachment_max_bytes:
+            # A presigned link is about 1 KB
+            return len(build_report_email(recipient_email, download_url='https://' + 'x' * 1024))
+        return len(build_report_email(recipient_email, pdf_path))
+    
+    def pending(self) -> int:
+        """Number of emails not yet sent or failed"""
+        with self._cond:
+            return len(self._pending)
+    
+    def drain(self, timeout: float = None) -> bool:
+        """Wait until all queued emails are sent or failed
+        
+        Args:
+            timeout: Maximum seconds to wait (None = no limit)
+            
+        Returns:
+            True if the outbox is empty
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending:
+                if self._closed:
+                    return False
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+    
+    def close(self) -> None:
+        """Stop the sender thread (pending records stay in the spool directory)"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        for email_id in list(self._locks):
+            self._release(email_id, remove=False)
+    
+    def _drain_at_exit(self) -> None:
+        count = self.pending()
+        if not count or self._closed:
+            return
+        print(f"[INFO] Email outbox: waiting for {count} queued email(s) (max {self.drain_timeout:.0f}s)...")
+        if not self.drain(self.drain_timeout):
+            print(f"[WARNING] Email outbox: {self.pending()} email(s) still queued in {self.spool_dir}; "
+                  f"they are sent by the next TRNDA process using this outbox")
+        self.close()
+    
+    # --- sender ---
+    
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = time.time()
+                    due = [r for r in self._pending.values() if r['next_attempt'] <= now]
+                    if due:
+                        break
+                    wake = min((r['next_attempt'] for r in self._pending.values()), default=None)
+                    self._cond.wait(None if wake is None else max(0.0, wake - now))
+                if self._closed:
+                    return
+                record = min(due, key=lambda r: r['next_attempt'])
+            
+            done = self._attempt(record)
+            
+            with self._cond:
+                if done:
+                    self._pending.pop(record['id'], None)
+                    self._cond.notify_all()
+    
+    def _attempt(self, record: dict) -> bool:
+        """One delivery attempt; True when the record is finished (sent or failed)"""
+        import random
+        record['attempts'] += 1
+        try:
+            message_id, delivery = self._deliver(record)
+        except Exception as e:
+            record['error'] = f"{type(e).__name__}: {e}"
+            if is_retryable_email_error(e) and record['attempts'] < self.max_attempts:
+                delay = min(self.max_delay, self.base_delay * 2 ** (record['attempts'] - 1))
+                delay *= random.uniform(0.5, 1.0)
+                record['next_attempt'] = time.time() + delay
+                self.stats['retries'] += 1
+                self._save(record)
+                print(f"[RETRY] Email {record['id']}: {record['error']} - retry "
+                      f"{record['attempts']}/{self.max_attempts - 1} in {delay:.1f}s")
+                return False
+            record['status'] = 'failed'
+            self.stats['failed'] += 1
+            self._save(record)
+            self._release(record['id'], remove=False)
+            print(f"[WARNING] Failed to send email {record['id']} to {record['recipient']}: {record['error']}")
+            print(f"         Report was generated successfully; record kept in {self.spool_dir}")
+            return True
+        
+        record.update(status='sent', message_id=message_id, delivery=delivery,
+                      sent=datetime.now().isoformat(timespec='seconds'))
+        self.stats['sent'] += 1
+        self._release(record['id'], remove=True)
+        print(f"[OK] Email {record['id']} sent to {record['recipient']} by {delivery} "
+              f"(MessageId: {message_id}, attempt {record['attempts']})")
+        return True
+    
+    def _deliver(self, record: dict) -> tuple:
+        """Send the email (attachment or presigned link)
+        
+        Returns:
+            (SES message ID, 'attachment' or 'link')
+        """
+        download_url, link_expires = None, None
+        if record['bytes'] > self.attachment_max_bytes:
+            download_url, link_expires = self._presigned_link(record)
+        
+        raw_message = build_report_email(record['recipient'], record['pdf'], download_url, link_expires)
+        response = self._client('ses').send_raw_email(
+            Source=REPORT_EMAIL_SENDER,
+            Destinations=[record['recipient'], REPORT_EMAIL_BCC],
+            RawMessage={'Data': raw_message}
+        )
+        if download_url:
+            self.stats['links'] += 1
+        return response['MessageId'], 'link' if download_url else 'attachment'
+    
+    def _presigned_link(self, record: dict) -> tuple:
+        """Presigned GET link to the PDF in S3 (uploads the spooled copy if the object is missing)"""
+        from datetime import timedelta
+        from botocore.exceptions import ClientError
+        
+        if not record.get('link_s3_uri'):
+            raise ValueError(f"PDF is {record['bytes'] / 1024 / 1024:.1f} MB (attachment limit "
+                             f"{self.attachment_max_bytes / 1024 / 1024:.1f} MB) and no S3 location was given")
+        s3 = self._client('s3')
+        bucket, key = parse_s3_path(record['link_s3_uri'])
+        try:
+            s3.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+            s3.upload_file(record['pdf'], bucket, key, ExtraArgs={'ContentType': 'application/pdf'})
+            print(f"[OK] Email {record['id']}: uploaded PDF to {record['link_s3_uri']} for the download link")
+        
+        url = s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket, 'Key': key,
+                    'ResponseContentDisposition': 'attachment; filename="trnda-report.pdf"'},
+            ExpiresIn=self.link_expires_seconds
+        )
+        return url, datetime.now() + timedelta(seconds=self.link_expires_seconds)
+
+
+_email_outboxes = {}
+_email_outboxes_lock = threading.Lock()
+
+
+def get_email_outbox(spool_dir: str = None, client_factory=None, aws_profile: str = None,
+                     region: str = None) -> EmailOutbox:
+    """Process-wide outbox per spool directory and AWS clients (one sender thread and SES client each)
+    
+    Contexts with the same spool directory, client factory, profile and region
+    share one outbox; a different client factory (or profile, region) gets its
+    own, so its emails go through its own SES client. Outboxes on the same
+    spool directory never deliver the same record (per-record locks).
+    
+    Args:
+        spool_dir: Spool directory (default: TRNDA_OUTBOX env, then ~/.trnda/outbox)
+        client_factory: Optional callable(service_name, region) -> AWS client
+        aws_profile: AWS profile for created clients
+        region: AWS region
+        
+    Returns:
+        EmailOutbox instance
+    """
+    spool_dir = os.path.abspath(spool_dir or os.environ.get('TRNDA_OUTBOX') or DEFAULT_OUTBOX_DIR)
+    key = (spool_dir, client_factory, aws_profile, region)
+    with _email_outboxes_lock:
+        if key not in _email_outboxes:
+            if client_factory is None and aws_profile:
+                def client_factory(service_name, client_region, profile=aws_profile):
+                    if service_name == 'ses':
+                        return get_ses_client(profile, client_region)
+                    return get_s3_client(profile, client_region)
+            _email_outboxes[key] = EmailOutbox(spool_dir, client_factory=client_factory, region=region)
+        return _email_outboxes[key]
+
+
+def is_s3_path(path: str) -> bool:
+    """Check if path is an S3 path"""
+    return path.startswith('s3://')
+
+
+def parse_s3_path(s3_path: str) -> tuple:
+    """Parse S3 path into bucket and key
+    
+    Args:
+        s3_path: S3 path in format s3://bucket/key
+        
+    Returns:
+        Tuple of (bucket, key)
+    """
+    if not s3_path.startswith('s3://'):
+        raise ValueError(f"Invalid S3 path: {s3_path}")
+    
+    path = s3_path[5:]  # Remove 's3://'
+    parts = path.split('/', 1)
+    
+    if len(parts) == 1:
+        return parts[0], ''
+    return parts[0], parts[1]
+
+
+def download_from_s3(s3_path: str, local_path: str, s3=None) -> str:
+    """Download file from S3
+    
+    Args:
+        s3_path: S3 path (s3://bucket/key)
+        local_path: Local path to save file
+        s3: Optional S3 client (default: new client from environment credentials)
+        
+    Returns:
+        Path to downloaded file
+    """
+    bucket, key = parse_s3_path(s3_path)
+    
+    # Add input/ prefix if not present and key doesn't start with it
+    key = normalize_input_key(key)
+    
+    print(f"[S3] Downloading s3://{bucket}/{key}")
+    
+    try:
+        s3 = s3 or get_s3_client()
+        os.makedirs(os.path.dirname(local_path) if os.path.dirname(local_path) else '.', exist_ok=True)
+        s3.download_file(bucket, key, local_path)
+        print(f"[OK] Downloaded to {local_path}")
+        return local_path
+    except Exception as e:
+        print(f"[ERROR] Failed to download from S3: {e}")
+        raise
+
+
+def upload_directory_to_s3(local_dir: str, s3_bucket: str, s3_prefix: str, s3=None, trace: RunTrace = None) -> list:
+    """Upload entire directory to S3
+    
+    Args:
+        local_dir: Local directory path
+        s3_bucket: S3 bucket name
+        s3_prefix: S3 prefix (folder)
+        s3: Optional S3 client (default: new client from environment credentials)
+        trace: Optional run trace (one span per uploaded file)
+        
+    Returns:
+        List of uploaded S3 keys
+    """
+    s3 = s3 or get_s3_client()
+    
+    print(f"[S3] Uploading results to s3://{s3_bucket}/{s3_prefix}/")
+    
+    uploaded_files = []
+    uploaded_bytes = 0
+    
+    for root, dirs, files in os.walk(local_dir):
+        for file in files:
+            local_file = os.path.join(root, file)
+            relative_path = os.path.relpath(local_file, local_dir)
+            s3_key = f"{s3_prefix}/{relative_path}".replace('\\', '/')
+            
+            try:
+                upload_start = time.time()
+                s3.upload_file(local_file, s3_bucket, s3_key, ExtraArgs=artifact_upload_args(file))
+                if trace:
+                    trace.add_span(s3_key, 's3', upload_start, time.time() - upload_start,
+                                   operation='upload', bytes=os.path.getsize(local_file))
+                print(f"[OK] Uploaded s3://{s3_bucket}/{s3_key}")
+                uploaded_files.append(s3_key)
+                uploaded_bytes += os.path.getsize(local_file)
+            except Exception as e:
+                print(f"[ERROR] Failed to upload {s3_key}: {e}")
+    
+    print(f"[S3] Uploaded {len(uploaded_files)} file(s), {uploaded_bytes / 1024:.0f} KB")
+    return uploaded_files
+
+
+# Processed-inputs manifest: s3://bucket/key -> {etag, output, run_id, processed}
+# TRNDA_MANIFEST: manifest file ('off' disables), TRNDA_MANIFEST_S3: s3://bucket/key of a
+# shared manifest object (ECS tasks and operator machines see the same processed inputs)
+DEFAULT_MANIFEST_PATH = os.path.join(os.path.expanduser('~'), '.trnda', 'manifest.json')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def normalize_input_key(key: str) -> str:
+    """Input key as download_from_s3 resolves it (input/ prefix added to bare names)"""
+    if key and not key.startswith('input/') and not key.startswith('output/'):
+        return f"input/{key}"
+    return key
+
+
+def status_key(input_key: str) -> str:
+    """S3 key of an input's status object: input/<name> -> status/<name>.json"""
+    key = normalize_input_key(input_key)
+    name = key[len('input/'):] if key.startswith('input/') else key
+    return f"status/{name}.json"
+
+
+def is_s3_prefix(path: str) -> bool:
+    """Check if path is an S3 prefix (s3://bucket/prefix/) rather than one object"""
+    return is_s3_path(path) and path.endswith('/')
+
+
+def list_s3_images(s3_uri: str, s3=None) -> list:
+    """List image objects under an S3 prefix (all pages)
+    
+    Args:
+        s3_uri: S3 prefix (s3://bucket/input/)
+        s3: Optional S3 client (default: new client from environment credentials)
+        
+    Returns:
+        List of {uri, key, etag, size} dictionaries, sorted by key
+    """
+    s3 = s3 or get_s3_client()
+    bucket, prefix = parse_s3_path(s3_uri)
+    images = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].lower().endswith(IMAGE_EXTENSIONS):
+                images.append({'uri': f"s3://{bucket}/{obj['Key']}", 'key': obj['Key'],
+                               'etag': obj['ETag'], 'size': obj['Size']})
+    return sorted(images, key=lambda image: image['key'])
+
+
+def _read_s3_manifest(s3_uri: str, s3) -> tuple:
+    """Manifest object and its ETag ({} and None if it does not exist yet)"""
+    import json
+    bucket, key = parse_s3_path(s3_uri)
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return {}, None
+        raise
+    return json.loads(response['Body'].read().decode('utf-8') or '{}'), response.get('ETag')
+
+
+def load_manifest(manifest_path: str = None, s3_uri: str = None, s3=None) -> dict:
+    """Load the processed-inputs manifest ({} if it does not exist)
+    
+    Args:
+        manifest_path: Local manifest file (None = no local manifest)
+        s3_uri: Optional s3://bucket/key of a shared manifest object
+        s3: S3 client (default: new client from environment credentials)
+        
+    Returns:
+        Entries of both manifests (the S3 entry wins for inputs in both)
+    """
+    import json
+    manifest = {}
+    if manifest_path and os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest.update(json.load(f))
+    if s3_uri:
+        manifest.update(_read_s3_manifest(s3_uri, s3 or get_s3_client())[0])
+    return manifest
+
+
+def is_processed(manifest: dict, input_uri: str, etag: str) -> bool:
+    """True if this exact object version (key + ETag) already produced a report"""
+    entry = manifest.get(input_uri)
+    return bool(entry) and entry.get('etag') == etag
+
+
+def update_manifest(manifest_path: str, input_uri: str, entry: dict, s3_uri: str = None, s3=None) -> None:
+    """Record a processed input (read-modify-write under a lock, atomic replace)
+    
+    Args:
+        manifest_path: Manifest file (None = no local manifest)
+        input_uri: s3://bucket/key of the input
+        entry: Manifest entry (etag, output, run_id, processed)
+        s3_uri: Optional s3://bucket/key of a shared manifest object
+        s3: S3 client (required with s3_uri)
+    """
+    import json
+    if manifest_path:
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+        with open(f"{manifest_path}.lock", 'a') as lock:
+            try:
+                import fcntl
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            except ImportError:
+                pass
+            manifest = load_manifest(manifest_path)
+            manifest[input_uri] = entry
+            temp_path = f"{manifest_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.replace(temp_path, manifest_path)
+    
+    if s3_uri and s3 is not None:
+        bucket, key = parse_s3_path(s3_uri)
+        # Read-modify-write with a conditional put; retried if another task wrote in between
+        for attempt in range(5):
+            manifest, etag = _read_s3_manifest(s3_uri, s3)
+            manifest[input_uri] = entry
+            body = json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+            conditions = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType='application/json', **conditions)
+                return
+            except Exception as e:
+                code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+                if code not in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+                    raise
+                time.sleep(0.2 * (attempt + 1))
+        raise RuntimeError(f"Manifest {s3_uri} kept changing, {input_uri} not recorded")
+
+
+# Near-duplicate inputs - perceptual hashes (dHash + pHash, 64 bits each) of processed images
+# with their output location. Confidence = 1 - (dHash + pHash Hamming distance) / 128.
+# TRNDA_SIMILARITY_INDEX: index file ('off' disables), TRNDA_SIMILARITY_S3: s3://bucket/key of a
+# shared index (ECS tasks), TRNDA_REUSE_CONFIDENCE / TRNDA_SEED_CONFIDENCE: decision thresholds
+# (read by RunContext)
+DEFAULT_SIMILARITY_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.trnda', 'similarity.jsonl')
+DEFAULT_REUSE_CONFIDENCE = 0.95
+DEFAULT_SEED_CONFIDENCE = 0.85
+
+
+def _hash_bits(values: list, threshold: float) -> int:
+    """Pack values into an int, one bit per value (1 = above threshold)"""
+    bits = 0
+    for value in values:
+        bits = (bits << 1) | (value > threshold)
+    return bits
+
+
+def image_hashes(image_path: str) -> tuple:
+    """Perceptual hashes of an image (robust to re-photographing, lighting and compression)
+    
+    dHash compares neighbouring pixels of a 9x8 thumbnail, pHash compares the
+    lowest 8x8 DCT frequencies of a 32x32 thumbnail with their median.
+    
+    Returns:
+        (dhash, phash) as 64-bit ints
+    """
+    import math
+    from PIL import Image, ImageOps
+    
+    with Image.open(image_path) as img:
+        # JPEGs are decoded at reduced scale - the hashes only need 32x32 pixels
+        img.draft('L', (256, 256))
+        gray = ImageOps.exif_transpose(img).convert('L')
+    
+    small = list(gray.resize((9, 8), Image.LANCZOS).getdata())
+    dhash = 0
+    for row in range(8):
+        for col in range(8):
+            dhash = (dhash << 1) | (small[row * 9 + col] > small[row * 9 + col + 1])
+    
+    pixels = list(gray.resize((32, 32), Image.LANCZOS).getdata())
+    cosines = [[math.cos((2 * x + 1) * u * math.pi / 64) for x in range(32)] for u in range(8)]
+    # Separable 2D DCT-II, only the 8x8 lowest frequencies are needed
+    rows = [[sum(pixels[y * 32 + x] * cosines[u][x] for x in range(32)) for u in range(8)] for y in range(32)]
+    dct = [sum(rows[y][u] * cosines[v][y] for y in range(32)) for v in range(8) for u in range(8)]
+    # DC term excluded from the median (it only reflects overall brightness)
+    median = sorted(dct[1:])[31]
+    phash = _hash_bits(dct, median)
+    return dhash, phash
+
+
+def similarity_confidence(dhash_distance: int, phash_distance: int) -> float:
+    """Confidence that two images show the same sketch (1.0 = identical hashes, ~0.5 = unrelated)"""
+    return max(0.0, 1.0 - (dhash_distance + phash_distance) / 128.0)
+
+
+class SimilarityIndex:
+    """Perceptual-hash index of processed inputs with sub-millisecond lookups.
+    
+    Multi-index hashing: the dHash is split into four 16-bit bands, each with
+    its own bucket table. Two hashes within max_distance bits differ in at
+    most max_distance // 4 bits of some band (pigeonhole), so a lookup probes
+    each band's buckets within that radius and only compares the entries
+    found there. Entries are appended to a local JSONL file and/or kept in
+    one S3 object.
+    """
+    
+    def __init__(self, path: str = None, s3_uri: str = None, s3=None, max_distance: int = 11):
+        """
+        Args:
+            path: Local JSONL index file (None = no local file)
+            s3_uri: Optional s3://bucket/key of a shared index object
+            s3: S3 client (required with s3_uri)
+            max_distance: Largest dHash distance a match may have
+        """
+        import itertools
+        self.path = path
+        self.s3_uri = s3_uri
+        self.s3 = s3
+        self.max_distance = max_distance
+        self._bands = [(16 * i, 16 * (i + 1)) for i in range(4)]
+        self._buckets = [{} for _ in self._bands]
+        # XOR masks of all 16-bit keys within the band radius
+        radius = max_distance // len(self._bands)
+        self._probes = [sum(1 << bit for bit in bits)
+                        for r in range(radius + 1) for bits in itertools.combinations(range(16), r)]
+        self.entries = []
+        self._loaded_size = 0
+        self._s3_loaded = False
+        self._lock = threading.Lock()
+        self.load()
+    
+    def _band_keys(self, dhash: int) -> list:
+        return [(dhash >> start) & ((1 << (end - start)) - 1) for start, end in self._bands]
+    
+    def _insert(self, entry: dict) -> None:
+        entry['_dhash'] = int(entry['dhash'], 16)
+        entry['_phash'] = int(entry['phash'], 16)
+        self.entries.append(entry)
+        for buckets, key in zip(self._buckets, self._band_keys(entry['_dhash'])):
+            buckets.setdefault(key, []).append(entry)
+    
+    def _parse(self, text: str, source: str) -> None:
+        import json
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                self._insert(json.loads(line))
+            except (ValueError, KeyError):
+                print(f"[WARNING] Skipping malformed similarity index line in {source}")
+    
+    def _read_s3(self) -> tuple:
+        """Index object text and ETag ('' and None if it does not exist yet)"""
+        bucket, key = parse_s3_path(self.s3_uri)
+        try:
+            response = self.s3.get_object(Bucket=bucket, Key=key)
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return '', None
+            raise
+        return response['Body'].read().decode('utf-8'), response.get('ETag')
+    
+    def load(self) -> None:
+        """(Re)load all entries; a local file is only re-read from where it was last read"""
+        with self._lock:
+            if self.path and os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    f.seek(self._loaded_size)
+                    text = f.read()
+                    self._loaded_size = f.tell()
+                self._parse(text, self.path)
+            if self.s3_uri and self.s3 is not None and not self._s3_loaded:
+                try:
+                    self._parse(self._read_s3()[0], self.s3_uri)
+                    self._s3_loaded = True
+                except Exception as e:
+                    print(f"[WARNING] Could not load similarity index {self.s3_uri}: {e}")
+    
+    def lookup(self, dhash: int, phash: int) -> tuple:
+        """Most similar indexed image within max_distance dHash bits
+        
+        Returns:
+            (entry, confidence, dhash_distance, phash_distance), or None if nothing is close enough
+        """
+        best = None
+        seen = set()
+        for buckets, key in zip(self._buckets, self._band_keys(dhash)):
+            for probe in self._probes:
+                for entry in buckets.get(key ^ probe, ()):
+                    if id(entry) in seen:
+                        continue
+                    seen.add(id(entry))
+                    dhash_distance = (entry['_dhash'] ^ dhash).bit_count()
+                    if dhash_distance > self.max_distance:
+                        continue
+                    phash_distance = (entry['_phash'] ^ phash).bit_count()
+                    confidence = similarity_confidence(dhash_distance, phash_distance)
+                    if best is None or confidence > best[1]:
+                        best = (entry, confidence, dhash_distance, phash_distance)
+        if best:
+            best = ({k: v for k, v in best[0].items() if not k.startswith('_')},) + best[1:]
+        return best
+    
+    def add(self, entry: dict) -> None:
+        """Add an entry ({dhash, phash, output, run_id, ...}) to the index and persist it"""
+        import json
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        
+        with self._lock:
+            if self.path:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                # One write() per entry in append mode - concurrent runs do not interleave lines
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+                    self._loaded_size = f.tell()
+            self._insert(dict(entry))
+        
+        if self.s3_uri and self.s3 is not None:
+            bucket, key = parse_s3_path(self.s3_uri)
+            # Read-modify-write with a conditional put; retried if another task wrote in between
+            for attempt in range(5):
+                text, etag = self._read_s3()
+                conditions = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+                try:
+                    self.s3.put_object(Bucket=bucket, Key=key, Body=(text + line).encode('utf-8'),
+                                       ContentType='application/x-ndjson', **conditions)
+                    return
+                except Exception as e:
+                    code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+                    if code not in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+                        raise
+                    time.sleep(0.2 * (attempt + 1))
+            raise RuntimeError(f"Similarity index {self.s3_uri} kept changing, entry not stored")
+
+
+_similarity_indexes = {}
+_similarity_indexes_lock = threading.Lock()
+
+
+def get_similarity_index(path: str = None, s3_uri: str = None, s3=None) -> SimilarityIndex:
+    """Similarity index shared by all runs of this process (local file re-read for new entries)"""
+    with _similarity_indexes_lock:
+        index = _similarity_indexes.get((path, s3_uri))
+        if index is None:
+            index = _similarity_indexes[(path, s3_uri)] = SimilarityIndex(path, s3_uri, s3)
+        else:
+            index.load()
+        return index
+
+
+# Model image: Claude scales anything with a longer edge down to this size, so
+# bigger inputs only cost upload and decode time. The web app exports photos
+# with this edge and quality and marks them with trnda-preprocessed metadata.
+MODEL_IMAGE_MAX_EDGE = 1568
+MODEL_IMAGE_QUALITY = 85
+# Bedrock has a 5 MB image limit; keep a buffer for the base64 encoding overhead
+MODEL_IMAGE_MAX_MB = 3.5
+PREPROCESSED_METADATA_KEY = 'trnda-preprocessed'
+
+
+def parse_preprocessed_metadata(value: str) -> dict:
+    """Parse trnda-preprocessed S3 metadata of a web app upload
+    
+    Args:
+        value: Metadata value, e.g. "w=1568,h=1176,q=0.85,src=4032x3024,ms=180"
+        
+    Returns:
+        Dictionary of the fields (width 'w' and height 'h' as int), None if missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        fields = dict(part.split('=', 1) for part in value.split(',') if part)
+        fields['w'], fields['h'] = int(fields['w']), int(fields['h'])
+        return fields
+    except (KeyError, ValueError):
+        print(f"[WARNING] Ignoring invalid {PREPROCESSED_METADATA_KEY} metadata: {value}")
+        return None
+
+
+def get_image_dimensions(image_path: str) -> tuple:
+    """Get image dimensions and aspect ratio.
+    
+    Args:
+        image_path: Path to the image
+        
+    Returns:
+        Tuple of (width, height, aspect_ratio, is_portrait)
+    """
+    try:
+        from PIL import Image
+        img = Image.open(image_path)
+        width, height = img.size
+        aspect_ratio = width / height
+        is_portrait = height > width
+        
+        print(f"[INFO] Image dimensions: {width}x{height}, aspect_ratio={aspect_ratio:.2f}, {'PORTRAIT' if is_portrait else 'LANDSCAPE'}")
+        
+        return width, height, aspect_ratio, is_portrait
+    except Exception as e:
+        print(f"[WARNING] Could not get image dimensions: {e}")
+        return None, None, 1.0, False
+
+
+def compress_image_if_needed(image_path: str, max_size_mb: float = 4.0, output_dir: str = None) -> str:
+    """Compress image if it exceeds max size.
+    
+    Args:
+        image_path: Path to the image
+        max_size_mb: Maximum size in MB (default 4.0 to be safe under 5MB limit)
+        output_dir: Directory for the compressed copy (default: next to the input)
+        
+    Returns:
+        Path to compressed image (or original if no compression needed)
+    """
+    try:
+        from PIL import Image
+        import io
+        
+        # Check current size
+        current_size_mb = os.path.getsize(image_path) / (1024 * 1024)
+        
+        if current_size_mb <= max_size_mb:
+            return image_path
+        
+        print(f"[INFO] Image is {current_size_mb:.1f}MB, compressing to under {max_size_mb}MB...")
+        
+        # Open image
+        img = Image.open(image_path)
+        
+        # Convert RGBA to RGB if needed
+        if img.mode == 'RGBA':
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[3])
+            img = background
+        elif img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        
+        # Create compressed version
+        compressed_path = image_path.rsplit('.', 1)[0] + '_compressed.jpg'
+        if output_dir:
+            compressed_path = os.path.join(output_dir, os.path.basename(compressed_path))
+        
+        # Start with quality 85 and reduce if needed
+        quality = MODEL_IMAGE_QUALITY
+        while quality > 20:
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=quality, optimize=True)
+            size_mb = len(buffer.getvalue()) / (1024 * 1024)
+            
+            if size_mb <= max_size_mb:
+                with open(compressed_path, 'wb') as f:
+                    f.write(buffer.getvalue())
+                print(f"[OK] Compressed to {size_mb:.1f}MB (quality={quality})")
+                return compressed_path
+            
+            quality -= 5
+        
+        # If still too large, resize
+        print("[INFO] Quality reduction not enough, resizing...")
+        img.thumbnail((MODEL_IMAGE_MAX_EDGE, MODEL_IMAGE_MAX_EDGE), Image.Resampling.LANCZOS)
+        
+        quality = MODEL_IMAGE_QUALITY
+        while quality > 20:
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=quality, optimize=True)
+            size_mb = len(buffer.getvalue()) / (1024 * 1024)
+            
+            if size_mb <= max_size_mb:
+                with open(compressed_path, 'wb') as f:
+                    f.write(buffer.getvalue())
+                print(f"[OK] Resized and compressed to {size_mb:.1f}MB (quality={quality})")
+                return compressed_path
+            
+            quality -= 5
+        
+        # Last resort - save whatever we have
+        img.save(compressed_path, format='JPEG', quality=20, optimize=True)
+        final_size_mb = os.path.getsize(compressed_path) / (1024 * 1024)
+        print(f"[WARNING] Best effort compression: {final_size_mb:.1f}MB")
+        return compressed_path
+        
+    except Exception as e:
+        print(f"[WARNING] Could not compress image: {e}")
+        return image_path
+
+
+# Report images are printed at most this large: pandoc's default US letter page with the
+# 2 cm margins of the PDF, REPORT_IMAGE_HEIGHTS of \textheight, REPORT_IMAGE_DPI.
+# Anything bigger only adds bytes to the PDF, the email and the S3 upload.
+REPORT_TEXT_WIDTH_INCHES = 8.5 - 2 * 2 / 2.54
+REPORT_TEXT_HEIGHT_INCHES = 11.0 - 2 * 2 / 2.54
+REPORT_IMAGE_DPI = 200
+INPUT_IMAGE_NAME = 'diagram_input'
+REPORT_IMAGE_HEIGHTS = {
+    INPUT_IMAGE_NAME: 0.5,
+    'generated-diagrams/diagram_as_is.png': 0.7,
+    'generated-diagrams/diagram_well_architected.png': 0.7,
+}
+# Pillow format -> extension of the stored input image (others are converted to PNG)
+INPUT_IMAGE_EXTENSIONS = {'JPEG': '.jpg', 'MPO': '.jpg', 'PNG': '.png'}
+# Uploaded report files: rendered images and PDFs do not change, everything else may
+# be rewritten by a resume
+ARTIFACT_CACHE_CONTROL = 'private, max-age=86400'
+ARTIFACT_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.pdf')
+
+
+def find_input_image(output_dir: str) -> str:
+    """Path of the input image stored in an output directory (diagram_input.jpg or .png)"""
+    for extension in ('.jpg', '.png'):
+        path = os.path.join(output_dir, INPUT_IMAGE_NAME + extension)
+        if os.path.exists(path):
+            return path
+    return os.path.join(output_dir, INPUT_IMAGE_NAME + '.png')
+
+
+def store_input_image(image_path: str, output_dir: str) -> str:
+    """Store the input image in the output directory under its real format
+    
+    JPEG stays JPEG (diagram_input.jpg), PNG stays PNG; other formats are
+    converted to PNG, which pandoc/LaTeX can embed.
+    
+    Args:
+        image_path: Preprocessed input image
+        output_dir: Output directory
+        
+    Returns:
+        Path of the stored image
+    """
+    from PIL import Image
+    
+    with Image.open(image_path) as img:
+        extension = INPUT_IMAGE_EXTENSIONS.get(img.format)
+        dest = os.path.join(output_dir, INPUT_IMAGE_NAME + (extension or '.png'))
+        if not extension:
+            img.save(dest, format='PNG', optimize=True)
+            return dest
+    shutil.copy2(image_path, dest)
+    return dest
+
+
+def printed_size(height_fraction: float) -> tuple:
+    """Largest pixel size (width, height) an image placed at height_fraction of \textheight is printed at"""
+    return (int(REPORT_TEXT_WIDTH_INCHES * REPORT_IMAGE_DPI),
+            int(REPORT_TEXT_HEIGHT_INCHES * height_fraction * REPORT_IMAGE_DPI))
+
+
+def optimize_image(path: str, max_size: tuple) -> dict:
+    """Downscale an image to max_size and re-save it optimized (PNG losslessly)
+    
+    A PNG is re-compressed with optimize=True even when it already fits; a
+    JPEG is only re-encoded when it has to be downscaled. The file is replaced
+    only if the result is smaller.
+    
+    Args:
+        path: PNG or JPEG file
+        max_size: Largest (width, height) in pixels
+        
+    Returns:
+        Dictionary with bytes_before, bytes, size (pixels) and resized
+    """
+    import io
+    from PIL import Image
+    
+    before = os.path.getsize(path)
+    with Image.open(path) as img:
+        image_format = img.format
+        img.load()
+    original_size = img.size
+    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+    resized = img.size != original_size
+    
+    buffer = io.BytesIO()
+    if image_format == 'PNG':
+        img.save(buffer, format='PNG', optimize=True)
+    elif resized:
+        img = img if img.mode in ('RGB', 'L') else img.convert('RGB')
+        img.save(buffer, format='JPEG', quality=MODEL_IMAGE_QUALITY, optimize=True)
+    
+    data = buffer.getvalue()
+    if data and len(data) < before:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    else:
+        resized = False
+    
+    with Image.open(path) as final:
+        size = list(final.size)
+    return {'bytes_before': before, 'bytes': os.path.getsize(path), 'size': size, 'resized': resized}
+
+
+def optimize_report_images(output_dir: str, checkpoint: dict = None, names: list = None,
+                           trace: RunTrace = None) -> dict:
+    """Optimization pass over the report images before PDF rendering and upload
+    
+    Every image is downscaled to the size it is printed at in the PDF
+    (printed_size) and optimized (optimize_image). Images already recorded in
+    checkpoint 'artifact_sizes' with their current size are skipped, so the
+    pass can run after every stage and again in post-processing.
+    
+    Args:
+        output_dir: Output directory
+        checkpoint: Optional checkpoint ('artifact_sizes' -> 'images' is updated, not saved)
+        names: Images to optimize (default: all of REPORT_IMAGE_HEIGHTS)
+        trace: Optional run trace (one 'optimize_image' span per image)
+        
+    Returns:
+        Dictionary of image name -> optimize_image result (optimized images only)
+    """
+    images = (checkpoint.setdefault('artifact_sizes', {}).setdefault('images', {})
+              if checkpoint is not None else {})
+    optimized = {}
+    
+    for name in names or list(REPORT_IMAGE_HEIGHTS):
+        path = find_input_image(output_dir) if name == INPUT_IMAGE_NAME else os.path.join(output_dir, name)
+        if not os.path.exists(path):
+            continue
+        key = os.path.relpath(path, output_dir)
+        if images.get(key, {}).get('bytes') == os.path.getsize(path):
+            continue
+        try:
+            start = time.time()
+            result = optimize_image(path, printed_size(REPORT_IMAGE_HEIGHTS[name]))
+            if trace:
+                trace.add_span(key, 'optimize_image', start, time.time() - start,
+                               bytes=result['bytes'], bytes_before=result['bytes_before'])
+            images[key] = optimized[key] = result
+            print(f"[OK] Optimized {key}: {result['bytes_before'] / 1024:.0f} KB -> {result['bytes'] / 1024:.0f} KB "
+                  f"({result['size'][0]}x{result['size'][1]})")
+        except Exception as e:
+            print(f"[WARNING] Could not optimize {key}: {e}")
+    
+    return optimized
+
+
+def artifact_upload_args(filename: str) -> dict:
+    """ExtraArgs (Content-Type, Cache-Control) for uploading a report file to S3"""
+    import mimetypes
+    
+    content_type = {'.md': 'text/markdown; charset=utf-8', '.json': 'application/json',
+                    '.jsonl': 'application/x-ndjson', '.folded': 'text/plain; charset=utf-8'}.get(os.path.splitext(filename)[1].lower())
+    content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') and 'charset' not in content_type:
+        content_type += '; charset=utf-8'
+    cache_control = ARTIFACT_CACHE_CONTROL if filename.lower().endswith(ARTIFACT_EXTENSIONS) else 'no-cache'
+    return {'ContentType': content_type, 'CacheControl': cache_control}
+
+
+@tool
+def write_file(filepath: str, content: str) -> str:
+    """Write content to a file.
+    
+    Args:
+        filepath: Path to the file to write
+        content: Content to write to the file
+        
+    Returns:
+        Success message
+    """
+    try:
+        # Ensure directory exists
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.write(content)
+        
+        return f"Successfully written to {filepath}"
+    except Exception as e:
+        return f"Error writing file: {e}"
+
+
+# Structured report payload written by the model; design.md is rendered from it
+REPORT_DATA_FILE = 'architecture.json'
+COST_SCENARIOS = ('low', 'medium', 'high')
+
+
+def validate_report_data(data: dict) -> list:
+    """Check a report payload for missing or malformed fields
+    
+    Returns:
+        List of problems (empty if valid)
+    """
+    problems = []
+    if not str(data.get('title') or '').strip():
+        problems.append("title is empty")
+    for field in ('as_is_components', 'improvements', 'benefits'):
+        if not data.get(field):
+            problems.append(f"{field} is empty")
+    for field in ('as_is_costs', 'well_architected_costs'):
+        costs = data.get(field) or {}
+        for scenario in COST_SCENARIOS:
+            try:
+                float(costs[scenario])
+            except (KeyError, TypeError, ValueError):
+                problems.append(f"{field}.{scenario} must be a number (monthly USD)")
+    breakdown = data.get('as_is_cost_breakdown') or {}
+    for scenario in COST_SCENARIOS:
+        if not breakdown.get(scenario):
+            problems.append(f"as_is_cost_breakdown.{scenario} is empty")
+    return problems
+
+
+@tool
+def save_report_data(output_dir: str, title: str, as_is_components: list[str], as_is_notes: list[str],
+                     as_is_costs: dict[str, float], as_is_cost_breakdown: dict[str, list[str]],
+                     improvements: list[str], well_architected_costs: dict[str, float],
+                     benefits: list[str]) -> str:
+    """Save the report content as architecture.json. design.md (headers, diagrams,
+    cost tables with differences) is rendered from it - do NOT write markdown.
+    
+    Args:
+        output_dir: Output directory of this run
+        title: Short architecture name (e.g. "Web Application")
+        as_is_components: As-Is components, one short bullet each
+        as_is_notes: Notes, comments and requirements found in the hand-drawn diagram, one bullet each
+        as_is_costs: As-Is monthly cost in USD per scenario: {"low": 45.2, "medium": 78.9, "high": 156.4}
+        as_is_cost_breakdown: As-Is cost lines per scenario: {"low": ["EC2 t4g.micro: $7.01", ...], "medium": [...], "high": [...]}
+        improvements: Well-Architected improvements, one short bullet each
+        well_architected_costs: Well-Architected monthly cost in USD per scenario (same keys as as_is_costs)
+        benefits: Key benefits of the Well-Architected design, one short bullet each
+        
+    Returns:
+        Success message or list of problems to fix
+    """
+    import json
+    
+    data = {
+        'title': title,
+        'as_is_components': list(as_is_components or []),
+        'as_is_notes': list(as_is_notes or []),
+        'as_is_costs': {k.lower(): v for k, v in (as_is_costs or {}).items()},
+        'as_is_cost_breakdown': {k.lower(): list(v) for k, v in (as_is_cost_breakdown or {}).items()},
+        'improvements': list(improvements or []),
+        'well_architected_costs': {k.lower(): v for k, v in (well_architected_costs or {}).items()},
+        'benefits': list(benefits or []),
+    }
+    
+    problems = validate_report_data(data)
+    if problems:
+        return "Error: fix and call save_report_data again: " + "; ".join(problems)
+    
+    for field in ('as_is_costs', 'well_architected_costs'):
+        data[field] = {scenario: round(float(data[field][scenario]), 2) for scenario in COST_SCENARIOS}
+    
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, REPORT_DATA_FILE)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        return f"Successfully saved report data to {path}"
+    except Exception as e:
+        return f"Error writing report data: {e}"
+
+
+def run_process_group(cmd: list, timeout: float = None, cwd: str = None) -> subprocess.CompletedProcess:
+    """subprocess.run in a new process group; on timeout the whole group is killed
+    
+    pandoc starts LaTeX as a child process - killing only pandoc would leave
+    it running.
+    
+    Args:
+        cmd: Command and arguments
+        timeout: Seconds before the process group is killed (None = no limit)
+        cwd: Working directory
+        
+    Returns:
+        Completed process (text stdout/stderr)
+        
+    Raises:
+        subprocess.TimeoutExpired: The command ran longer than timeout (group already killed)
+    """
+    import signal
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=cwd,
+                               start_new_session=True)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.communicate()
+        raise
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+def pandoc_timeout() -> float:
+    """Seconds pandoc may run (TRNDA_PANDOC_TIMEOUT env, then DEFAULT_PANDOC_TIMEOUT; 0 = no limit)"""
+    return float(os.environ.get('TRNDA_PANDOC_TIMEOUT', DEFAULT_PANDOC_TIMEOUT)) or None
+
+
+def build_system_prompt():
+    """Simple system prompt - the report content is returned as structured data
+    (save_report_data), design.md is rendered from it by render_design_md()."""
+    return """You are an AWS Solutions Architect. Create a CONCISE report (MAX 3-4 PAGES).
+
+AVAILABLE TOOLS:
+- image_reader: Analyze images
+- AWS Diagram MCP: Generate AWS diagrams
+- AWS Pricing MCP: Calculate costs
+- save_report_data: Save the report content (design.md and PDF are rendered from it)
+- write_file: Save content to files
+
+WORKFLOW:
+
+1. Use image_reader to analyze the hand-drawn diagram
+2. Generate As-Is diagram (aws_diagram MCP)
+3. Calculate As-Is costs (aws_pricing MCP) - 3 scenarios
+4. Design Well-Architected version (LIST improvements only)
+5. Generate Well-Architected diagram (aws_diagram MCP)
+6. Calculate Well-Architected costs (aws_pricing MCP) - 3 scenarios
+7. Compare costs (show percentage differences)
+8. Use save_report_data to save the report content
+
+REPORT CONTENT (save_report_data fields):
+- title: short architecture name
+- as_is_components: As-Is components (exactly as drawn)
+- as_is_notes: notes, comments, requirements found in the hand-drawn diagram
+- as_is_costs / well_architected_costs: monthly USD for low, medium, high (numbers only)
+- as_is_cost_breakdown: cost lines per scenario (low, medium, high), e.g. "EC2 t4g.micro: $7.01"
+- improvements: Well-Architected improvements
+- benefits: key benefits of the Well-Architected design
+
+The report layout (header, diagrams, cost tables, percentage differences)
+is generated from these fields - do NOT write markdown or LaTeX.
+
+CRITICAL REQUIREMENTS:
+- MAX 3-4 pages total: short bullet points, NO verbose descriptions
+- NO UTF-8 special characters (no checkmarks, no emojis, no fancy bullets)
+- You MUST use save_report_data to save the report content
+- Region: eu-central-1
+- Do NOT just print the content - SAVE IT using save_report_data!"""
+
+
+# Compute size when neither ECS task metadata nor TRNDA_TASK_VCPU/TRNDA_TASK_MEMORY_GB is available
+DEFAULT_TASK_VCPU = 2.0
+DEFAULT_TASK_MEMORY_GB = 4.0
+
+_compute_size = None
+
+
+def get_compute_size() -> tuple:
+    """vCPU and memory (GB) this process is billed for.
+    
+    On ECS the Fargate task size is read from the task metadata endpoint,
+    otherwise TRNDA_TASK_VCPU / TRNDA_TASK_MEMORY_GB, otherwise 2 vCPU / 4 GB.
+    
+    Returns:
+        Tuple of (vcpu, memory_gb)
+    """
+    global _compute_size
+    if _compute_size:
+        return _compute_size
+    
+    vcpu = float(os.environ.get('TRNDA_TASK_VCPU', DEFAULT_TASK_VCPU))
+    memory_gb = float(os.environ.get('TRNDA_TASK_MEMORY_GB', DEFAULT_TASK_MEMORY_GB))
+    
+    metadata_uri = os.environ.get('ECS_CONTAINER_METADATA_URI_V4')
+    if metadata_uri:
+        try:
+            import json
+            import urllib.request
+            with urllib.request.urlopen(f"{metadata_uri}/task", timeout=1) as response:
+                limits = json.load(response).get('Limits', {})
+            vcpu = float(limits.get('CPU', vcpu))
+            memory_gb = float(limits['Memory']) / 1024 if 'Memory' in limits else memory_gb
+        except Exception as e:
+            print(f"[WARNING] Could not read ECS task size, using {vcpu:g} vCPU / {memory_gb:g} GB: {e}")
+    
+    _compute_size = (vcpu, memory_gb)
+    return _compute_size
+
+
+def calculate_complete_cost(input_tokens: int, output_tokens: int, runtime_minutes: float = 15.0,
+                            model_usage: dict = None, vcpu: float = None, memory_gb: float = None) -> dict:
+    """Calculate complete AWS costs for TRNDA report generation.
+    
+    Args:
+        input_tokens: Number of input tokens used
+        output_tokens: Number of output tokens used
+        runtime_minutes: Estimated runtime in minutes (default 15 min)
+        model_usage: Optional per-model usage, model ID -> {'input_tokens', 'output_tokens', 'stages'}
+                     (default: all tokens on DEFAULT_MODEL_ID)
+        vcpu: Task vCPUs (default: get_compute_size())
+        memory_gb: Task memory in GB (default: get_compute_size())
+        
+    Returns:
+        Dictionary with cost breakdown (per-model Bedrock costs under 'bedrock_models')
+    """
+    # Bedrock pricing per model (eu-central-1, see MODEL_CATALOG)
+    if not model_usage:
+        model_usage = {DEFAULT_MODEL_ID: {'input_tokens': input_tokens, 'output_tokens': output_tokens}}
+    
+    bedrock_models = {}
+    for model_id, model_tokens in model_usage.items():
+        info = get_model_info(model_id)
+        model_input_cost = (model_tokens['input_tokens'] / 1_000_000) * info['input_price']
+        model_output_cost = (model_tokens['output_tokens'] / 1_000_000) * info['output_price']
+        bedrock_models[model_id] = {
+            'name': info['name'],
+            'stages': list(model_tokens.get('stages', [])),
+            'input_tokens': model_tokens['input_tokens'],
+            'output_tokens': model_tokens['output_tokens'],
+            'input_price': info['input_price'],
+            'output_price': info['output_price'],
+            'input_cost': model_input_cost,
+            'output_cost': model_output_cost,
+            'total': model_input_cost + model_output_cost,
+        }
+    
+    bedrock_input_cost = sum(m['input_cost'] for m in bedrock_models.values())
+    bedrock_output_cost = sum(m['output_cost'] for m in bedrock_models.values())
+    bedrock_total = bedrock_input_cost + bedrock_output_cost
+    
+    # ECS Fargate pricing (eu-central-1) - actual task size
+    # vCPU: $0.04656 per vCPU per hour
+    # Memory: $0.00511 per GB per hour
+    if vcpu is None or memory_gb is None:
+        default_vcpu, default_memory_gb = get_compute_size()
+        vcpu = default_vcpu if vcpu is None else vcpu
+        memory_gb = default_memory_gb if memory_gb is None else memory_gb
+    vcpu_cost_per_hour = 0.04656 * vcpu
+    memory_cost_per_hour = 0.00511 * memory_gb
+    ecs_cost_per_hour = vcpu_cost_per_hour + memory_cost_per_hour
+    ecs_total = ecs_cost_per_hour * (runtime_minutes / 60.0)
+    
+    # S3 costs (minimal for this use case)
+    # Storage: $0.023 per GB/month (assume 10 MB output = 0.01 GB)
+    # PUT requests: $0.005 per 1000 requests (assume 5 PUT requests)
+    # GET requests: $0.0004 per 1000 requests (assume 5 GET requests)
+    s3_storage = 0.023 * 0.01 / 30  # Daily cost for 10 MB
+    s3_put = 0.005 * (5 / 1000)
+    s3_get = 0.0004 * (5 / 1000)
+    s3_total = s3_storage + s3_put + s3_get
+    
+    # Total cost
+    total = bedrock_total + ecs_total + s3_total
+    
+    return {
+        'bedrock': bedrock_total,
+        'bedrock_input': bedrock_input_cost,
+        'bedrock_output': bedrock_output_cost,
+        'bedrock_models': bedrock_models,
+        'ecs': ecs_total,
+        'ecs_vcpu': vcpu_cost_per_hour * (runtime_minutes / 60.0),
+        'ecs_memory': memory_cost_per_hour * (runtime_minutes / 60.0),
+        'vcpu': vcpu,
+        'memory_gb': memory_gb,
+        's3': s3_total,
+        's3_storage': s3_storage,
+        's3_put': s3_put,
+        's3_get': s3_get,
+        'total': total,
+        'runtime_minutes': runtime_minutes
+    }
+
+
+def format_projection_section(summary: dict, ledger_path: str = None) -> str:
+    """Markdown "Monthly Cost Estimates" section from a ledger summary (real runs, no assumed volumes)"""
+    if not summary or not summary['succeeded']:
+        return """### Monthly Cost Estimates
+
+No successful runs in the run ledger yet - run `python trnda-cli.py stats` once reports have been generated.
+"""
+    
+    cost, tokens = summary['cost'], summary['tokens']
+    rate = summary['monthly_rate']
+    month_rows = "\n".join(
+        f"| {m['month']} | {m['reports']} | {m['failed']} | {m['input_tokens'] + m['output_tokens']:,} | ${m['cost']:.2f} |"
+        for m in summary['months']
+    )
+    first = summary.get('first_artifact')
+    first_artifact_row = (f"| First artifact (min) | {first['mean'] / 60:.1f} | {first['p50'] / 60:.1f} | "
+                          f"{first['p95'] / 60:.1f} |\n" if first else "")
+    return f"""### Monthly Cost Estimates
+
+Based on {summary['succeeded']} successful run(s) in the run ledger{f' (`{ledger_path}`)' if ledger_path else ''},
+{summary['first'][:10]} to {summary['last'][:10]}.
+
+| Per report | Mean | p50 | p95 |
+|------------|------|-----|-----|
+| Cost | ${cost['mean']:.4f} | ${cost['p50']:.4f} | ${cost['p95']:.4f} |
+| Runtime (min) | {summary['runtime']['mean'] / 60:.1f} | {summary['runtime']['p50'] / 60:.1f} | {summary['runtime']['p95'] / 60:.1f} |
+{first_artifact_row}| Tokens | {tokens['mean']:,.0f} | {tokens['p50']:,.0f} | {tokens['p95']:,.0f} |
+
+| Month | Reports | Failed | Tokens | Cost |
+|-------|---------|--------|--------|------|
+{month_rows}
+
+**Projection at the current rate** ({rate:.1f} reports / 30 days):
+${rate * cost['mean']:.2f} per month (at p95 cost per report: ${rate * cost['p95']:.2f})
+"""
+
+
+def save_cost_breakdown(output_dir: str, cost_breakdown: dict, usage, start_datetime, end_datetime, elapsed_str,
+                        resumes: list = None, trace: RunTrace = None, ledger_summary: dict = None,
+                        ledger_path: str = None, first_artifact_str: str = None, artifact_sizes: dict = None) -> None:
+    """Save detailed cost breakdown to cost.md file.
+    
+    Args:
+        output_dir: Output directory path
+        cost_breakdown: Cost breakdown dictionary
+        usage: Token usage object
+        start_datetime: Start time as datetime object
+        end_datetime: End time as datetime object
+        elapsed_str: Elapsed time as formatted string (MM:SS)
+        resumes: Optional list of checkpoint resumes (tokens and minutes saved)
+        trace: Optional run trace (slowest spans are summarised)
+        ledger_summary: Optional run ledger summary (monthly estimates from real runs)
+        ledger_path: Optional run ledger path shown in the estimates
+        first_artifact_str: Optional time to the first published preview (MM:SS)
+        artifact_sizes: Optional PDF, email, upload and image sizes (checkpoint 'artifact_sizes')
+    """
+    cost_file = os.path.join(output_dir, 'cost.md')
+    
+    artifact_section = ""
+    if artifact_sizes:
+        rows = [f"| {label} | {artifact_sizes[key] / 1024:,.0f} KB | |"
+                for key, label in (('pdf_bytes', 'design.pdf'), ('email_bytes', 'Email'),
+                                   ('upload_bytes', 'S3 upload')) if artifact_sizes.get(key)]
+        rows += [f"| {name} | {image['bytes'] / 1024:,.0f} KB | {image['bytes_before'] / 1024:,.0f} KB, "
+                 f"{image['size'][0]}x{image['size'][1]} px |"
+                 for name, image in sorted(artifact_sizes.get('images', {}).items())]
+        artifact_section = f"""
+## Report Size
+
+| Artifact | Size | Before optimization |
+|----------|------|---------------------|
+""" + "\n".join(rows) + """
+
+---
+"""
+    
+    trace_section = ""
+    if trace and trace.spans:
+        kind_rows = "\n".join(
+            f"| {kind} | {total['count']} | {total['seconds']:.1f} |"
+            for kind, total in sorted(trace.totals_by_kind().items(), key=lambda item: -item[1]['seconds'])
+        )
+        span_rows = "\n".join(
+            f"| {span['name']} | {span['kind']} | {span['attrs'].get('stage') or '-'} | {span['duration']:.2f} | {describe_span(span)} |"
+            for span in trace.slowest(10)
+        )
+        trace_section = f"""
+## Where The Time Went
+
+Full per-span data: `trace.json`
+
+| Kind | Spans | Seconds |
+|------|-------|---------|
+{kind_rows}
+
+### Slowest Spans
+
+| Span | Kind | Stage | Duration (s) | Details |
+|------|------|-------|--------------|---------|
+{span_rows}
+
+---
+"""
+    
+    resume_section = ""
+    if resumes:
+        rows = "\n".join(
+            f"| {r['resumed']} | {r['from_stage']} | {r['stages_reused']} | {r['tokens_saved']:,} | {r['minutes_saved']:.1f} |"
+            for r in resumes
+        )
+        resume_section = f"""
+## Checkpoint Resumes
+
+| Resumed | From stage | Stages reused | Tokens saved | Minutes saved |
+|---------|------------|---------------|--------------|---------------|
+{rows}
+
+---
+"""
+    
+    model_rows = "\n".join(
+        f"| {m['name']} | {', '.join(m['stages']) or '-'} | {m['input_tokens']:,} | {m['output_tokens']:,} | "
+        f"${m['input_price']:.2f} / ${m['output_price']:.2f} | ${m['total']:.4f} |"
+        for m in cost_breakdown['bedrock_models'].values()
+    )
+    model_ids = ", ".join(f"`{model_id}`" for model_id in cost_breakdown['bedrock_models'])
+    projection_section = format_projection_section(ledger_summary, ledger_path)
+    
+    content = f"""# TRNDA Generation Cost Breakdown
+
+**Generated:** {datetime.now().strftime("%B %d, %Y at %H:%M:%S")}  
+**Region:** eu-central-1  
+**Runtime:** {elapsed_str} (MM:SS)
+
+---
+
+## Execution Timeline
+
+| Event | Time |
+|-------|------|
+| Start | {start_datetime.strftime("%H:%M:%S")} |{f'''
+| First artifact (preview.md) | +{first_artifact_str} |''' if first_artifact_str else ''}
+| End | {end_datetime.strftime("%H:%M:%S")} |
+| **Duration** | **{elapsed_str}** |
+
+---
+{resume_section}{trace_section}{artifact_section}
+## Summary
+
+| Component | Cost (USD) |
+|-----------|------------|
+| **Amazon Bedrock** | **${cost_breakdown['bedrock']:.4f}** |
+| **ECS Fargate Compute** | **${cost_breakdown['ecs']:.4f}** |
+| **S3 Storage & Transfer** | **${cost_breakdown['s3']:.6f}** |
+| **TOTAL** | **${cost_breakdown['total']:.4f}** |
+
+---
+
+## Detailed Breakdown
+
+### 1. Amazon Bedrock
+
+**Models:** {model_ids}  
+**Region:** eu-central-1
+
+| Model | Stages | Input tokens | Output tokens | Rate in / out (per 1M) | Cost |
+|-------|--------|--------------|---------------|------------------------|------|
+{model_rows}
+| **Bedrock Total** | | **{usage.input_tokens:,}** | **{usage.output_tokens:,}** | | **${cost_breakdown['bedrock']:.4f}** |
+
+### 2. Amazon ECS Fargate
+
+**Configuration:** {cost_breakdown['vcpu']:g} vCPU, {cost_breakdown['memory_gb']:g} GB RAM  
+**Runtime:** ~{cost_breakdown['runtime_minutes']:.1f} minutes
+
+| Resource | Usage | Rate (per hour) | Cost |
+|----------|-------|-----------------|------|
+| vCPU ({cost_breakdown['vcpu']:g}x) | {cost_breakdown['runtime_minutes']:.1f} min | $0.04656/vCPU | ${cost_breakdown['ecs_vcpu']:.4f} |
+| Memory ({cost_breakdown['memory_gb']:g} GB) | {cost_breakdown['runtime_minutes']:.1f} min | $0.00511/GB | ${cost_breakdown['ecs_memory']:.4f} |
+| **ECS Total** | | | **${cost_breakdown['ecs']:.4f}** |
+
+### 3. Amazon S3
+
+**Usage:** Input image upload, output files storage
+
+| Operation | Volume | Rate | Cost |
+|-----------|--------|------|------|
+| Storage (daily) | ~10 MB | $0.023/GB/month | ${cost_breakdown['s3_storage']:.6f} |
+| PUT requests | ~5 requests | $0.005/1000 | ${cost_breakdown['s3_put']:.6f} |
+| GET requests | ~5 requests | $0.0004/1000 | ${cost_breakdown['s3_get']:.6f} |
+| **S3 Total** | | | **${cost_breakdown['s3']:.6f}** |
+
+---
+
+## Cost Optimization Notes
+
+### Current Configuration
+- **ECS:** {cost_breakdown['vcpu']:g} vCPU, {cost_breakdown['memory_gb']:g} GB RAM
+- **Runtime:** ~{cost_breakdown['runtime_minutes']:.0f} minutes average
+- **Bedrock:** per-stage model routing (see Detailed Breakdown, section 1)
+
+### Optimization Opportunities
+1. **Reduce token usage:**
+   - Optimize prompts and system instructions
+   - Use smaller context windows where possible
+   - Cache frequently used prompts
+
+2. **Adjust ECS resources:**
+   - Consider 1 vCPU, 2 GB for smaller diagrams
+   - Current: {cost_breakdown['vcpu']:g} vCPU, {cost_breakdown['memory_gb']:g} GB (compare runtimes with `trnda-cli.py stats`)
+
+3. **Batch processing:**
+   - Process multiple diagrams in one session
+   - Amortize ECS startup costs
+
+{projection_section}
+---
+
+## Pricing References
+
+- **Bedrock Pricing:** https://aws.amazon.com/bedrock/pricing/
+- **ECS Fargate Pricing:** https://aws.amazon.com/fargate/pricing/
+- **S3 Pricing:** https://aws.amazon.com/s3/pricing/
+
+**Note:** Prices are for eu-central-1 region and subject to change. Always verify current pricing.
+"""
+    
+    try:
+        with open(cost_file, 'w', encoding='utf-8') as f:
+            f.write(content)
+        print(f"[OK] Cost breakdown saved to {cost_file}")
+    except Exception as e:
+        print(f"[WARNING] Could not save cost breakdown: {e}")
+
+
+# Run ledger - one JSON line per run attempt, aggregated by `trnda-cli.py stats`
+# TRNDA_LEDGER: ledger file ('off' disables), TRNDA_LEDGER_S3: s3://bucket/prefix/ to sync records to
+DEFAULT_LEDGER_PATH = os.path.join(os.path.expanduser('~'), '.trnda', 'ledger.jsonl')
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file (hex)"""
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile (0.0 for empty input)"""
+    import math
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(pct / 100.0 * len(ordered))) - 1]
+
+
+def build_ledger_record(ctx: 'RunContext', checkpoint: dict, outcome: str, runtime_seconds: float,
+                        cost_breakdown: dict = None, error: str = None) -> dict:
+    """Ledger record for one run attempt
+    
+    Args:
+        ctx: Run context (trace provides cache tokens of this attempt)
+        checkpoint: Run checkpoint (stage timings and tokens, incl. reused stages)
+        outcome: 'success', 'no_pdf', 'failed' or 'timeout'
+        runtime_seconds: Runtime incl. stages reused from earlier attempts
+        cost_breakdown: Optional cost breakdown
+        error: Optional error message
+        
+    Returns:
+        Ledger record dictionary
+    """
+    stages = checkpoint.get('stages', {})
+    model_spans = [span['attrs'] for span in ctx.trace.spans if span['kind'] == 'model']
+    
+    models = {}
+    for stage_name, record in stages.items():
+        entry = models.setdefault(record.get('model_id') or DEFAULT_MODEL_ID, {'input_tokens': 0, 'output_tokens': 0})
+        entry['input_tokens'] += record.get('input_tokens', 0)
+        entry['output_tokens'] += record.get('output_tokens', 0)
+    
+    return {
+        'run_id': checkpoint.get('run_id', ctx.run_id),
+        'started': checkpoint.get('created'),
+        'finished': datetime.now().isoformat(timespec='seconds'),
+        'outcome': outcome,
+        'error': error,
+        'input_uri': checkpoint.get('input_uri'),
+        'image_sha256': checkpoint.get('image_sha256'),
+        'deployment': ctx.deployment,
+        'runtime_seconds': round(runtime_seconds, 2),
+        'first_artifact_seconds': checkpoint.get('first_artifact_seconds'),
+        'queue_wait_seconds': round(max(0.0, ctx.trace.started - ctx.queued_at), 2) if ctx.queued_at else None,
+        'bedrock_queue_seconds': round(sum(span['duration'] for span in ctx.trace.spans
+                                           if span['kind'] == 'throttle'), 2),
+        'tokens': {
+            'input': sum(r.get('input_tokens', 0) for r in stages.values()),
+            'output': sum(r.get('output_tokens', 0) for r in stages.values()),
+            'cache_read': sum(a.get('cache_read_tokens') or 0 for a in model_spans),
+            'cache_write': sum(a.get('cache_write_tokens') or 0 for a in model_spans),
+        },
+        'models': models,
+        'stages': {name: record.get('seconds', 0) for name, record in stages.items()},
+        'stages_reused': sum(r.get('stages_reused', 0) for r in checkpoint.get('resumes', [])),
+        'resumes': len(checkpoint.get('resumes', [])),
+        'similarity': {k: v for k, v in checkpoint['similarity'].items() if k != 'report_data'}
+                      if checkpoint.get('similarity') else None,
+        'deadline': checkpoint.get('deadline'),
+        'pdf': checkpoint.get('post_processing', {}).get('pdf'),
+        'email': checkpoint.get('post_processing', {}).get('email'),
+        'artifact_sizes': {k: v for k, v in checkpoint.get('artifact_sizes', {}).items() if k != 'images'} or None,
+        'cost': {
+            'total': round(cost_breakdown['total'], 6),
+            'bedrock': round(cost_breakdown['bedrock'], 6),
+            'ecs': round(cost_breakdown['ecs'], 6),
+            's3': round(cost_breakdown['s3'], 6),
+        } if cost_breakdown else None,
+        'compute': {'vcpu': cost_breakdown['vcpu'], 'memory_gb': cost_breakdown['memory_gb']} if cost_breakdown else None,
+        'workspace': ctx.workspace.report(),
+    }
+
+
+def append_ledger_record(record: dict, ledger_path: str, s3_uri: str = None, s3=None) -> None:
+    """Append a record to the local ledger and optionally store it in S3 (<prefix><run_id>.json)
+    
+    Args:
+        record: Ledger record
+        ledger_path: Local JSONL ledger (None = no local ledger)
+        s3_uri: Optional s3://bucket/prefix/ to sync the record to
+        s3: S3 client (required with s3_uri)
+    """
+    import json
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    
+    if ledger_path:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(ledger_path)), exist_ok=True)
+            # One write() per record in append mode - concurrent runs do not interleave lines
+            with open(ledger_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            print(f"[OK] Run recorded in ledger {ledger_path}")
+        except Exception as e:
+            print(f"[WARNING] Could not write run ledger: {e}")
+    
+    if s3_uri and s3 is not None:
+        try:
+            bucket, prefix = parse_s3_path(s3_uri)
+            key = f"{prefix.rstrip('/')}/{record['run_id']}.json".lstrip('/')
+            s3.put_object(Bucket=bucket, Key=key, Body=line.encode('utf-8'), ContentType='application/json')
+            print(f"[OK] Run record synced to s3://{bucket}/{key}")
+        except Exception as e:
+            print(f"[WARNING] Could not sync run record to S3: {e}")
+
+
+def load_ledger(ledger_path: str = None, s3_uri: str = None, s3=None) -> list:
+    """Load ledger records from the local file and/or S3
+    
+    Several attempts of one run (resumes) are collapsed to the latest record.
+    
+    Returns:
+        List of records sorted by start time
+    """
+    import json
+    records = []
+    
+    if ledger_path and os.path.exists(ledger_path):
+        with open(ledger_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print(f"[WARNING] Skipping malformed ledger line in {ledger_path}")
+    
+    if s3_uri and s3 is not None:
+        bucket, prefix = parse_s3_path(s3_uri)
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith('.json'):
+                    body = s3.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read()
+                    records.append(json.loads(body))
+    
+    latest = {}
+    for record in records:
+        previous = latest.get(record['run_id'])
+        if not previous or (record.get('finished') or '') >= (previous.get('finished') or ''):
+            latest[record['run_id']] = record
+    
+    return sorted(latest.values(), key=lambda r: r.get('started') or '')
+
+
+def summarize_ledger(records: list, now: datetime = None) -> dict:
+    """Aggregate ledger records: runtime/token/cost percentiles, monthly totals, current monthly rate
+    
+    Args:
+        records: Ledger records (see load_ledger)
+        now: Reference time for the monthly rate (default: now)
+        
+    Returns:
+        Summary dictionary
+    """
+    now = now or datetime.now()
+    succeeded = [r for r in records if r.get('outcome') in ('success', 'no_pdf')]
+    costs = [r['cost']['total'] for r in succeeded if r.get('cost')]
+    runtimes = [r['runtime_seconds'] for r in succeeded]
+    first_artifacts = [r['first_artifact_seconds'] for r in succeeded if r.get('first_artifact_seconds') is not None]
+    tokens = [r['tokens']['input'] + r['tokens']['output'] for r in succeeded]
+    sizes = {key: [r['artifact_sizes'][key] for r in succeeded if (r.get('artifact_sizes') or {}).get(key)]
+             for key in ('pdf_bytes', 'email_bytes', 'upload_bytes')}
+    
+    def mean(values):
+        return sum(values) / len(values) if values else 0.0
+    
+    stage_seconds = {}
+    models = {}
+    for record in succeeded:
+        for stage_name, seconds in record.get('stages', {}).items():
+            stage_seconds.setdefault(stage_name, []).append(seconds)
+        for model_id, usage in record.get('models', {}).items():
+            entry = models.setdefault(model_id, {'input_tokens': 0, 'output_tokens': 0})
+            entry['input_tokens'] += usage.get('input_tokens', 0)
+            entry['output_tokens'] += usage.get('output_tokens', 0)
+    
+    months = {}
+    for record in records:
+        month = (record.get('started') or record.get('finished') or '')[:7]
+        entry = months.setdefault(month, {'month': month, 'reports': 0, 'failed': 0, 'input_tokens': 0,
+                                          'output_tokens': 0, 'cost': 0.0})
+        if record.get('outcome') in ('success', 'no_pdf'):
+            entry['reports'] += 1
+        else:
+            entry['failed'] += 1
+        entry['input_tokens'] += record['tokens']['input']
+        entry['output_tokens'] += record['tokens']['output']
+        entry['cost'] += (record.get('cost') or {}).get('total', 0.0)
+    
+    # Reports per 30 days: last 30 days, or extrapolated when the ledger is younger than that
+    monthly_rate = 0.0
+    if succeeded:
+        started = [datetime.fromisoformat(r['started']) for r in succeeded if r.get('started')]
+        recent = [t for t in started if (now - t).days < 30]
+        span_days = max((now - min(started)).total_seconds() / 86400, 1.0) if started else 30.0
+        monthly_rate = len(recent) if span_days >= 30 else len(started) / span_days * 30
+    
+    return {
+        'runs': len(records),
+        'succeeded': len(succeeded),
+        'failed': len(records) - len(succeeded),
+        'timeouts': len([r for r in records if r.get('outcome') == 'timeout']),
+        'first': records[0].get('started') or '' if records else '',
+        'last': records[-1].get('started') or '' if records else '',
+        'runtime': {'mean': mean(runtimes), 'p50': percentile(runtimes, 50), 'p95': percentile(runtimes, 95)},
+        'first_artifact': {'mean': mean(first_artifacts), 'p50': percentile(first_artifacts, 50),
+                           'p95': percentile(first_artifacts, 95)} if first_artifacts else None,
+        'artifact_sizes': {key: {'mean': mean(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95)}
+                           for key, values in sizes.items() if values},
+        'tokens': {
+            'mean': mean(tokens), 'p50': percentile(tokens, 50), 'p95': percentile(tokens, 95),
+            'input_mean': mean([r['tokens']['input'] for r in succeeded]),
+            'output_mean': mean([r['tokens']['output'] for r in succeeded]),
+            'cache_read_total': sum(r['tokens'].get('cache_read', 0) for r in records),
+        },
+        'cost': {
+            'mean': mean(costs), 'p50': percentile(costs, 50), 'p95': percentile(costs, 95),
+            'bedrock_mean': mean([r['cost']['bedrock'] for r in succeeded if r.get('cost')]),
+            'ecs_mean': mean([r['cost']['ecs'] for r in succeeded if r.get('cost')]),
+            'total': sum((r.get('cost') or {}).get('total', 0.0) for r in records),
+        },
+        'stages': {name: {'p50': percentile(v, 50), 'p95': percentile(v, 95)} for name, v in stage_seconds.items()},
+        'models': models,
+        'resumed_runs': len([r for r in records if r.get('resumes')]),
+        'stages_reused': sum(r.get('stages_reused', 0) for r in records),
+        'months': [months[m] for m in sorted(months)],
+        'monthly_rate': monthly_rate,
+    }
+
+
+# CloudWatch metrics in Embedded Metric Format: one JSON log line per record on stdout, turned
+# into metrics when the log is ingested (Lambda, ECS awslogs, SSM output). TRNDA_METRICS=off disables.
+EMF_NAMESPACE = os.environ.get('TRNDA_METRICS_NAMESPACE', 'TRNDA')
+EMF_UNITS = {
+    'Seconds', 'Microseconds', 'Milliseconds', 'Bytes', 'Kilobytes', 'Megabytes', 'Gigabytes', 'Terabytes',
+    'Bits', 'Kilobits', 'Megabits', 'Gigabits', 'Terabits', 'Percent', 'Count', 'Bytes/Second',
+    'Kilobytes/Second', 'Megabytes/Second', 'Gigabytes/Second', 'Terabytes/Second', 'Bits/Second',
+    'Kilobits/Second', 'Megabits/Second', 'Gigabits/Second', 'Terabits/Second', 'Count/Second', 'None',
+}
+# CloudWatch limits per EMF record
+EMF_MAX_METRICS = 100
+EMF_MAX_DIMENSIONS = 30
+# Where the run executes (Deployment dimension); the ECS handler and the EC2 trigger set it
+DEFAULT_DEPLOYMENT = 'local'
+
+
+def metrics_enabled() -> bool:
+    """EMF metric lines are printed unless TRNDA_METRICS env is 'off'"""
+    return os.environ.get('TRNDA_METRICS', 'on') != 'off'
+
+
+def parse_event_time(value) -> float:
+    """Parse an event timestamp (ISO 8601 as in EventBridge / S3 events, or epoch seconds)
+    
+    Returns:
+        time.time() value, or None if missing or unparseable
+    """
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+
+def build_emf_record(metrics: dict, dimensions: dict, properties: dict = None, dimension_sets: list = None,
+                     namespace: str = None, timestamp: float = None) -> dict:
+    """CloudWatch Embedded Metric Format record
+    
+    Args:
+        metrics: Metric name -> (value, unit); None values are left out
+        dimensions: Dimension name -> value (strings)
+        properties: Extra fields for Logs Insights (not metrics)
+        dimension_sets: Lists of dimension names to aggregate by (default: all dimensions as one set)
+        namespace: CloudWatch namespace (default: EMF_NAMESPACE)
+        timestamp: time.time() value (default: now)
+    
+    Returns:
+        EMF record dictionary
+    
+    Raises:
+        ValueError: Invalid unit, value, dimension or too many metrics / dimensions
+    """
+    import math
+    
+    metrics = {name: value for name, value in metrics.items() if value[0] is not None}
+    if not metrics:
+        raise ValueError("EMF record needs at least one metric")
+    if len(metrics) > EMF_MAX_METRICS:
+        raise ValueError(f"{len(metrics)} metrics in one EMF record (max {EMF_MAX_METRICS})")
+    dimension_sets = dimension_sets or [list(dimensions)]
+    for names in dimension_sets:
+        if len(names) > EMF_MAX_DIMENSIONS:
+            raise ValueError(f"{len(names)} dimensions in one set (max {EMF_MAX_DIMENSIONS})")
+        for name in names:
+            if not isinstance(dimensions.get(name), str) or not dimensions[name]:
+                raise ValueError(f"Dimension {name} needs a non-empty string value")
+    
+    record = {}
+    for name, value in (properties or {}).items():
+        if value is not None:
+            record[name] = value
+    definitions = []
+    for name, (value, unit) in metrics.items():
+        if unit not in EMF_UNITS:
+            raise ValueError(f"Unknown unit {unit!r} for metric {name}")
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"Metric {name} needs a finite number, got {value!r}")
+        record[name] = value
+        definitions.append({'Name': name, 'Unit': unit})
+    record.update({name: dimensions[name] for names in dimension_sets for name in names})
+    record['_aws'] = {
+        'Timestamp': int((timestamp if timestamp is not None else time.time()) * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': namespace or EMF_NAMESPACE,
+            'Dimensions': [list(names) for names in dimension_sets],
+            'Metrics': definitions,
+        }],
+    }
+    return record
+
+
+def emit_metrics(metrics: dict, dimensions: dict, properties: dict = None, dimension_sets: list = None) -> dict:
+    """Print one EMF record as a single stdout line (see build_emf_record). Errors only warn.
+    
+    Returns:
+        The printed record, or None (disabled or invalid)
+    """
+    import json
+    if not metrics_enabled():
+        return None
+    try:
+        record = build_emf_record(metrics, dimensions, properties, dimension_sets)
+    except ValueError as e:
+        print(f"[WARNING] Metrics not emitted: {e}")
+        return None
+    # One write per line - records of concurrent runs must not interleave
+    sys.stdout.write(json.dumps(record, separators=(',', ':'), default=str) + "\n")
+    sys.stdout.flush()
+    return record
+
+
+def emit_run_metrics(record: dict, deployment: str = None) -> None:
+    """Emit the CloudWatch metrics of one ledger record (run attempt)
+    
+    Per run (by Deployment and by Deployment + Outcome): runtime, time to first
+    artifact, tokens, prompt cache hit rate, cost, time queued before the worker
+    picked the job up, time queued in the Bedrock rate limiter, report sizes.
+    Per stage (by Deployment + Stage): stage runtime.
+    
+    Args:
+        record: Ledger record (build_ledger_record)
+        deployment: Deployment dimension (default: DEFAULT_DEPLOYMENT)
+    """
+    dimensions = {'Deployment': deployment or DEFAULT_DEPLOYMENT, 'Outcome': record['outcome']}
+    tokens = record.get('tokens') or {}
+    prompt_tokens = tokens.get('input', 0) + tokens.get('cache_read', 0) + tokens.get('cache_write', 0)
+    sizes = record.get('artifact_sizes') or {}
+    emit_metrics({
+        'Runs': (1, 'Count'),
+        'RunFailed': (int(record['outcome'] in ('failed', 'timeout')), 'Count'),
+        'RunTimedOut': (int(record['outcome'] == 'timeout'), 'Count'),
+        'ReportReused': (int((record.get('similarity') or {}).get('decision') == 'reuse'), 'Count'),
+        'RuntimeSeconds': (record.get('runtime_seconds'), 'Seconds'),
+        'FirstArtifactSeconds': (record.get('first_artifact_seconds'), 'Seconds'),
+        'QueueWaitSeconds': (record.get('queue_wait_seconds'), 'Seconds'),
+        'BedrockQueueSeconds': (record.get('bedrock_queue_seconds'), 'Seconds'),
+        'InputTokens': (tokens.get('input'), 'Count'),
+        'OutputTokens': (tokens.get('output'), 'Count'),
+        'CacheReadTokens': (tokens.get('cache_read'), 'Count'),
+        'CacheWriteTokens': (tokens.get('cache_write'), 'Count'),
+        'CacheHitRate': (round(100.0 * tokens.get('cache_read', 0) / prompt_tokens, 2) if prompt_tokens else None,
+                         'Percent'),
+        'CostUSD': ((record.get('cost') or {}).get('total'), 'None'),
+        'PdfBytes': (sizes.get('pdf_bytes'), 'Bytes'),
+        'EmailBytes': (sizes.get('email_bytes'), 'Bytes'),
+        'UploadBytes': (sizes.get('upload_bytes'), 'Bytes'),
+    }, dimensions, properties={'run_id': record.get('run_id'), 'input_uri': record.get('input_uri'),
+                               'error': record.get('error')},
+        dimension_sets=[['Deployment'], ['Deployment', 'Outcome']])
+    
+    for stage_name, seconds in (record.get('stages') or {}).items():
+        emit_metrics({'StageSeconds': (seconds, 'Seconds')},
+                     {'Deployment': dimensions['Deployment'], 'Stage': stage_name},
+                     properties={'run_id': record.get('run_id')})
+
+
+def create_output_dir(base_dir: str = '.', run_id: str = None):
+    """Create output directory output_<run_id> (unique per run).
+    
+    Args:
+        base_dir: Parent directory (default: current working directory)
+        run_id: Run ID (default: new unique run ID)
+    """
+    output_dir = os.path.join(base_dir, f"output_{run_id or new_run_id()}")
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(f"{output_dir}/generated-diagrams", exist_ok=True)
+    return output_dir
+
+
+# Workflow stages - each stage is one agent turn and writes a checkpoint
+# when it completes. Artifacts are relative to the output directory.
+# 'model' selects the model tier: 'fast' (transcription, tool calls, sums)
+# or 'primary' (Well-Architected reasoning and the written report).
+# 'preview' is the heading of the stage's section in preview.md, published
+# while the run is still going (see publish_preview).
+WORKFLOW_STAGES = [
+    {
+        'name': 'analyze',
+        'model': 'fast',
+        'title': 'Analyze hand-drawn diagram',
+        'preview': 'Analysis',
+        'artifacts': [],
+        'instruction': "Use image_reader: analyze {output_dir}/{input_image} - LOOK FOR ANY notes, comments, requirements",
+    },
+    {
+        'name': 'as_is_diagram',
+        'model': 'fast',
+        'title': 'Generate As-Is diagram',
+        'preview': 'As-Is Architecture',
+        'artifacts': ['generated-diagrams/diagram_as_is.png'],
+        'instruction': """Generate As-Is diagram -> SAVE TO: {output_dir}/generated-diagrams/diagram_as_is.png
+   - IMPORTANT: Use EXACT number of resources from image (if image shows 1 EC2, use 1 EC2, even if it makes no sense)
+   - As-Is means EXACTLY as drawn, no additions""",
+    },
+    {
+        'name': 'as_is_costs',
+        'model': 'fast',
+        'title': 'Calculate As-Is costs',
+        'preview': 'As-Is Costs',
+        'artifacts': [],
+        'instruction': "Calculate As-Is costs (low/medium/high)",
+    },
+    {
+        'name': 'well_architected_design',
+        'model': 'primary',
+        'title': 'Design Well-Architected version',
+        'preview': 'Well-Architected Design',
+        'artifacts': [],
+        'instruction': "Design Well-Architected (list improvements only)",
+    },
+    {
+        'name': 'well_architected_diagram',
+        'model': 'fast',
+        'title': 'Generate Well-Architected diagram',
+        'preview': 'Well-Architected Architecture',
+        'artifacts': ['generated-diagrams/diagram_well_architected.png'],
+        'instruction': "Generate Well-Architected diagram -> SAVE TO: {output_dir}/generated-diagrams/diagram_well_architected.png",
+    },
+    {
+        'name': 'well_architected_costs',
+        'model': 'fast',
+        'title': 'Calculate Well-Architected costs',
+        'preview': 'Well-Architected Costs',
+        'artifacts': [],
+        'instruction': """Calculate Well-Architected costs (low/medium/high)
+   - Compare costs with As-Is (% differences)""",
+    },
+    {
+        'name': 'report',
+        'model': 'primary',
+        'title': 'Save report content',
+        'artifacts': [REPORT_DATA_FILE],
+        'instruction': """Use save_report_data (output_dir: {output_dir}) - design.md is rendered from it
+   - Include "as_is_notes" with any notes found in the hand-drawn diagram""",
+    },
+]
+
+CHECKPOINT_FILE = 'checkpoint.json'
+
+# Max length of a stage summary kept in the checkpoint
+CHECKPOINT_SUMMARY_CHARS = 4000
+
+
+def new_checkpoint(ctx: RunContext) -> dict:
+    """Create empty checkpoint state for a new run"""
+    return {
+        'run_id': ctx.run_id,
+        'input_uri': ctx.input_uri,
+        'input_etag': ctx.input_etag,
+        'client_name': ctx.client_name,
+        'recipient_email': ctx.recipient_email,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'stages': {},
+        'post_processing': {},
+        'resumes': [],
+    }
+
+
+def load_checkpoint(output_dir: str) -> dict:
+    """Load checkpoint state from output directory
+    
+    Args:
+        output_dir: Run output directory
+        
+    Returns:
+        Checkpoint dictionary, or None if the directory has no checkpoint
+    """
+    import json
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+    if not os.path.exists(checkpoint_path):
+        return None
+    
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_checkpoint(output_dir: str, checkpoint: dict) -> None:
+    """Write checkpoint state atomically (temp file + rename)
+    
+    Args:
+        output_dir: Run output directory
+        checkpoint: Checkpoint dictionary
+    """
+    import json
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+    temp_path = f"{checkpoint_path}.tmp"
+    
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, indent=2, ensure_ascii=False)
+    os.replace(temp_path, checkpoint_path)
+
+
+def is_stage_complete(checkpoint: dict, stage: dict, output_dir: str) -> bool:
+    """Check that a stage finished and all its artifacts still exist"""
+    record = checkpoint.get('stages', {}).get(stage['name'])
+    if not record or record.get('status') != 'done':
+        return False
+    return all(os.path.exists(os.path.join(output_dir, artifact)) for artifact in stage['artifacts'])
+
+
+def first_incomplete_stage(checkpoint: dict, output_dir: str) -> int:
+    """Index of the first workflow stage that has to be (re)run
+    
+    Returns:
+        Stage index, or len(WORKFLOW_STAGES) if all stages are complete
+    """
+    for index, stage in enumerate(WORKFLOW_STAGES):
+        if not is_stage_complete(checkpoint, stage, output_dir):
+            return index
+    return len(WORKFLOW_STAGES)
+
+
+def build_run_prompt(ctx: RunContext, output_dir: str, input_img_dest: str, checkpoint: dict = None,
+                     start_index: int = 0) -> str:
+    """Build the run-level prompt (paths, client, scenarios, rules).
+    
+    When resuming, summaries of the already completed stages are included
+    so the agent can continue without redoing them.
+    """
+    import json
+    client_name = ctx.client_name
+    
+    # Client name is context only - the report header is rendered by render_design_md()
+    client_instruction = f"\nCLIENT/PROJECT NAME: {client_name}" if client_name else ""
+    
+    steps = "\n".join(
+        f"{index}. " + stage['instruction'].format(output_dir=output_dir,
+                                                   input_image=os.path.basename(input_img_dest))
+        for index, stage in enumerate(WORKFLOW_STAGES, 1)
+    )
+    
+    prompt = f"""Create AWS architecture report (MAX 3-4 pages):
+
+IMAGE: {input_img_dest}
+OUTPUT DIR: {output_dir}
+INPUT IMAGE: {input_img_dest} (ALREADY SAVED){client_instruction}
+
+CRITICAL - PATHS (the report template expects exactly these):
+- Input diagram (already saved): {input_img_dest}
+- As-Is diagram: {output_dir}/generated-diagrams/diagram_as_is.png
+- Well-Architected diagram: {output_dir}/generated-diagrams/diagram_well_architected.png
+- Report content: save_report_data with output_dir {output_dir}
+
+IMPORTANT: Diagramy MUSÍ být uloženy do generated-diagrams/ podsložky!
+
+STEPS:
+{steps}
+
+AS-IS COST EXAMPLE SCENARIOS (assume based on predicted traffic/size/app):
+- LOW: 1 Availability Zone, 1 EC2 Graviton (t4g.micro - ARM-based, cheapest), 1 RDS Single-AZ Graviton (db.t4g.micro)
+- MEDIUM: 1 AZ, 2 EC2 instances (t3.micro - x86), 1 RDS Single-AZ (db.t3.micro)
+- HIGH: 1 AZ, 4 EC2 instances (t3.small - x86), 1 RDS Single-AZ (db.t3.small - larger instance)
+
+IMPORTANT:
+- Keep report SHORT (3-4 pages max)
+- NO UTF-8 special fancy characters (like icons)
+- If any service is unclear, choose a reasonable AWS service
+- MUST use save_report_data in the last step (NO markdown, NO PDF generation!)
+- Region: eu-central-1
+- Work step by step: I will ask for ONE step at a time"""
+    
+    if checkpoint and start_index > 0:
+        completed = []
+        for index, stage in enumerate(WORKFLOW_STAGES[:start_index], 1):
+            summary = checkpoint['stages'][stage['name']].get('summary', '')
+            completed.append(f"--- STEP {index} ({stage['title']}) ---\n{summary}")
+        prompt += "\n\nALREADY COMPLETED (restored from checkpoint - do NOT redo these steps):\n\n" + "\n\n".join(completed)
+    
+    similar = (checkpoint or {}).get('similarity') or {}
+    if similar.get('decision') == 'seed' and similar.get('report_data'):
+        prompt += f"""
+
+SIMILAR EARLIER SKETCH (confidence {similar['confidence']:.2f}) - its report data is below. Start from it:
+keep what the image still shows, change what differs. The image is authoritative.
+{json.dumps(similar['report_data'], indent=1, ensure_ascii=False)}"""
+    
+    return prompt
+
+
+def build_stage_prompt(index: int, output_dir: str) -> str:
+    """Build the prompt for one workflow stage"""
+    stage = WORKFLOW_STAGES[index]
+    instruction = stage['instruction'].format(output_dir=output_dir,
+                                              input_image=os.path.basename(find_input_image(output_dir)))
+    
+    return f"""STEP {index + 1}: {instruction}
+
+Do ONLY this step now. When done, reply with a compact summary of the results
+(key facts, components, numbers, file paths) - it is saved as a checkpoint."""
+
+
+PREVIEW_FILE = 'preview.md'
+
+
+def render_preview_md(checkpoint: dict) -> str:
+    """Markdown preview of the completed stages (stage answers and their diagrams)"""
+    sections = []
+    for stage in WORKFLOW_STAGES:
+        record = checkpoint.get('stages', {}).get(stage['name'])
+        if not stage.get('preview') or not record or record.get('status') != 'done':
+            continue
+        section = f"## {stage['preview']}\n\n{record.get('summary', '').strip()}"
+        for artifact in stage['artifacts']:
+            if artifact.endswith('.png'):
+                section += f"\n\n![{stage['preview']}]({artifact})"
+        sections.append(section)
+    
+    return (f"# Preliminary Results\n\n"
+            f"Run `{checkpoint.get('run_id')}` is still in progress. These are the finished stages as the model "
+            f"answered them; the final report (design.pdf) supersedes them.\n\n" + "\n\n".join(sections) + "\n")
+
+
+def publish_preview(ctx: RunContext, output_dir: str, checkpoint: dict, stage: dict) -> None:
+    """Publish preview.md (and the stage's diagrams) as soon as a stage completes
+    
+    preview.md is always written to the output directory. For S3 inputs it is
+    also uploaded to the run's output prefix and linked from the status object
+    (presigned URLs), so the web app can show the analysis, the As-Is diagram
+    and cost table and the Well-Architected section long before the PDF. The
+    first publish is the run's time to first useful artifact
+    (checkpoint 'first_artifact_seconds'). Errors only warn.
+    
+    Args:
+        ctx: Run context
+        output_dir: Absolute output directory
+        checkpoint: Checkpoint dictionary (stage summaries; updated and saved)
+        stage: Workflow stage that just completed
+    """
+    record = checkpoint['stages'].get(stage['name'], {})
+    if not stage.get('preview') or record.get('status') != 'done':
+        return
+    
+    try:
+        # The stage's diagrams are final: optimize them before they are uploaded
+        optimize_report_images(output_dir, checkpoint,
+                               [a for a in stage['artifacts'] if a in REPORT_IMAGE_HEIGHTS], ctx.trace)
+        with open(os.path.join(output_dir, PREVIEW_FILE), 'w', encoding='utf-8') as f:
+            f.write(render_preview_md(checkpoint))
+        
+        uri = ctx.status_uri or ctx.input_uri
+        if ctx.status_enabled and uri and is_s3_path(uri):
+            s3_bucket = parse_s3_path(uri)[0]
+            s3_prefix = f"output/{os.path.basename(os.path.normpath(output_dir)).replace('output_', '')}"
+            files = [PREVIEW_FILE] + [a for a in stage['artifacts'] if a.endswith('.png')]
+            s3 = ctx.client('s3')
+            
+            with ctx.trace.span('publish_preview', 's3', operation='upload', files=len(files)) as span_attrs:
+                span_attrs['bytes'] = sum(os.path.getsize(os.path.join(output_dir, name)) for name in files)
+                for name in files:
+                    key = f"{s3_prefix}/{name}"
+                    s3.upload_file(os.path.join(output_dir, name), s3_bucket, key,
+                                   ExtraArgs=artifact_upload_args(name))
+                    url = s3.generate_presigned_url('get_object', Params={'Bucket': s3_bucket, 'Key': key},
+                                                    ExpiresIn=REPORT_LINK_EXPIRES_SECONDS)
+                    if name == PREVIEW_FILE:
+                        ctx.preview['url'] = url
+                    else:
+                        ctx.preview.setdefault('diagrams', {})[stage['preview']] = url
+            ctx.preview['sections'] = ctx.preview.get('sections', []) + [stage['preview']]
+        
+        elapsed = round(time.time() - ctx.trace.started, 2)
+        if checkpoint.get('first_artifact_seconds') is None:
+            checkpoint['first_artifact_seconds'] = elapsed
+            save_checkpoint(output_dir, checkpoint)
+        ctx.publish_status('running', preview=ctx.preview, first_artifact_seconds=checkpoint['first_artifact_seconds'])
+        print(f"[PREVIEW] {stage['preview']} published ({elapsed:.0f}s into the run)")
+    except Exception as e:
+        print(f"[WARNING] Could not publish preview of {stage['name']}: {e}")
+
+
+def run_agent_turn(agent, ctx: RunContext, prompt: str, stage_name: str):
+    """Run one agent turn (workflow stage) under the stage and job deadlines
+    
+    The turn runs in a worker thread. At the deadline ctx.cancel_signal is set,
+    which ends the in-flight model stream and cancels running MCP tool calls;
+    the caller's MCP ExitStack then kills the server process groups. A turn that
+    does not unwind within CANCEL_GRACE_SECONDS is abandoned (daemon thread).
+    
+    Args:
+        agent: Initialized agent
+        ctx: Run context (deadlines and cancel signal)
+        prompt: Stage prompt
+        stage_name: Workflow stage name (for the error)
+        
+    Returns:
+        Agent result
+        
+    Raises:
+        DeadlineExceeded: The stage or the job ran past its deadline
+    """
+    deadline, scope = ctx.deadline(stage_name)
+    if deadline is None:
+        return agent(prompt=prompt)
+    if time.time() >= deadline:
+        ctx.cancel_signal.set()
+        raise DeadlineExceeded(f"Job deadline ({ctx.deadlines.job_timeout:.0f}s) passed before stage {stage_name}",
+                               stage_name, 'job')
+    
+    outcome = {}
+    
+    def turn():
+        try:
+            outcome['result'] = agent(prompt=prompt, cancel_signal=ctx.cancel_signal)
+        except BaseException as e:
+            outcome['error'] = e
+    
+    worker = threading.Thread(target=turn, name=f"trnda-{ctx.run_id}-{stage_name}", daemon=True)
+    worker.start()
+    worker.join(max(0.0, deadline - time.time()))
+    
+    if worker.is_alive():
+        limit = ctx.deadlines.stage_timeout if scope == 'stage' else ctx.deadlines.job_timeout
+        print(f"[DEADLINE] {scope.capitalize()} deadline ({limit:.0f}s) reached in stage {stage_name} - cancelling")
+        ctx.cancel_signal.set()
+        cancel_start = time.time()
+        worker.join(CANCEL_GRACE_SECONDS)
+        ctx.trace.add_span('cancel', 'deadline', cancel_start, time.time() - cancel_start,
+                           scope=scope, unwound=not worker.is_alive())
+        if worker.is_alive():
+            print(f"[WARNING] Stage {stage_name} did not stop within {CANCEL_GRACE_SECONDS}s - abandoned")
+        raise DeadlineExceeded(f"{scope.capitalize()} deadline ({limit:.0f}s) exceeded in stage {stage_name}",
+                               stage_name, scope)
+    
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+def run_workflow_stages(agent, ctx: RunContext, output_dir: str, input_img_dest: str,
+                        checkpoint: dict, start_index: int) -> None:
+    """Run the workflow stages from start_index, checkpointing after each one
+    
+    Args:
+        agent: Initialized agent
+        ctx: Run context
+        output_dir: Absolute output directory
+        input_img_dest: Path to input image in output directory
+        checkpoint: Checkpoint dictionary (updated in place and saved)
+        start_index: Index of the first stage to run
+    """
+    run_prompt = build_run_prompt(ctx, output_dir, input_img_dest, checkpoint, start_index)
+    
+    for index in range(start_index, len(WORKFLOW_STAGES)):
+        stage = WORKFLOW_STAGES[index]
+        prompt = build_stage_prompt(index, output_dir)
+        if index == start_index:
+            prompt = f"{run_prompt}\n\n{prompt}"
+        
+        print()
+        print(f"[STAGE {index + 1}/{len(WORKFLOW_STAGES)}] {stage['title']}")
+        
+        ctx.publish_status('running', stage=stage['name'], stage_index=index + 1, stages=len(WORKFLOW_STAGES))
+        usage_before = dict(agent.event_loop_metrics.accumulated_usage)
+        stage_start = time.time()
+        ctx.trace.stage = stage['name']
+        
+        with ctx.trace.span(stage['name'], 'stage') as span_attrs:
+            try:
+                response = run_agent_turn(agent, ctx, prompt, stage['name'])
+            except DeadlineExceeded as e:
+                # Partial result: stages done so far stay checkpointed, the failing one is recorded
+                checkpoint['deadline'] = {
+                    'stage': stage['name'],
+                    'scope': e.scope,
+                    'seconds': round(time.time() - stage_start, 2),
+                    'job_seconds': round(time.time() - ctx.trace.started, 2),
+                    'at': datetime.now().isoformat(timespec='seconds'),
+                }
+                save_checkpoint(output_dir, checkpoint)
+                raise
+            
+            usage_after = agent.event_loop_metrics.accumulated_usage
+            span_attrs['input_tokens'] = usage_after.get('inputTokens', 0) - usage_before.get('inputTokens', 0)
+            span_attrs['output_tokens'] = usage_after.get('outputTokens', 0) - usage_before.get('outputTokens', 0)
+        
+        missing = [a for a in stage['artifacts'] if not os.path.exists(os.path.join(output_dir, a))]
+        if missing:
+            print(f"[WARNING] Stage {stage['name']} finished without: {', '.join(missing)}")
+        
+        checkpoint['stages'][stage['name']] = {
+            'status': 'incomplete' if missing else 'done',
+            'summary': str(response).strip()[:CHECKPOINT_SUMMARY_CHARS],
+            'artifacts': stage['artifacts'],
+            'input_tokens': usage_after.get('inputTokens', 0) - usage_before.get('inputTokens', 0),
+            'output_tokens': usage_after.get('outputTokens', 0) - usage_before.get('outputTokens', 0),
+            'model_id': get_model_id(ctx.model_for_stage(stage['name'])),
+            'seconds': round(time.time() - stage_start, 2),
+            'completed': datetime.now().isoformat(timespec='seconds'),
+        }
+        save_checkpoint(output_dir, checkpoint)
+        print(f"[CHECKPOINT] Stage {stage['name']} saved")
+        publish_preview(ctx, output_dir, checkpoint, stage)
+    
+    ctx.trace.stage = None
+
+
+def resume_run(output_dir: str, ctx: RunContext = None) -> str:
+    """Resume an interrupted run at its first incomplete stage.
+    
+    Args:
+        output_dir: Output directory of the interrupted run (contains checkpoint.json)
+        ctx: Optional run context (default: restored from the checkpoint)
+        
+    Returns:
+        Output location (local directory or S3 path, like process_image_standalone)
+    """
+    checkpoint = load_checkpoint(output_dir)
+    if not checkpoint:
+        raise FileNotFoundError(f"No {CHECKPOINT_FILE} found in {output_dir}")
+    
+    ctx = ctx or RunContext(
+        client_name=checkpoint.get('client_name'),
+        recipient_email=checkpoint.get('recipient_email'),
+        run_id=checkpoint['run_id']
+    )
+    ctx.output_dir = output_dir
+    ctx.input_uri = ctx.input_uri or checkpoint.get('input_uri')
+    ctx.input_etag = ctx.input_etag or checkpoint.get('input_etag')
+    
+    print("=" * 70)
+    print(f"RESUME MODE: Continuing run {checkpoint['run_id']} from {output_dir}")
+    print("=" * 70)
+    
+    published = False
+    try:
+        output_dir = _process_image_local(find_input_image(output_dir), ctx=ctx)
+        
+        if ctx.input_uri and is_s3_path(ctx.input_uri):
+            s3_bucket, _ = parse_s3_path(ctx.input_uri)
+            output_location = publish_output_to_s3(ctx, output_dir, s3_bucket)
+            published = True
+            ctx.record_processed_input(output_location)
+            ctx.record_report_hashes(output_location)
+            return output_location
+        
+        if not ctx.workspace.contains(output_dir):
+            # Outputs in the workspace are published by the caller (S3 handler), which indexes them
+            ctx.record_report_hashes(os.path.abspath(output_dir))
+        return output_dir
+    except DeadlineExceeded as e:
+        record_deadline_failure(ctx, e, parse_s3_path(ctx.input_uri)[0]
+                                if ctx.input_uri and is_s3_path(ctx.input_uri) else None)
+        raise
+    except Exception as e:
+        ctx.publish_status('failed', error=str(e))
+        raise
+    finally:
+        ctx.workspace.finalize(ctx.output_dir, published)
 
-[List in bullet points]
 
-&nbsp;
+# Files a re-issue needs from a published report (the input image is .jpg or .png)
+REISSUE_FILES = [CHECKPOINT_FILE, REPORT_DATA_FILE, 'design.md'] + [
+    artifact for artifact in REPORT_IMAGE_HEIGHTS if artifact != INPUT_IMAGE_NAME
+] + [INPUT_IMAGE_NAME + extension for extension in ('.jpg', '.png')]
 
-**As-Is Notes:**
 
-[Include any notes, comments, or requirements found in the hand-drawn diagram in bullet points]
+def read_report_header(design_md_path: str) -> tuple:
+    """Generation time and total cost from the header of a design.md
+    
+    Returns:
+        (elapsed "MM:SS" or None, cost breakdown {'total': ...} or None)
+    """
+    import re
+    with open(design_md_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    elapsed = re.search(r'^\*\*Generation time:\*\* (\d+:\d+)', content, re.MULTILINE)
+    cost = re.search(r'^\*\*Total cost for report generation:\*\* \$([\d.]+)', content, re.MULTILINE)
+    return (elapsed.group(1) if elapsed else None,
+            {'total': float(cost.group(1))} if cost else None)
 
-&nbsp;
 
-**Monthly Costs:**
+def set_client_line(design_md_path: str, client_name: str = None) -> None:
+    """Replace the "**Analysis is made for:**" line of a model-written design.md
+    
+    The line goes before "**Generated by:**" (like render_design_md puts it);
+    without client_name it is removed.
+    """
+    with open(design_md_path, 'r', encoding='utf-8') as f:
+        lines = f.read().split('\n')
+    lines = [line for line in lines if not line.startswith('**Analysis is made for:**')]
+    if client_name:
+        index = next((i for i, line in enumerate(lines) if line.startswith('**Generated by:**')), None)
+        if index is not None:
+            lines.insert(index, f"**Analysis is made for:** {_md_text(client_name)}  ")
+    with open(design_md_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
 
-| Scenario | Cost |
-|----------|------|
-| Low | $XXX |
-| Medium | $YYY |
-| High | $ZZZ |
 
-### Cost Breakdown (Low Scenario):
+def fetch_report(ctx: RunContext, location: str, output_dir: str) -> None:
+    """Download the files of a published report (REISSUE_FILES) into output_dir
+    
+    Args:
+        ctx: Run context (S3 client, trace)
+        location: s3://bucket/output/<run_id>/
+        output_dir: Local output directory
+    """
+    bucket, prefix = parse_s3_path(location)
+    s3 = ctx.client('s3')
+    for name in REISSUE_FILES:
+        local_path = os.path.join(output_dir, name)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        try:
+            with ctx.trace.span(name, 's3', operation='download_report'):
+                s3.download_file(bucket, f"{prefix.rstrip('/')}/{name}", local_path)
+        except Exception:
+            # Optional files (architecture.json of older runs, the other input extension)
+            if os.path.exists(local_path):
+                os.remove(local_path)
 
-[Details in bullet points]
 
-### Cost Breakdown (Medium Scenario):
+def reissue_report(location: str, client_name: str = None, recipient_email: str = None,
+                   ctx: RunContext = None) -> dict:
+    """Re-issue a finished report: new header, new PDF, email - without running the agent
+    
+    Re-renders design.md from architecture.json (or rewrites the client line of a
+    model-written design.md), keeping date, generation time and cost of the
+    original run. Then it renders the PDF and queues the email. No model is
+    created, so no Bedrock call is made. For an S3 location, the files are
+    downloaded to the scratch directory of the workspace, and design.md,
+    design.pdf and checkpoint.json are uploaded back; the scratch copy is then
+    removed (never published, so an archived output of the original run stays
+    intact).
+    
+    Args:
+        location: Output directory (output_<run_id>) or s3://bucket/output/<run_id>/
+        client_name: New client/project name (default: the original one)
+        recipient_email: Send to this address (default: from client_name, like a run)
+        ctx: Optional run context (default: context with the original run ID)
+    
+    Returns:
+        {'output': location, 'pdf': PDF path (S3 URI for an S3 location) or None,
+         'recipient': email or None, 'email_id': outbox ID or None, 'seconds': duration}
+    """
+    start = time.time()
+    run_id = os.path.basename(os.path.normpath(parse_s3_path(location)[1] if is_s3_path(location)
+                                               else location)).replace('output_', '')
+    ctx = ctx or RunContext(run_id=run_id)
+    
+    if is_s3_path(location):
+        output_dir = os.path.join(ctx.workspace.create(), 'scratch', f"output_{run_id}")
+        fetch_report(ctx, location, output_dir)
+    else:
+        output_dir = location
+        # Published local outputs may have moved to the archive since
+        if not os.path.isdir(output_dir):
+            output_dir = os.path.join(ctx.workspace.archive_dir, os.path.basename(os.path.normpath(location)))
+    output_dir = os.path.abspath(output_dir)
+    
+    design_md_path = os.path.join(output_dir, 'design.md')
+    has_data = os.path.exists(os.path.join(output_dir, REPORT_DATA_FILE))
+    if not (has_data or os.path.exists(design_md_path)):
+        raise FileNotFoundError(f"No {REPORT_DATA_FILE} or design.md found in {location}")
+    
+    checkpoint = load_checkpoint(output_dir) or {'run_id': run_id, 'post_processing': {}}
+    client_name = client_name if client_name is not None else checkpoint.get('client_name')
+    recipient = resolve_recipient_email(recipient_email, client_name)
+    
+    print("=" * 70)
+    print(f"REISSUE MODE: Report {run_id} from {location}")
+    print("=" * 70)
+    
+    elapsed_str, cost_breakdown = read_report_header(design_md_path) if os.path.exists(design_md_path) else (None, None)
+    report_date = (datetime.fromisoformat(checkpoint['created']).strftime("%B %d, %Y")
+                   if checkpoint.get('created') else None)
+    with ctx.workspace.io('render_design_md', ctx.trace):
+        if has_data:
+            write_design_md(output_dir, client_name, report_date, elapsed_str, cost_breakdown)
+        else:
+            set_client_line(design_md_path, client_name)
+    print(f"[OK] design.md header updated (client: {client_name or 'none'})")
+    
+    result = {'output': location, 'pdf': None, 'recipient': recipient, 'email_id': None}
+    if render_report_pdf(ctx, output_dir, checkpoint):
+        pdf_path = os.path.join(output_dir, 'design.pdf')
+        result['pdf'] = pdf_path
+        if recipient:
+            bucket = parse_s3_path(location)[0] if is_s3_path(location) else ctx.bucket
+            link_s3_uri = f"s3://{bucket}/output/{run_id}/design.pdf"
+            with ctx.trace.span('enqueue_report_email', 'ses', bytes=os.path.getsize(pdf_path)) as span_attrs:
+                span_attrs['email_id'] = ctx.outbox.enqueue(pdf_path, recipient, ctx.run_id, link_s3_uri)
+            result['email_id'] = span_attrs['email_id']
+        else:
+            print("[INFO] No recipient email - PDF re-rendered only")
+    
+    checkpoint.setdefault('reissues', []).append({
+        'reissued': datetime.now().isoformat(timespec='seconds'),
+        'client_name': client_name,
+        'recipient': recipient,
+        'pdf': 'done' if result['pdf'] else 'failed',
+        'email_id': result['email_id'],
+    })
+    save_checkpoint(output_dir, checkpoint)
+    
+    if is_s3_path(location):
+        bucket, prefix = parse_s3_path(location)
+        s3 = ctx.client('s3')
+        for name in ('design.md', 'design.pdf', CHECKPOINT_FILE):
+            if os.path.exists(os.path.join(output_dir, name)):
+                with ctx.trace.span(name, 's3', operation='upload'):
+                    s3.upload_file(os.path.join(output_dir, name), bucket, f"{prefix.rstrip('/')}/{name}",
+                                   ExtraArgs=artifact_upload_args(name))
+        print(f"[OK] Updated design.md, design.pdf and {CHECKPOINT_FILE} in {location}")
+        if result['pdf']:
+            result['pdf'] = f"s3://{bucket}/{prefix.rstrip('/')}/design.pdf"
+        # Removes the scratch copy only - the outbox keeps its own copy of the PDF
+        ctx.workspace.finalize()
+    
+    result['seconds'] = round(time.time() - start, 2)
+    return result
 
-[Details in bullet points]
 
-### Cost Breakdown (High Scenario):
+def publish_output_to_s3(ctx: RunContext, output_dir: str, s3_bucket: str) -> str:
+    """Upload run output directory to s3://bucket/output/<run_id>/
+    
+    Returns:
+        S3 output location
+    """
+    # Determine S3 output path - always just output/<run_id>
+    run_id = os.path.basename(os.path.normpath(output_dir)).replace('output_', '')
+    s3_output_prefix = f"output/{run_id}"
+    
+    # Upload results to S3
+    print()
+    print("=" * 70)
+    print("[S3] Uploading results to S3...")
+    print("=" * 70)
+    s3 = ctx.client('s3')
+    uploaded_files = upload_directory_to_s3(output_dir, s3_bucket, s3_output_prefix, s3=s3, trace=ctx.trace)
+    
+    # Re-upload trace.json so it includes the S3 upload spans
+    try:
+        trace_path = ctx.trace.save(output_dir)
+        s3.upload_file(trace_path, s3_bucket, f"{s3_output_prefix}/trace.json")
+    except Exception as e:
+        print(f"[WARNING] Could not update trace.json in S3: {e}")
+    
+    # Status object of the input: output prefix and PDF link for pollers
+    pdf_url = None
+    pdf_key = f"{s3_output_prefix}/design.pdf"
+    if ctx.status_enabled and pdf_key in uploaded_files:
+        try:
+            pdf_url = s3.generate_presigned_url('get_object', Params={'Bucket': s3_bucket, 'Key': pdf_key},
+                                                ExpiresIn=REPORT_LINK_EXPIRES_SECONDS)
+        except Exception as e:
+            print(f"[WARNING] Could not generate presigned URL: {e}")
+    ctx.publish_status('done', output=f"s3://{s3_bucket}/{s3_output_prefix}/", pdf_url=pdf_url,
+                       runtime_seconds=round(time.time() - ctx.trace.started, 2))
+    
+    print()
+    print("=" * 70)
+    print(f"[SUCCESS] Results uploaded to S3")
+    print("=" * 70)
+    print(f"S3 Location: s3://{s3_bucket}/{s3_output_prefix}/")
+    print()
+    print("Files uploaded:")
+    for file_key in uploaded_files:
+        print(f"  - {file_key}")
+    print("=" * 70)
+    
+    return f"s3://{s3_bucket}/{s3_output_prefix}/"
 
-[Details in bullet points]
 
-\newpage
+def record_deadline_failure(ctx: RunContext, error: DeadlineExceeded, s3_bucket: str = None) -> str:
+    """Publish the partial result of a run cancelled at a deadline
+    
+    With a bucket, the output directory as far as it got (checkpoint with the
+    failing stage, preview.md, diagrams, trace.json) is uploaded to
+    output/<run_id>/. The status object is marked failed with the stage.
+    
+    Args:
+        ctx: Run context
+        error: The deadline error
+        s3_bucket: Optional bucket for the partial output
+        
+    Returns:
+        S3 location of the partial output, or None
+    """
+    location = None
+    if ctx.output_dir and s3_bucket and os.path.isdir(ctx.output_dir):
+        try:
+            ctx.trace.save(ctx.output_dir)
+            s3_prefix = f"output/{os.path.basename(os.path.normpath(ctx.output_dir)).replace('output_', '')}"
+            upload_directory_to_s3(ctx.output_dir, s3_bucket, s3_prefix, s3=ctx.client('s3'))
+            location = f"s3://{s3_bucket}/{s3_prefix}/"
+            print(f"[DEADLINE] Partial result uploaded to {location}")
+        except Exception as e:
+            print(f"[WARNING] Could not upload partial result: {e}")
+    ctx.publish_status('failed', error=str(error), failed_stage=error.stage, deadline=error.scope,
+                       partial_output=location)
+    return location
 
-**As-Is Architecture Diagram:**
 
-\begin{{{{center}}}}
-\includegraphics[height=0.7\textheight,keepaspectratio]{{{{generated-diagrams/diagram_as_is.png}}}}
-\end{{{{center}}}}
+def fail_upload_claim(table: str, claim_id: str, error: str, dynamodb=None) -> None:
+    """Mark the trigger Lambda's idempotency claim of a failed job as failed
+    
+    The trigger claims each upload in DynamoDB before it launches the worker
+    and passes the claim along (TRNDA_EVENT of the ECS task, exported
+    TRNDA_IDEMPOTENCY_* variables on EC2). A failed claim can be claimed
+    again, so a re-upload of the same photo starts a new job instead of being
+    dropped as a duplicate of this one. Errors only warn.
+    
+    Args:
+        table: Idempotency table name (None = job was not claimed, nothing to do)
+        claim_id: Idempotency ID of the upload
+        error: Error message stored with the claim
+        dynamodb: Optional DynamoDB client (default: boto3 client for AWS_REGION)
+    """
+    if not (table and claim_id):
+        return
+    try:
+        if dynamodb is None:
+            import boto3
+            dynamodb = boto3.client('dynamodb', region_name=os.environ.get('AWS_REGION', DEFAULT_REGION))
+        dynamodb.update_item(
+            TableName=table,
+            Key={'id': {'S': claim_id}},
+            UpdateExpression='SET #status = :status, #error = :error',
+            ExpressionAttributeNames={'#status': 'status', '#error': 'error'},
+            ExpressionAttributeValues={':status': {'S': 'failed'}, ':error': {'S': error[:1000]}}
+        )
+        print(f"[INFO] Upload claim {claim_id} marked failed - a re-upload will be processed")
+    except Exception as e:
+        print(f"[WARNING] Could not mark upload claim {claim_id} failed: {e}")
 
-\newpage
 
-## 2. Well-Architected Design
+def resolve_image_path(ctx: RunContext, image_path: str) -> str:
+    """Resolve short names (sample1.jpg without a local file) to s3://<bucket>/input/<name>"""
+    if not is_s3_path(image_path) and not os.path.exists(image_path) and '/' not in image_path:
+        image_path = f"s3://{ctx.bucket}/input/{image_path}"
+        print(f"[INFO] Treating as S3 path: {image_path}")
+    return image_path
 
-**Improvements:**
-[List in bullet points]
 
-&nbsp;
+def fetch_s3_input(ctx: RunContext, image_path: str) -> str:
+    """Download an S3 input into the run workspace
+    
+    The output directory of the run is created in the workspace too (unless
+    ctx.base_dir is set), so it can be archived or removed once published.
+    
+    Returns:
+        Local path of the downloaded image
+    """
+    s3_bucket, s3_key = parse_s3_path(image_path)
+    if ctx.base_dir is None:
+        ctx.base_dir = ctx.workspace.create()
+    filename = os.path.basename(s3_key) if s3_key else 'image.jpg'
+    local_image = os.path.join(ctx.workspace.scratch, filename)
+    
+    try:
+        with ctx.trace.span(s3_key, 's3', operation='download') as span_attrs:
+            download_from_s3(image_path, local_image, s3=ctx.client('s3'))
+            span_attrs['bytes'] = os.path.getsize(local_image)
+    except Exception as e:
+        raise FileNotFoundError(f"Failed to download from S3: {e}")
+    
+    # Object version for the processed-inputs manifest, metadata of web app uploads
+    try:
+        head = ctx.client('s3').head_object(Bucket=s3_bucket, Key=normalize_input_key(s3_key))
+        if ctx.records.manifest_enabled and not ctx.input_etag:
+            ctx.input_etag = head['ETag']
+        ctx.input_preprocessed = head.get('Metadata', {}).get(PREPROCESSED_METADATA_KEY)
+    except Exception as e:
+        print(f"[WARNING] Could not read input ETag/metadata: {e}")
+    return local_image
 
-**Monthly Costs:**
 
-| Scenario | As-Is | Well-Architected | Difference |
-|----------|-------|------------------|------------|
-| Low | $XXX | $AAA | +$BBB (+X%) |
-| Medium | $YYY | $CCC | +$DDD (+Y%) |
-| High | $ZZZ | $EEE | +$FFF (+Z%) |
+def preprocess_input_image(ctx: RunContext, image_path: str) -> str:
+    """Decode and, if needed, compress the input image into the run's scratch directory
+    
+    Uploads the web app already exported at model size (trnda-preprocessed
+    metadata) are used as they are, without decoding. The metadata comes from
+    the client, so the real dimensions are checked from the image header.
+    
+    Returns:
+        Path of the image sent to the model (the input itself if it is small enough)
+    """
+    with ctx.trace.span('preprocess', 'preprocess', bytes=os.path.getsize(image_path)) as span_attrs:
+        preprocessed = parse_preprocessed_metadata(ctx.input_preprocessed)
+        if preprocessed:
+            from PIL import Image
+            try:
+                # Image header only (no decode)
+                with Image.open(image_path) as img:
+                    width, height = img.size
+            except Exception:
+                width, height = None, None
+            if (width and max(width, height) <= MODEL_IMAGE_MAX_EDGE
+                    and span_attrs['bytes'] <= MODEL_IMAGE_MAX_MB * 1024 * 1024):
+                print(f"[INFO] Image pre-normalised by the web app ({width}x{height}, "
+                      f"quality {preprocessed.get('q', '?')}), skipping compression")
+                span_attrs['preprocessed'] = True
+                span_attrs['compressed_bytes'] = span_attrs['bytes']
+                return image_path
+            print(f"[WARNING] Image marked as pre-normalised ({preprocessed['w']}x{preprocessed['h']}) is "
+                  f"{width}x{height}, {span_attrs['bytes'] / 1024:.0f} KB - preprocessing it")
+        
+        # Get image dimensions for adaptive sizing
+        get_image_dimensions(image_path)
+        
+        # Compress image if needed (Bedrock has 5MB limit)
+        with ctx.workspace.io('compress_image', ctx.trace):
+            processed_image_path = compress_image_if_needed(image_path, max_size_mb=MODEL_IMAGE_MAX_MB,
+                                                            output_dir=ctx.workspace.scratch)
+        span_attrs['compressed_bytes'] = os.path.getsize(processed_image_path)
+    return processed_image_path
 
-**Key Benefits:**
-[List in bullet points]
 
-\newpage
+def find_similar_report(ctx: RunContext, image_path: str) -> dict:
+    """Look up the input in the similarity index and decide what to reuse
+    
+    Decisions: 'reuse' (confidence >= ctx.similarity_config.reuse_confidence - take the earlier
+    report as is), 'seed' (>= ctx.similarity_config.seed_confidence - start from the earlier
+    report data), 'none' (no match, full run).
+    
+    Returns:
+        Decision dictionary (also kept in ctx.similarity and the checkpoint)
+    """
+    with ctx.trace.span('similarity_lookup', 'preprocess') as span_attrs:
+        dhash, phash = image_hashes(image_path)
+        info = {'decision': 'none', 'dhash': f"{dhash:016x}", 'phash': f"{phash:016x}"}
+        index = ctx.similarity_index
+        if index is not None:
+            lookup_start = time.perf_counter()
+            match = index.lookup(dhash, phash)
+            info['lookup_ms'] = round((time.perf_counter() - lookup_start) * 1000, 3)
+            info['indexed'] = len(index.entries)
+            if match:
+                entry, confidence, dhash_distance, phash_distance = match
+                info.update({
+                    'confidence': round(confidence, 3),
+                    'dhash_distance': dhash_distance,
+                    'phash_distance': phash_distance,
+                    'match_run_id': entry.get('run_id'),
+                    'match_output': entry.get('output'),
+                })
+                if confidence >= ctx.similarity_config.reuse_confidence:
+                    info['decision'] = 'reuse'
+                elif confidence >= ctx.similarity_config.seed_confidence:
+                    info['decision'] = 'seed'
+        span_attrs.update(decision=info['decision'], confidence=info.get('confidence'))
+    
+    if info.get('match_run_id'):
+        print(f"[INFO] Similar earlier input: run {info['match_run_id']} (confidence {info['confidence']:.2f}, "
+              f"dHash {info['dhash_distance']} / pHash {info['phash_distance']} bits, "
+              f"{info['indexed']} indexed, lookup {info['lookup_ms']:.3f} ms) - decision: {info['decision']}")
+    elif index is not None:
+        print(f"[INFO] No similar earlier input ({info['indexed']} indexed, lookup {info['lookup_ms']:.3f} ms)")
+    ctx.similarity = info
+    return info
+
+
+def fetch_prior_report(ctx: RunContext, location: str, output_dir: str) -> bool:
+    """Copy an earlier run's report data, diagrams and checkpoint into output_dir
+    
+    Args:
+        ctx: Run context
+        location: Output location of the earlier run (s3://bucket/output/<run_id>/ or local directory)
+        output_dir: Output directory of this run
+        
+    Returns:
+        True if the earlier report data (architecture.json) was copied
+    """
+    files = [CHECKPOINT_FILE, REPORT_DATA_FILE] + [artifact for stage in WORKFLOW_STAGES
+                                                   for artifact in stage['artifacts'] if artifact != REPORT_DATA_FILE]
+    if is_s3_path(location):
+        bucket, prefix = parse_s3_path(location)
+        s3 = ctx.client('s3')
+        for name in files:
+            local_path = os.path.join(output_dir, name)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            try:
+                with ctx.trace.span(name, 's3', operation='download_prior'):
+                    s3.download_file(bucket, f"{prefix.rstrip('/')}/{name}", local_path)
+            except Exception as e:
+                print(f"[WARNING] Could not fetch {name} of the earlier report: {e}")
+    else:
+        # Published local outputs may have moved to the archive since
+        if not os.path.isdir(location):
+            location = os.path.join(ctx.workspace.archive_dir, os.path.basename(os.path.normpath(location)))
+        for name in files:
+            if os.path.exists(os.path.join(location, name)):
+                os.makedirs(os.path.dirname(os.path.join(output_dir, name)), exist_ok=True)
+                shutil.copy2(os.path.join(location, name), os.path.join(output_dir, name))
+    return os.path.exists(os.path.join(output_dir, REPORT_DATA_FILE))
+
+
+def apply_similar_report(ctx: RunContext, checkpoint: dict, image_path: str, output_dir: str) -> None:
+    """Reuse or seed this run from a near-duplicate earlier input (see find_similar_report)
+    
+    'reuse' copies the earlier report into output_dir and marks every stage
+    done (zero tokens, reused_from = earlier run); 'seed' keeps the earlier
+    report data in the checkpoint for the run prompt. If the earlier report
+    cannot be fetched, the run falls back to a full run.
+    
+    Args:
+        ctx: Run context
+        checkpoint: New run's checkpoint (updated in place and saved)
+        image_path: Preprocessed input image
+        output_dir: Output directory of this run
+    """
+    import json
+    try:
+        info = find_similar_report(ctx, image_path)
+    except Exception as e:
+        print(f"[WARNING] Similarity lookup failed: {e}")
+        return
+    checkpoint['similarity'] = info
+    
+    if info['decision'] == 'reuse':
+        checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+        if fetch_prior_report(ctx, info['match_output'], output_dir) and os.path.exists(checkpoint_path):
+            prior = load_checkpoint(output_dir)
+            stages = {name: record for name, record in prior.get('stages', {}).items()
+                      if record.get('status') == 'done'}
+            info['tokens_saved'] = sum(r.get('input_tokens', 0) + r.get('output_tokens', 0) for r in stages.values())
+            info['minutes_saved'] = round(sum(r.get('seconds', 0) for r in stages.values()) / 60.0, 2)
+            for record in stages.values():
+                record.update(input_tokens=0, output_tokens=0, seconds=0,
+                              reused_from=record.get('reused_from') or info['match_run_id'])
+            checkpoint['stages'] = stages
+            print(f"[REUSE] Report of run {info['match_run_id']} reused "
+                  f"(saved {info['tokens_saved']:,} tokens, ~{info['minutes_saved']:.1f} min)")
+        else:
+            print(f"[WARNING] Earlier report {info['match_output']} not available - running the full workflow")
+            info['decision'] = 'none'
+    elif info['decision'] == 'seed':
+        if fetch_prior_report(ctx, info['match_output'], output_dir):
+            with open(os.path.join(output_dir, REPORT_DATA_FILE), 'r', encoding='utf-8') as f:
+                info['report_data'] = json.load(f)
+            print(f"[INFO] Starting from the report data of run {info['match_run_id']}")
+        else:
+            info['decision'] = 'none'
+    
+    if info['decision'] != 'reuse':
+        # Only the report data goes into the prompt; the new run writes its own files
+        for name in (CHECKPOINT_FILE, REPORT_DATA_FILE):
+            if os.path.exists(os.path.join(output_dir, name)):
+                os.remove(os.path.join(output_dir, name))
+        shutil.rmtree(os.path.join(output_dir, 'generated-diagrams'), ignore_errors=True)
+    save_checkpoint(output_dir, checkpoint)
 
-**Well-Architected Design Diagram:**
 
-\begin{{{{center}}}}
-\includegraphics[height=0.7\textheight,keepaspectratio]{{{{generated-diagrams/diagram_well_architected.png}}}}
-\end{{{{center}}}}
+def process_image_standalone(image_path: str, client_name: str = None, recipient_email: str = None,
+                             ctx: RunContext = None) -> str:
+    """Standalone function for processing images - used by CLI and S3 handler.
+    
+    Supports both local paths and S3 paths (s3://bucket/key or just filename).
+    For S3 paths, downloads input, processes locally, and uploads output.
+    
+    Args:
+        image_path: Local path, S3 URI (s3://bucket/key), or short name (sample1.jpg)
+        client_name: Optional client/project name (displayed in report header)
+        recipient_email: Optional email address for sending report (overrides auto-detection from client_name)
+        ctx: Optional run context (default: new context for this run)
+        
+    Returns:
+        Output location (local directory or S3 path)
+    """
+    ctx = ctx or RunContext(client_name=client_name, recipient_email=recipient_email)
+    
+    image_path = resolve_image_path(ctx, image_path)
+    ctx.input_uri = image_path
+    
+    # Handle S3 path
+    if is_s3_path(image_path):
+        print("=" * 70)
+        print("S3 MODE: Downloading from S3, processing, uploading results")
+        print("=" * 70)
+        
+        s3_bucket, _ = parse_s3_path(image_path)
+        published = False
+        try:
+            ctx.publish_status('running', stage=None)
+            local_image = fetch_s3_input(ctx, image_path)
+            
+            # Process locally (reuse rest of the function)
+            output_dir = _process_image_local(local_image, ctx=ctx)
+            
+            output_location = publish_output_to_s3(ctx, output_dir, s3_bucket)
+            published = True
+            ctx.record_processed_input(output_location)
+            ctx.record_report_hashes(output_location)
+            return output_location
+        except DeadlineExceeded as e:
+            record_deadline_failure(ctx, e, s3_bucket)
+            raise
+        except Exception as e:
+            ctx.publish_status('failed', error=str(e))
+            raise
+        finally:
+            ctx.workspace.finalize(ctx.output_dir, published)
+    
+    # Local file processing
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"Image not found: {image_path}")
+    
+    try:
+        output_dir = _process_image_local(image_path, ctx=ctx)
+        if not ctx.workspace.contains(output_dir):
+            # Outputs in the workspace are published by the caller (S3 handler), which indexes them
+            ctx.record_report_hashes(os.path.abspath(output_dir))
+        return output_dir
+    finally:
+        ctx.workspace.finalize(ctx.output_dir)
 
-```
 
-CRITICAL REQUIREMENTS:
-- MAX 3-4 pages total
-- NO verbose descriptions  
-- NO UTF-8 special characters (no checkmarks, no emojis, no fancy bullets)
-- You MUST use write_file tool to save the markdown
-- You MUST use convert_with_pandoc tool to create PDF
-- Region: eu-central-1
-- Do NOT just print the content - SAVE IT using write_file tool!"""
+def _interval_overlap(interval: tuple, others: list) -> float:
+    """Seconds of interval (start, end) covered by a list of non-overlapping intervals"""
+    start, end = interval
+    return sum(max(0.0, min(end, o_end) - max(start, o_start)) for o_start, o_end in others)
 
 
-def calculate_complete_cost(input_tokens: int, output_tokens: int, runtime_minutes: float = 15.0) -> dict:
-    """Calculate complete AWS costs for TRNDA report generation.
+def process_images_pipelined(image_paths: list, client_name: str = None, recipient_email: str = None,
+                             context_factory=None) -> tuple:
+    """Process several images with I/O pipelined around report generation.
+    
+    Reports are generated one after another (same model load as a plain
+    loop), but while report N runs, image N+1 is downloaded and preprocessed
+    and the output of report N-1 is uploaded in the background.
     
     Args:
-        input_tokens: Number of input tokens used
-        output_tokens: Number of output tokens used
-        runtime_minutes: Estimated runtime in minutes (default 15 min)
+        image_paths: Local paths, S3 URIs or short names
+        client_name: Optional client/project name for all reports
+        recipient_email: Optional email address for all reports
+        context_factory: Optional callable(client_name, recipient_email) -> RunContext
         
     Returns:
-        Dictionary with cost breakdown
+        (results, summary): one result dict per image ({image, output, success, error}) and
+        the pipeline summary (wall time, per-phase seconds, overlap)
     """
-    # Bedrock Claude 4.5 Sonnet pricing (eu-central-1)
-    # Input: $3 per 1M tokens, Output: $15 per 1M tokens
-    bedrock_input_cost = (input_tokens / 1_000_000) * 3.0
-    bedrock_output_cost = (output_tokens / 1_000_000) * 15.0
-    bedrock_total = bedrock_input_cost + bedrock_output_cost
+    from concurrent.futures import ThreadPoolExecutor
     
-    # ECS Fargate pricing (eu-central-1) - 2 vCPU, 4 GB RAM
-    # vCPU: $0.04656 per vCPU per hour
-    # Memory: $0.00511 per GB per hour
-    vcpu_cost_per_hour = 0.04656 * 2  # 2 vCPU
-    memory_cost_per_hour = 0.00511 * 4  # 4 GB
-    ecs_cost_per_hour = vcpu_cost_per_hour + memory_cost_per_hour
-    ecs_total = ecs_cost_per_hour * (runtime_minutes / 60.0)
+    factory = context_factory or (lambda client_name, recipient_email: RunContext(
+        client_name=client_name, recipient_email=recipient_email))
+    jobs = [{'image': image_path, 'success': False, 'output': None, 'error': None, 'phases': {}}
+            for image_path in image_paths]
     
-    # S3 costs (minimal for this use case)
-    # Storage: $0.023 per GB/month (assume 10 MB output = 0.01 GB)
-    # PUT requests: $0.005 per 1000 requests (assume 5 PUT requests)
-    # GET requests: $0.0004 per 1000 requests (assume 5 GET requests)
-    s3_storage = 0.023 * 0.01 / 30  # Daily cost for 10 MB
-    s3_put = 0.005 * (5 / 1000)
-    s3_get = 0.0004 * (5 / 1000)
-    s3_total = s3_storage + s3_put + s3_get
+    def timed(job, phase, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            job['phases'][phase] = (start, time.time())
     
-    # Total cost
-    total = bedrock_total + ecs_total + s3_total
+    def prefetch(job):
+        ctx = job['ctx'] = factory(client_name, recipient_email)
+        image_path = ctx.input_uri = resolve_image_path(ctx, job['image'])
+        if is_s3_path(image_path):
+            image_path = fetch_s3_input(ctx, image_path)
+        elif not os.path.exists(image_path):
+            raise FileNotFoundError(f"Image not found: {image_path}")
+        return image_path, preprocess_input_image(ctx, image_path)
     
-    return {
-        'bedrock': bedrock_total,
-        'bedrock_input': bedrock_input_cost,
-        'bedrock_output': bedrock_output_cost,
-        'ecs': ecs_total,
-        'ecs_vcpu': vcpu_cost_per_hour * (runtime_minutes / 60.0),
-        'ecs_memory': memory_cost_per_hour * (runtime_minutes / 60.0),
-        's3': s3_total,
-        's3_storage': s3_storage,
-        's3_put': s3_put,
-        's3_get': s3_get,
-        'total': total,
-        'runtime_minutes': runtime_minutes
+    def publish(job):
+        ctx = job['ctx']
+        published = False
+        try:
+            if is_s3_path(ctx.input_uri):
+                job['output'] = publish_output_to_s3(ctx, job['output'], parse_s3_path(ctx.input_uri)[0])
+                published = True
+                ctx.record_processed_input(job['output'])
+                ctx.record_report_hashes(job['output'])
+            else:
+                ctx.record_report_hashes(os.path.abspath(job['output']))
+        finally:
+            ctx.workspace.finalize(ctx.output_dir, published)
+    
+    batch_start = time.time()
+    wait_seconds = 0.0
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='trnda-prefetch') as prefetcher, \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix='trnda-upload') as uploader:
+        uploads = []
+        next_prefetch = prefetcher.submit(timed, jobs[0], 'prefetch', prefetch, jobs[0]) if jobs else None
+        
+        for index, job in enumerate(jobs):
+            print(f"[{index + 1}/{len(jobs)}] Processing: {job['image']}")
+            print("-" * 70)
+            
+            wait_start = time.time()
+            try:
+                local_image, processed_image = next_prefetch.result()
+            except Exception as e:
+                local_image = None
+                job['error'] = str(e)
+            wait_seconds += time.time() - wait_start
+            
+            if local_image is not None:
+                # The job clock (deadline, queue wait) starts now, minus the job's own prefetch time -
+                # not while the previous report was generating
+                prefetch_start, prefetch_end = job['phases']['prefetch']
+                job['ctx'].trace.restart(time.time() - (prefetch_end - prefetch_start))
+            
+            # Start fetching the next image before this report is generated
+            if index + 1 < len(jobs):
+                next_prefetch = prefetcher.submit(timed, jobs[index + 1], 'prefetch', prefetch, jobs[index + 1])
+            
+            if local_image is None:
+                if job.get('ctx'):
+                    job['ctx'].publish_status('failed', error=job['error'])
+                    job['ctx'].workspace.finalize(job['ctx'].output_dir)
+                print(f"[ERROR] Failed to fetch {job['image']}: {job['error']}")
+                continue
+            
+            try:
+                job['output'] = timed(job, 'process', _process_image_local, local_image, None, None,
+                                      job['ctx'], processed_image)
+            except DeadlineExceeded as e:
+                job['error'] = str(e)
+                bucket = parse_s3_path(job['ctx'].input_uri)[0] if is_s3_path(job['ctx'].input_uri) else None
+                record_deadline_failure(job['ctx'], e, bucket)
+                job['ctx'].workspace.finalize(job['ctx'].output_dir)
+                print(f"[ERROR] Failed to process {job['image']}: {e}")
+                continue
+            except Exception as e:
+                job['error'] = str(e)
+                job['ctx'].publish_status('failed', error=job['error'])
+                job['ctx'].workspace.finalize(job['ctx'].output_dir)
+                print(f"[ERROR] Failed to process {job['image']}: {e}")
+                continue
+            
+            uploads.append((job, uploader.submit(timed, job, 'upload', publish, job)))
+        
+        wait_start = time.time()
+        for job, upload in uploads:
+            try:
+                upload.result()
+                job['success'] = True
+            except Exception as e:
+                job['error'] = f"Upload failed: {e}"
+                job['ctx'].publish_status('failed', error=job['error'])
+        wait_seconds += time.time() - wait_start
+    wall_seconds = time.time() - batch_start
+    
+    # Background I/O that ran while a report was being generated
+    process_intervals = [job['phases']['process'] for job in jobs if 'process' in job['phases']]
+    phase_seconds = {phase: round(sum(end - start for job in jobs for p, (start, end) in job['phases'].items()
+                                      if p == phase), 3)
+                     for phase in ('prefetch', 'process', 'upload')}
+    io_intervals = [interval for job in jobs for phase, interval in job['phases'].items() if phase != 'process']
+    overlapped = sum(_interval_overlap(interval, process_intervals) for interval in io_intervals)
+    io_seconds = phase_seconds['prefetch'] + phase_seconds['upload']
+    
+    summary = {
+        'wall_seconds': round(wall_seconds, 3),
+        'sequential_seconds': round(sum(phase_seconds.values()), 3),
+        'phase_seconds': phase_seconds,
+        'io_overlapped_seconds': round(overlapped, 3),
+        'io_overlap_percent': round(overlapped / io_seconds * 100, 1) if io_seconds else 0.0,
+        'wait_seconds': round(wait_seconds, 3),
     }
+    results = [{'image': job['image'], 'output': job['output'], 'success': job['success'], 'error': job['error']}
+               for job in jobs]
+    return results, summary
 
 
-def save_cost_breakdown(output_dir: str, cost_breakdown: dict, usage, start_datetime, end_datetime, elapsed_str) -> None:
-    """Save detailed cost breakdown to cost.md file.
+def _md_text(text) -> str:
+    """Model-provided text as one markdown line (no line breaks, literal dollar signs)"""
+    text = ' '.join(str(text).split())
+    return text.replace('\\$', '$').replace('$', '\\$')
+
+
+def _md_bullets(items: list) -> str:
+    """Markdown bullet list"""
+    if not items:
+        return "- None"
+    return "\n".join(f"- {_md_text(item)}" for item in items)
+
+
+def format_cost_difference(as_is: float, well_architected: float) -> str:
+    """Cost difference cell, e.g. +$36.90 (+81.6%)"""
+    difference = well_architected - as_is
+    sign = '+' if difference >= 0 else '-'
+    percent = f" ({sign}{abs(difference) / as_is * 100:.1f}%)" if as_is else ""
+    return f"{sign}${abs(difference):,.2f}{percent}"
+
+
+def render_design_md(data: dict, client_name: str = None, report_date: str = None,
+                     elapsed_str: str = None, cost_breakdown: dict = None,
+                     input_image: str = INPUT_IMAGE_NAME + '.png') -> str:
+    """Render design.md from the structured report payload (architecture.json).
     
     Args:
-        output_dir: Output directory path
-        cost_breakdown: Cost breakdown dictionary
-        usage: Token usage object
-        start_datetime: Start time as datetime object
-        end_datetime: End time as datetime object
-        elapsed_str: Elapsed time as formatted string (MM:SS)
+        data: Report payload (see save_report_data)
+        client_name: Optional client/project name ("Analysis is made for:" line)
+        report_date: Report date (default: today)
+        elapsed_str: Optional generation time (MM:SS) - adds the runtime/cost header lines
+        cost_breakdown: Optional cost breakdown (total cost header line)
+        input_image: File name of the input image in the output directory
+        
+    Returns:
+        Markdown content
     """
-    cost_file = os.path.join(output_dir, 'cost.md')
+    header = [f"**Analysis is made for:** {_md_text(client_name)}  "] if client_name else []
+    header += [
+        "**Generated by:** TRNDA (Trask Ručně Nakreslí, Dokončí AWS)  ",
+        f"**Date:** {report_date or datetime.now().strftime('%B %d, %Y')}  ",
+        "**Region:** eu-central-1  ",
+    ]
+    if elapsed_str:
+        header.append(f"**Generation time:** {elapsed_str} (MM:SS)  ")
+        if cost_breakdown:
+            header.append(f"**Total cost for report generation:** ${cost_breakdown['total']:.4f}")
+        else:
+            header.append("**Total cost for report generation:** N/A (usage data not available)")
     
-    content = f"""# TRNDA Generation Cost Breakdown
+    as_is, well_architected = data['as_is_costs'], data['well_architected_costs']
+    as_is_rows = "\n".join(
+        f"| {scenario.capitalize()} | ${as_is[scenario]:,.2f} |" for scenario in COST_SCENARIOS
+    )
+    comparison_rows = "\n".join(
+        f"| {scenario.capitalize()} | ${as_is[scenario]:,.2f} | ${well_architected[scenario]:,.2f} | "
+        f"{format_cost_difference(as_is[scenario], well_architected[scenario])} |"
+        for scenario in COST_SCENARIOS
+    )
+    breakdowns = "\n\n".join(
+        f"### Cost Breakdown ({scenario.capitalize()} Scenario):\n\n"
+        f"{_md_bullets(data['as_is_cost_breakdown'].get(scenario, []))}"
+        for scenario in COST_SCENARIOS
+    )
+    header_lines = "\n".join(header)
+    heights = REPORT_IMAGE_HEIGHTS
+    
+    return rf"""# AWS Architecture Design - {_md_text(data['title'])}
 
-**Generated:** {datetime.now().strftime("%B %d, %Y at %H:%M:%S")}  
-**Region:** eu-central-1  
-**Runtime:** {elapsed_str} (MM:SS)
+{header_lines}
+
+---
+
+## Original Hand-Drawn Design
+
+**Original input diagram:**
+
+\begin{{center}}
+\includegraphics[height={heights[INPUT_IMAGE_NAME]}\textheight,keepaspectratio]{{{input_image}}}
+\end{{center}}
 
----
+\newpage
 
-## Execution Timeline
+## 1. As-Is Architecture
 
-| Event | Time |
-|-------|------|
-| Start | {start_datetime.strftime("%H:%M:%S")} |
-| End | {end_datetime.strftime("%H:%M:%S")} |
-| **Duration** | **{elapsed_str}** |
+**Components:** 
 
----
+{_md_bullets(data['as_is_components'])}
 
-## Summary
+&nbsp;
 
-| Component | Cost (USD) |
-|-----------|------------|
-| **Bedrock (Claude 4.5 Sonnet)** | **${cost_breakdown['bedrock']:.4f}** |
-| **ECS Fargate Compute** | **${cost_breakdown['ecs']:.4f}** |
-| **S3 Storage & Transfer** | **${cost_breakdown['s3']:.6f}** |
-| **TOTAL** | **${cost_breakdown['total']:.4f}** |
+**As-Is Notes:**
 
----
+{_md_bullets(data.get('as_is_notes'))}
 
-## Detailed Breakdown
+&nbsp;
 
-### 1. Amazon Bedrock - Claude 4.5 Sonnet
+**Monthly Costs:**
 
-**Model:** `eu.anthropic.claude-sonnet-4-5-20250929-v1:0`  
-**Region:** eu-central-1
+| Scenario | Cost |
+|----------|------|
+{as_is_rows}
 
-| Metric | Usage | Rate | Cost |
-|--------|-------|------|------|
-| Input tokens | {usage.input_tokens:,} | $3.00 per 1M | ${cost_breakdown['bedrock_input']:.4f} |
-| Output tokens | {usage.output_tokens:,} | $15.00 per 1M | ${cost_breakdown['bedrock_output']:.4f} |
-| **Bedrock Total** | **{usage.input_tokens + usage.output_tokens:,}** | | **${cost_breakdown['bedrock']:.4f}** |
+{breakdowns}
 
-### 2. Amazon ECS Fargate
+\newpage
 
-**Configuration:** 2 vCPU, 4 GB RAM  
-**Runtime:** ~{cost_breakdown['runtime_minutes']:.1f} minutes
+**As-Is Architecture Diagram:**
 
-| Resource | Usage | Rate (per hour) | Cost |
-|----------|-------|-----------------|------|
-| vCPU (2x) | {cost_breakdown['runtime_minutes']:.1f} min | $0.04656/vCPU | ${cost_breakdown['ecs_vcpu']:.4f} |
-| Memory (4 GB) | {cost_breakdown['runtime_minutes']:.1f} min | $0.00511/GB | ${cost_breakdown['ecs_memory']:.4f} |
-| **ECS Total** | | | **${cost_breakdown['ecs']:.4f}** |
+\begin{{center}}
+\includegraphics[height={heights['generated-diagrams/diagram_as_is.png']}\textheight,keepaspectratio]{{generated-diagrams/diagram_as_is.png}}
+\end{{center}}
 
-### 3. Amazon S3
+\newpage
 
-**Usage:** Input image upload, output files storage
+## 2. Well-Architected Design
 
-| Operation | Volume | Rate | Cost |
-|-----------|--------|------|------|
-| Storage (daily) | ~10 MB | $0.023/GB/month | ${cost_breakdown['s3_storage']:.6f} |
-| PUT requests | ~5 requests | $0.005/1000 | ${cost_breakdown['s3_put']:.6f} |
-| GET requests | ~5 requests | $0.0004/1000 | ${cost_breakdown['s3_get']:.6f} |
-| **S3 Total** | | | **${cost_breakdown['s3']:.6f}** |
+**Improvements:**
 
----
+{_md_bullets(data['improvements'])}
 
-## Cost Optimization Notes
+&nbsp;
 
-### Current Configuration
-- **ECS:** 2 vCPU, 4 GB RAM - optimal for typical workloads
-- **Runtime:** ~{cost_breakdown['runtime_minutes']:.0f} minutes average
-- **Bedrock:** Claude 4.5 Sonnet with 1M context window
+**Monthly Costs:**
 
-### Optimization Opportunities
-1. **Reduce token usage:**
-   - Optimize prompts and system instructions
-   - Use smaller context windows where possible
-   - Cache frequently used prompts
+| Scenario | As-Is | Well-Architected | Difference |
+|----------|-------|------------------|------------|
+{comparison_rows}
 
-2. **Adjust ECS resources:**
-   - Consider 1 vCPU, 2 GB for smaller diagrams
-   - Current: 2 vCPU, 4 GB is good for complex diagrams
+**Key Benefits:**
 
-3. **Batch processing:**
-   - Process multiple diagrams in one session
-   - Amortize ECS startup costs
+{_md_bullets(data['benefits'])}
 
-### Monthly Cost Estimates
+\newpage
 
-Assuming 100 reports per month:
+**Well-Architected Design Diagram:**
 
-| Volume | Bedrock | ECS | S3 | **Total** |
-|--------|---------|-----|----|-----------| 
-| 10 reports | ${cost_breakdown['bedrock'] * 10:.2f} | ${cost_breakdown['ecs'] * 10:.2f} | ${cost_breakdown['s3'] * 10:.2f} | **${cost_breakdown['total'] * 10:.2f}** |
-| 50 reports | ${cost_breakdown['bedrock'] * 50:.2f} | ${cost_breakdown['ecs'] * 50:.2f} | ${cost_breakdown['s3'] * 50:.2f} | **${cost_breakdown['total'] * 50:.2f}** |
-| 100 reports | ${cost_breakdown['bedrock'] * 100:.2f} | ${cost_breakdown['ecs'] * 100:.2f} | ${cost_breakdown['s3'] * 100:.2f} | **${cost_breakdown['total'] * 100:.2f}** |
-| 200 reports | ${cost_breakdown['bedrock'] * 200:.2f} | ${cost_breakdown['ecs'] * 200:.2f} | ${cost_breakdown['s3'] * 200:.2f} | **${cost_breakdown['total'] * 200:.2f}** |
+\begin{{center}}
+\includegraphics[height={heights['generated-diagrams/diagram_well_architected.png']}\textheight,keepaspectratio]{{generated-diagrams/diagram_well_architected.png}}
+\end{{center}}
+"""
 
----
 
-## Pricing References
+def write_design_md(output_dir: str, client_name: str = None, report_date: str = None,
+                    elapsed_str: str = None, cost_breakdown: dict = None) -> str:
+    """Render <output_dir>/design.md from <output_dir>/architecture.json.
+    
+    Returns:
+        Path to design.md, or None if there is no report data
+    """
+    import json
+    
+    data_path = os.path.join(output_dir, REPORT_DATA_FILE)
+    if not os.path.exists(data_path):
+        return None
+    
+    with open(data_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    
+    design_md_path = os.path.join(output_dir, 'design.md')
+    with open(design_md_path, 'w', encoding='utf-8') as f:
+        f.write(render_design_md(data, client_name, report_date, elapsed_str, cost_breakdown,
+                                 os.path.basename(find_input_image(output_dir))))
+    return design_md_path
 
-- **Bedrock Pricing:** https://aws.amazon.com/bedrock/pricing/
-- **ECS Fargate Pricing:** https://aws.amazon.com/fargate/pricing/
-- **S3 Pricing:** https://aws.amazon.com/s3/pricing/
 
-**Note:** Prices are for eu-central-1 region and subject to change. Always verify current pricing.
-"""
+def add_runtime_info(design_md_path: str, elapsed_str: str, cost_breakdown: dict = None) -> None:
+    """Add generation time and cost lines after the **Region:** header line.
     
-    try:
-        with open(cost_file, 'w', encoding='utf-8') as f:
-            f.write(content)
-        print(f"[OK] Cost breakdown saved to {cost_file}")
-    except Exception as e:
-        print(f"[WARNING] Could not save cost breakdown: {e}")
+    Only needed for model-written design.md files (runs checkpointed before
+    architecture.json); rendered reports get these lines from render_design_md().
+    Lines from a previous pass (e.g. before a resume) are replaced, not duplicated.
+    """
+    with open(design_md_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    
+    # Find the header section and add runtime info after "Region:"
+    lines = content.split('\n')
+    new_lines = []
+    for i, line in enumerate(lines):
+        if line.startswith('**Generation time:**') or line.startswith('**Total cost for report generation:**'):
+            continue
+        new_lines.append(line)
+        if line.startswith('**Region:**'):
+            # Add runtime info after Region line
+            new_lines.append(f'**Generation time:** {elapsed_str} (MM:SS)  ')
+            if cost_breakdown:
+                new_lines.append(f'**Total cost for report generation:** ${cost_breakdown["total"]:.4f}')
+            else:
+                new_lines.append(f'**Total cost for report generation:** N/A (usage data not available)')
+    
+    # Write back
+    with open(design_md_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(new_lines))
 
 
-def create_output_dir():
-    """Create timestamped output directory."""
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    output_dir = f"output_{timestamp}"
-    os.makedirs(output_dir, exist_ok=True)
-    os.makedirs(f"{output_dir}/generated-diagrams", exist_ok=True)
-    return output_dir
+# pandoc header: graphics and the page footer of the PDF
+REPORT_HEADER_TEX = r'''\usepackage{graphicx}
+\usepackage{fancyhdr}
+\pagestyle{fancy}
+\fancyhf{}
+\fancyfoot[L]{Trask Solutions a.s.}
+\fancyfoot[C]{\thepage}
+\fancyfoot[R]{TRNDA report v0.5}
+\renewcommand{\headrulewidth}{0pt}
+\renewcommand{\footrulewidth}{0.4pt}
+'''
 
 
-def process_image_standalone(image_path: str, client_name: str = None, recipient_email: str = None) -> str:
-    """Standalone function for processing images - used by CLI and S3 handler.
+def render_report_pdf(ctx: RunContext, output_dir: str, checkpoint: dict) -> bool:
+    """Render <output_dir>/design.md to design.pdf with pandoc (header.tex adds the page footer)
     
-    Supports both local paths and S3 paths (s3://bucket/key or just filename).
-    For S3 paths, downloads input, processes locally, and uploads output.
+    pandoc runs in its own process group with PANDOC_TIMEOUT, cut to what is
+    left of the job deadline. The result goes to checkpoint['post_processing']['pdf'].
     
     Args:
-        image_path: Local path, S3 URI (s3://bucket/key), or short name (sample1.jpg)
-        client_name: Optional client/project name (displayed in report header)
-        recipient_email: Optional email address for sending report (overrides auto-detection from client_name)
-        
+        ctx: Run context (trace, workspace, job deadline)
+        output_dir: Absolute output directory with design.md
+        checkpoint: Run checkpoint (saved after the PDF state changes)
+    
     Returns:
-        Output location (local directory or S3 path)
+        True if design.pdf was generated
     """
-    # Store original sys.argv
-    original_argv = sys.argv.copy()
-    
-    # Detect S3 path and handle accordingly
-    is_s3 = is_s3_path(image_path)
-    
-    # If just a filename without path, treat as S3
-    if not is_s3 and not os.path.exists(image_path) and '/' not in image_path:
-        # Short name like "sample1.jpg" -> convert to S3 path
-        image_path = f"s3://{DEFAULT_BUCKET}/input/{image_path}"
-        is_s3 = True
-        print(f"[INFO] Treating as S3 path: {image_path}")
-    
-    # Handle S3 path
-    if is_s3:
-        print("=" * 70)
-        print("S3 MODE: Downloading from S3, processing, uploading results")
-        print("=" * 70)
-        
-        # Parse S3 path
-        s3_bucket, s3_key = parse_s3_path(image_path)
-        
-        # Create temporary directory for S3 download/processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Download from S3
-            filename = os.path.basename(s3_key) if s3_key else 'image.jpg'
-            local_image = os.path.join(temp_dir, filename)
-            
-            try:
-                download_from_s3(image_path, local_image)
-            except Exception as e:
-                raise FileNotFoundError(f"Failed to download from S3: {e}")
-            
-            # Process locally (reuse rest of the function)
-            output_dir = _process_image_local(local_image, client_name, recipient_email)
-            
-            # Determine S3 output path - always just output/timestamp
-            timestamp = os.path.basename(output_dir).replace('output_', '')
-            s3_output_prefix = f"output/{timestamp}"
-            
-            # Upload results to S3
-            print()
-            print("=" * 70)
-            print("[S3] Uploading results to S3...")
-            print("=" * 70)
-            uploaded_files = upload_directory_to_s3(output_dir, s3_bucket, s3_output_prefix)
-            
-            print()
-            print("=" * 70)
-            print(f"[SUCCESS] Results uploaded to S3")
-            print("=" * 70)
-            print(f"S3 Location: s3://{s3_bucket}/{s3_output_prefix}/")
-            print()
-            print("Files uploaded:")
-            for file_key in uploaded_files:
-                print(f"  - {file_key}")
-            print("=" * 70)
-            
-            return f"s3://{s3_bucket}/{s3_output_prefix}/"
+    post_processing = checkpoint.setdefault('post_processing', {})
     
-    # Local file processing
-    # Temporarily set sys.argv for main()
-    sys.argv = ['trnda-agent.py', image_path]
-    if client_name:
-        sys.argv.append(client_name)
+    # Create header.tex for pandoc
+    header_tex_path = os.path.join(output_dir, 'header.tex')
+    with ctx.workspace.io('write_header_tex', ctx.trace), open(header_tex_path, 'w') as f:
+        f.write(REPORT_HEADER_TEX)
     
+    print(f"[START] Generating PDF...")
+    # pandoc timeout, cut to what is left of the job deadline
+    timeout = pandoc_timeout()
+    job_deadline = ctx.deadline()[0]
+    if job_deadline:
+        timeout = max(1.0, min(timeout or float('inf'), job_deadline - time.time()))
     try:
-        if not os.path.exists(image_path):
-            raise FileNotFoundError(f"Image not found: {image_path}")
-        
-        output_dir = _process_image_local(image_path, client_name)
-        return output_dir
-        
-    finally:
-        # Restore original sys.argv
-        sys.argv = original_argv
+        with ctx.trace.span('pandoc', 'pandoc', timeout=timeout) as span_attrs:
+            result = run_process_group(
+                ['pandoc', 'design.md', '-o', 'design.pdf',
+                 '-V', 'geometry:margin=2cm',
+                 '-V', 'linestretch=1.1',
+                 '-V', 'fontsize=10pt',
+                 '-H', 'header.tex'],
+                timeout=timeout,
+                cwd=output_dir
+            )
+            span_attrs['returncode'] = result.returncode
+        if result.returncode == 0:
+            pdf_bytes = os.path.getsize(os.path.join(output_dir, 'design.pdf'))
+            print(f"[OK] PDF generated successfully: {output_dir}/design.pdf ({pdf_bytes / 1024:.0f} KB)")
+            post_processing['pdf'] = 'done'
+            checkpoint.setdefault('artifact_sizes', {})['pdf_bytes'] = pdf_bytes
+            save_checkpoint(output_dir, checkpoint)
+            return True
+        print(f"[ERROR] PDF generation failed: {result.stderr}")
+    except subprocess.TimeoutExpired:
+        print(f"[ERROR] pandoc still running after {timeout:.0f}s - process group killed, no PDF")
+        post_processing['pdf'] = 'timeout'
+        save_checkpoint(output_dir, checkpoint)
+    except Exception as e:
+        print(f"[ERROR] Could not generate PDF: {e}")
+    return False
 
 
-def _process_image_local(image_path: str, client_name: str = None, recipient_email: str = None) -> str:
+def resolve_recipient_email(recipient_email: str = None, client_name: str = None) -> str:
+    """Determine email address for sending report
+    
+    Priority 1: Use recipient_email if provided
+    Priority 2: Check if client_name is a clean email address
+    Priority 3: Try to extract email from client_name text
+    """
+    email_to_send = recipient_email
+    if not email_to_send and client_name:
+        if is_email(client_name):
+            # Clean email address
+            email_to_send = client_name
+        else:
+            # Try to extract email from longer text
+            extracted = extract_email_from_text(client_name)
+            if extracted:
+                email_to_send = extracted
+                print(f"[INFO] Extracted email from client info: {email_to_send}")
+    return email_to_send
+
+
+def _process_image_local(image_path: str, client_name: str = None, recipient_email: str = None,
+                         ctx: RunContext = None, processed_image_path: str = None) -> str:
     """Internal function to process image locally.
     
+    If ctx.output_dir already holds a checkpoint, the run is resumed at the
+    first incomplete stage instead of starting over. With ctx.profile the run
+    is sampled by a RunProfiler; its files are written into the output
+    directory (uploaded with the report), also when the run fails.
+    
     Args:
         image_path: Local path to image
-        client_name: Optional client name
-        recipient_email: Optional email address for sending report
+        client_name: Optional client name (ignored when ctx is given)
+        recipient_email: Optional email address for sending report (ignored when ctx is given)
+        ctx: Optional run context (default: new context for this run)
+        processed_image_path: Image already preprocessed by preprocess_input_image (default: preprocess here)
         
     Returns:
         Local output directory path
     """
-    # Get image dimensions for adaptive sizing
-    width, height, aspect_ratio, is_portrait = get_image_dimensions(image_path)
-    
-    # Compress image if needed (Bedrock has 5MB limit)
-    # Use 3.5 MB max to have safe buffer for base64 encoding overhead
-    processed_image_path = compress_image_if_needed(image_path, max_size_mb=3.5)
-    
-    output_dir = create_output_dir()
+    ctx = ctx or RunContext(client_name=client_name, recipient_email=recipient_email)
+    if not ctx.profile:
+        return _generate_report_local(image_path, ctx, processed_image_path)
     
-    # Copy image to output directory
+    profiler = RunProfiler().start()
     try:
-        input_img_dest = f"{output_dir}/diagram_input.png"
-        shutil.copy2(processed_image_path, input_img_dest)
-        print(f"[OK] Input image copied to {input_img_dest}")
+        return _generate_report_local(image_path, ctx, processed_image_path)
+    finally:
+        write_run_profile(ctx, profiler)
+
+
+def write_run_profile(ctx: RunContext, profiler: RunProfiler) -> None:
+    """Stop a run's profiler and write its files into the output directory (errors only warn)"""
+    try:
+        profiler.stop()
+        summary = profiler.summary()
+        ctx.trace.add_span('profile', 'profile', profiler.started, summary['seconds'], **summary)
+        if not ctx.output_dir:
+            print("[WARNING] No output directory - profile not written")
+            return
+        profiler.write(ctx.output_dir)
+        ctx.trace.save(ctx.output_dir)
+        print(f"[PROFILE] {summary['samples']} samples, {summary['cpu_seconds']:.1f}s Python CPU, "
+              f"{summary['memory_peak_mb']:.0f} MB peak traced memory (process), sampler overhead "
+              f"{summary['overhead_percent']:.1f}% -> {', '.join(PROFILE_FILES)}")
     except Exception as e:
-        print(f"[WARNING] Could not copy input image: {e}")
+        print(f"[WARNING] Could not write profile: {e}")
+
+
+def _generate_report_local(image_path: str, ctx: RunContext, processed_image_path: str = None) -> str:
+    """Generate the report of a local image (see _process_image_local)"""
+    client_name = ctx.client_name
+    recipient_email = ctx.recipient_email
+    
+    checkpoint = load_checkpoint(ctx.output_dir) if ctx.output_dir else None
+    
+    if checkpoint:
+        output_dir = ctx.output_dir
+        input_img_dest = find_input_image(output_dir)
+        processed_image_path = input_img_dest
+    else:
+        processed_image_path = processed_image_path or preprocess_input_image(ctx, image_path)
+        output_dir = ctx.create_output_dir()
+        
+        # Copy image to output directory (in its real format)
+        try:
+            input_img_dest = find_input_image(output_dir)
+            with ctx.workspace.io('copy_input', ctx.trace, bytes=os.path.getsize(processed_image_path)):
+                input_img_dest = store_input_image(processed_image_path, output_dir)
+            print(f"[OK] Input image copied to {input_img_dest}")
+        except Exception as e:
+            print(f"[WARNING] Could not copy input image: {e}")
+        
+        checkpoint = new_checkpoint(ctx)
+        checkpoint['image_sha256'] = file_sha256(image_path)
+        save_checkpoint(output_dir, checkpoint)
+        
+        # Near-duplicate of an earlier input: reuse its report or start from it
+        apply_similar_report(ctx, checkpoint, processed_image_path, output_dir)
+    
+    ctx.similarity = checkpoint.get('similarity')
+    
+    # Get absolute path to output directory
+    abs_output_dir = os.path.abspath(output_dir)
+    
+    start_index = first_incomplete_stage(checkpoint, abs_output_dir)
     
     print("=" * 70)
     print("TRNDA - Trask Ručně Nakreslí, Dokončí AWS")
     print("=" * 70)
+    print(f"Run ID: {ctx.run_id}")
     print(f"Output: {output_dir}")
     print(f"Image: {processed_image_path}")
-    print(f"Model: Claude 4.5 Sonnet (1M context)")
+    for tier, model in (('primary', ctx.model), ('fast', ctx.fast_model)):
+        stage_names = [s['name'] for s in WORKFLOW_STAGES if s.get('model', 'primary') == tier]
+        print(f"Model ({tier}): {get_model_info(get_model_id(model))['name']} - {', '.join(stage_names)}")
     print("=" * 70)
     print()
     
-    with aws_knowledge_mcp, aws_diagram_mcp, aws_pricing_mcp:
-        tools = (
-            aws_knowledge_mcp.list_tools_sync() +
-            aws_diagram_mcp.list_tools_sync() +
-            aws_pricing_mcp.list_tools_sync()
-        )
-        
-        print(f"[OK] Loaded {len(tools)} MCP tools")
-        
-        # Add custom tools
-        all_tools = tools + [image_reader, write_file, convert_with_pandoc]
+    # Stages reused from a previous attempt (not from a near-duplicate input)
+    if start_index > 0 and not all(checkpoint['stages'][stage['name']].get('reused_from')
+                                   for stage in WORKFLOW_STAGES[:start_index]):
+        reused = [checkpoint['stages'][stage['name']] for stage in WORKFLOW_STAGES[:start_index]]
+        resume_info = {
+            'resumed': datetime.now().isoformat(timespec='seconds'),
+            'from_stage': WORKFLOW_STAGES[start_index]['name'] if start_index < len(WORKFLOW_STAGES) else 'post_processing',
+            'stages_reused': start_index,
+            'tokens_saved': sum(r['input_tokens'] + r['output_tokens'] for r in reused),
+            'minutes_saved': round(sum(r['seconds'] for r in reused) / 60.0, 2),
+        }
+        checkpoint['resumes'].append(resume_info)
+        save_checkpoint(abs_output_dir, checkpoint)
+        print(f"[RESUME] Reusing {start_index}/{len(WORKFLOW_STAGES)} completed stages "
+              f"(saved {resume_info['tokens_saved']:,} tokens, ~{resume_info['minutes_saved']:.1f} min)")
+        print()
+    
+    # Invalidate stages that will be re-run (later stages depend on earlier ones)
+    for stage in WORKFLOW_STAGES[start_index:]:
+        checkpoint['stages'].pop(stage['name'], None)
+    
+    # Start timing
+    start_time = time.time()
+    start_datetime = datetime.now()
+    
+    if start_index < len(WORKFLOW_STAGES):
+        try:
+            with ExitStack() as mcp_stack:
+                tools = []
+                tool_servers = {}
+                for server_name, mcp_client in ctx.mcp_clients.items():
+                    with ctx.trace.span(server_name, 'mcp_start') as span_attrs:
+                        mcp_stack.enter_context(mcp_client)
+                        server_tools = mcp_client.list_tools_sync()
+                        span_attrs['tools'] = len(server_tools)
+                    tools += server_tools
+                    tool_servers.update({t.tool_name: server_name for t in server_tools})
+                
+                print(f"[OK] Loaded {len(tools)} MCP tools")
+                
+                # Add custom tools
+                all_tools = tools + ctx.tools
+                
+                agent = Agent(
+                    model=TracedModel(ModelRouter(ctx), ctx.trace, ctx.cancel_signal),
+                    system_prompt=build_system_prompt(),
+                    tools=all_tools,
+                    conversation_manager=SlidingWindowConversationManager(),
+                    hooks=[TraceHooks(ctx.trace, tool_servers)]
+                )
+                
+                print("[OK] Agent initialized")
+                print("[START] Processing...")
+                print()
+                
+                run_workflow_stages(agent, ctx, abs_output_dir, input_img_dest, checkpoint, start_index)
+        except Exception as e:
+            if isinstance(e, DeadlineExceeded):
+                # Leaving the ExitStack stopped the MCP clients, which kill their server process groups
+                print(f"[DEADLINE] {e} - MCP servers stopped, partial result in {CHECKPOINT_FILE}")
+            reused_seconds = sum(checkpoint['stages'][st['name']]['seconds'] for st in WORKFLOW_STAGES[:start_index])
+            ctx.record_run(build_ledger_record(ctx, checkpoint, 'timeout' if isinstance(e, DeadlineExceeded) else 'failed',
+                                               time.time() - start_time + reused_seconds,
+                                               error=f"{type(e).__name__}: {e}"))
+            raise
+    
+    # End timing
+    end_time = time.time()
+    end_datetime = datetime.now()
+    
+    # Calculate elapsed time (including stages reused from previous attempts)
+    reused_seconds = sum(
+        checkpoint['stages'][stage['name']]['seconds'] for stage in WORKFLOW_STAGES[:start_index]
+    )
+    elapsed_seconds = end_time - start_time + reused_seconds
+    elapsed_minutes = int(elapsed_seconds // 60)
+    elapsed_secs = int(elapsed_seconds % 60)
+    elapsed_str = f"{elapsed_minutes:02d}:{elapsed_secs:02d}"
+    runtime_minutes = elapsed_seconds / 60.0
+    
+    print()
+    print("=" * 70)
+    print("[COMPLETED] Report generation finished")
+    print("=" * 70)
+    print(f"Runtime: {elapsed_str} (MM:SS)")
+    first_artifact_str = None
+    if checkpoint.get('first_artifact_seconds') is not None:
+        first_artifact = int(checkpoint['first_artifact_seconds'])
+        first_artifact_str = f"{first_artifact // 60:02d}:{first_artifact % 60:02d}"
+        print(f"First artifact: {first_artifact_str} (MM:SS, {PREVIEW_FILE})")
+    print("=" * 70)
+    
+    # Calculate and log complete costs - tokens of all stages (incl. reused ones)
+    cost_breakdown = None
+    
+    stage_records = [r for r in checkpoint['stages'].values()]
+    usage_data = None
+    if stage_records:
+        # Create usage object with expected attributes
+        class Usage:
+            def __init__(self, input_tokens, output_tokens):
+                self.input_tokens = input_tokens
+                self.output_tokens = output_tokens
         
-        agent = Agent(
-            model=bedrock_model,
-            system_prompt=build_system_prompt(),
-            tools=all_tools,
-            conversation_manager=SlidingWindowConversationManager()
+        usage_data = Usage(
+            sum(r.get('input_tokens', 0) for r in stage_records),
+            sum(r.get('output_tokens', 0) for r in stage_records)
         )
         
-        print("[OK] Agent initialized")
-        print("[START] Processing...")
+        # Per-model usage (each stage ran on one model)
+        model_usage = {}
+        for stage_name, record in checkpoint['stages'].items():
+            entry = model_usage.setdefault(record.get('model_id') or DEFAULT_MODEL_ID,
+                                           {'input_tokens': 0, 'output_tokens': 0, 'stages': []})
+            entry['input_tokens'] += record.get('input_tokens', 0)
+            entry['output_tokens'] += record.get('output_tokens', 0)
+            entry['stages'].append(stage_name)
+    
+    if usage_data:
         print()
+        print("TOKEN USAGE STATISTICS:")
+        print("-" * 70)
         
-        # Start timing
-        start_time = time.time()
-        start_datetime = datetime.now()
+        # Input tokens
+        print(f"Input tokens:  {usage_data.input_tokens:,}")
         
-        # Get absolute path to output directory
-        abs_output_dir = os.path.abspath(output_dir)
+        # Output tokens
+        print(f"Output tokens: {usage_data.output_tokens:,}")
         
-        # Build client name instruction
-        client_instruction = f"\nCLIENT/PROJECT NAME: {client_name}\n- INCLUDE in header: **Analysis is made for:** {client_name}" if client_name else "\nCLIENT/PROJECT NAME: NOT PROVIDED\n- SKIP the 'Analysis is made for:' line in header"
+        # Total tokens
+        total_tokens = usage_data.input_tokens + usage_data.output_tokens
+        print(f"Total tokens:  {total_tokens:,}")
         
-        # Get current date
-        current_date = datetime.now().strftime("%B %d, %Y")
+        # Calculate complete AWS costs using actual runtime and per-model prices
+        cost_breakdown = calculate_complete_cost(usage_data.input_tokens, usage_data.output_tokens, runtime_minutes,
+                                                 model_usage)
+        for model_cost in cost_breakdown['bedrock_models'].values():
+            print(f"  {model_cost['name']}: {model_cost['input_tokens']:,} in / "
+                  f"{model_cost['output_tokens']:,} out = ${model_cost['total']:.4f}")
+        print(f"Bedrock cost:   ${cost_breakdown['bedrock']:.4f}")
         
-        prompt = f"""Create AWS architecture report (MAX 3-4 pages):
-
-IMAGE: {input_img_dest}
-OUTPUT DIR: {abs_output_dir}
-INPUT IMAGE: {input_img_dest} (ALREADY SAVED){client_instruction}
-CURRENT DATE: {current_date} - USE THIS EXACT DATE in the report header
-
-CRITICAL - DIAGRAM PATHS (must match markdown template):
-- Input diagram (already saved): {abs_output_dir}/diagram_input.png
-- As-Is diagram: {abs_output_dir}/generated-diagrams/diagram_as_is.png
-- Well-Architected diagram: {abs_output_dir}/generated-diagrams/diagram_well_architected.png
-- Markdown file: {abs_output_dir}/design.md
-
-IMPORTANT: Diagramy MUSÍ být uloženy do generated-diagrams/ podsložky!
-
-STEPS:
-1. Use image_reader: analyze {abs_output_dir}/diagram_input.png - LOOK FOR ANY notes, comments, requirements
-2. Generate As-Is diagram -> SAVE TO: {abs_output_dir}/generated-diagrams/diagram_as_is.png
-   - IMPORTANT: Use EXACT number of resources from image (if image shows 1 EC2, use 1 EC2, even if it makes no sense)
-   - As-Is means EXACTLY as drawn, no additions
-3. Calculate As-Is costs (low/medium/high)
-4. Design Well-Architected (list improvements only)
-5. Generate Well-Architected diagram -> SAVE TO: {abs_output_dir}/generated-diagrams/diagram_well_architected.png
-6. Calculate Well-Architected costs (low/medium/high)
-7. Compare costs (% differences)
-8. Use write_file: save markdown to {abs_output_dir}/design.md
-   - Include "Original Hand-Drawn Design" with diagram_input.png
-   - Include "As-Is Notes" with any notes found
-
-AS-IS COST EXAMPLE SCENARIOS (assume based on predicted traffic/size/app):
-- LOW: 1 Availability Zone, 1 EC2 Graviton (t4g.micro - ARM-based, cheapest), 1 RDS Single-AZ Graviton (db.t4g.micro)
-- MEDIUM: 1 AZ, 2 EC2 instances (t3.micro - x86), 1 RDS Single-AZ (db.t3.micro)
-- HIGH: 1 AZ, 4 EC2 instances (t3.small - x86), 1 RDS Single-AZ (db.t3.small - larger instance)
-
-IMPORTANT:
-- Keep report SHORT (3-4 pages max)
-- NO UTF-8 special fancy characters (like icons)
-- MUST include diagram_input.png in markdown (it's already saved!)
-- If any service is unclear, choose a reasonable AWS service
-- MUST use write_file to save design.md (NO PDF generation, just markdown!)
-- Region: eu-central-1"""
+        print()
+        print("COMPLETE AWS COST BREAKDOWN:")
+        print("-" * 70)
+        print(f"Runtime:               {elapsed_str} ({runtime_minutes:.2f} min)")
+        print(f"Bedrock models:        ${cost_breakdown['bedrock']:.4f}")
+        print(f"ECS Fargate compute:   ${cost_breakdown['ecs']:.4f}")
+        print(f"S3 storage & transfer: ${cost_breakdown['s3']:.4f}")
+        print(f"{'─' * 70}")
+        print(f"TOTAL COST FOR REPORT GENERATION: ${cost_breakdown['total']:.4f}")
+        print("-" * 70)
         
-        try:
-            response = agent(prompt=prompt)
-            
-            # End timing
-            end_time = time.time()
-            end_datetime = datetime.now()
-            
-            # Calculate elapsed time
-            elapsed_seconds = end_time - start_time
-            elapsed_minutes = int(elapsed_seconds // 60)
-            elapsed_secs = int(elapsed_seconds % 60)
-            elapsed_str = f"{elapsed_minutes:02d}:{elapsed_secs:02d}"
-            runtime_minutes = elapsed_seconds / 60.0
-            
-            print()
-            print("=" * 70)
-            print("[COMPLETED] Report generation finished")
-            print("=" * 70)
-            print(f"Runtime: {elapsed_str} (MM:SS)")
-            print("=" * 70)
-            
-            # Calculate and log complete costs - tokeny jsou v response.metrics.accumulated_usage
-            cost_breakdown = None
+        print("-" * 70)
+    
+    # POST-PROCESSING: Add runtime info and generate PDF
+    post_processing = checkpoint['post_processing']
+    print()
+    print("[POST-PROCESSING] Adding runtime info and generating PDF...")
+    try:
+        design_md_path = os.path.join(abs_output_dir, 'design.md')
+        report_date = datetime.fromisoformat(checkpoint['created']).strftime("%B %d, %Y")
+        with ctx.workspace.io('render_design_md', ctx.trace):
+            rendered = write_design_md(abs_output_dir, client_name, report_date, elapsed_str, cost_breakdown)
+        if rendered:
+            print(f"[OK] Rendered design.md from {REPORT_DATA_FILE}")
+        elif os.path.exists(design_md_path):
+            # Model-written design.md (run checkpointed before structured report data)
+            add_runtime_info(design_md_path, elapsed_str, cost_breakdown)
+            print(f"[OK] Added runtime info to design.md")
+        
+        if os.path.exists(design_md_path):
             
-            # Get usage from metrics.accumulated_usage (not response.usage)
-            usage_data = None
-            if hasattr(response, 'metrics') and hasattr(response.metrics, 'accumulated_usage'):
-                acc_usage = response.metrics.accumulated_usage
-                # Create usage object with expected attributes
-                class Usage:
-                    def __init__(self, input_tokens, output_tokens):
-                        self.input_tokens = input_tokens
-                        self.output_tokens = output_tokens
-                
-                usage_data = Usage(
-                    acc_usage.get('inputTokens', 0),
-                    acc_usage.get('outputTokens', 0)
-                )
+            # Downscale and optimize the images before they go into the PDF
+            optimize_report_images(abs_output_dir, checkpoint, trace=ctx.trace)
+            save_checkpoint(abs_output_dir, checkpoint)
             
-            if usage_data:
-                print()
-                print("TOKEN USAGE STATISTICS:")
-                print("-" * 70)
-                
-                # Input tokens
-                print(f"Input tokens:  {usage_data.input_tokens:,}")
-                
-                # Output tokens
-                print(f"Output tokens: {usage_data.output_tokens:,}")
-                
-                # Total tokens
-                total_tokens = usage_data.input_tokens + usage_data.output_tokens
-                print(f"Total tokens:  {total_tokens:,}")
+            # Generate PDF with updated markdown
+            if render_report_pdf(ctx, abs_output_dir, checkpoint):
+                email_to_send = resolve_recipient_email(recipient_email, client_name)
                 
-                # Cost estimation (approximate for Claude Sonnet 4.5)
-                # Input: $3 per 1M tokens, Output: $15 per 1M tokens
-                input_cost = (usage_data.input_tokens / 1_000_000) * 3.0
-                output_cost = (usage_data.output_tokens / 1_000_000) * 15.0
-                bedrock_cost = input_cost + output_cost
-                print(f"Bedrock cost:   ${bedrock_cost:.4f}")
-                
-                # Calculate complete AWS costs using actual runtime
-                cost_breakdown = calculate_complete_cost(usage_data.input_tokens, usage_data.output_tokens, runtime_minutes)
-                
-                print()
-                print("COMPLETE AWS COST BREAKDOWN:")
-                print("-" * 70)
-                print(f"Runtime:               {elapsed_str} ({runtime_minutes:.2f} min)")
-                print(f"Bedrock (Claude 4.5):  ${cost_breakdown['bedrock']:.4f}")
-                print(f"ECS Fargate compute:   ${cost_breakdown['ecs']:.4f}")
-                print(f"S3 storage & transfer: ${cost_breakdown['s3']:.4f}")
-                print(f"{'─' * 70}")
-                print(f"TOTAL COST FOR REPORT GENERATION: ${cost_breakdown['total']:.4f}")
-                print("-" * 70)
-                
-                # Save cost breakdown to file
-                save_cost_breakdown(abs_output_dir, cost_breakdown, usage_data, start_datetime, end_datetime, elapsed_str)
-                
-                print("-" * 70)
-            
-            # POST-PROCESSING: Add runtime info and generate PDF
-            print()
-            print("[POST-PROCESSING] Adding runtime info and generating PDF...")
-            try:
-                design_md_path = os.path.join(abs_output_dir, 'design.md')
-                if os.path.exists(design_md_path):
-                    with open(design_md_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    # Find the header section and add runtime info after "Region:"
-                    lines = content.split('\n')
-                    new_lines = []
-                    for i, line in enumerate(lines):
-                        new_lines.append(line)
-                        if line.startswith('**Region:**'):
-                            # Add runtime info after Region line
-                            new_lines.append(f'**Generation time:** {elapsed_str} (MM:SS)  ')
-                            if cost_breakdown:
-                                new_lines.append(f'**Total cost for report generation:** ${cost_breakdown["total"]:.4f}')
-                            else:
-                                new_lines.append(f'**Total cost for report generation:** N/A (usage data not available)')
-                    
-                    # Write back
-                    with open(design_md_path, 'w', encoding='utf-8') as f:
-                        f.write('\n'.join(new_lines))
-                    
-                    print(f"[OK] Added runtime info to design.md")
-                    
-                    # Create header.tex for pandoc
-                    header_tex_path = os.path.join(abs_output_dir, 'header.tex')
-                    with open(header_tex_path, 'w') as f:
-                        f.write(r'''\usepackage{graphicx}
-\usepackage{fancyhdr}
-\pagestyle{fancy}
-\fancyhf{}
-\fancyfoot[L]{Trask Solutions a.s.}
-\fancyfoot[C]{\thepage}
-\fancyfoot[R]{TRNDA report v0.5}
-\renewcommand{\headrulewidth}{0pt}
-\renewcommand{\footrulewidth}{0.4pt}
-''')
-                    
-                    # Generate PDF with updated markdown
-                    print(f"[START] Generating PDF...")
+                if email_to_send and post_processing.get('email') in ('done', 'queued'):
+                    print(f"[SKIP] Report email to {email_to_send} already {post_processing['email']} (checkpoint)")
+                elif email_to_send:
+                    print()
+                    print("=" * 70)
+                    print(f"[EMAIL] Queueing report for: {email_to_send}")
+                    print("=" * 70)
+                    pdf_path = os.path.join(abs_output_dir, 'design.pdf')
+                    # Published location of the PDF (presigned link for PDFs too big to attach)
+                    s3_bucket = parse_s3_path(ctx.input_uri)[0] if ctx.input_uri and is_s3_path(ctx.input_uri) else ctx.bucket
+                    link_s3_uri = f"s3://{s3_bucket}/output/{os.path.basename(abs_output_dir).replace('output_', '')}/design.pdf"
                     try:
-                        result = subprocess.run(
-                            ['pandoc', 'design.md', '-o', 'design.pdf',
-                             '-V', 'geometry:margin=2cm',
-                             '-V', 'linestretch=1.1',
-                             '-V', 'fontsize=10pt',
-                             '-H', 'header.tex'],
-                            capture_output=True,
-                            text=True,
-                            cwd=abs_output_dir
-                        )
-                        if result.returncode == 0:
-                            print(f"[OK] PDF generated successfully: {abs_output_dir}/design.pdf")
-                            
-                            # Determine email address for sending report
-                            # Priority 1: Use recipient_email if provided
-                            # Priority 2: Check if client_name is a clean email address
-                            # Priority 3: Try to extract email from client_name text
-                            email_to_send = recipient_email
-                            if not email_to_send and client_name:
-                                if is_email(client_name):
-                                    # Clean email address
-                                    email_to_send = client_name
-                                else:
-                                    # Try to extract email from longer text
-                                    extracted = extract_email_from_text(client_name)
-                                    if extracted:
-                                        email_to_send = extracted
-                                        print(f"[INFO] Extracted email from client info: {email_to_send}")
-                            
-                            if email_to_send:
-                                print()
-                                print("=" * 70)
-                                print(f"[EMAIL] Sending report to: {email_to_send}")
-                                print("=" * 70)
-                                pdf_path = os.path.join(abs_output_dir, 'design.pdf')
-                                send_report_email(pdf_path, email_to_send)
-                                print("=" * 70)
-                        else:
-                            print(f"[ERROR] PDF generation failed: {result.stderr}")
+                        with ctx.trace.span('enqueue_report_email', 'ses', bytes=os.path.getsize(pdf_path)) as span_attrs:
+                            span_attrs['email_id'] = ctx.outbox.enqueue(pdf_path, email_to_send, ctx.run_id, link_s3_uri)
+                        post_processing['email'] = 'queued'
+                        post_processing['email_id'] = span_attrs['email_id']
+                        checkpoint.setdefault('artifact_sizes', {})['email_bytes'] = \
+                            ctx.outbox.message_bytes(pdf_path, email_to_send)
+                        save_checkpoint(abs_output_dir, checkpoint)
                     except Exception as e:
-                        print(f"[ERROR] Could not generate PDF: {e}")
-                else:
-                    print(f"[WARNING] design.md not found, skipping PDF generation")
-            except Exception as e:
-                print(f"[ERROR] Post-processing failed: {e}")
-                import traceback
-                traceback.print_exc()
-            
-            return output_dir
-            
+                        print(f"[WARNING] Could not queue email: {e}")
+                        print(f"         Email notification skipped, but report was generated successfully")
+                    print("=" * 70)
+        else:
+            print(f"[WARNING] design.md not found, skipping PDF generation")
+    except Exception as e:
+        print(f"[ERROR] Post-processing failed: {e}")
+        import traceback
+        traceback.print_exc()
+    
+    # Scratch I/O and disk usage of this run (workspace + output directory)
+    workspace_bytes = ctx.workspace.measure(abs_output_dir)
+    print(f"[INFO] Workspace: {workspace_bytes / 1024 / 1024:.1f} MB on disk"
+          f"{' (tmpfs)' if ctx.workspace.tmpfs else ''}, scratch I/O {ctx.workspace.io_seconds:.2f}s")
+    
+    # For S3 inputs every file of the output directory is uploaded
+    if ctx.input_uri and is_s3_path(ctx.input_uri):
+        checkpoint.setdefault('artifact_sizes', {})['upload_bytes'] = disk_usage(abs_output_dir)
+        save_checkpoint(abs_output_dir, checkpoint)
+    
+    # Record the run in the ledger, then save cost breakdown (with slowest spans and
+    # projections from the ledger) and trace
+    ctx.record_run(build_ledger_record(ctx, checkpoint, 'success' if post_processing.get('pdf') == 'done' else 'no_pdf',
+                                       elapsed_seconds, cost_breakdown))
+    if cost_breakdown:
+        ledger_summary = None
+        try:
+            ledger_summary = summarize_ledger(load_ledger(ctx.records.ledger_path))
         except Exception as e:
-            raise
+            print(f"[WARNING] Could not read run ledger: {e}")
+        save_cost_breakdown(abs_output_dir, cost_breakdown, usage_data, start_datetime, end_datetime, elapsed_str,
+                            resumes=checkpoint['resumes'], trace=ctx.trace,
+                            ledger_summary=ledger_summary, ledger_path=ctx.records.ledger_path,
+                            first_artifact_str=first_artifact_str, artifact_sizes=checkpoint.get('artifact_sizes'))
+    try:
+        trace_path = ctx.trace.save(abs_output_dir)
+        print(f"[OK] Trace saved to {trace_path}")
+    except Exception as e:
+        print(f"[WARNING] Could not save trace: {e}")
+    
+    return output_dir
 
 
 def main():
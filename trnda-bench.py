@@ -0,0 +1,768 @@
+#!/usr/bin/env python3
+"""
+TRNDA Benchmark - offline end-to-end run on the samples/ images
+
+Runs the full S3 processing path (download, preprocessing, workflow stages,
+post-processing, upload) with a scripted model, stub MCP servers replaying
+recorded tool interactions and a local S3 stand-in. Measures TRNDA's own
+overhead without Bedrock or real MCP servers.
+
+Each sample runs in its own subprocess so peak RSS is per run.
+Results are compared against benchmarks/baseline.json.
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(BASE_DIR, 'benchmarks')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, 'last-run.json')
+
+BENCH_BUCKET = 'trnda-bench'
+RESULT_PREFIX = 'BENCH_RESULT '
+
+# Regression thresholds: relative change AND absolute change must both be exceeded
+TIME_TOLERANCE = 0.25         # +25%
+TIME_MIN_DELTA = 1.0          # seconds (MCP server start-up alone varies by ~0.5 s)
+RSS_TOLERANCE = 0.20          # +20%
+RSS_MIN_DELTA = 20.0          # MB
+TOKEN_TOLERANCE = 0.05        # +5%
+
+# "Latency" of a hanging scripted model (--hang model)
+HANG_MS = 3600 * 1000.0
+
+# Fault of endpoint A per --failover scenario (endpoint B of each tier is healthy)
+FAILOVER_SCENARIOS = {
+    'throttle': {'throttle_after': 3},
+    'errors': {'error_rate': 0.5},
+    'slow': {'latency_ms': 1500.0},
+}
+# Time to first event above which the bench's endpoints count as slow
+FAILOVER_SLOW_SECONDS = 1.0
+
+# Client of the re-issued report (--reissue); the address in it receives the email
+REISSUE_CLIENT = 'Bench Corrected s.r.o. reissue@example.com'
+
+# CloudWatch metrics every finished run must print (EMF lines on stdout)
+EXPECTED_METRICS = ('Runs', 'RuntimeSeconds', 'InputTokens', 'OutputTokens', 'StageSeconds')
+
+
+def load_trnda_agent():
+    """Import trnda-agent.py (hyphenated file name)"""
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("trnda_agent", os.path.join(BASE_DIR, "trnda-agent.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def child_processes() -> list:
+    """Live (non-zombie) child processes of this process: [(pid, cmdline)] (Linux /proc)"""
+    children = []
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f"/proc/{pid}/stat", 'r') as f:
+                stat = f.read().rsplit(')', 1)[1].split()
+            if int(stat[1]) != os.getpid() or stat[0] == 'Z':
+                continue
+            with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                children.append((int(pid), f.read().replace(b'\0', b' ').decode(errors='replace').strip()))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+
+def hanging_recordings(workdir: str, tool_name: str) -> str:
+    """Copy of the MCP recordings in which tool_name never answers
+
+    Returns:
+        Recordings directory
+    """
+    sys.path.insert(0, BENCH_DIR)
+    from stubs import DEFAULT_RECORDINGS
+
+    recordings_dir = os.path.join(workdir, 'recordings')
+    os.makedirs(recordings_dir, exist_ok=True)
+    found = False
+    for path in glob.glob(os.path.join(DEFAULT_RECORDINGS, '*.json')):
+        with open(path, 'r', encoding='utf-8') as f:
+            recording = json.load(f)
+        if any(t['name'] == tool_name for t in recording['tools']):
+            recording.setdefault('responses', {}).setdefault(tool_name, {})['hang'] = True
+            found = True
+        with open(os.path.join(recordings_dir, os.path.basename(path)), 'w', encoding='utf-8') as f:
+            json.dump(recording, f)
+    if not found:
+        raise ValueError(f"No recorded MCP tool named {tool_name}")
+    return recordings_dir
+
+
+def run_one(image_path: str, workdir: str, model_latency_ms: float, hang: str = None,
+            stage_timeout: float = None, failover: str = None, reissue: bool = False) -> dict:
+    """Run one sample through process_image_standalone with stubs (called in a subprocess)
+
+    With hang ('model' or an MCP tool name) the model or that tool never
+    answers, and the run is expected to end at the stage deadline. With
+    failover (a FAILOVER_SCENARIOS key) each tier's model sits behind two stub
+    endpoints, A faulty and B healthy, and the run must finish on B. With reissue
+    the finished report is re-issued to another client and address, which must
+    not call the model.
+
+    Returns:
+        Result dictionary (timings, peak RSS, tokens, request counts; deadline checks with hang,
+        endpoint checks with failover, re-issue checks with reissue)
+    """
+    import resource
+    sys.path.insert(0, BENCH_DIR)
+    from stubs import ScriptedModel, StubEndpoint, stub_mcp_clients
+    from local_aws import LocalS3, LocalSES, local_client_factory
+
+    trnda_agent = load_trnda_agent()
+
+    s3 = LocalS3(os.path.join(workdir, 's3'))
+    ses = LocalSES()
+    outbox = trnda_agent.EmailOutbox(os.path.join(workdir, 'outbox'), client_factory=local_client_factory(s3, ses))
+    image_name = os.path.basename(image_path)
+    with open(image_path, 'rb') as f:
+        s3.put_object(Bucket=BENCH_BUCKET, Key=f"input/{image_name}", Body=f.read(), ContentType='image/jpeg')
+    s3.requests.clear()
+
+    # One scripted model per tier, so the trace shows which tier served each stage
+    stage_names = [stage['name'] for stage in trnda_agent.WORKFLOW_STAGES]
+    models = {
+        tier: ScriptedModel(stage_names=stage_names, latency_ms=HANG_MS if hang == 'model' else model_latency_ms,
+                            model_id=f"scripted-{tier}")
+        for tier in ('primary', 'fast')
+    }
+    tier_models = dict(models)
+    endpoints = {}
+    if failover:
+        for tier, model in models.items():
+            endpoints[tier] = {'a': StubEndpoint(model, **FAILOVER_SCENARIOS[failover]), 'b': StubEndpoint(model)}
+            tier_models[tier] = trnda_agent.FailoverModel(
+                [(f"{tier}@{name}", endpoint) for name, endpoint in endpoints[tier].items()],
+                slow_seconds=FAILOVER_SLOW_SECONDS)
+    recordings_dir = hanging_recordings(workdir, hang) if hang and hang != 'model' else None
+    ctx = trnda_agent.RunContext(
+        client_name='bench@example.com',
+        base_dir=workdir,
+        bucket=BENCH_BUCKET,
+        model=tier_models['primary'],
+        fast_model=tier_models['fast'],
+        mcp_clients=stub_mcp_clients(recordings_dir) if recordings_dir else stub_mcp_clients(),
+        client_factory=local_client_factory(s3, ses),
+        records=trnda_agent.RecordsConfig(ledger_path=os.path.join(workdir, 'ledger.jsonl'),
+                                          manifest_path=os.path.join(workdir, 'manifest.json')),
+        similarity_config=trnda_agent.SimilarityConfig(index_path=os.path.join(workdir, 'similarity.jsonl')),
+        outbox=outbox,
+        deadlines=trnda_agent.DeadlineConfig(stage_timeout=stage_timeout)
+    )
+    for model in tier_models.values():
+        if failover:
+            model.bind_trace(ctx.trace)
+
+    start = time.time()
+    if hang:
+        return run_hanging(trnda_agent, ctx, s3, image_name, start)
+    trnda_agent.process_image_standalone(f"s3://{BENCH_BUCKET}/input/{image_name}", ctx=ctx)
+    total_seconds = time.time() - start
+    # Email delivery is off the run's critical path - wait for it only to count the sends
+    outbox.drain(timeout=60)
+
+    stages = {span['name']: span['duration'] for span in ctx.trace.spans if span['kind'] == 'stage'}
+    kinds = {kind: total['seconds'] for kind, total in ctx.trace.totals_by_kind().items()}
+    model_seconds = kinds.get('model', 0.0)
+    
+    # Every model turn of a stage must have gone to the stage's configured tier
+    routing = {}
+    for span in ctx.trace.spans:
+        if span['kind'] == 'model':
+            routing.setdefault(span['attrs'].get('stage'), set()).add(span['attrs'].get('model_id'))
+    routing_errors = [
+        f"{stage['name']}: expected scripted-{stage.get('model', 'primary')}, got {sorted(routing.get(stage['name'], []))}"
+        for stage in trnda_agent.WORKFLOW_STAGES
+        if routing.get(stage['name']) != {f"scripted-{stage.get('model', 'primary')}"}
+    ]
+
+    # ru_maxrss is KB on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+    result = {
+        'image': image_name,
+        'input_bytes': os.path.getsize(image_path),
+        'total_seconds': round(total_seconds, 3),
+        'overhead_seconds': round(total_seconds - model_seconds, 3),
+        'stages': stages,
+        'kinds': kinds,
+        'peak_rss_mb': round(peak_rss_mb, 1),
+        'model_turns': sum(m.calls for m in models.values()),
+        'input_tokens': sum(m.input_tokens for m in models.values()),
+        'output_tokens': sum(m.output_tokens for m in models.values()),
+        'tokens_by_tier': {tier: {'input': m.input_tokens, 'output': m.output_tokens} for tier, m in models.items()},
+        'routing_errors': routing_errors,
+        's3_requests': dict(s3.requests),
+        'emails_sent': len(ses.sent),
+    }
+    if failover:
+        result['failover'] = check_failover(ctx, s3, endpoints, failover)
+    if reissue:
+        result['reissue'] = check_reissue(trnda_agent, ctx, s3, ses, outbox, models)
+    return result
+
+
+def check_reissue(trnda_agent, ctx, s3, ses, outbox, models: dict) -> dict:
+    """Re-issue the finished report with a new client name and address; check that no model turn ran
+
+    Returns:
+        Re-issue result (seconds, model turns, PDF, emails) and failures
+    """
+    turns = sum(m.calls for m in models.values())
+    sent = len(ses.sent)
+    # A host that archived the original run: its archived output must survive the re-issue unchanged
+    workspace = trnda_agent.RunWorkspace(ctx.run_id, root=os.path.join(ctx.base_dir, 'workspaces'),
+                                         published_output='archive', archive_dir=os.path.join(ctx.base_dir, 'archive'))
+    archived = os.path.join(workspace.archive_dir, os.path.basename(ctx.output_dir))
+    shutil.copytree(ctx.output_dir, archived)
+    archived_files = sorted(os.listdir(archived))
+    reissue_ctx = trnda_agent.RunContext(run_id=ctx.run_id, bucket=BENCH_BUCKET, client_factory=ctx._client_factory,
+                                         records=ctx.records, outbox=outbox, workspace=workspace)
+    result = trnda_agent.reissue_report(f"s3://{BENCH_BUCKET}/output/{ctx.run_id}/", client_name=REISSUE_CLIENT,
+                                        ctx=reissue_ctx)
+    outbox.drain(timeout=60)
+    design_md = s3.get_object(Bucket=BENCH_BUCKET, Key=f"output/{ctx.run_id}/design.md")['Body'].read().decode()
+    model_turns = sum(m.calls for m in models.values()) - turns
+
+    failures = []
+    if model_turns:
+        failures.append(f"{model_turns} model turn(s) during the re-issue")
+    if f"**Analysis is made for:** {REISSUE_CLIENT}" not in design_md:
+        failures.append("design.md in S3 has no new client line")
+    if not os.path.isdir(archived) or sorted(os.listdir(archived)) != archived_files:
+        failures.append(f"archived output {archived} changed by the re-issue")
+    if os.path.exists(workspace.path):
+        failures.append(f"re-issue workspace {workspace.path} left behind")
+    if shutil.which('pandoc'):
+        if not result['pdf']:
+            failures.append("no PDF")
+        if len(ses.sent) != sent + 1:
+            failures.append(f"{len(ses.sent) - sent} email(s) sent, expected 1")
+    return {
+        'seconds': result['seconds'],
+        'model_turns': model_turns,
+        'pdf': bool(result['pdf']),
+        'recipient': result['recipient'],
+        'emails_sent': len(ses.sent) - sent,
+        'failures': failures,
+    }
+
+
+def check_failover(ctx, s3, endpoints: dict, scenario: str) -> dict:
+    """Check that a run with one faulty endpoint per tier was served by the healthy one
+
+    Returns:
+        Per-endpoint stats (from trace.json) and failures
+    """
+    trace = json.loads(s3.get_object(Bucket=BENCH_BUCKET, Key=f"output/{ctx.run_id}/trace.json")['Body'].read())
+    stats = trace.get('endpoints', {})
+    failovers = sum(s['failovers'] for s in stats.values())
+
+    failures = []
+    if len(stats) != 4:
+        failures.append(f"trace.json has {len(stats)} endpoint(s), expected 4")
+    for tier, tier_endpoints in endpoints.items():
+        if not tier_endpoints['b'].served:
+            failures.append(f"{tier}: healthy endpoint served no turns")
+        if scenario == 'slow' and tier_endpoints['a'].served >= tier_endpoints['b'].served:
+            failures.append(f"{tier}: slow endpoint served {tier_endpoints['a'].served} turn(s), "
+                            f"healthy one {tier_endpoints['b'].served}")
+    if scenario != 'slow':
+        injected = sum(tier_endpoints['a'].errors for tier_endpoints in endpoints.values())
+        if not failovers:
+            failures.append("no turn failed over")
+        if injected != failovers:
+            failures.append(f"{injected} injected error(s), {failovers} failover(s)")
+
+    return {
+        'scenario': scenario,
+        'failovers': failovers,
+        'endpoints': stats,
+        'served': {f"{tier}@{name}": endpoint.served
+                   for tier, tier_endpoints in endpoints.items() for name, endpoint in tier_endpoints.items()},
+        'failures': failures,
+    }
+
+
+def run_hanging(trnda_agent, ctx, s3, image_name: str, start: float) -> dict:
+    """Run a sample whose model or MCP tool hangs; check that the stage deadline ended it cleanly
+
+    Returns:
+        Deadline result: failing stage, seconds to the error, status object, leftover processes
+    """
+    error = None
+    try:
+        trnda_agent.process_image_standalone(f"s3://{BENCH_BUCKET}/input/{image_name}", ctx=ctx)
+    except trnda_agent.DeadlineExceeded as e:
+        error = e
+    seconds = time.time() - start
+
+    status_key = trnda_agent.status_key(f"input/{image_name}")
+    status = json.loads(s3.get_object(Bucket=BENCH_BUCKET, Key=status_key)['Body'].read())
+    leftover = [cmd for _, cmd in child_processes()]
+    checkpoint = trnda_agent.load_checkpoint(ctx.output_dir) if ctx.output_dir else None
+
+    failures = []
+    if not error:
+        failures.append("run did not raise DeadlineExceeded")
+    stage_timeout = ctx.deadlines.stage_timeout
+    if seconds > stage_timeout + trnda_agent.CANCEL_GRACE_SECONDS + 15:
+        failures.append(f"run took {seconds:.1f}s with a {stage_timeout:.0f}s stage timeout")
+    if leftover:
+        failures.append(f"{len(leftover)} child process(es) still running: {leftover}")
+    if status.get('state') != 'failed' or not status.get('failed_stage'):
+        failures.append(f"status object is {status.get('state')}, failed_stage {status.get('failed_stage')}")
+    if not (checkpoint or {}).get('deadline'):
+        failures.append("checkpoint has no deadline record")
+
+    return {
+        'image': image_name,
+        'hang': True,
+        'seconds': round(seconds, 3),
+        'failed_stage': error.stage if error else None,
+        'scope': error.scope if error else None,
+        'stages_done': [name for name, r in (checkpoint or {}).get('stages', {}).items() if r.get('status') == 'done'],
+        'status': {k: status.get(k) for k in ('state', 'failed_stage', 'deadline', 'partial_output')},
+        'cancel_spans': [span['attrs'] for span in ctx.trace.spans if span['kind'] == 'deadline'],
+        'leftover_processes': leftover,
+        'failures': failures,
+    }
+
+
+def check_metrics(output: str) -> dict:
+    """Validate the CloudWatch metric (EMF) lines a run printed (see benchmarks/emf_check.py)
+
+    Returns:
+        check_emf_output summary; 'errors' also lists run metrics that are missing
+    """
+    sys.path.insert(0, BENCH_DIR)
+    from emf_check import check_emf_output
+
+    summary = check_emf_output(output)
+    summary['errors'] += [f"No {name} metric" for name in EXPECTED_METRICS if name not in summary['metrics']]
+    return summary
+
+
+def run_concurrent(image_path: str, workdir: str, model_latency_ms: float, jobs: int) -> dict:
+    """Run several jobs of one sample at the same time in this process (called in a subprocess)
+
+    Every job has its own RunContext, scripted models and stub MCP servers and
+    its own input key and client; S3, SES, outbox and ledger are shared like
+    in a worker process. Checks that the jobs did not leak into each other:
+    run IDs and output directories, the client line of each report, tokens in
+    the ledger against each job's own models, model IDs in each trace, and
+    sys.argv / os.environ left untouched.
+
+    Returns:
+        Concurrency result (seconds, run IDs, model turns per job) and failures
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    sys.path.insert(0, BENCH_DIR)
+    from stubs import ScriptedModel, stub_mcp_clients
+    from local_aws import LocalS3, LocalSES, local_client_factory
+
+    trnda_agent = load_trnda_agent()
+
+    s3 = LocalS3(os.path.join(workdir, 's3'))
+    ses = LocalSES()
+    outbox = trnda_agent.EmailOutbox(os.path.join(workdir, 'outbox'), client_factory=local_client_factory(s3, ses))
+    ledger_path = os.path.join(workdir, 'ledger.jsonl')
+    image_name = os.path.basename(image_path)
+    with open(image_path, 'rb') as f:
+        image_bytes = f.read()
+
+    stage_names = [stage['name'] for stage in trnda_agent.WORKFLOW_STAGES]
+    contexts, models, clients = [], [], []
+    for index in range(jobs):
+        s3.put_object(Bucket=BENCH_BUCKET, Key=f"input/job{index}-{image_name}", Body=image_bytes,
+                      ContentType='image/jpeg')
+        job_models = {tier: ScriptedModel(stage_names=stage_names, latency_ms=model_latency_ms,
+                                          model_id=f"scripted-{tier}-job{index}")
+                      for tier in ('primary', 'fast')}
+        clients.append(f"Concurrent Client {index} job{index}@example.com")
+        models.append(job_models)
+        contexts.append(trnda_agent.RunContext(
+            client_name=clients[-1],
+            base_dir=workdir,
+            bucket=BENCH_BUCKET,
+            model=job_models['primary'],
+            fast_model=job_models['fast'],
+            mcp_clients=stub_mcp_clients(),
+            client_factory=local_client_factory(s3, ses),
+            records=trnda_agent.RecordsConfig(ledger_path=ledger_path,
+                                              manifest_path=os.path.join(workdir, 'manifest.json')),
+            # Every job is the same image - near-duplicate reuse would skip all but the first
+            similarity_config=trnda_agent.SimilarityConfig(index_path='off'),
+            outbox=outbox
+        ))
+
+    argv, environ = list(sys.argv), dict(os.environ)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='trnda-job') as executor:
+        futures = [executor.submit(trnda_agent.process_image_standalone,
+                                   f"s3://{BENCH_BUCKET}/input/job{index}-{image_name}", ctx=ctx)
+                   for index, ctx in enumerate(contexts)]
+        errors = [future.exception() for future in futures]
+    seconds = time.time() - start
+    outbox.drain(timeout=60)
+
+    with open(ledger_path, 'r', encoding='utf-8') as f:
+        ledger = {record['run_id']: record for record in map(json.loads, f) if record.get('run_id')}
+
+    failures = [f"job {index}: {type(error).__name__}: {error}" for index, error in enumerate(errors) if error]
+    if len({ctx.run_id for ctx in contexts}) != jobs:
+        failures.append("run IDs are not unique")
+    if len({ctx.output_dir for ctx in contexts}) != jobs:
+        failures.append("output directories are not unique")
+    if sys.argv != argv:
+        failures.append(f"sys.argv changed: {argv} -> {sys.argv}")
+    changed = sorted(k for k in set(environ) | set(os.environ) if environ.get(k) != os.environ.get(k))
+    if changed:
+        failures.append(f"os.environ changed: {changed}")
+    for index, ctx in enumerate(contexts):
+        if errors[index]:
+            continue
+        job_models = models[index]
+        try:
+            design_md = s3.get_object(Bucket=BENCH_BUCKET, Key=f"output/{ctx.run_id}/design.md")['Body'].read().decode()
+        except Exception:
+            design_md = ''
+        if f"**Analysis is made for:** {clients[index]}" not in design_md:
+            failures.append(f"job {index}: design.md has no client line for {clients[index]}")
+        foreign = [other for other in clients if other != clients[index] and other in design_md]
+        if foreign:
+            failures.append(f"job {index}: design.md names other jobs' clients {foreign}")
+        record = ledger.get(ctx.run_id)
+        tokens = (sum(m.input_tokens for m in job_models.values()), sum(m.output_tokens for m in job_models.values()))
+        if not record:
+            failures.append(f"job {index}: no ledger record for {ctx.run_id}")
+        elif (record['tokens']['input'], record['tokens']['output']) != tokens:
+            failures.append(f"job {index}: ledger tokens {record['tokens']['input']}/{record['tokens']['output']}, "
+                            f"its models counted {tokens[0]}/{tokens[1]}")
+        model_ids = {span['attrs'].get('model_id') for span in ctx.trace.spans if span['kind'] == 'model'}
+        if not model_ids or model_ids - {m.config['model_id'] for m in job_models.values()}:
+            failures.append(f"job {index}: trace has model turns of {sorted(model_ids)}")
+    turns = [sum(m.calls for m in job_models.values()) for job_models in models]
+    if len(set(turns)) != 1:
+        failures.append(f"model turns differ between identical jobs: {turns}")
+    if shutil.which('pandoc'):
+        # Destinations also list the sender's copy
+        recipients = [d for message in ses.sent for d in message['Destinations']]
+        for index in range(jobs):
+            if recipients.count(f"job{index}@example.com") != 1:
+                failures.append(f"job {index}: {recipients.count(f'job{index}@example.com')} email(s), expected 1")
+
+    return {
+        'jobs': jobs,
+        'seconds': round(seconds, 3),
+        'run_ids': [ctx.run_id for ctx in contexts],
+        'model_turns': turns,
+        'emails_sent': len(ses.sent),
+        'failures': failures,
+    }
+
+
+def run_sample_subprocess(image_path: str, model_latency_ms: float, keep: bool, hang: str = None,
+                          stage_timeout: float = None, failover: str = None, reissue: bool = False,
+                          concurrent: int = None) -> dict:
+    """Run one sample in a fresh interpreter and parse its result line"""
+    workdir = tempfile.mkdtemp(prefix='trnda-bench-')
+    try:
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-one', image_path,
+               '--workdir', workdir, '--model-latency-ms', str(model_latency_ms)]
+        if hang:
+            cmd += ['--hang', hang, '--stage-timeout', str(stage_timeout)]
+        if failover:
+            cmd += ['--failover', failover]
+        if reissue:
+            cmd += ['--reissue']
+        if concurrent:
+            cmd += ['--concurrent', str(concurrent)]
+        proc = subprocess.run(cmd, capture_output=True, text=True, cwd=BASE_DIR)
+        for line in proc.stdout.splitlines():
+            if line.startswith(RESULT_PREFIX):
+                result = json.loads(line[len(RESULT_PREFIX):])
+                result['metrics'] = check_metrics(proc.stdout)
+                return result
+        raise RuntimeError(f"Benchmark run failed for {image_path}:\n{proc.stdout[-3000:]}\n{proc.stderr[-3000:]}")
+    finally:
+        if keep:
+            print(f"[INFO] Kept workdir: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare_to_baseline(results: dict, baseline: dict) -> list:
+    """Compare per-sample metrics with the baseline
+
+    Returns:
+        List of regression descriptions (empty if none)
+    """
+    regressions = []
+
+    def check(sample, metric, current, previous, tolerance, min_delta=0.0):
+        if previous is None or current is None:
+            return
+        if current > previous * (1 + tolerance) and current - previous > min_delta:
+            regressions.append(f"{sample}: {metric} {previous} -> {current}")
+
+    for sample, current in results['samples'].items():
+        previous = baseline.get('samples', {}).get(sample)
+        if not previous:
+            continue
+        check(sample, 'overhead_seconds', current['overhead_seconds'], previous.get('overhead_seconds'),
+              TIME_TOLERANCE, TIME_MIN_DELTA)
+        for kind, seconds in current['kinds'].items():
+            if kind in ('model', 'stage'):
+                continue
+            check(sample, f"{kind}_seconds", seconds, previous.get('kinds', {}).get(kind),
+                  TIME_TOLERANCE, TIME_MIN_DELTA)
+        check(sample, 'peak_rss_mb', current['peak_rss_mb'], previous.get('peak_rss_mb'),
+              RSS_TOLERANCE, RSS_MIN_DELTA)
+        check(sample, 'input_tokens', current['input_tokens'], previous.get('input_tokens'), TOKEN_TOLERANCE)
+        check(sample, 'output_tokens', current['output_tokens'], previous.get('output_tokens'), TOKEN_TOLERANCE)
+
+    return regressions
+
+
+def print_results(results: dict) -> None:
+    """Print results table"""
+    print()
+    print("=" * 70)
+    print("BENCHMARK RESULTS")
+    print("=" * 70)
+    print(f"{'Sample':<22} {'Total s':>8} {'Overhead s':>10} {'RSS MB':>8} {'In tok':>9} {'Out tok':>8}")
+    print("-" * 70)
+    for name, r in results['samples'].items():
+        print(f"{name:<22} {r['total_seconds']:>8.2f} {r['overhead_seconds']:>10.2f} {r['peak_rss_mb']:>8.1f} "
+              f"{r['input_tokens']:>9,} {r['output_tokens']:>8,}")
+    print("-" * 70)
+
+    kinds = {}
+    for r in results['samples'].values():
+        for kind, seconds in r['kinds'].items():
+            kinds[kind] = kinds.get(kind, 0.0) + seconds
+    print("Time per span kind (all samples):")
+    for kind, seconds in sorted(kinds.items(), key=lambda item: -item[1]):
+        print(f"  {kind:<12} {seconds:>8.2f} s")
+    print("=" * 70)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='TRNDA offline benchmark (scripted model, stub MCP servers, local S3)',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # Run all samples and compare with benchmarks/baseline.json
+  python trnda-bench.py
+
+  # Record a new baseline
+  python trnda-bench.py --update-baseline
+
+  # Selected samples with 500 ms simulated model latency per turn
+  python trnda-bench.py --samples samples/sample1.jpg samples/sample4.png --model-latency-ms 500
+
+  # Deadline check: the diagram tool (or the model) never answers, stages get 5 s
+  python trnda-bench.py --samples samples/sample1.jpg --hang generate_diagram
+  python trnda-bench.py --samples samples/sample1.jpg --hang model
+
+  # Failover check: one of two model endpoints throttles (or fails, or is slow)
+  python trnda-bench.py --samples samples/sample1.jpg --failover throttle
+
+  # Re-issue check: the finished report goes out again with a new client name, no model turns
+  python trnda-bench.py --samples samples/sample1.jpg --reissue
+
+  # Concurrency check: 4 jobs at once in one process, outputs and usage kept per run
+  python trnda-bench.py --samples samples/sample1.jpg --concurrent 4
+        """
+    )
+    parser.add_argument('--samples', nargs='+', help='Images to benchmark (default: samples/*)')
+    parser.add_argument('--model-latency-ms', type=float, default=0.0,
+                        help='Simulated model latency per turn (default: 0 = measure TRNDA overhead only)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline JSON file')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='Where to write this run\'s results')
+    parser.add_argument('--update-baseline', action='store_true', help='Write results as new baseline')
+    parser.add_argument('--keep', action='store_true', help='Keep per-sample working directories')
+    parser.add_argument('--hang', metavar='TOOL|model',
+                        help='Deadline check: this MCP tool (or the model) hangs; the run must end at the '
+                             'stage deadline with a partial result and no leftover processes')
+    parser.add_argument('--stage-timeout', type=float, default=5.0,
+                        help='Stage timeout with --hang (default: 5 s)')
+    parser.add_argument('--failover', choices=sorted(FAILOVER_SCENARIOS),
+                        help='Failover check: each model tier has a faulty and a healthy stub endpoint; '
+                             'the run must finish with the healthy one')
+    parser.add_argument('--reissue', action='store_true',
+                        help='Re-issue check: after the run, re-issue the report with a new client name; '
+                             'header, PDF and email must be redone without a model turn')
+    parser.add_argument('--concurrent', type=int, metavar='N',
+                        help='Concurrency check: run N jobs of each sample at once in one process; '
+                             'outputs, clients, tokens and traces must stay per run')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one and args.concurrent:
+        print(RESULT_PREFIX + json.dumps(run_concurrent(args.run_one, args.workdir, args.model_latency_ms,
+                                                        args.concurrent)))
+        return
+    if args.run_one:
+        result = run_one(args.run_one, args.workdir, args.model_latency_ms, args.hang,
+                         args.stage_timeout if args.hang else None, args.failover, args.reissue)
+        print(RESULT_PREFIX + json.dumps(result))
+        return
+
+    samples = args.samples or sorted(
+        p for p in glob.glob(os.path.join(BASE_DIR, 'samples', '*'))
+        if p.lower().endswith(('.jpg', '.jpeg', '.png'))
+    )
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pandoc': bool(shutil.which('pandoc')),
+        },
+        'model_latency_ms': args.model_latency_ms,
+        'samples': {},
+    }
+
+    if args.hang:
+        failed = False
+        for idx, sample in enumerate(samples, 1):
+            print(f"[{idx}/{len(samples)}] Deadline check ({args.hang} hangs) on {os.path.basename(sample)}...")
+            result = run_sample_subprocess(sample, args.model_latency_ms, args.keep, args.hang, args.stage_timeout)
+            print(f"[{'OK' if not result['failures'] else 'ERROR'}] Stopped in {result['failed_stage']} "
+                  f"after {result['seconds']:.1f}s ({args.stage_timeout:g}s stage timeout), "
+                  f"{len(result['stages_done'])} stage(s) kept, status {result['status']['state']}, "
+                  f"{len(result['leftover_processes'])} leftover process(es)")
+            for failure in result['failures']:
+                print(f"  - {failure}")
+            failed = failed or bool(result['failures'])
+        sys.exit(1 if failed else 0)
+
+    if args.failover:
+        failed = False
+        for idx, sample in enumerate(samples, 1):
+            print(f"[{idx}/{len(samples)}] Failover check ({args.failover}) on {os.path.basename(sample)}...")
+            result = run_sample_subprocess(sample, args.model_latency_ms, args.keep, failover=args.failover)
+            check = result['failover']
+            failures = check['failures'] + result['routing_errors']
+            print(f"[{'OK' if not failures else 'ERROR'}] {result['total_seconds']:.2f}s total, "
+                  f"{check['failovers']} failover(s)")
+            for name, stats in check['endpoints'].items():
+                first_event = stats['first_event_seconds']
+                print(f"  {name:12s} {stats['turns']:3d} turns  {stats['failures']:2d} failures  "
+                      f"first event {first_event if first_event is not None else '-'}s  "
+                      f"error rate {stats['health']['error_rate']:.2f}")
+            for failure in failures:
+                print(f"  - {failure}")
+            failed = failed or bool(failures)
+        sys.exit(1 if failed else 0)
+
+    if args.reissue:
+        failed = False
+        for idx, sample in enumerate(samples, 1):
+            print(f"[{idx}/{len(samples)}] Re-issue check on {os.path.basename(sample)}...")
+            result = run_sample_subprocess(sample, args.model_latency_ms, args.keep, reissue=True)
+            check = result['reissue']
+            pdf = 'yes' if check['pdf'] else 'no' if shutil.which('pandoc') else 'no (pandoc not installed)'
+            print(f"[{'OK' if not check['failures'] else 'ERROR'}] Re-issued in {check['seconds']:.2f}s "
+                  f"(run: {result['total_seconds']:.2f}s), {check['model_turns']} model turn(s), PDF {pdf}, "
+                  f"{check['emails_sent']} email(s) to {check['recipient']}")
+            for failure in check['failures']:
+                print(f"  - {failure}")
+            failed = failed or bool(check['failures'])
+        sys.exit(1 if failed else 0)
+
+    if args.concurrent:
+        failed = False
+        for idx, sample in enumerate(samples, 1):
+            print(f"[{idx}/{len(samples)}] Concurrency check ({args.concurrent} jobs) on {os.path.basename(sample)}...")
+            result = run_sample_subprocess(sample, args.model_latency_ms, args.keep, concurrent=args.concurrent)
+            failures = result['failures'] + result['metrics']['errors']
+            print(f"[{'OK' if not failures else 'ERROR'}] {result['jobs']} jobs in {result['seconds']:.2f}s, "
+                  f"model turns per job {result['model_turns']}, {result['emails_sent']} email(s), "
+                  f"{result['metrics']['records']} metric records")
+            for failure in failures:
+                print(f"  - {failure}")
+            failed = failed or bool(failures)
+        sys.exit(1 if failed else 0)
+
+    for idx, sample in enumerate(samples, 1):
+        print(f"[{idx}/{len(samples)}] Benchmarking {os.path.basename(sample)}...")
+        result = run_sample_subprocess(sample, args.model_latency_ms, args.keep)
+        results['samples'][result['image']] = result
+        print(f"[OK] {result['total_seconds']:.2f}s total, {result['overhead_seconds']:.2f}s overhead, "
+              f"{result['peak_rss_mb']:.1f} MB peak RSS, {result['metrics']['records']} metric records")
+
+    print_results(results)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"[OK] Results saved to {args.output}")
+
+    metric_errors = [f"{name}: {error}" for name, r in results['samples'].items() for error in r['metrics']['errors']]
+    if metric_errors:
+        print("[ERROR] Invalid CloudWatch metric (EMF) lines:")
+        for error in metric_errors:
+            print(f"  - {error}")
+        sys.exit(1)
+    if not all(r['metrics']['schema'] for r in results['samples'].values()):
+        print("[WARNING] jsonschema not installed - EMF lines checked without benchmarks/emf-schema.json")
+
+    routing_errors = [f"{name}: {error}" for name, r in results['samples'].items() for error in r['routing_errors']]
+    if routing_errors:
+        print("[ERROR] Stages ran on the wrong model tier:")
+        for error in routing_errors:
+            print(f"  - {error}")
+        sys.exit(1)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"[OK] Baseline updated: {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"[INFO] No baseline at {args.baseline} - run with --update-baseline to create one")
+        return
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('model_latency_ms') != args.model_latency_ms:
+        print(f"[WARNING] Baseline was recorded with model latency {baseline.get('model_latency_ms')} ms")
+
+    regressions = compare_to_baseline(results, baseline)
+    if regressions:
+        print()
+        print("[REGRESSION] Compared to baseline:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        sys.exit(1)
+
+    print("[OK] No regressions compared to baseline")
+
+
+if __name__ == "__main__":
+    main()
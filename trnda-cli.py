@@ -15,8 +15,153 @@ spec = importlib.util.spec_from_file_location("trnda_agent",
 trnda_agent_module = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(trnda_agent_module)
 
-# Get the process function
+# Get the process functions
 process_image_standalone = trnda_agent_module.process_image_standalone
+resume_run = trnda_agent_module.resume_run
+process_images_pipelined = trnda_agent_module.process_images_pipelined
+is_s3_prefix = trnda_agent_module.is_s3_prefix
+load_ledger = trnda_agent_module.load_ledger
+summarize_ledger = trnda_agent_module.summarize_ledger
+
+
+def expand_s3_prefixes(images: list, reprocess: bool = False) -> list:
+    """Replace S3 prefixes (s3://bucket/input/) with their images not yet in the manifest
+    
+    Already processed images (same key and ETag) cost nothing but the list request.
+    
+    Args:
+        images: Image arguments (S3 prefixes, S3 URIs, short names, local paths)
+        reprocess: Ignore the manifest and process every listed image
+        
+    Returns:
+        Image arguments with prefixes expanded
+    """
+    s3 = trnda_agent_module.get_s3_client()
+    # Local manifest and the shared S3 manifest of ECS tasks (TRNDA_MANIFEST_S3)
+    records = trnda_agent_module.RecordsConfig()
+    manifest = {} if reprocess else trnda_agent_module.load_manifest(records.manifest_path,
+                                                                     records.manifest_s3_uri, s3)
+    
+    expanded = []
+    for image in images:
+        if not is_s3_prefix(image):
+            expanded.append(image)
+            continue
+        listed = trnda_agent_module.list_s3_images(image, s3=s3)
+        new = [obj['uri'] for obj in listed if not trnda_agent_module.is_processed(manifest, obj['uri'], obj['etag'])]
+        print(f"[S3] {image}: {len(listed)} image(s), {len(listed) - len(new)} already processed, {len(new)} new")
+        expanded += new
+    return expanded
+
+
+def stats_main(argv: list):
+    """`trnda-cli.py stats` - aggregate the run ledger (runtime, tokens, cost, monthly totals)"""
+    from datetime import datetime, timedelta
+    
+    parser = argparse.ArgumentParser(
+        prog='trnda-cli.py stats',
+        description='Report runtime, tokens and cost across recorded runs'
+    )
+    parser.add_argument('--ledger', default=os.environ.get('TRNDA_LEDGER') or trnda_agent_module.DEFAULT_LEDGER_PATH,
+                        help='Local run ledger (default: TRNDA_LEDGER or ~/.trnda/ledger.jsonl)')
+    parser.add_argument('--s3', default=os.environ.get('TRNDA_LEDGER_S3'),
+                        help='Also read records from s3://bucket/prefix/ (default: TRNDA_LEDGER_S3)')
+    parser.add_argument('--days', type=int, help='Only runs started in the last N days')
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+    args = parser.parse_args(argv)
+    
+    s3 = trnda_agent_module.get_s3_client() if args.s3 else None
+    records = load_ledger(args.ledger, args.s3, s3)
+    if args.days:
+        since = (datetime.now() - timedelta(days=args.days)).isoformat(timespec='seconds')
+        records = [r for r in records if (r.get('started') or '') >= since]
+    
+    if not records:
+        print(f"[INFO] No runs recorded in {args.ledger}" + (f" or {args.s3}" if args.s3 else ""))
+        return
+    
+    summary = summarize_ledger(records)
+    
+    if args.json:
+        import json
+        print(json.dumps(summary, indent=2))
+        return
+    
+    runtime, tokens, cost = summary['runtime'], summary['tokens'], summary['cost']
+    print("=" * 70)
+    print("TRNDA RUN STATISTICS")
+    print("=" * 70)
+    print(f"Runs:       {summary['runs']} ({summary['succeeded']} succeeded, {summary['failed']} failed)")
+    print(f"Period:     {summary['first'][:10]} to {summary['last'][:10]}")
+    print(f"Resumed:    {summary['resumed_runs']} run(s), {summary['stages_reused']} stage(s) reused")
+    if summary.get('timeouts'):
+        print(f"Timeouts:   {summary['timeouts']} run(s) cancelled at a stage or job deadline")
+    print("-" * 70)
+    print(f"{'Per report':<22} {'mean':>12} {'p50':>12} {'p95':>12}")
+    print(f"{'Runtime (min)':<22} {runtime['mean'] / 60:>12.1f} {runtime['p50'] / 60:>12.1f} {runtime['p95'] / 60:>12.1f}")
+    if summary.get('first_artifact'):
+        first = summary['first_artifact']
+        print(f"{'First artifact (min)':<22} {first['mean'] / 60:>12.1f} {first['p50'] / 60:>12.1f} {first['p95'] / 60:>12.1f}")
+    print(f"{'Tokens':<22} {tokens['mean']:>12,.0f} {tokens['p50']:>12,.0f} {tokens['p95']:>12,.0f}")
+    for key, label in (('pdf_bytes', 'PDF (KB)'), ('email_bytes', 'Email (KB)'), ('upload_bytes', 'S3 upload (KB)')):
+        size = summary.get('artifact_sizes', {}).get(key)
+        if size:
+            print(f"{label:<22} {size['mean'] / 1024:>12,.0f} {size['p50'] / 1024:>12,.0f} {size['p95'] / 1024:>12,.0f}")
+    print(f"{'Cost (USD)':<22} {cost['mean']:>12.4f} {cost['p50']:>12.4f} {cost['p95']:>12.4f}")
+    print(f"Input / output tokens per report: {tokens['input_mean']:,.0f} / {tokens['output_mean']:,.0f}")
+    print(f"Cache read tokens (all runs):     {tokens['cache_read_total']:,}")
+    print("-" * 70)
+    print("Stage runtime (s):")
+    for stage_name, seconds in summary['stages'].items():
+        print(f"  {stage_name:<28} p50 {seconds['p50']:>8.1f}   p95 {seconds['p95']:>8.1f}")
+    print("Tokens by model:")
+    for model_id, usage in summary['models'].items():
+        print(f"  {model_id:<50} {usage['input_tokens']:>12,} in {usage['output_tokens']:>10,} out")
+    print("-" * 70)
+    print(f"{'Month':<10} {'Reports':>8} {'Failed':>7} {'Tokens':>14} {'Cost (USD)':>12}")
+    for month in summary['months']:
+        print(f"{month['month']:<10} {month['reports']:>8} {month['failed']:>7} "
+              f"{month['input_tokens'] + month['output_tokens']:>14,} {month['cost']:>12.2f}")
+    print("-" * 70)
+    print(f"Current rate: {summary['monthly_rate']:.1f} reports / 30 days -> "
+          f"${summary['monthly_rate'] * cost['mean']:.2f} per month "
+          f"(p95: ${summary['monthly_rate'] * cost['p95']:.2f})")
+    print("=" * 70)
+
+
+def reissue_main(argv: list):
+    """`trnda-cli.py reissue` - new header, PDF and email of a finished report, no agent run"""
+    parser = argparse.ArgumentParser(
+        prog='trnda-cli.py reissue',
+        description='Re-render the header and PDF of a finished report and email it again '
+                    '(no Bedrock calls)'
+    )
+    parser.add_argument('location', help='Output directory (output_<run_id>) or s3://bucket/output/<run_id>/')
+    parser.add_argument('-c', '--client', help='Corrected client or project name (default: the original one)')
+    parser.add_argument('--email', help='Send the report to this address (default: email in the client name)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the traceback of errors')
+    args = parser.parse_args(argv)
+    
+    try:
+        result = trnda_agent_module.reissue_report(args.location, client_name=args.client,
+                                                   recipient_email=args.email)
+    except Exception as e:
+        print(f"[ERROR] Failed to reissue {args.location}")
+        print(f"        {e}")
+        if args.verbose:
+            import traceback
+            traceback.print_exc()
+        sys.exit(1)
+    
+    print()
+    if not result['pdf']:
+        print(f"[ERROR] No PDF generated for {args.location} ({result['seconds']:.1f}s)")
+        sys.exit(1)
+    print(f"[OK] Report reissued in {result['seconds']:.1f}s")
+    print(f"    → {result['output']}")
+    if result['email_id']:
+        # The outbox delivers it before the process exits
+        print(f"    Email to {result['recipient']} queued (id {result['email_id']})")
 
 
 def main():
@@ -25,6 +170,13 @@ def main():
     # - On EC2: Uses IAM instance profile role
     # - Locally: Uses AWS_PROFILE environment variable or default profile
     
+    if len(sys.argv) > 1 and sys.argv[1] == 'stats':
+        stats_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'reissue':
+        reissue_main(sys.argv[2:])
+        return
+    
     parser = argparse.ArgumentParser(
         description='TRNDA - Trask Ručně Nakreslí, Dokončí AWS',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -42,11 +194,31 @@ Examples:
   # Local file (traditional mode)
   python trnda-cli.py local/diagram.jpg
   
-  # Multiple images
+  # Multiple images (downloads and uploads overlap report generation; --no-pipeline to disable)
   python trnda-cli.py sample1.jpg sample2.jpg
+  
+  # Every stage on Sonnet (no Haiku routing)
+  python trnda-cli.py sample1.jpg --single-model
+  
+  # Every image under a prefix that has no report yet (manifest: ~/.trnda/manifest.json)
+  python trnda-cli.py s3://tr-sw-trnda-diagrams/input/
+  
+  # Profile the Python side of a run (profile.txt, profile.folded, allocations.txt in the output)
+  python trnda-cli.py sample1.jpg --profile
+  
+  # Resume an interrupted run at its first incomplete stage
+  python trnda-cli.py --resume output_20251013093721-1a2b3c4d
+  
+  # Send a finished report again, to another address or with a corrected client name
+  python trnda-cli.py reissue s3://tr-sw-trnda-diagrams/output/20251013093721-1a2b3c4d/ --client "ACME a.s." --email cto@acme.example
+  
+  # Runtime, tokens and cost across all recorded runs (run ledger)
+  python trnda-cli.py stats
+  python trnda-cli.py stats --s3 s3://tr-sw-trnda-diagrams/ledger/ --days 30
 
 Note: 
 - S3 paths starting with 's3://' are processed from S3
+- S3 paths ending with '/' are prefixes: new or changed images (key + ETag) are processed
 - Short names like 'sample1.jpg' are treated as s3://tr-sw-trnda-diagrams/input/sample1.jpg
 - Local file paths work as before
         """
@@ -54,8 +226,15 @@ Note:
     
     parser.add_argument(
         'images',
-        nargs='+',
-        help='Image path(s): S3 URI (s3://bucket/key), short name (sample1.jpg), or local path'
+        nargs='*',
+        help='Image path(s): S3 URI (s3://bucket/key), S3 prefix (s3://bucket/input/), short name (sample1.jpg), or local path'
+    )
+    
+    parser.add_argument(
+        '--resume',
+        metavar='OUTPUT_DIR',
+        help='Resume an interrupted run from its output directory (checkpoint.json)',
+        default=None
     )
     
     parser.add_argument(
@@ -64,6 +243,44 @@ Note:
         default=None
     )
     
+    parser.add_argument(
+        '--model',
+        metavar='MODEL_ID',
+        help='Bedrock model for design reasoning and the report (default: Claude 4.5 Sonnet)',
+        default=None
+    )
+    
+    parser.add_argument(
+        '--fast-model',
+        metavar='MODEL_ID',
+        help='Bedrock model for transcription and tool orchestration (default: Claude 4.5 Haiku)',
+        default=None
+    )
+    
+    parser.add_argument(
+        '--single-model',
+        action='store_true',
+        help='Run every workflow stage on the --model model (no routing)'
+    )
+    
+    parser.add_argument(
+        '--no-pipeline',
+        action='store_true',
+        help='Process several images strictly one after another (no background download/upload)'
+    )
+    
+    parser.add_argument(
+        '--reprocess',
+        action='store_true',
+        help='With an S3 prefix: also process images already recorded in the manifest'
+    )
+    
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Sample the run with a profiler and memory tracer; profile files go to the output directory'
+    )
+    
     parser.add_argument(
         '-v', '--verbose',
         action='store_true',
@@ -72,6 +289,46 @@ Note:
     
     args = parser.parse_args()
     
+    # Model routing applies to every run of this process (RunContext reads these)
+    if args.model:
+        os.environ['TRNDA_MODEL_ID'] = args.model
+    if args.fast_model:
+        os.environ['TRNDA_FAST_MODEL_ID'] = args.fast_model
+    if args.single_model:
+        os.environ['TRNDA_FAST_MODEL_ID'] = args.model or trnda_agent_module.DEFAULT_MODEL_ID
+    if args.profile:
+        os.environ['TRNDA_PROFILE'] = '1'
+    
+    if args.resume:
+        if args.images:
+            parser.error('--resume cannot be combined with image arguments')
+        try:
+            output_location = resume_run(args.resume)
+        except Exception as e:
+            print(f"[ERROR] Failed to resume {args.resume}")
+            print(f"        {e}")
+            if args.verbose:
+                import traceback
+                traceback.print_exc()
+            sys.exit(1)
+        print()
+        print(f"[OK] Resumed run completed")
+        print(f"    → {output_location}")
+        return
+    
+    if not args.images:
+        parser.error('at least one image is required (or --resume OUTPUT_DIR)')
+    
+    if any(is_s3_prefix(image) for image in args.images):
+        try:
+            args.images = expand_s3_prefixes(args.images, reprocess=args.reprocess)
+        except Exception as e:
+            print(f"[ERROR] Failed to list S3 prefix: {e}")
+            sys.exit(1)
+        if not args.images:
+            print("[OK] Nothing to do - every image is already processed (see --reprocess)")
+            return
+    
     print("=" * 70)
     print("TRNDA - Trask Ručně Nakreslí, Dokončí AWS")
     print("=" * 70)
@@ -82,8 +339,13 @@ Note:
     print()
     
     results = []
+    pipeline_summary = None
     
-    for idx, image_path in enumerate(args.images, 1):
+    if len(args.images) > 1 and not args.no_pipeline:
+        # Next image downloads/preprocesses and previous output uploads while a report is generated
+        results, pipeline_summary = process_images_pipelined(args.images, client_name=args.client)
+    
+    for idx, image_path in enumerate(args.images if pipeline_summary is None else [], 1):
         print(f"[{idx}/{len(args.images)}] Processing: {image_path}")
         print("-" * 70)
         
@@ -121,6 +383,16 @@ Note:
                 'error': str(e)
             })
             
+            if len(args.images) == 1:
+                # Upload claimed by the SSM trigger: mark it failed so a re-upload is processed again
+                trnda_agent_module.fail_upload_claim(os.environ.get('TRNDA_IDEMPOTENCY_TABLE'),
+                                                     os.environ.get('TRNDA_IDEMPOTENCY_ID'), str(e))
+            
+            if isinstance(e, trnda_agent_module.DeadlineExceeded) and len(args.images) == 1:
+                # Exit now - an abandoned agent turn must not keep the SSM command running
+                sys.stdout.flush()
+                os._exit(trnda_agent_module.DEADLINE_EXIT_CODE)
+            
             if len(args.images) > 1:
                 # Continue with next image
                 print("Continuing with next image...")
@@ -142,6 +414,18 @@ Note:
     print(f"Total: {len(results)} | Success: {successful} | Failed: {failed}")
     print()
     
+    if pipeline_summary:
+        phases = pipeline_summary['phase_seconds']
+        print("Pipeline:")
+        print(f"  Wall time:            {pipeline_summary['wall_seconds']:.1f}s "
+              f"(sequential: {pipeline_summary['sequential_seconds']:.1f}s)")
+        print(f"  Download+preprocess:  {phases['prefetch']:.1f}s | Reports: {phases['process']:.1f}s | "
+              f"Upload: {phases['upload']:.1f}s")
+        print(f"  I/O overlapped:       {pipeline_summary['io_overlapped_seconds']:.1f}s "
+              f"({pipeline_summary['io_overlap_percent']:.0f}% of download/upload time)")
+        print(f"  Waiting for I/O:      {pipeline_summary['wait_seconds']:.1f}s")
+        print()
+    
     if successful > 0:
         print("Successful outputs:")
         for r in results:
@@ -0,0 +1,724 @@
+#!/usr/bin/env python3
+"""
+TRNDA Load Test - many concurrent uploads through the whole pipeline
+
+Pushes N uploads through the real code of every hop:
+
+    frontend/lambda/upload.py  ->  S3 POST  ->  (EventBridge)  ->  Lambda trigger  ->  worker
+                                                                 ECS: lambda-trigger/lambda_function.py
+                                                                      -> trnda-s3-handler.py process_s3_event
+                                                                 SSM: ec2-standalone/lambda-trigger/lambda_function.py
+                                                                      -> process_image_standalone (trnda-cli.py path)
+
+S3 is a local stand-in, ECS/SSM are fakes that hand the job to a worker
+pool (one worker = one Fargate task / one EC2 slot), the model is the
+scripted benchmark model with injected latency and an optional shared
+requests/tokens-per-minute quota that throttles like Bedrock does.
+
+For every concurrency setting it reports throughput, queueing delay,
+end-to-end latency percentiles, upload key collisions and model throttling.
+With --idempotency the trigger Lambdas claim each upload in a local
+DynamoDB stand-in; duplicate event deliveries and identical re-uploads
+show up as launches avoided. With --failing-uploads the first jobs fail
+and their photos are uploaded again once every job has finished; the
+re-uploads must be processed, not dropped as duplicates of the failed jobs.
+"""
+
+import os
+import io
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import base64
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(BASE_DIR, 'benchmarks')
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, 'loadtest-last-run.json')
+
+LOAD_BUCKET = 'trnda-load'
+# Processed-inputs manifest shared by all workers, as set by Terraform (TRNDA_MANIFEST_S3)
+LOAD_MANIFEST = f"s3://{LOAD_BUCKET}/manifest/manifest.json"
+# Metric counts shown per load level (one record per trigger event, handler job and run)
+LOAD_METRICS = ('TriggerEvents', 'Jobs', 'Runs')
+UPLOAD_PASSWORD = 'loadtest'
+
+UPLOAD_LAMBDA = os.path.join(BASE_DIR, 'frontend', 'lambda', 'upload.py')
+ECS_TRIGGER = os.path.join(BASE_DIR, 'aws-deployment', 'lambda-trigger', 'lambda_function.py')
+SSM_TRIGGER = os.path.join(BASE_DIR, 'aws-deployment', 'ec2-standalone', 'lambda-trigger', 'lambda_function.py')
+S3_HANDLER = os.path.join(BASE_DIR, 'aws-deployment', 'trnda-s3-handler.py')
+
+
+def load_module(name: str, path: str, env: dict = None):
+    """Import a script by path with the environment variables it reads at import time"""
+    os.environ.update(env or {})
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile (None for empty input)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def web_app_export(image_bytes: bytes, max_edge: int, quality: int) -> tuple:
+    """Export a photo like the web app's exportImage (orientation applied, longest edge, JPEG quality)
+
+    Returns:
+        Tuple of (JPEG bytes, trnda-preprocessed metadata value)
+    """
+    from PIL import Image, ImageOps
+
+    start = time.time()
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes))).convert('RGB')
+    source = f"{img.width}x{img.height}"
+    img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    preprocessed = (f"w={img.width},h={img.height},q={quality / 100:.2f},src={source},"
+                    f"ms={int((time.time() - start) * 1000)}")
+    return buffer.getvalue(), preprocessed
+
+
+class FakeLambdaContext:
+    """Minimal Lambda context (the SSM trigger uses aws_request_id for the log name)"""
+
+    def __init__(self):
+        self.aws_request_id = str(uuid.uuid4())
+        self.function_name = 'trnda-loadtest'
+
+
+class WorkerPool:
+    """Fixed number of job slots (Fargate tasks / EC2 worker capacity)
+
+    Jobs wait in FIFO order until a slot is free; the wait is the queueing delay.
+    """
+
+    def __init__(self, slots: int, start_delay_ms: float = 0.0):
+        self.executor = ThreadPoolExecutor(max_workers=slots, thread_name_prefix='trnda-worker')
+        self.start_delay_ms = start_delay_ms
+        self.futures = []
+
+    def submit(self, job: dict, run):
+        job['triggered'] = time.time()
+
+        def work():
+            job['started'] = time.time()
+            if self.start_delay_ms:
+                # Task provisioning / container start
+                time.sleep(self.start_delay_ms / 1000.0)
+            job['running'] = time.time()
+            try:
+                run()
+                job['status'] = 'done'
+            except BaseException as e:
+                job['status'] = 'failed'
+                job['error'] = f"{type(e).__name__}: {e}"
+            job['finished'] = time.time()
+
+        self.futures.append(self.executor.submit(work))
+
+    def wait(self):
+        for future in list(self.futures):
+            future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class FakeECS:
+    """ECS client stand-in: run_task hands the TRNDA_EVENT to the worker pool"""
+
+    def __init__(self, pool: WorkerPool, run_event, router: 'EventRouter'):
+        self.pool = pool
+        self.run_event = run_event
+        self.router = router
+        self.tasks = 0
+        self._lock = threading.Lock()
+
+    def run_task(self, overrides: dict = None, **kwargs) -> dict:
+        environment = overrides['containerOverrides'][0]['environment']
+        event = json.loads(next(e['value'] for e in environment if e['name'] == 'TRNDA_EVENT'))
+        job = self.router.pop_event(event['detail']['object']['key'])
+        self.pool.submit(job, lambda: self.run_event(event))
+        with self._lock:
+            self.tasks += 1
+            task_id = self.tasks
+        return {'tasks': [{'taskArn': f"arn:aws:ecs:local:000000000000:task/trnda-load/{task_id}"}]}
+
+
+class FakeSSM:
+    """SSM client stand-in: send_command parses the trnda-cli.py call and hands it to the worker pool"""
+
+    def __init__(self, pool: WorkerPool, run_cli, router: 'EventRouter'):
+        self.pool = pool
+        self.run_cli = run_cli
+        self.router = router
+
+    def send_command(self, Parameters: dict = None, **kwargs) -> dict:
+        command = Parameters['commands'][-1]
+        s3_path = re.search(r'trnda-cli\.py \\"(s3://[^\\"]+)\\"', command).group(1)
+        client = re.search(r'--client \\"(.*?)\\"(?: |$)', command)
+        client_name = client.group(1).replace('\\"', '"') if client else None
+        # Variables the command exports for trnda-cli.py (deployment, event time, idempotency claim)
+        environment = {name: quoted or plain for name, quoted, plain in
+                       re.findall(r'export (TRNDA_\w+)=(?:\\"([^"\\]*)\\"|([^\s&"]+))', command)}
+        job = self.router.pop_event(s3_path.split('/', 3)[3])
+        self.pool.submit(job, lambda: self.run_cli(s3_path, client_name, environment))
+        return {'Command': {'CommandId': str(uuid.uuid4())}}
+
+
+class EventRouter:
+    """Matches trigger calls back to the upload that caused them
+
+    upload.py gives every upload its own key; should two uploads ever land on
+    the same key, S3 still emits one event per PUT, so events are matched in
+    upload order per key (and the collision shows up as Overwr.).
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def push_event(self, key: str, job: dict):
+        with self._lock:
+            self._pending.setdefault(key, []).append(job)
+
+    def pop_event(self, key: str) -> dict:
+        with self._lock:
+            return self._pending[key].pop(0)
+
+    def discard_event(self, key: str, job: dict):
+        """Forget an event the trigger dropped (no launch to match it with)"""
+        with self._lock:
+            self._pending[key].remove(job)
+
+
+def run_level(args, concurrency: int, image_bytes: bytes, workdir: str, preprocessed: str = None) -> dict:
+    """Run one load level (all uploads with a fixed number of workers)
+
+    Returns:
+        Result dictionary for this concurrency setting
+    """
+    sys.path.insert(0, BENCH_DIR)
+    from stubs import ScriptedModel, ThrottlingScriptedModel, FakeBedrockQuota, StubEndpoint, stub_mcp_clients
+    from local_aws import LocalS3, LocalSES, LocalDynamoDB, local_client_factory
+
+    s3 = LocalS3(os.path.join(workdir, 's3'), latency_ms=args.s3_latency_ms)
+    ses = LocalSES()
+    quota = FakeBedrockQuota(args.rpm, args.tpm) if (args.rpm or args.tpm) else None
+    models = []
+    contexts = []
+    # Uploads (markers) whose first job was made to fail (--failing-uploads)
+    failed_markers = set()
+    models_lock = threading.Lock()
+
+    upload = load_module('trnda_upload', UPLOAD_LAMBDA, {
+        'BUCKET_NAME': LOAD_BUCKET, 'UPLOAD_PASSWORD': UPLOAD_PASSWORD
+    })
+    upload.s3 = s3
+
+    handler = load_module('trnda_s3_handler', S3_HANDLER, {
+        'TRNDA_APP_DIR': BASE_DIR, 'TRNDA_RETRY_DELAY_SECONDS': str(args.retry_delay_seconds)
+    })
+    handler.get_s3_client = lambda: s3
+    trnda_agent = handler.trnda_agent_module
+    # One outbox (sender thread + SES client) shared by all jobs, like in a real process
+    outbox = trnda_agent.EmailOutbox(os.path.join(workdir, 'outbox'), client_factory=local_client_factory(s3, ses))
+    stage_names = [stage['name'] for stage in trnda_agent.WORKFLOW_STAGES]
+    # Rate limiter in front of the model, shared by all jobs (in memory or through a state file)
+    limiter = None
+    if args.limiter != 'off':
+        state_path = os.path.join(workdir, 'limiter', 'scripted.json') if args.limiter == 'file' else None
+        limiter = trnda_agent.BedrockRateLimiter('scripted', args.limiter_rpm, args.limiter_tpm,
+                                                 state_path=state_path)
+
+    def context_factory(client_name=None, recipient_email=None, **kwargs):
+        if quota:
+            model = ThrottlingScriptedModel(quota, stage_names=stage_names, latency_ms=args.model_latency_ms)
+        else:
+            model = ScriptedModel(stage_names=stage_names, latency_ms=args.model_latency_ms)
+        with models_lock:
+            models.append(model)
+            marker = re.match(r'Load test (\d+) ', client_name or '')
+            if marker and int(marker.group(1)) < args.failing_uploads and marker.group(1) not in failed_markers:
+                # Every model request of this job fails (all attempts share the context)
+                failed_markers.add(marker.group(1))
+                model = StubEndpoint(model, error_rate=1.0)
+        limited = trnda_agent.RateLimitedModel(model, limiter) if limiter else None
+        ctx = handler.RunContext(
+            client_name=client_name,
+            recipient_email=recipient_email,
+            base_dir=os.path.join(workdir, 'runs'),
+            bucket=LOAD_BUCKET,
+            model=limited or model,
+            mcp_clients=stub_mcp_clients(latency_scale=args.mcp_latency_scale),
+            client_factory=local_client_factory(s3, ses),
+            # Workers only record processed inputs in the shared manifest object
+            records=trnda_agent.RecordsConfig(ledger_path=os.path.join(workdir, 'ledger.jsonl'), manifest_path='off',
+                                              manifest_s3_uri=LOAD_MANIFEST),
+            # Every upload is the same image - near-duplicate reuse would skip all but the first run
+            similarity_config=trnda_agent.SimilarityConfig(index_path='off'),
+            outbox=outbox,
+            **kwargs
+        )
+        if limited:
+            limited.trace = ctx.trace
+        with models_lock:
+            contexts.append(ctx)
+        return ctx
+
+    def run_cli(s3_path: str, client_name: str, environment: dict):
+        # Same call trnda-cli.py makes on the EC2 worker (RunContext reads these from its environment)
+        ctx = context_factory(client_name=client_name, deployment=environment.get('TRNDA_DEPLOYMENT'),
+                              queued_at=trnda_agent.parse_event_time(environment.get('TRNDA_EVENT_TIME')))
+        try:
+            trnda_agent.process_image_standalone(s3_path, ctx=ctx)
+        except Exception as e:
+            trnda_agent.fail_upload_claim(environment.get('TRNDA_IDEMPOTENCY_TABLE'),
+                                          environment.get('TRNDA_IDEMPOTENCY_ID'), str(e), dynamodb=dynamodb)
+            raise
+
+    router = EventRouter()
+    pool = WorkerPool(concurrency, args.task_start_ms)
+    trigger_env = {'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION', 'eu-central-1')}
+    if args.trigger == 'ecs':
+        trigger = load_module('trnda_ecs_trigger', ECS_TRIGGER, dict(trigger_env, **{
+            'ECS_CLUSTER_NAME': 'trnda-load', 'TASK_DEFINITION_ARN': 'trnda-load:1',
+            'SUBNET_IDS': 'subnet-local', 'SECURITY_GROUP_IDS': 'sg-local'
+        }))
+        trigger.s3 = s3
+        trigger.ecs_client = FakeECS(pool, lambda event: handler.process_s3_event(event, context_factory=context_factory),
+                                     router)
+    else:
+        trigger = load_module('trnda_ssm_trigger', SSM_TRIGGER, dict(trigger_env, **{
+            'INSTANCE_ID': 'i-local', 'WORKING_DIRECTORY': BASE_DIR, 'S3_BUCKET': LOAD_BUCKET,
+            'MANIFEST_S3': LOAD_MANIFEST
+        }))
+        trigger.s3 = s3
+        trigger.ssm = FakeSSM(pool, run_cli, router)
+    dynamodb = LocalDynamoDB() if args.idempotency else None
+    trigger.dynamodb = dynamodb
+    handler.get_dynamodb_client = lambda: dynamodb
+    trigger.IDEMPOTENCY_TABLE = 'trnda-load-events' if dynamodb else None
+
+    jobs = []
+    duplicates = []
+
+    def upload_marker(index: int) -> int:
+        # The identical re-uploads repeat upload 0 (bytes and client info)
+        return 0 if args.idempotency and index >= args.uploads - args.reuploads else index
+
+    def upload_body(index: int) -> bytes:
+        if not args.idempotency:
+            return image_bytes
+        # Distinct bytes per upload (trailing bytes after the image data)
+        return image_bytes + f"trnda-load-{upload_marker(index)}".encode('ascii')
+
+    def deliver(job: dict) -> None:
+        # EventBridge "Object Created" event (carries the object's ETag and the event time)
+        etag = s3.head_object(Bucket=LOAD_BUCKET, Key=job['key'])['ETag'].strip('"')
+        router.push_event(job['key'], job)
+        result = trigger.lambda_handler({
+            'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+            'detail': {'bucket': {'name': LOAD_BUCKET}, 'object': {'key': job['key'], 'etag': etag}}
+        }, FakeLambdaContext())
+        if result['statusCode'] != 200:
+            job['status'] = 'trigger_failed'
+            job['error'] = result['body']
+        elif 'idempotencyId' in result['body']:
+            job['status'] = 'deduplicated'
+            router.discard_event(job['key'], job)
+
+    def uplink(size: int) -> None:
+        # Browser upload over a limited (mobile) link
+        if args.uplink_mbps:
+            time.sleep(size * 8 / (args.uplink_mbps * 1000000))
+
+    def upload_one(index: int, scheduled: float):
+        delay = scheduled - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        job = {'index': index, 'upload_start': time.time()}
+        jobs.append(job)
+        data = upload_body(index)
+        marker = upload_marker(index)
+        request = {'password': UPLOAD_PASSWORD, 'clientInfo': f"Load test {marker} load{marker}@example.com"}
+        if args.upload_mode == 'base64':
+            request['image'] = base64.b64encode(data).decode('ascii')
+        elif preprocessed:
+            request['preprocessed'] = preprocessed
+        request_body = json.dumps(request)
+        if args.upload_mode == 'base64':
+            uplink(len(request_body))
+        response = upload.lambda_handler({
+            'rawPath': '/upload',
+            'requestContext': {'http': {'method': 'POST'}},
+            'body': request_body
+        }, FakeLambdaContext())
+        job['lambda_seconds'] = time.time() - job['upload_start']
+        job['lambda_request_bytes'] = len(request_body)
+        body = json.loads(response['body'])
+        if response['statusCode'] == 200 and 'upload' in body:
+            # Browser: form POST of the photo straight to S3
+            try:
+                uplink(len(data))
+                s3.post_object(body['upload']['url'], body['upload']['fields'], data)
+            except Exception as e:
+                response, body = {'statusCode': 403}, {'error': f"S3 POST: {e}"}
+        job['upload_end'] = time.time()
+        job['upload_bytes'] = len(data)
+        if response['statusCode'] != 200:
+            job['status'] = 'upload_failed'
+            job['error'] = body.get('error')
+            return job
+        job['key'] = body['key']
+
+        # EventBridge: one "Object Created" event per PUT
+        if args.event_delay_ms:
+            time.sleep(args.event_delay_ms / 1000.0)
+        deliver(job)
+        # At-least-once delivery: the same event again while the first one is in flight
+        for _ in range(args.duplicate_deliveries):
+            duplicate = {'index': index, 'key': job['key'], 'upload_start': job['upload_start']}
+            duplicates.append(duplicate)
+            deliver(duplicate)
+        return job
+
+    log_path = os.path.join(workdir, f"concurrency-{concurrency}.log")
+    start = time.time()
+    with open(log_path, 'w', encoding='utf-8') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        interval = 1.0 / args.arrival_rate if args.arrival_rate else 0.0
+        with ThreadPoolExecutor(max_workers=min(args.uploads, 64), thread_name_prefix='trnda-upload') as uploaders:
+            for index in range(args.uploads):
+                uploaders.submit(upload_one, index, start + index * interval)
+        pool.wait()
+        # The photo of every failed job once more (same bytes and client info) - it must run again
+        reuploads = [upload_one(job['index'], time.time()) for job in list(jobs)
+                     if job.get('status') == 'failed' and job['index'] < args.failing_uploads]
+        pool.wait()
+        pool.close()
+        end = time.time()
+        # Jobs finish without waiting for mail; drain the outbox before counting sends
+        emails_pending = outbox.pending()
+        outbox.drain(timeout=60)
+        outbox.close()
+
+        # What the web app sees: one /status call (one S3 GET) per upload
+        status_gets = s3.requests.get('GetObject', 0)
+        status_states = {}
+        status_bodies = []
+        for key in sorted({j['key'] for j in jobs if 'key' in j}):
+            response = upload.lambda_handler({
+                'rawPath': '/status',
+                'requestContext': {'http': {'method': 'POST'}},
+                'body': json.dumps({'password': UPLOAD_PASSWORD, 'key': key})
+            }, FakeLambdaContext())
+            status_bodies.append(json.loads(response['body']))
+            state = status_bodies[-1].get('state', f"http {response['statusCode']}")
+            status_states[state] = status_states.get(state, 0) + 1
+        status_gets = s3.requests.get('GetObject', 0) - status_gets
+        # All jobs have finished - every upload (deduplicated ones via their original) must show it
+        unfinished = [b['input'] for b in status_bodies if b.get('state') not in ('done', 'failed')]
+        status_errors = ([f"/status of {len(unfinished)} finished upload(s) not done, e.g. {unfinished[0]}"]
+                         if unfinished else [])
+        # One status object per upload - uploads sharing a key would share (and overwrite) one
+        uploaded = len([j for j in jobs if 'key' in j])
+        if len(status_bodies) != uploaded:
+            status_errors.append(f"{uploaded} uploads share {len(status_bodies)} status object(s)")
+        if len(reuploads) < args.failing_uploads:
+            status_errors.append(f"{len(reuploads)} of {args.failing_uploads} failing upload(s) failed")
+        not_rerun = [job for job in reuploads if job.get('status') != 'done']
+        if not_rerun:
+            status_errors.append(f"{len(not_rerun)} re-upload(s) after a failed job not processed, "
+                                 f"e.g. {not_rerun[0].get('status')}")
+        # What a catch-up run on an operator machine (trnda-cli.py s3://bucket/input/) would skip:
+        # every processed upload, recorded by the workers in the shared manifest
+        manifest = trnda_agent.load_manifest(None, LOAD_MANIFEST, s3)
+        done_keys = {j['key'] for j in jobs if j.get('status') == 'done'}
+        unrecorded = [obj['key'] for obj in trnda_agent.list_s3_images(f"s3://{LOAD_BUCKET}/input/", s3=s3)
+                      if obj['key'] in done_keys and not trnda_agent.is_processed(manifest, obj['uri'], obj['etag'])]
+        if unrecorded:
+            status_errors.append(f"{len(unrecorded)} processed upload(s) missing from the manifest, "
+                                 f"e.g. {unrecorded[0]}")
+
+    # CloudWatch metric lines (EMF) printed by trigger, handler and runs
+    sys.path.insert(0, BENCH_DIR)
+    from emf_check import check_emf_output
+    with open(log_path, 'r', encoding='utf-8') as f:
+        metrics = check_emf_output(f.read())
+
+    done = [j for j in jobs if j.get('status') == 'done']
+    e2e = [j['finished'] - j['upload_start'] for j in done]
+    queue = [j['started'] - j['triggered'] for j in jobs if 'started' in j]
+    service = [j['finished'] - j['running'] for j in done]
+    upload_latency = [j['upload_end'] - j['upload_start'] for j in jobs]
+    keys = [j['key'] for j in jobs if 'key' in j]
+
+    def stats(values: list) -> dict:
+        return {
+            'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99),
+            'max': max(values) if values else None,
+        }
+
+    return {
+        'concurrency': concurrency,
+        'uploads': args.uploads,
+        'completed': len(done),
+        'failed': len([j for j in jobs if j.get('status') not in ('done', 'deduplicated', None)]),
+        'errors': sorted({j['error'] for j in jobs if j.get('error')})[:5] + status_errors,
+        'wall_seconds': round(end - start, 3),
+        'throughput_per_minute': round(len(done) / (end - start) * 60, 2) if done else 0.0,
+        'e2e_seconds': stats(e2e),
+        'queue_seconds': stats(queue),
+        'service_seconds': stats(service),
+        'upload_seconds': stats(upload_latency),
+        'upload_bytes': max([j['upload_bytes'] for j in jobs if 'upload_bytes' in j], default=None),
+        'preprocess_seconds': stats([span['duration'] for ctx in contexts for span in ctx.trace.spans
+                                     if span['name'] == 'preprocess']),
+        'upload_lambda_seconds': stats([j['lambda_seconds'] for j in jobs if 'lambda_seconds' in j]),
+        'upload_lambda_request_bytes': max([j['lambda_request_bytes'] for j in jobs if 'lambda_request_bytes' in j],
+                                           default=None),
+        'distinct_keys': len(set(keys)),
+        'overwritten_uploads': len(keys) - len(set(keys)),
+        'deliveries': len(jobs) + len(duplicates),
+        'launches': len([j for j in jobs + duplicates if 'triggered' in j]),
+        'launches_avoided': len([j for j in jobs + duplicates if j.get('status') == 'deduplicated']),
+        'reuploads_after_failure': len(reuploads),
+        'reuploads_processed': len([j for j in reuploads if j.get('status') == 'done']),
+        'manifest_entries': len(manifest),
+        'idempotency_requests': dict(dynamodb.requests) if dynamodb else None,
+        'model_turns': sum(m.calls for m in models),
+        'model_throttles': quota.throttled if quota else 0,
+        'first_throttle_seconds': (round(quota.first_throttled_at - start, 3)
+                                   if quota and quota.first_throttled_at else None),
+        'limiter': dict(limiter.stats, wait_seconds=round(limiter.stats['wait_seconds'], 3),
+                        final_rates=limiter.rates()) if limiter else None,
+        'status_states': status_states,
+        'status_gets_per_poll': round(status_gets / max(1, sum(status_states.values())), 2),
+        # Time to the first published preview vs. the finished report (worker clock, from the status objects)
+        'first_artifact_seconds': stats([b['first_artifact_seconds'] for b in status_bodies
+                                         if b.get('first_artifact_seconds') is not None]),
+        'report_seconds': stats([b['runtime_seconds'] for b in status_bodies if b.get('runtime_seconds') is not None]),
+        'emails_sent': len(ses.sent),
+        'emails_pending_at_end': emails_pending,
+        'email_retries': outbox.stats['retries'],
+        's3_requests': dict(s3.requests),
+        'metrics': metrics,
+        'log': log_path,
+    }
+
+
+def print_results(results: dict) -> None:
+    """Print one row per concurrency setting"""
+
+    def fmt(value):
+        return f"{value:.2f}" if value is not None else '-'
+
+    print()
+    print("=" * 100)
+    print(f"LOAD TEST RESULTS ({results['uploads']} uploads, trigger: {results['trigger']}, "
+          f"model latency {results['model_latency_ms']:.0f} ms/turn)")
+    print("=" * 100)
+    print(f"{'Workers':>7} {'Done':>5} {'Fail':>5} {'Jobs/min':>9} "
+          f"{'Queue p50':>10} {'p95':>7} {'p99':>7} {'E2E p50':>9} {'p95':>7} {'p99':>7} "
+          f"{'Overwr.':>7} {'Throttl.':>8}")
+    print("-" * 100)
+    for r in results['levels']:
+        q, e = r['queue_seconds'], r['e2e_seconds']
+        print(f"{r['concurrency']:>7} {r['completed']:>5} {r['failed']:>5} {r['throughput_per_minute']:>9.2f} "
+              f"{fmt(q['p50']):>10} {fmt(q['p95']):>7} {fmt(q['p99']):>7} "
+              f"{fmt(e['p50']):>9} {fmt(e['p95']):>7} {fmt(e['p99']):>7} "
+              f"{r['overwritten_uploads']:>7} {r['model_throttles']:>8}")
+    print("-" * 100)
+    print("Times in seconds. Overwr. = uploads that landed on an already used input key.")
+    for r in results['levels']:
+        if r['first_throttle_seconds'] is not None:
+            print(f"[INFO] {r['concurrency']} workers: first model throttle after {r['first_throttle_seconds']:.1f}s")
+        if r['limiter']:
+            limiter = r['limiter']
+            print(f"[INFO] {r['concurrency']} workers: limiter queued {limiter['queued']} turn(s) for "
+                  f"{limiter['wait_seconds']:.1f}s, {limiter['throttled']} throttle(s), "
+                  f"final rate {limiter['final_rates']['rpm']} requests/min")
+        print(f"[INFO] {r['concurrency']} workers: upload Lambda ({results['upload_mode']}) "
+              f"p95 {fmt(r['upload_lambda_seconds']['p95'])}s, request body up to "
+              f"{r['upload_lambda_request_bytes'] or 0:,} bytes")
+        print(f"[INFO] {r['concurrency']} workers: upload {(r['upload_bytes'] or 0) / 1024:.0f} KB, "
+              f"upload p95 {fmt(r['upload_seconds']['p95'])}s, backend preprocess p95 "
+              f"{fmt(r['preprocess_seconds']['p95'])}s")
+        print(f"[INFO] {r['concurrency']} workers: /status of every upload: "
+              f"{', '.join(f'{n} {state}' for state, n in sorted(r['status_states'].items()))} "
+              f"({r['status_gets_per_poll']} S3 GET per poll)")
+        if r['first_artifact_seconds']['max'] is not None:
+            print(f"[INFO] {r['concurrency']} workers: first preview p50 {fmt(r['first_artifact_seconds']['p50'])}s "
+                  f"(p95 {fmt(r['first_artifact_seconds']['p95'])}s), full report p50 "
+                  f"{fmt(r['report_seconds']['p50'])}s (p95 {fmt(r['report_seconds']['p95'])}s)")
+        if r['reuploads_after_failure']:
+            print(f"[INFO] {r['concurrency']} workers: {r['reuploads_processed']}/{r['reuploads_after_failure']} "
+                  f"re-uploads after a failed job processed again")
+        if r['launches_avoided']:
+            print(f"[INFO] {r['concurrency']} workers: {r['deliveries']} event deliveries, {r['launches']} launches "
+                  f"({r['launches_avoided']} avoided by idempotency records)")
+        metrics = r['metrics']
+        print(f"[INFO] {r['concurrency']} workers: {metrics['records']} metric records "
+              f"({', '.join(f'{n} {name}' for name, n in sorted(metrics['metrics'].items()) if name in LOAD_METRICS)}"
+              f"){'' if metrics['schema'] else ' - jsonschema not installed, schema not checked'}")
+        for error in r['errors'] + metrics['errors'][:5]:
+            print(f"[WARNING] {r['concurrency']} workers: {error}")
+    print("=" * 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='TRNDA load test (upload Lambda -> trigger Lambda -> handler, all stubbed locally)',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # 10 simultaneous uploads, 1, 2 and 4 workers
+  python trnda-loadtest.py
+
+  # 30 uploads at 2/s through the EC2/SSM path, 1 s model latency per turn
+  python trnda-loadtest.py --uploads 30 --arrival-rate 2 --trigger ssm --model-latency-ms 1000
+
+  # Where does Bedrock throttling start? (shared 50 requests / 400k tokens per minute)
+  python trnda-loadtest.py --concurrency 2,4,8,16 --rpm 50 --tpm 400000
+
+  # Duplicate EventBridge deliveries and identical re-uploads against the idempotency records
+  python trnda-loadtest.py --concurrency 4 --idempotency --duplicate-deliveries 2 --reuploads 3
+
+  # Failed jobs release their idempotency claim: re-uploads of the same photo run again
+  python trnda-loadtest.py --concurrency 2 --idempotency --failing-uploads 2
+
+  # Same quota with the adaptive rate limiter in front of the model (shared through a state file)
+  python trnda-loadtest.py --concurrency 8 --rpm 50 --limiter file --limiter-rpm 100
+        """
+    )
+    parser.add_argument('--uploads', type=int, default=10, help='Uploads per concurrency setting (default: 10)')
+    parser.add_argument('--concurrency', default='1,2,4',
+                        help='Comma-separated worker counts to test (default: 1,2,4)')
+    parser.add_argument('--arrival-rate', type=float, default=0.0,
+                        help='Uploads per second (default: 0 = all at once)')
+    parser.add_argument('--trigger', choices=['ecs', 'ssm'], default='ecs',
+                        help='Trigger Lambda to use: ECS Fargate or EC2/SSM (default: ecs)')
+    parser.add_argument('--image', default=os.path.join(BASE_DIR, 'samples', 'sample1.jpg'),
+                        help='Image to upload (default: samples/sample1.jpg)')
+    parser.add_argument('--upload-mode', choices=['presigned', 'base64'], default='presigned',
+                        help='presigned: upload Lambda signs a POST and the image goes straight to S3; '
+                             'base64: legacy, image inside the Lambda request (default: presigned)')
+    parser.add_argument('--web-export', action='store_true',
+                        help='Upload what the web app exports (model-size JPEG with trnda-preprocessed metadata) '
+                             'instead of the original photo')
+    parser.add_argument('--uplink-mbps', type=float, default=0.0,
+                        help='Simulated browser upload bandwidth in Mbit/s, e.g. 5 for a mobile network '
+                             '(default: 0 = unlimited)')
+    parser.add_argument('--model-latency-ms', type=float, default=200.0,
+                        help='Simulated model latency per turn (default: 200)')
+    parser.add_argument('--mcp-latency-scale', type=float, default=1.0,
+                        help='Scale factor for recorded MCP tool latencies (default: 1.0)')
+    parser.add_argument('--s3-latency-ms', type=float, default=0.0, help='Simulated latency per S3 request')
+    parser.add_argument('--event-delay-ms', type=float, default=0.0, help='Simulated EventBridge delivery delay')
+    parser.add_argument('--task-start-ms', type=float, default=0.0,
+                        help='Simulated task start time (Fargate provisioning, default: 0)')
+    parser.add_argument('--rpm', type=int, help='Shared model quota: requests per minute')
+    parser.add_argument('--tpm', type=int, help='Shared model quota: tokens per minute')
+    parser.add_argument('--retry-delay-seconds', type=int, default=1,
+                        help='Handler retry delay (TRNDA_RETRY_DELAY_SECONDS, default: 1)')
+    parser.add_argument('--idempotency', action='store_true',
+                        help='Claim uploads in a local DynamoDB stand-in before launching (each upload gets '
+                             'distinct bytes, except --reuploads)')
+    parser.add_argument('--duplicate-deliveries', type=int, default=0,
+                        help='Extra deliveries of every S3 event (EventBridge is at-least-once, default: 0)')
+    parser.add_argument('--reuploads', type=int, default=0,
+                        help='With --idempotency: the last N uploads repeat the bytes of the first one')
+    parser.add_argument('--failing-uploads', type=int, default=0,
+                        help='Jobs of the first N uploads fail; their photos are uploaded again after all jobs '
+                             'finished and must be processed (default: 0)')
+    parser.add_argument('--limiter', choices=['off', 'process', 'file'], default='off',
+                        help='Bedrock rate limiter in front of the model: off, shared in memory or '
+                             'through a state file (default: off)')
+    parser.add_argument('--limiter-rpm', type=int,
+                        help='Limiter maximum requests per minute (default: TRNDA_BEDROCK_RPM env, then 50)')
+    parser.add_argument('--limiter-tpm', type=int,
+                        help='Limiter maximum tokens per minute (default: TRNDA_BEDROCK_TPM env, then 400000)')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='Where to write results JSON')
+    parser.add_argument('--keep', action='store_true', help='Keep working directories and logs')
+    args = parser.parse_args()
+
+    try:
+        levels = [int(value) for value in args.concurrency.split(',') if value.strip()]
+    except ValueError:
+        parser.error(f"Invalid --concurrency: {args.concurrency}")
+
+    with open(args.image, 'rb') as f:
+        image_bytes = f.read()
+    preprocessed = None
+    if args.web_export:
+        trnda_agent = load_module('trnda_agent_export', os.path.join(BASE_DIR, 'trnda-agent.py'))
+        original_size = len(image_bytes)
+        image_bytes, preprocessed = web_app_export(image_bytes, trnda_agent.MODEL_IMAGE_MAX_EDGE,
+                                                   trnda_agent.MODEL_IMAGE_QUALITY)
+        print(f"[INFO] Web app export: {original_size / 1024:.0f} KB -> {len(image_bytes) / 1024:.0f} KB "
+              f"({preprocessed})")
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'uploads': args.uploads,
+        'arrival_rate': args.arrival_rate,
+        'trigger': args.trigger,
+        'image': os.path.basename(args.image),
+        'upload_mode': args.upload_mode,
+        'web_export': args.web_export,
+        'uplink_mbps': args.uplink_mbps,
+        'model_latency_ms': args.model_latency_ms,
+        'mcp_latency_scale': args.mcp_latency_scale,
+        'task_start_ms': args.task_start_ms,
+        'rpm': args.rpm,
+        'tpm': args.tpm,
+        'limiter': args.limiter,
+        'idempotency': args.idempotency,
+        'duplicate_deliveries': args.duplicate_deliveries,
+        'reuploads': args.reuploads,
+        'failing_uploads': args.failing_uploads,
+        'levels': [],
+    }
+
+    for concurrency in levels:
+        workdir = tempfile.mkdtemp(prefix=f"trnda-load-{concurrency}-")
+        print(f"[INFO] {args.uploads} uploads with {concurrency} worker(s)... (log: {workdir})")
+        try:
+            result = run_level(args, concurrency, image_bytes, workdir, preprocessed)
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+        if not args.keep:
+            result.pop('log')
+        results['levels'].append(result)
+        print(f"[OK] {result['completed']}/{args.uploads} done in {result['wall_seconds']:.1f}s, "
+              f"e2e p95 {result['e2e_seconds']['p95'] or 0:.1f}s")
+
+    print_results(results)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"[OK] Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()